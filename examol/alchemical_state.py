@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Alchemical state of merged-topology Contexts.
+
+A merged System (see `examol.multitopology.multitopology`) selects its alchemical state through the global context
+parameters `alchemical_variant` and `alchemical_lambda`.  With variant_selection='tabulated', its softcore
+CustomNonbondedForce objects also read the coupling of each variant from a `variant_lambda` table, which must be
+updated whenever either parameter changes.  These functions do not depend on OpenEye, so that simulation drivers
+can keep tables in sync without importing the merged-topology factory.
+
+Example
+-------
+
+Select variant 3 at lambda 0.5.
+
+>>> set_alchemical_state(context, variant=3, alchemical_lambda=0.5)
+
+Set a parameter by name, as simulation drivers do.
+
+>>> set_context_parameter(context, 'alchemical_lambda', 0.7)
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import simtk.openmm as mm
+import numpy as np
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+ALCHEMICAL_PARAMETERS = ['alchemical_variant', 'alchemical_lambda'] # context parameters that select the alchemical state of a merged System
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def compute_variant_lambdas(ntable, variant, alchemical_lambda):
+    """
+    Compute the coupling of every entry of the `variant_lambda` table for the given alchemical state.
+
+    Parameters
+    ----------
+    ntable : int
+       The number of table entries (the largest variant index plus two).
+    variant : int
+       The value of `alchemical_variant`.
+    alchemical_lambda : float
+       The value of `alchemical_lambda`.
+
+    Returns
+    -------
+    values : list of float
+       values[variant+1] is the coupling of particles of `variant`; values[0] is the coupling of environment particles.
+
+    """
+    values = np.zeros([ntable], np.float64)
+    values[0] = 1.0
+    values[1] = 1.0 - alchemical_lambda
+    if 0 <= variant < ntable - 1:
+        values[variant+1] += alchemical_lambda
+    return list(values)
+
+def get_variant_table(force):
+    """
+    Return the `variant_lambda` Discrete1DFunction of a CustomNonbondedForce, or None if it has none.
+
+    """
+    for index in range(force.getNumTabulatedFunctions()):
+        if force.getTabulatedFunctionName(index) == 'variant_lambda':
+            return force.getTabulatedFunction(index)
+    return None
+
+def set_alchemical_state(context, variant=None, alchemical_lambda=None):
+    """
+    Set `alchemical_variant` and/or `alchemical_lambda`, keeping tabulated variant selection in sync.
+
+    Use this instead of Context.setParameter for these parameters: with variant_selection='tabulated', the CustomNonbondedForce
+    reads the coupling of each variant from the `variant_lambda` table, which is updated here.
+
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+       The Context of the merged System.
+    variant : int, optional, default=None
+       The new value of `alchemical_variant`, or None to leave it unchanged.
+    alchemical_lambda : float, optional, default=None
+       The new value of `alchemical_lambda`, or None to leave it unchanged.
+
+    """
+    if variant is not None:
+        context.setParameter('alchemical_variant', variant)
+    if alchemical_lambda is not None:
+        context.setParameter('alchemical_lambda', alchemical_lambda)
+
+    system = context.getSystem()
+    for index in range(system.getNumForces()):
+        force = system.getForce(index)
+        if not isinstance(force, mm.CustomNonbondedForce):
+            continue
+        table = get_variant_table(force)
+        if table is None:
+            continue
+        ntable = len(table.getFunctionParameters())
+        table.setFunctionParameters(compute_variant_lambdas(ntable, int(round(context.getParameter('alchemical_variant'))), context.getParameter('alchemical_lambda')))
+        force.updateParametersInContext(context)
+
+def set_context_parameter(context, name, value):
+    """
+    Set a global context parameter, going through `set_alchemical_state` for ALCHEMICAL_PARAMETERS.
+
+    Simulation drivers that are given a parameter name use this instead of Context.setParameter, so that the
+    `variant_lambda` tables of merged Systems built with variant_selection='tabulated' stay in sync.
+
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+       The Context.
+    name : str
+       The name of the global context parameter.
+    value : float
+       The new value.
+
+    """
+    if name == 'alchemical_variant':
+        set_alchemical_state(context, variant=value)
+    elif name == 'alchemical_lambda':
+        set_alchemical_state(context, alchemical_lambda=value)
+    else:
+        context.setParameter(name, value)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Cached AM1-BCC charge assignment with a configurable conformer budget.
+
+AM1-BCC charging is the slowest step of parameterizing a ligand: the canonical recipe expands up to 800
+Omega conformers and runs AM1 on every one of them.  `ChargeService` caches charges by canonical isomeric
+SMILES (with explicit hydrogens, so the protonation state is part of the key), lets the conformer budget be
+reduced, offers the ELF10 scheme that only runs AM1 on ten selected conformers, and keeps the conformers it
+generates so callers do not need to expand the molecule again.
+
+Example
+-------
+
+>>> service = ChargeService(mode='am1bccelf10', max_confs=200)
+>>> molecule = service.assignCharges(molecule)
+>>> (service.nhits, service.nmisses)
+
+See examples/benchmarks/charge_budget_benchmark.py for the accuracy-versus-time tradeoff of the available budgets.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+try:
+    import openeye.oechem as oe
+except ImportError:
+    oe = None
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+CHARGE_MODES = ['am1bccsym', 'am1bccelf10'] # AM1-BCC on all conformers (canonical recipe), or on ten ELF-selected conformers
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_protonated_smiles(molecule):
+    """
+    Return canonical isomeric SMILES with explicit hydrogens, identifying both the molecule and its protonation state.
+
+    """
+    flags = oe.OESMILESFlag_Canonical | oe.OESMILESFlag_ISOMERIC | oe.OESMILESFlag_Hydrogens
+    return oe.OECreateSmiString(molecule, flags)
+
+def map_onto_smiles_order(molecule, smiles):
+    """
+    Map the atoms of a molecule onto the atom order of a SMILES string.
+
+    Parameters
+    ----------
+    molecule : openeye.oechem.OEMol
+        The molecule, with explicit hydrogens.
+    smiles : str
+        SMILES with explicit hydrogens describing the same molecule, as returned by `get_protonated_smiles`.
+
+    Returns
+    -------
+    order : list of int
+        order[i] is the index in `molecule` of atom i of `smiles`.
+
+    Notes
+    -----
+    Symmetry-equivalent atoms may be mapped onto each other in any order; AM1-BCC charges are symmetrized, so this does not affect the charges.
+
+    """
+    pattern = oe.OEMol()
+    oe.OEParseSmiles(pattern, smiles)
+    subsearch = oe.OESubSearch(pattern, oe.OEExprOpts_ExactAtoms, oe.OEExprOpts_ExactBonds)
+    for match in subsearch.Match(molecule, True):
+        order = [ None ] * pattern.NumAtoms()
+        for matchpair in match.GetAtoms():
+            order[matchpair.pattern.GetIdx()] = matchpair.target.GetIdx()
+        return order
+    raise Exception("Could not map molecule '%s' onto SMILES '%s'." % (molecule.GetTitle(), smiles))
+
+################################################################################
+# CHARGE SERVICE
+################################################################################
+
+class ChargeService(object):
+    """\
+    Assign AM1-BCC charges with a configurable conformer budget, caching charges by canonical SMILES and protonation state.
+
+    """
+    def __init__(self, mode='am1bccsym', max_confs=800, energy_window=15.0, rms_threshold=1.0):
+        """\
+        Create a charge service.
+
+        Parameters
+        ----------
+        mode : str, optional, default='am1bccsym'
+            One of CHARGE_MODES.  'am1bccsym' runs AM1 on every conformer (the canonical recipe);
+            'am1bccelf10' runs AM1 only on ten conformers selected by the ELF procedure.
+        max_confs : int, optional, default=800
+            Maximum number of Omega conformers to expand.
+        energy_window : float, optional, default=15.0
+            Omega energy window (kcal/mol).
+        rms_threshold : float, optional, default=1.0
+            Omega RMS threshold (angstroms) for distinguishing conformers.
+
+        """
+        if mode not in CHARGE_MODES:
+            raise Exception("Charge mode '%s' unknown; must be one of %s." % (mode, str(CHARGE_MODES)))
+
+        self.mode = mode
+        self.max_confs = max_confs
+        self.energy_window = energy_window
+        self.rms_threshold = rms_threshold
+
+        # Cached charges, keyed by (protonated SMILES, mode, max_confs, energy_window, rms_threshold), in SMILES atom order.
+        self._charges = dict()
+        self.nhits = 0
+        self.nmisses = 0
+
+        return
+
+    def _expandConformers(self, molecule):
+        """\
+        Expand conformers of `molecule` in place using the configured budget.
+
+        """
+        from openeye import oeomega
+        omega = oeomega.OEOmega()
+        omega.SetIncludeInput(False)
+        omega.SetCanonOrder(False)
+        omega.SetSampleHydrogens(True)
+        omega.SetEnergyWindow(self.energy_window)
+        omega.SetMaxConfs(self.max_confs)
+        omega.SetRMSThreshold(self.rms_threshold)
+        omega(molecule)
+        return
+
+    def _computeCharges(self, molecule):
+        """\
+        Assign charges to `molecule` in place, which must already contain conformers.
+
+        """
+        from openeye import oequacpac
+        if self.mode == 'am1bccsym':
+            oequacpac.OEAssignPartialCharges(molecule, oequacpac.OECharges_AM1BCCSym)
+        elif self.mode == 'am1bccelf10':
+            oequacpac.OEAssignCharges(molecule, oequacpac.OEAM1BCCELF10Charges())
+        return
+
+    def assignCharges(self, molecule):
+        """\
+        Return a copy of `molecule` with AM1-BCC charges.
+
+        Parameters
+        ----------
+        molecule : openeye.oechem.OEMol
+            The molecule to charge, with explicit hydrogens.
+
+        Returns
+        -------
+        molecule : openeye.oechem.OEMol
+            The charged copy.  If charges had to be computed, the copy carries the expanded conformers (lowest energy first)
+            so that no further conformer expansion is needed; if charges were cached, the copy keeps the input conformers.
+
+        """
+        molecule = oe.OEMol(molecule)
+        smiles = get_protonated_smiles(molecule)
+        key = (smiles, self.mode, self.max_confs, self.energy_window, self.rms_threshold)
+
+        if key in self._charges:
+            self.nhits += 1
+            charges = self._charges[key]
+            order = map_onto_smiles_order(molecule, smiles)
+            atoms = [ atom for atom in molecule.GetAtoms() ]
+            for (smiles_index, molecule_index) in enumerate(order):
+                atoms[molecule_index].SetPartialCharge(charges[smiles_index])
+            return molecule
+
+        self.nmisses += 1
+        self._expandConformers(molecule)
+        self._computeCharges(molecule)
+
+        # Store charges in SMILES atom order so they can be transferred to other atom orderings.
+        order = map_onto_smiles_order(molecule, smiles)
+        atoms = [ atom for atom in molecule.GetAtoms() ]
+        self._charges[key] = [ atoms[molecule_index].GetPartialCharge() for molecule_index in order ]
+
+        return molecule
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+LRU cache of OpenMM Contexts keyed by System fingerprint, integrator and platform.
+
+Creating a Context (copying the System, compiling kernels and uploading parameters) often costs far more than
+the energy evaluations or short simulations a workflow performs with it.  `ContextCache` keeps recently used
+Contexts alive and hands them out again when the same System is revisited with an equivalent integrator on the
+same platform.  Systems are identified by `get_system_fingerprint`, which hashes the serialized System, or its
+structure and all of its parameters without serializing it.
+
+Example
+-------
+
+>>> cache = ContextCache(capacity=4, max_memory=4*1024**3)
+>>> [context, integrator] = cache.getContext(system, openmm.VerletIntegrator(1.0*unit.femtoseconds))
+>>> context.setPositions(positions)
+>>> (cache.nhits, cache.nmisses, cache.nevictions)
+
+Notes
+-----
+* A cached Context keeps the positions, velocities and parameters it was last left with; callers must set whatever
+  state they rely on.  The integrator returned on a hit is the cached copy, not the one passed in.
+* By default the fingerprint hashes the full serialized System.  With `exact=False` it covers every parameter the
+  wrappers expose, reading the terms of supported forces as force tables, which avoids building the XML string but
+  was measured to be slightly slower than serializing with OpenMM 8.
+* Memory is measured as the growth of the resident set size while each Context is created, which requires
+  /proc/self/statm; elsewhere only `capacity` applies.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import hashlib
+import collections
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.force_tables import FORCE_TABLE_LAYOUTS, get_force_table_kinds, get_force_table
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+COUNT_METHODS = ['getNumParticles', 'getNumBonds', 'getNumAngles', 'getNumTorsions', 'getNumExceptions', 'getNumExclusions',
+                 'getNumInteractionGroups', 'getNumTabulatedFunctions', 'getNumPerParticleParameters', 'getNumPerBondParameters',
+                 'getNumPerAngleParameters', 'getNumPerTorsionParameters'] # force methods counting terms or parameters
+
+SETTING_METHODS = ['getNonbondedMethod', 'getCutoffDistance', 'getUseSwitchingFunction', 'getSwitchingDistance', 'getUseDispersionCorrection',
+                   'getUseLongRangeCorrection', 'getReactionFieldDielectric', 'getEwaldErrorTolerance', 'getSoluteDielectric', 'getSolventDielectric',
+                   'usesPeriodicBoundaryConditions'] # force methods returning settings that affect energies
+
+PARAMETER_METHODS = [('getNumParticles', 'getParticleParameters'), ('getNumBonds', 'getBondParameters'), ('getNumAngles', 'getAngleParameters'),
+                     ('getNumTorsions', 'getTorsionParameters'), ('getNumExceptions', 'getExceptionParameters'), ('getNumExclusions', 'getExclusionParticles'),
+                     ('getNumParticleParameterOffsets', 'getParticleParameterOffset'),
+                     ('getNumExceptionParameterOffsets', 'getExceptionParameterOffset')] # (count, parameter) method pairs
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def _hash_description(digest, description):
+    digest.update(repr(description).encode('utf-8'))
+
+def get_system_fingerprint(system, exact=True):
+    """
+    Compute a fingerprint of a System.
+
+    Unless `exact` is True, the System is not serialized.  Instead the fingerprint covers particle and constraint
+    counts, periodic box vectors, all masses and constraints, and for every force its class, force group, term counts,
+    energy expression, global parameters, nonbonded settings, tabulated functions, interaction groups and the
+    parameters of every term.  Terms of forces with a force table layout are hashed from their `get_force_table`
+    arrays; terms of other forces are hashed one by one.
+
+    Parameters
+    ----------
+    system : simtk.openmm.System
+        The System.
+    exact : bool, optional, default=True
+        If True, hash the full serialized System.
+
+    Returns
+    -------
+    fingerprint : str
+        Hex digest identifying the System.
+
+    """
+    if exact:
+        return hashlib.sha256(mm.XmlSerializer.serialize(system).encode('utf-8')).hexdigest()
+
+    digest = hashlib.sha256()
+    nparticles = system.getNumParticles()
+    _hash_description(digest, [ nparticles, system.getNumConstraints(), system.usesPeriodicBoundaryConditions(), str(system.getDefaultPeriodicBoxVectors()) ])
+    # OpenMM returns masses and distances in md_unit_system, so units can be dropped without conversion.
+    digest.update(np.array([ system.getParticleMass(index)._value for index in range(nparticles) ], np.float64).tobytes())
+    constraints = [ system.getConstraintParameters(index) for index in range(system.getNumConstraints()) ]
+    digest.update(np.array([ (atom1, atom2, distance._value) for (atom1, atom2, distance) in constraints ], np.float64).tobytes())
+    for force in system.getForces():
+        force_name = force.__class__.__name__
+        force_description = [ force_name, force.getForceGroup() ]
+        for method in COUNT_METHODS + SETTING_METHODS:
+            if hasattr(force, method):
+                force_description.append((method, str(getattr(force, method)())))
+        if hasattr(force, 'getEnergyFunction'):
+            force_description.append(force.getEnergyFunction())
+        if hasattr(force, 'getNumGlobalParameters'):
+            force_description.append([ (force.getGlobalParameterName(index), force.getGlobalParameterDefaultValue(index)) for index in range(force.getNumGlobalParameters()) ])
+        if hasattr(force, 'getNumTabulatedFunctions'):
+            force_description.append([ (force.getTabulatedFunctionName(index), force.getTabulatedFunction(index).__class__.__name__,
+                                        str(force.getTabulatedFunction(index).getFunctionParameters())) for index in range(force.getNumTabulatedFunctions()) ])
+        if hasattr(force, 'getNumInteractionGroups'):
+            force_description.append([ [ sorted(group) for group in force.getInteractionGroupParameters(index) ] for index in range(force.getNumInteractionGroups()) ])
+        _hash_description(digest, force_description)
+
+        # Parameters of every term, from force tables where a layout exists.
+        tabulated_methods = set()
+        if force_name in FORCE_TABLE_LAYOUTS:
+            for kind in get_force_table_kinds(force):
+                tabulated_methods.add(FORCE_TABLE_LAYOUTS[force_name][kind][1])
+                table = get_force_table(force, kind)
+                _hash_description(digest, (kind, table.dtype.descr))
+                digest.update(table.tobytes())
+        for (count_method, parameter_method) in PARAMETER_METHODS:
+            if (parameter_method not in tabulated_methods) and hasattr(force, count_method) and hasattr(force, parameter_method):
+                _hash_description(digest, [ str(getattr(force, parameter_method)(index)) for index in range(getattr(force, count_method)()) ])
+
+    return digest.hexdigest()
+
+def get_resident_memory():
+    """
+    Return the resident set size of this process in bytes, or None if it cannot be determined.
+
+    """
+    try:
+        with open('/proc/self/statm', 'r') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+################################################################################
+# CONTEXT CACHE
+################################################################################
+
+class ContextCache(object):
+    """\
+    Least-recently-used cache of Contexts, bounded by a number of entries and optionally by measured memory.
+
+    """
+    def __init__(self, capacity=8, max_memory=None, exact=True):
+        """\
+        Create an empty cache.
+
+        Parameters
+        ----------
+        capacity : int, optional, default=8
+            The maximum number of cached Contexts.
+        max_memory : int, optional, default=None
+            The maximum total measured memory of cached Contexts in bytes, or None for no limit.
+        exact : bool, optional, default=True
+            If True, fingerprint the full serialized System; otherwise, fingerprint its structure and parameters without serializing it.
+
+        """
+        self.capacity = capacity
+        self.max_memory = max_memory
+        self.exact = exact
+
+        # _entries[key] = dict(fingerprint, context, integrator, memory), in order of least to most recent use.
+        self._entries = collections.OrderedDict()
+
+        # Statistics.
+        self.nhits = 0
+        self.nmisses = 0
+        self.nevictions = 0
+
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def memory(self):
+        """\
+        The total measured memory of cached Contexts in bytes.
+
+        """
+        return sum([ self._entries[key]['memory'] for key in self._entries ])
+
+    def makeKey(self, system, integrator, platform=None, properties=None, fingerprint=None):
+        """\
+        Compute the key under which a Context is cached.
+
+        Integrators are compared by their serialized form, so integrators of the same type with different settings do not match.
+
+        """
+        if fingerprint is None:
+            fingerprint = get_system_fingerprint(system, exact=self.exact)
+        platform_name = platform.getName() if (platform is not None) else None
+        properties = tuple(sorted(properties.items())) if properties else None
+        return (fingerprint, integrator.__class__.__name__, mm.XmlSerializer.serialize(integrator), platform_name, properties)
+
+    def getContext(self, system, integrator, platform=None, properties=None, fingerprint=None):
+        """\
+        Return a Context for `system` with an integrator equivalent to `integrator`, creating it if necessary.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The System.
+        integrator : simtk.openmm.Integrator
+            The integrator; on a miss, a copy of it is bound to the new Context.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform; the fastest available if None.
+        properties : dict, optional, default=None
+            Platform properties.
+        fingerprint : str, optional, default=None
+            A precomputed fingerprint of `system`, to skip fingerprinting on repeated calls.
+
+        Returns
+        -------
+        context : simtk.openmm.Context
+            The cached or newly created Context.
+        integrator : simtk.openmm.Integrator
+            The integrator bound to `context`.
+
+        """
+        key = self.makeKey(system, integrator, platform=platform, properties=properties, fingerprint=fingerprint)
+        if key in self._entries:
+            # Move to the most recently used end.
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            self.nhits += 1
+            return [entry['context'], entry['integrator']]
+
+        self.nmisses += 1
+        integrator = mm.XmlSerializer.deserialize(mm.XmlSerializer.serialize(integrator))
+        initial_memory = get_resident_memory()
+        if platform is None:
+            context = mm.Context(system, integrator)
+        elif properties:
+            context = mm.Context(system, integrator, platform, properties)
+        else:
+            context = mm.Context(system, integrator, platform)
+        final_memory = get_resident_memory()
+        memory = max(0, final_memory - initial_memory) if (initial_memory is not None) and (final_memory is not None) else 0
+
+        self._entries[key] = dict(fingerprint=key[0], context=context, integrator=integrator, memory=memory)
+        self._enforceLimits()
+        return [context, integrator]
+
+    def _enforceLimits(self):
+        """\
+        Evict least-recently-used entries beyond the capacity or memory cap, always keeping the most recent entry.
+
+        """
+        while len(self._entries) > 1:
+            over_capacity = len(self._entries) > self.capacity
+            over_memory = (self.max_memory is not None) and (self.memory > self.max_memory)
+            if not (over_capacity or over_memory):
+                break
+            self._evictKey(next(iter(self._entries)))
+
+    def _evictKey(self, key):
+        entry = self._entries.pop(key)
+        del entry['context'], entry['integrator']
+        self.nevictions += 1
+
+    def evict(self, system=None, fingerprint=None):
+        """\
+        Remove all cached Contexts for a System, or all Contexts if neither `system` nor `fingerprint` is given.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System, optional, default=None
+            The System whose Contexts are removed.
+        fingerprint : str, optional, default=None
+            A precomputed fingerprint of the System.
+
+        Returns
+        -------
+        nevicted : int
+            The number of Contexts removed.
+
+        """
+        if (system is not None) and (fingerprint is None):
+            fingerprint = get_system_fingerprint(system, exact=self.exact)
+        keys = [ key for key in self._entries if (fingerprint is None) or (key[0] == fingerprint) ]
+        for key in keys:
+            self._evictKey(key)
+        return len(keys)
+
+    def clear(self):
+        """\
+        Remove all cached Contexts.
+
+        """
+        self.evict()
@@ -2,6 +2,9 @@
 """
 Testbed for creating relative alchemical transformations.
 
+`RelativeTransformationFactory` prepares a reference molecule once and builds transformations from it to many
+target molecules, streaming them back from worker processes as they complete.
+
 """
 
 from openmoltools import openeye
@@ -10,6 +13,17 @@ import simtk.openmm as mm
 from simtk import unit
 import simtk.openmm.app as app
 import numpy as np
+import copy
+import itertools
+import traceback
+import multiprocessing
+
+from examol.positions import PositionBuffer
+from examol.force_tables import FORCE_TABLE_LAYOUTS, get_force_table_kinds, get_force_table, add_force_table, set_force_table, create_force_table, convert_force_table, index_force_table
+from examol.lambda_schedule import LambdaScheduleOptimizer, LambdaScheduleCache
+from examol.reporters import load_energy_store
+from examol.runner import AlchemicalRunner
+from examol.mcss import get_default_mcss_searcher
 
 def create_molecule(iupac_name):
     molecule = openeye.iupac_to_oemol(iupac_name)
@@ -20,13 +34,20 @@ def create_molecule(iupac_name):
     #omega(molecule)
     return molecule
 
-def generate_openmm_system(molecule):
-    trajs, ffxmls = openeye.oemols_to_ffxml([molecule])
-    ff = app.ForceField(ffxmls)
-    # Get OpenMM Topology.
-    topology = trajs[0].top.to_openmm()
-    # Create OpenMM System object.
-    system = ff.createSystem(topology)
+def generate_openmm_system(molecule, cache=None):
+    # Reuse a previous parameterization of this molecule, if available.
+    if cache is not None:
+        key = cache.makeKey(molecule, function='generate_openmm_system', charge_model=None, implicitSolvent=None, constraints=None)
+        entry = cache.get(key)
+    if (cache is not None) and (entry is not None):
+        [system, topology] = [entry['system'], entry['topology']]
+    else:
+        trajs, ffxmls = openeye.oemols_to_ffxml([molecule])
+        ff = app.ForceField(ffxmls)
+        # Get OpenMM Topology.
+        topology = trajs[0].top.to_openmm()
+        # Create OpenMM System object.
+        system = ff.createSystem(topology)
     # Create positions.
     natoms = molecule.NumAtoms()
     positions = unit.Quantity(np.zeros([natoms,3], np.float32), unit.angstrom)
@@ -36,13 +57,857 @@ def generate_openmm_system(molecule):
         positions[index,0] = x * unit.angstrom
         positions[index,1] = y * unit.angstrom
         positions[index,2] = z * unit.angstrom
+    # Store new parameterizations.
+    if (cache is not None) and (entry is None):
+        cache.put(key, system, topology, positions)
     # Return results.
     return [system, topology, positions]
 
 ONE_4PI_EPS0 = 138.935456 # OpenMM constant for Coulomb interactions (openmm/platforms/reference/include/SimTKOpenMMRealType.h) in OpenMM units
 
+MAPPING_ATOM_EXPRESSION = oe.OEExprOpts_DefaultAtoms
+MAPPING_BOND_EXPRESSION = oe.OEExprOpts_BondOrder | oe.OEExprOpts_EqSingleDouble | oe.OEExprOpts_EqAromatic
+MAPPING_OPTIONS = ('OEMCSSearch', MAPPING_ATOM_EXPRESSION, MAPPING_BOND_EXPRESSION, 'OEMCSType_Exhaustive', 'OEMCSMaxAtomsCompleteCycles') # everything that affects the atom mapping, for mapping stores
+APPROXIMATE_MAPPING_OPTIONS = MAPPING_OPTIONS[:3] + ('OEMCSType_Approximate',) + MAPPING_OPTIONS[4:] # the same, for the approximate search
+
+def create_mapping_search(molecule1, mcss_searcher=None):
+    """
+    Create the MCSS search that maps the atoms of molecule1 onto those of other molecules for relative transformations.
+
+    Parameters
+    ----------
+    molecule1 : openeye.oechem.OEMol
+        The pattern molecule.
+    mcss_searcher : examol.mcss.MCSSSearcher, optional, default=None
+        The searcher that bounds the time of each exhaustive search and records its statistics; the default searcher if None.
+
+    Returns
+    -------
+    mcss : examol.mcss.BoundedMCSSearch
+        The search, returning at most one match.  It is described by MAPPING_OPTIONS, or by APPROXIMATE_MAPPING_OPTIONS
+        when `mcss.mode` is 'approximate' after a match (requested, or fallen back to when out of time).
+
+    """
+    if mcss_searcher is None:
+        mcss_searcher = get_default_mcss_searcher()
+    # complete_cycles modifies the scoring function to prefer keeping cycles complete.
+    # TODO: Set initial substructure size?
+    return mcss_searcher.createSearch(molecule1, MAPPING_ATOM_EXPRESSION, MAPPING_BOND_EXPRESSION, mcss_type=oe.OEMCSType_Exhaustive,
+                                      complete_cycles=True)
+
+def read_indexed_tables(system):
+    """
+    Read every supported force of a System into force tables, indexing terms by unique atom tuple.
+
+    Returns
+    -------
+    tables : list of dict
+        tables[force_index][kind] is [table, index] for each term kind of force `force_index`, where index is None for particles.
+
+    """
+    tables = list()
+    for force in system.getForces():
+        force_tables = dict()
+        if force.__class__.__name__ in FORCE_TABLE_LAYOUTS:
+            for kind in get_force_table_kinds(force):
+                table = get_force_table(force, kind)
+                force_tables[kind] = [table, (index_force_table(table) if ('atoms' in table.dtype.names) else None)]
+        tables.append(force_tables)
+    return tables
+
+def _initialize_worker(factory, options):
+    """
+    Store the factory and options of a batch in a worker process.
+
+    """
+    global _worker_factory, _worker_options
+    _worker_factory = factory
+    _worker_options = options
+
+def _create_transformation(arguments):
+    """
+    Create one transformation of a batch with the factory stored by `_initialize_worker`.
+
+    Parameters
+    ----------
+    arguments : tuple of (index, molecule_bytes)
+        The position of the target in the batch, and the target molecule serialized in OEB format.
+
+    Returns
+    -------
+    result : tuple of (index, dict)
+        The dict contains 'mcss_statistics', the statistics records of the MCSS searches run for this target, which
+        are moved out of the searcher of the worker.  On success, it also contains 'system' (the System serialized to
+        XML), 'topology' and 'positions'; on failure, it contains 'error', the formatted traceback.
+
+    """
+    (index, molecule_bytes) = arguments
+    # Record the statistics of this target separately from those the searcher already holds.
+    searcher = _worker_factory.mcss_searcher
+    [statistics, searcher.statistics] = [searcher.statistics, list()]
+    try:
+        molecule2 = oe.OEMol()
+        oe.OEReadMolFromBytes(molecule2, '.oeb', molecule_bytes)
+        [system, topology, positions] = _worker_factory.createTransformation(molecule2, **_worker_options)
+        result = dict(system=mm.XmlSerializer.serialize(system), topology=topology, positions=positions)
+    except Exception:
+        result = dict(error=traceback.format_exc())
+    finally:
+        [records, searcher.statistics] = [searcher.statistics, statistics]
+    result['mcss_statistics'] = records
+    return (index, result)
+
+class RelativeTransformationFactory(object):
+    """\
+    Create relative alchemical transformations from one reference molecule to many target molecules.
+
+    The reference molecule is parameterized, its MCSS pattern is built, and the terms of the environment System and of
+    the reference are read into indexed force tables once, when the factory is created.  Each target then only costs
+    its own parameterization, one MCSS match against the shared pattern, and the construction of its hybrid System.
+
+    Example
+    -------
+
+    >>> factory = RelativeTransformationFactory(system, topology, positions, range(reference.NumAtoms()), reference)
+    >>> for (index, transformation) in factory.createTransformations(targets, nworkers=8):
+    ...     if transformation is not None:
+    ...         [hybrid_system, hybrid_topology, hybrid_positions] = transformation
+
+    """
+    def __init__(self, system, topology, positions, molecule1_indices_in_system, molecule1, cache=None, mapping_store=None, prefilter=None,
+                 mcss_searcher=None):
+        """\
+        Prepare the reference molecule and its environment.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The system to be modified, already containing molecule1 whose atoms correspond to molecule1_indices_in_system.
+        topology : simtk.openmm.app.Topology
+            The topology object corresponding to system.
+        positions : simtk.unit.Quantity of numpy array natoms x 3 compatible with units angstroms
+            The positions array corresponding to system and topology.
+        molecule1_indices_in_system : list of int
+            Indices of molecule1 in system, with atoms in same order.
+        molecule1 : openeye.oechem.OEMol
+            Molecule already present in system, where the atom mapping is given by molecule1_indices_in_system.
+        cache : examol.parameterization_cache.ParameterizationCache, optional, default=None
+            If specified, used by `generate_openmm_system` to reuse earlier parameterizations.
+        mapping_store : examol.mapping_store.AtomMappingStore, optional, default=None
+            If specified, atom mappings and overlays are looked up here before searching, and stored after searching.
+        prefilter : examol.fingerprints.FingerprintFilter, optional, default=None
+            If specified, decides from fingerprint similarity whether each target is searched exhaustively, searched
+            approximately, or rejected.
+        mcss_searcher : examol.mcss.MCSSSearcher, optional, default=None
+            Bounds the time of each exhaustive MCSS search, falling back to the approximate search, and records the
+            statistics of every search; the default searcher if None.
+
+        """
+        # Copy and normalize molecule1.
+        # TODO: May need to do more normalization here.
+        self.molecule1 = oe.OEMol(molecule1)
+        oe.OEPerceiveChiral(self.molecule1)
+        self.molecule1_indices_in_system = list(molecule1_indices_in_system)
+        self.cache = cache
+        self.mapping_store = mapping_store
+        self.prefilter = prefilter
+        if mcss_searcher is None:
+            mcss_searcher = get_default_mcss_searcher()
+        self.mcss_searcher = mcss_searcher
+
+        # Each transformation deserializes its own copy of the System, so the original objects are never modified.
+        self._system_xml = mm.XmlSerializer.serialize(system)
+        self.topology = copy.deepcopy(topology)
+        self.positions = copy.deepcopy(positions)
+
+        # Build the MCSS search with molecule1 as pattern once for all targets.
+        self._mcss = create_mapping_search(self.molecule1, mcss_searcher=mcss_searcher)
+
+        # Create OpenMM System object for molecule1 using GAFF/AM1-BCC.
+        # NOTE: This must generate the same forcefield parameters as occur in `system`.
+        [self._system1, topology1, positions1] = generate_openmm_system(self.molecule1, cache=cache)
+
+        # Read and index the terms of system by force index, and those of system1 by force name.
+        self._tables = read_indexed_tables(system)
+        self._tables1 = dict([ (force.__class__.__name__, tables) for (force, tables) in zip(self._system1.getForces(), read_indexed_tables(self._system1)) ])
+
+        # Tracebacks of the targets that failed in the last batch, keyed by position in the batch.
+        self.transformation_failures = dict()
+
+        return
+
+    def createTransformation(self, molecule2, softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2, verbose=False):
+        """\
+        Create an OpenMM System object to handle the alchemical transformation from molecule1 to molecule2.
+
+        Parameters
+        ----------
+        molecule2 : openeye.oechem.OEMol
+            New molecule that molecule1 will be transformed into as lambda parameter goes from 0 -> 1.
+        softcore_alpha : float, optional, default=0.5
+            Softcore parameter for Lennard-Jones softening.
+        softcore_beta : simtk.unit.Quantity with units compatible with angstrom**2
+            Softcore parameter for Coulomb interaction softening.
+        verbose : bool, optional, default=False
+            If True, print the atom mapping and progress.
+
+        Returns
+        -------
+        system : simtk.openmm.System
+            Modified version of system in which old system is recovered for global context paramaeter `lambda` = 0 and new molecule is substituted for `lambda` = 1.
+        topology : system.openmm.Topology
+            Topology corresponding to system.
+        positions : simtk.unit.Quantity of numpy array natoms x 3 compatible with units angstroms
+            Positions corresponding to system.
+
+        """
+        molecule1 = self.molecule1
+        molecule1_indices_in_system = self.molecule1_indices_in_system
+
+        # Copy and normalize molecule2.
+        molecule2 = oe.OEMol(molecule2)
+        oe.OEPerceiveChiral(molecule2)
+
+        # Make copies to not destroy original objects.
+        system = mm.XmlSerializer.deserialize(self._system_xml)
+        topology = copy.deepcopy(self.topology)
+        positions = copy.deepcopy(self.positions)
+
+        # Choose the search from the fingerprint similarity of the molecules.
+        mcss = self._mcss
+        [mcss_type, mapping_options] = [oe.OEMCSType_Exhaustive, MAPPING_OPTIONS]
+        if self.prefilter is not None:
+            mcss_type = self.prefilter.getSearchType(molecule1, molecule2)
+            if mcss_type is None:
+                raise Exception("molecule2 was rejected by the fingerprint pre-filter: similarity %.3f to molecule1 is below %.3f." %
+                                (self.prefilter.getSimilarity(molecule1, molecule2), self.prefilter.reject_threshold))
+            if mcss_type == oe.OEMCSType_Approximate:
+                mapping_options = APPROXIMATE_MAPPING_OPTIONS
+
+        # Reuse a stored mapping of molecule1 to molecule2 (or of molecule2 to molecule1), if available.
+        # An exhaustive search that ran out of time earlier stored its approximate fallback, which is reused rather than timing out again.
+        record = None
+        if self.mapping_store is not None:
+            record = self.mapping_store.getMapping(molecule1, molecule2, mapping_options)
+            if (record is None) and (mapping_options == MAPPING_OPTIONS):
+                record = self.mapping_store.getMapping(molecule1, molecule2, APPROXIMATE_MAPPING_OPTIONS)
+
+        overlay = True
+        rmat  = oe.OEDoubleArray(9)
+        trans = oe.OEDoubleArray(3)
+        if record is None:
+            # Determine common atoms in second molecule; an exhaustive search that runs out of time falls back to the approximate search.
+            matches = mcss.Match(molecule2, True, mcss_type=mcss_type)
+            if len(matches) == 0:
+                raise Exception("No common substructure found between molecule1 and molecule2.")
+            if mcss.mode == 'approximate':
+                mapping_options = APPROXIMATE_MAPPING_OPTIONS
+            match = matches[0] # we only need the first match
+            mapping1 = dict([ (matchpair.pattern.GetIdx(), matchpair.target.GetIdx()) for matchpair in match.GetAtoms() ]) # mapping of atoms in molecule1 to molecule2
+
+            # Align common substructure of molecule2 with molecule1.
+            rms = oe.OERMSD(mcss.GetPattern(), molecule2, match, overlay, rmat, trans)
+            if rms < 0.0:
+                raise Exception("RMS overlay failure")
+            if self.mapping_store is not None:
+                self.mapping_store.putMapping(molecule1, molecule2, mapping_options, mapping1, rotation=[ rmat[i] for i in range(9) ],
+                                              translation=[ trans[i] for i in range(3) ], rmsd=rms)
+        elif record['rotation'] is not None:
+            # The stored overlay was computed for these conformations.
+            mapping1 = record['mapping']
+            for (i, x) in enumerate(record['rotation']):
+                rmat[i] = x
+            for (i, x) in enumerate(record['translation']):
+                trans[i] = x
+        else:
+            # Align the stored common substructure of molecule2 with molecule1.
+            mapping1 = record['mapping']
+            atoms1 = [ atom for atom in molecule1.GetAtoms() ]
+            atoms2 = [ atom for atom in molecule2.GetAtoms() ]
+            match = oe.OEMatch()
+            for (index1, index2) in mapping1.items():
+                match.AddPair(atoms1[index1], atoms2[index2])
+            rms = oe.OERMSD(molecule1, molecule2, match, overlay, rmat, trans)
+            if rms < 0.0:
+                raise Exception("RMS overlay failure")
+        oe.OERotate(molecule2, rmat)
+        oe.OETranslate(molecule2, trans)
+
+        # Make a list of the atoms in common, molecule1 only, and molecule2 only
+        mapping2 = dict([ (index2, index1) for (index1, index2) in mapping1.items() ]) # mapping of atoms in molecule2 to molecule1
+        all1 = frozenset(range(molecule1.NumAtoms()))
+        all2 = frozenset(range(molecule2.NumAtoms()))
+        common1 = frozenset(mapping1.keys())
+        common2 = frozenset(mapping2.keys())
+        unique1 = all1 - common1
+        unique2 = all2 - common2
+
+        if verbose:
+            print "list of atoms common to both molecules:"
+            print "molecule1: %s" % str(common1)
+            print "molecule2: %s" % str(common2)
+            print "list of atoms unqiue to individual molecules:"
+            print "molecule1: %s" % str(unique1)
+            print "molecule2: %s" % str(unique2)
+            print "MAPPING FROM MOLECULE1 TO MOLECULE2"
+            for atom1 in mapping1.keys():
+                atom2 = mapping1[atom1]
+                print "%5d => %5d" % (atom1, atom2)
+
+        # Create OpenMM Topology and System objects for molecule2 using GAFF/AM1-BCC; molecule1 was parameterized with the factory.
+        system1 = self._system1
+        [system2, topology2, positions2] = generate_openmm_system(molecule2, cache=self.cache)
+
+        #
+        # Start building combined OpenMM System object.
+        #
+
+        molecule1_atoms = [ atom for atom in molecule1.GetAtoms() ]
+        molecule2_atoms = [ atom for atom in molecule2.GetAtoms() ]
+
+        molecule2_indices_in_system = dict()
+
+        # Build mapping of common substructure for molecule 2.
+        for atom2 in common2:
+            molecule2_indices_in_system[atom2] = molecule1_indices_in_system[mapping2[atom2]]
+
+        # Find residue for molecule1.
+        residue = None
+        for atom in topology.atoms():
+            if atom.index in molecule1_indices_in_system:
+                residue = atom.residue
+                break
+
+        # Handle additional particles.
+        if verbose: print "Adding particles from system2..."
+        for atom2 in unique2:
+            atom = molecule2_atoms[atom2]
+            name = atom.GetName()
+            atomic_number = atom.GetAtomicNum()
+            element = app.Element.getByAtomicNumber(atomic_number)
+            mass = system2.getParticleMass(atom2)
+            if verbose: print [name, element, mass]
+            index = system.addParticle(mass)
+            molecule2_indices_in_system[atom2] = index
+
+            # TODO: Add new atoms to topology object as well.
+            topology.addAtom(name, element, residue)
+
+        # Turn molecule2_indices_in_system into list
+        molecule2_indices_in_system = [ molecule2_indices_in_system[atom2] for atom2 in range(molecule2.NumAtoms()) ]
+        molecule1_indices_array = np.array(molecule1_indices_in_system, np.int64)
+        molecule2_indices_array = np.array(molecule2_indices_in_system, np.int64)
+
+        if verbose: print "Atom mappings into System object"
+        if verbose: print "molecule1: %s" % str(molecule1_indices_in_system)
+        if verbose: print "molecule2: %s" % str(molecule2_indices_in_system)
+
+        # Handle constraints.
+        # TODO: What happens if constraints change? Raise Exception then.
+        if verbose: print "Adding constraints from system2..."
+        for index in range(system2.getNumConstraints()):
+            # Extract constraint distance from system2.
+            [atom2_i, atom2_j, distance] = system.getConstraintParameters(index)
+            # Map atoms from system2 into system.
+            atom_i = molecule2_indices_in_system[atom2_i]
+            atom_j = molecule2_indices_in_system[atom2_j]
+            # Add constraint to system.
+            system.addConstraint(atom_i, atom_j, distance)
+
+        # Create new positions array.
+        natoms = positions.shape[0] + len(unique2) # new number of atoms
+        position_buffer = PositionBuffer(natoms)
+        position_buffer.addBlock(positions)
+        block = position_buffer.addBlock(nparticles=len(unique2))
+        (start, stop) = position_buffer.getBlockRange(block)
+        unique2_positions = position_buffer.getBlockArray(block) # view into buffer, in angstroms
+        for atom2 in unique2:
+            index = molecule2_indices_in_system[atom2]
+            unique2_positions[index-start,:] = molecule2.GetCoords(molecule2_atoms[atom2])
+        positions = position_buffer.getPositions()
+
+        # Build a list of Force objects in system.
+        forces = [ system.getForce(index) for index in range(system.getNumForces()) ]
+        forces1 = { system1.getForce(index).__class__.__name__ : system1.getForce(index) for index in range(system1.getNumForces()) }
+        forces2 = { system2.getForce(index).__class__.__name__ : system2.getForce(index) for index in range(system2.getNumForces()) }
+
+        # Process forces.
+        for (force_index, force) in enumerate(forces):
+            # Get force name.
+            force_name = force.__class__.__name__
+            force1 = forces1[force_name]
+            force2 = forces2[force_name]
+            if verbose: print force_name
+            if force_name == 'HarmonicBondForce':
+                #
+                # Process HarmonicBondForce
+                #
+
+                # Create index of bonds in system, system1, and system2.
+                def unique(*args):
+                    if args[0] > args[-1]:
+                        return tuple(reversed(args))
+                    else:
+                        return tuple(args)
+
+                [table, bonds]   = self._tables[force_index]['bonds']  # indexed when the factory was created
+                [table1, bonds1] = self._tables1[force_name]['bonds']  # indexed when the factory was created
+                table2 = get_force_table(force2)
+                bonds2 = index_force_table(table2)  # index of bonds for system2
+
+                # Find bonds that are unique to each molecule.
+                if verbose: print "Finding bonds unique to each molecule..."
+                unique_bonds1 = [ bonds1[atoms] for atoms in bonds1 if not set(atoms).issubset(common1) ]
+                unique_bonds2 = [ bonds2[atoms] for atoms in bonds2 if not set(atoms).issubset(common2) ]
+
+                # Build list of bonds shared among all molecules.
+                if verbose: print "Building a list of shared bonds..."
+                shared_bonds = list()
+                for atoms2 in bonds2:
+                    if set(atoms2).issubset(common2):
+                        atoms  = tuple(molecule2_indices_in_system[atom2] for atom2 in atoms2)
+                        atoms1 = tuple(mapping2[atom2] for atom2 in atoms2)
+                        # Find bond index terms.
+                        index  = bonds[unique(*atoms)]
+                        index1 = bonds1[unique(*atoms1)]
+                        index2 = bonds2[unique(*atoms2)]
+                        # Store.
+                        shared_bonds.append( (index, index1, index2) )
+
+                # Add bonds that are unique to molecule2.
+                if verbose: print "Adding bonds unique to molecule2..."
+                new_bonds = table2[np.array(unique_bonds2, np.int64)]
+                new_bonds['atoms'] = molecule2_indices_array[new_bonds['atoms']]
+                add_force_table(force, new_bonds)
+
+                # Create a CustomBondForce to handle interpolated bond parameters.
+                if verbose: print "Creating CustomBondForce..."
+                energy_expression  = '(K/2)*(r-length)^2;'
+                energy_expression += 'K = (1-lambda)*K1 + lambda*K2;' # linearly interpolate spring constant
+                energy_expression += 'length = (1-lambda)*length1 + lambda*length2;' # linearly interpolate bond length
+                custom_force = mm.CustomBondForce(energy_expression)
+                custom_force.addGlobalParameter('lambda', 0.0)
+                custom_force.addPerBondParameter('length1') # molecule1 bond length
+                custom_force.addPerBondParameter('K1') # molecule1 spring constant
+                custom_force.addPerBondParameter('length2') # molecule2 bond length
+                custom_force.addPerBondParameter('K2') # molecule2 spring constant
+                system.addForce(custom_force)
+
+                # Process bonds that are shared by molecule1 and molecule2.
+                if verbose: print "Translating shared bonds to CustomBondForce..."
+                [indices, indices1, indices2] = np.array(shared_bonds, np.int64).reshape([-1,3]).T
+                # Zero out standard bond force.
+                set_force_table(force, indices, convert_force_table(table[indices], force, K=0.0))
+                # Create interpolated bond parameters.
+                add_force_table(custom_force, convert_force_table(table[indices], custom_force, length1=table1['length'][indices1], K1=table1['K'][indices1],
+                                                                  length2=table2['length'][indices2], K2=table2['K'][indices2]))
+
+            if force_name == 'HarmonicAngleForce':
+                #
+                # Process HarmonicAngleForce
+                #
+
+                # Create index of angles in system, system1, and system2.
+                def unique(*args):
+                    if args[0] > args[-1]:
+                        return tuple(reversed(args))
+                    else:
+                        return tuple(args)
+
+                [table, angles]   = self._tables[force_index]['angles']  # indexed when the factory was created
+                [table1, angles1] = self._tables1[force_name]['angles']  # indexed when the factory was created
+                table2 = get_force_table(force2)
+                angles2 = index_force_table(table2)  # index of angles for system2
+
+                # Find angles that are unique to each molecule.
+                if verbose: print "Finding angles unique to each molecule..."
+                unique_angles1 = [ angles1[atoms] for atoms in angles1 if not set(atoms).issubset(common1) ]
+                unique_angles2 = [ angles2[atoms] for atoms in angles2 if not set(atoms).issubset(common2) ]
+
+                # Build list of angles shared among all molecules.
+                if verbose: print "Building a list of shared angles..."
+                shared_angles = list()
+                for atoms2 in angles2:
+                    if set(atoms2).issubset(common2):
+                        atoms  = tuple(molecule2_indices_in_system[atom2] for atom2 in atoms2)
+                        atoms1 = tuple(mapping2[atom2] for atom2 in atoms2)
+                        # Find angle index terms.
+                        index  = angles[unique(*atoms)]
+                        index1 = angles1[unique(*atoms1)]
+                        index2 = angles2[unique(*atoms2)]
+                        # Store.
+                        shared_angles.append( (index, index1, index2) )
+
+                # Add angles that are unique to molecule2.
+                if verbose: print "Adding angles unique to molecule2..."
+                new_angles = table2[np.array(unique_angles2, np.int64)]
+                new_angles['atoms'] = molecule2_indices_array[new_angles['atoms']]
+                add_force_table(force, new_angles)
+
+                # Create a CustomAngleForce to handle interpolated angle parameters.
+                if verbose: print "Creating CustomAngleForce..."
+                energy_expression  = '(K/2)*(theta-theta0)^2;'
+                energy_expression += 'K = (1-lambda)*K_1 + lambda*K_2;' # linearly interpolate spring constant
+                energy_expression += 'theta0 = (1-lambda)*theta0_1 + lambda*theta0_2;' # linearly interpolate equilibrium angle
+                custom_force = mm.CustomAngleForce(energy_expression)
+                custom_force.addGlobalParameter('lambda', 0.0)
+                custom_force.addPerAngleParameter('theta0_1') # molecule1 equilibrium angle
+                custom_force.addPerAngleParameter('K_1') # molecule1 spring constant
+                custom_force.addPerAngleParameter('theta0_2') # molecule2 equilibrium angle
+                custom_force.addPerAngleParameter('K_2') # molecule2 spring constant
+                system.addForce(custom_force)
+
+                # Process angles that are shared by molecule1 and molecule2.
+                if verbose: print "Translating shared angles to CustomAngleForce..."
+                [indices, indices1, indices2] = np.array(shared_angles, np.int64).reshape([-1,3]).T
+                # Zero out standard angle force.
+                set_force_table(force, indices, convert_force_table(table[indices], force, K=0.0))
+                # Create interpolated angle parameters.
+                add_force_table(custom_force, convert_force_table(table[indices], custom_force, theta0_1=table1['theta0'][indices1], K_1=table1['K'][indices1],
+                                                                  theta0_2=table2['theta0'][indices2], K_2=table2['K'][indices2]))
+
+            if force_name == 'PeriodicTorsionForce':
+                #
+                # Process PeriodicTorsionForce
+                # TODO: Match up periodicities and deal with multiple terms per torsion
+                #
+
+                # Create index of torsions in system, system1, and system2.
+                def unique(*args):
+                    if args[0] > args[-1]:
+                        return tuple(reversed(args))
+                    else:
+                        return tuple(args)
+
+                [table, torsions]   = self._tables[force_index]['torsions']  # indexed when the factory was created
+                [table1, torsions1] = self._tables1[force_name]['torsions']  # indexed when the factory was created
+                table2 = get_force_table(force2)
+                torsions2 = index_force_table(table2)  # index of torsions for system2
+
+                # Find torsions that are unique to each molecule.
+                if verbose: print "Finding torsions unique to each molecule..."
+                unique_torsions1 = [ torsions1[atoms] for atoms in torsions1 if not set(atoms).issubset(common1) ]
+                unique_torsions2 = [ torsions2[atoms] for atoms in torsions2 if not set(atoms).issubset(common2) ]
+
+                # Build list of torsions shared among all molecules.
+                if verbose: print "Building a list of shared torsions..."
+                shared_torsions = list()
+                for atoms2 in torsions2:
+                    if set(atoms2).issubset(common2):
+                        atoms  = tuple(molecule2_indices_in_system[atom2] for atom2 in atoms2)
+                        atoms1 = tuple(mapping2[atom2] for atom2 in atoms2)
+                        # Find torsion index terms.
+                        try:
+                            index  = torsions[unique(*atoms)]
+                            index1 = torsions1[unique(*atoms1)]
+                            index2 = torsions2[unique(*atoms2)]
+                        except Exception as e:
+                            print e
+                            print "torsions :  %s" % str(unique(*atoms))
+                            print "torsions1:  %s" % str(unique(*atoms1))
+                            print "torsions2:  %s" % str(unique(*atoms2))
+                            raise Exception("Error occurred in building a list of torsions common to all molecules.")
+
+                        # Store.
+                        shared_torsions.append( (index, index1, index2) )
+
+                # Add torsions that are unique to molecule2.
+                if verbose: print "Adding torsions unique to molecule2..."
+                new_torsions = table2[np.array(unique_torsions2, np.int64)]
+                new_torsions['atoms'] = molecule2_indices_array[new_torsions['atoms']]
+                add_force_table(force, new_torsions)
+
+                # Create a CustomTorsionForce to handle interpolated torsion parameters.
+                if verbose: print "Creating CustomTorsionForce..."
+                energy_expression  = '(1-lambda)*U1 + lambda*U2;'
+                energy_expression += 'U1 = K1*(1+cos(periodicity1*theta-phase1));'
+                energy_expression += 'U2 = K2*(1+cos(periodicity2*theta-phase2));'
+                custom_force = mm.CustomTorsionForce(energy_expression)
+                custom_force.addGlobalParameter('lambda', 0.0)
+                custom_force.addPerTorsionParameter('periodicity1') # molecule1 periodicity
+                custom_force.addPerTorsionParameter('phase1') # molecule1 phase
+                custom_force.addPerTorsionParameter('K1') # molecule1 spring constant
+                custom_force.addPerTorsionParameter('periodicity2') # molecule2 periodicity
+                custom_force.addPerTorsionParameter('phase2') # molecule2 phase
+                custom_force.addPerTorsionParameter('K2') # molecule2 spring constant
+                system.addForce(custom_force)
+
+                # Process torsions that are shared by molecule1 and molecule2.
+                if verbose: print "Translating shared torsions to CustomTorsionForce..."
+                [indices, indices1, indices2] = np.array(shared_torsions, np.int64).reshape([-1,3]).T
+                # Zero out standard torsion force.
+                set_force_table(force, indices, convert_force_table(table[indices], force, K=0.0))
+                # Create interpolated torsion parameters.
+                add_force_table(custom_force, convert_force_table(table[indices], custom_force,
+                                                                  periodicity1=table1['periodicity'][indices1], phase1=table1['phase'][indices1], K1=table1['K'][indices1],
+                                                                  periodicity2=table2['periodicity'][indices2], phase2=table2['phase'][indices2], K2=table2['K'][indices2]))
+
+            if force_name == 'NonbondedForce':
+                #
+                # Process NonbondedForce
+                #
+
+                # Add nonbonded entries for molecule2 to ensure total number of particle entries is correct.
+                particles1 = self._tables1[force_name]['particles'][0]
+                particles2 = get_force_table(force2, 'particles')
+                new_particles = particles2[np.array(list(unique2), np.int64)]
+                add_force_table(force, new_particles, 'particles')
+
+                # Zero out nonbonded entries for molecule1 and molecule2.
+                particles = np.concatenate([self._tables[force_index]['particles'][0], new_particles])
+                alchemical_particles = np.union1d(molecule1_indices_array, molecule2_indices_array)
+                particles['charge'][alchemical_particles] = 0.0
+                particles['epsilon'][alchemical_particles] = 0.0
+                set_force_table(force, alchemical_particles, particles[alchemical_particles], 'particles')
+
+                # Create index of exceptions in system, system1, and system2.
+                def unique(*args):
+                    if args[0] > args[-1]:
+                        return tuple(reversed(args))
+                    else:
+                        return tuple(args)
+
+                [table, exceptions]   = self._tables[force_index]['exceptions']  # indexed when the factory was created
+                [table1, exceptions1] = self._tables1[force_name]['exceptions']  # indexed when the factory was created
+                table2 = get_force_table(force2, 'exceptions')
+                exceptions2 = index_force_table(table2)  # index of exceptions for system2
+
+                # Find exceptions that are unique to each molecule.
+                if verbose: print "Finding exceptions unique to each molecule..."
+                unique_exceptions1 = [ exceptions1[atoms] for atoms in exceptions1 if not set(atoms).issubset(common1) ]
+                unique_exceptions2 = [ exceptions2[atoms] for atoms in exceptions2 if not set(atoms).issubset(common2) ]
+
+                # Build list of exceptions shared among all molecules.
+                if verbose: print "Building a list of shared exceptions..."
+                shared_exceptions = list()
+                for atoms2 in exceptions2:
+                    if set(atoms2).issubset(common2):
+                        atoms  = tuple(molecule2_indices_in_system[atom2] for atom2 in atoms2)
+                        atoms1 = tuple(mapping2[atom2] for atom2 in atoms2)
+                        # Find exception index terms.
+                        index  = exceptions[unique(*atoms)]
+                        index1 = exceptions1[unique(*atoms1)]
+                        index2 = exceptions2[unique(*atoms2)]
+                        # Store.
+                        shared_exceptions.append( (index, index1, index2) )
+
+                # Add exceptions that are unique to molecule2.
+                if verbose: print "Adding exceptions unique to molecule2..."
+                new_exceptions = table2[np.array(unique_exceptions2, np.int64)]
+                new_exceptions['atoms'] = molecule2_indices_array[new_exceptions['atoms']]
+                add_force_table(force, new_exceptions, 'exceptions')
+
+                # Create list of alchemically modified atoms in system.
+                alchemical_atom_indices = list(set(molecule1_indices_in_system).union(set(molecule2_indices_in_system)))
+
+                # Create atom groups.
+                natoms = system.getNumParticles()
+                atomset1 = set(alchemical_atom_indices) # only alchemically-modified atoms
+                atomset2 = set(range(system.getNumParticles())) # all atoms, including alchemical region
+
+                # CustomNonbondedForce energy expression.
+                sterics_energy_expression = ""
+                electrostatics_energy_expression = ""
+
+                # Create a CustomNonbondedForce to handle alchemically interpolated nonbonded parameters.
+                # Select functional form based on nonbonded method.
+                method = force.getNonbondedMethod()
+                if method in [mm.NonbondedForce.NoCutoff]:
+                    # soft-core Lennard-Jones
+                    sterics_energy_expression += "U_sterics = 4*epsilon*x*(x-1.0); x1 = (sigma/reff_sterics)^6;"
+                    # soft-core Coulomb
+                    electrostatics_energy_expression += "U_electrostatics = ONE_4PI_EPS0*chargeprod/reff_electrostatics;"
+                elif method in [mm.NonbondedForce.CutoffPeriodic, mm.NonbondedForce.CutoffNonPeriodic]:
+                    # soft-core Lennard-Jones
+                    sterics_energy_expression += "U_sterics = 4*epsilon*x*(x-1.0); x = (sigma/reff_sterics)^6;"
+                    # reaction-field electrostatics
+                    epsilon_solvent = force.getReactionFieldDielectric()
+                    r_cutoff = force.getCutoffDistance()
+                    electrostatics_energy_expression += "U_electrostatics = ONE_4PI_EPS0*chargeprod*(reff_electrostatics^(-1) + k_rf*reff_electrostatics^2 - c_rf);"
+                    k_rf = r_cutoff**(-3) * ((epsilon_solvent - 1) / (2*epsilon_solvent + 1))
+                    c_rf = r_cutoff**(-1) * ((3*epsilon_solvent) / (2*epsilon_solvent + 1))
+                    electrostatics_energy_expression += "k_rf = %f;" % (k_rf / k_rf.in_unit_system(unit.md_unit_system).unit)
+                    electrostatics_energy_expression += "c_rf = %f;" % (c_rf / c_rf.in_unit_system(unit.md_unit_system).unit)
+                elif method in [mm.NonbondedForce.PME, mm.NonbondedForce.Ewald]:
+                    # soft-core Lennard-Jones
+                    sterics_energy_expression += "U_sterics = 4*epsilon*x*(x-1.0); x = (sigma/reff_sterics)^6;"
+                    # Ewald direct-space electrostatics
+                    [alpha_ewald, nx, ny, nz] = force.getPMEParameters()
+                    if alpha_ewald == 0.0:
+                        # If alpha is 0.0, alpha_ewald is computed by OpenMM from from the error tolerance.
+                        delta = force.getEwaldErrorTolerance()
+                        r_cutoff = force.getCutoffDistance()
+                        alpha_ewald = np.sqrt(-np.log(2*delta)) / r_cutoff
+                    electrostatics_energy_expression += "U_electrostatics = ONE_4PI_EPS0*chargeprod*erfc(alpha_ewald*reff_electrostatics)/reff_electrostatics;"
+                    electrostatics_energy_expression += "alpha_ewald = %f;" % (alpha_ewald / alpha_ewald.in_unit_system(unit.md_unit_system).unit)
+                    # TODO: Handle reciprocal-space electrostatics
+                else:
+                    raise Exception("Nonbonded method %s not supported yet." % str(method))
+
+                # Add additional definitions common to all methods.
+                sterics_energy_expression += "epsilon = (1-lambda)*epsilonA + lambda*epsilonB;" #interpolation
+                sterics_energy_expression += "reff_sterics = sigma*((softcore_alpha*lambda_alpha + (r/sigma)^6))^(1/6);" # effective softcore distance for sterics
+                sterics_energy_expression += "softcore_alpha = %f;" % softcore_alpha
+                # TODO: We may have to ensure that softcore_degree is 1 if we are close to an alchemically-eliminated endpoint.
+                sterics_energy_expression += "lambda_alpha = lambda*(1-lambda);"
+                electrostatics_energy_expression += "chargeProd = (1-lambda)*chargeProdA + lambda*chargeProdB;" #interpolation
+                electrostatics_energy_expression += "reff_electrostatics = sqrt(softcore_beta*lambda_beta + r^2);" # effective softcore distance for electrostatics
+                electrostatics_energy_expression += "softcore_beta = %f;" % (softcore_beta / softcore_beta.in_unit_system(unit.md_unit_system).unit)
+                electrostatics_energy_expression += "ONE_4PI_EPS0 = %f;" % ONE_4PI_EPS0 # already in OpenMM units
+                # TODO: We may have to ensure that softcore_degree is 1 if we are close to an alchemically-eliminated endpoint.
+                sterics_energy_expression += "lambda_beta = lambda*(1-lambda);"
+
+                # Define mixing rules.
+                sterics_mixing_rules = ""
+                sterics_mixing_rules += "epsilonA = sqrt(epsilonA1*epsilonA2);" # mixing rule for epsilon
+                sterics_mixing_rules += "epsilonB = sqrt(epsilonB1*epsilonB2);" # mixing rule for epsilon
+                sterics_mixing_rules += "sigmaA = 0.5*(sigmaA1 + sigmaA2);" # mixing rule for sigma
+                sterics_mixing_rules += "sigmaB = 0.5*(sigmaB1 + sigmaB2);" # mixing rule for sigma
+                electrostatics_mixing_rules = ""
+                electrostatics_mixing_rules += "chargeprodA = chargeA1*chargeA2;" # mixing rule for charges
+                electrostatics_mixing_rules += "chargeprodB = chargeB1*chargeB2;" # mixing rule for charges
+
+                # Create CustomNonbondedForce to handle interactions between alchemically-modified atoms and rest of system.
+                electrostatics_custom_nonbonded_force = mm.CustomNonbondedForce("U_electrostatics;" + electrostatics_energy_expression + electrostatics_mixing_rules)
+                electrostatics_custom_nonbonded_force.addGlobalParameter("lambda", 0.0);
+                electrostatics_custom_nonbonded_force.addPerParticleParameter("chargeA") # partial charge initial
+                electrostatics_custom_nonbonded_force.addPerParticleParameter("chargeB") # partial charge final
+                sterics_custom_nonbonded_force = mm.CustomNonbondedForce("U_sterics;" + sterics_energy_expression + sterics_mixing_rules)
+                sterics_custom_nonbonded_force.addGlobalParameter("lambda", 0.0);
+                sterics_custom_nonbonded_force.addPerParticleParameter("sigmaA") # Lennard-Jones sigma initial
+                sterics_custom_nonbonded_force.addPerParticleParameter("epsilonA") # Lennard-Jones epsilon initial
+                sterics_custom_nonbonded_force.addPerParticleParameter("sigmaB") # Lennard-Jones sigma final
+                sterics_custom_nonbonded_force.addPerParticleParameter("epsilonB") # Lennard-Jones epsilon final
+
+                # Restrict interaction evaluation to be between alchemical atoms and rest of environment.
+                # TODO: Exclude intra-alchemical region if we are separately handling that through a separate CustomNonbondedForce for decoupling.
+                sterics_custom_nonbonded_force.addInteractionGroup(atomset1, atomset2)
+                electrostatics_custom_nonbonded_force.addInteractionGroup(atomset1, atomset2)
+
+                # Add exclusions between unique parts of molecule1 and molecule2 so they do not interact.
+                if verbose: print "Add exclusions between unique parts of molecule1 and molecule2 that should not interact..."
+                exclusions = create_force_table(sterics_custom_nonbonded_force, len(unique1) * len(unique2), 'exclusions')
+                exclusions['atoms'] = np.array([ [molecule1_indices_in_system[atom1_i], molecule2_indices_in_system[atom2_j]] for atom1_i in unique1 for atom2_j in unique2 ], np.int64).reshape([-1,2])
+                add_force_table(electrostatics_custom_nonbonded_force, exclusions, 'exclusions')
+                add_force_table(sterics_custom_nonbonded_force, exclusions, 'exclusions')
+
+                # Add custom forces to system.
+                system.addForce(sterics_custom_nonbonded_force)
+                system.addForce(electrostatics_custom_nonbonded_force)
+
+                # Create CustomBondForce to handle exceptions for both kinds of interactions.
+                #custom_bond_force = mm.CustomBondForce("U_sterics + U_electrostatics;" + sterics_energy_expression + electrostatics_energy_expression)
+                #custom_bond_force.addGlobalParameter("lambda", 0.0);
+                #custom_bond_force.addPerBondParameter("chargeprodA") # charge product
+                #custom_bond_force.addPerBondParameter("sigmaA") # Lennard-Jones effective sigma
+                #custom_bond_force.addPerBondParameter("epsilonA") # Lennard-Jones effective epsilon
+                #custom_bond_force.addPerBondParameter("chargeprodB") # charge product
+                #custom_bond_force.addPerBondParameter("sigmaB") # Lennard-Jones effective sigma
+                #custom_bond_force.addPerBondParameter("epsilonB") # Lennard-Jones effective epsilon
+                #system.addForce(custom_bond_force)
+
+                # Copy over all Nonbonded parameters for normal atoms to Custom*Force objects.
+                sterics_particles = convert_force_table(particles, sterics_custom_nonbonded_force, 'particles', sigmaA=particles['sigma'], epsilonA=particles['epsilon'],
+                                                        sigmaB=particles['sigma'], epsilonB=particles['epsilon'])
+                electrostatics_particles = convert_force_table(particles, electrostatics_custom_nonbonded_force, 'particles', chargeA=particles['charge'], chargeB=particles['charge'])
+
+                # Copy over parameters for common substructure.
+                atoms1 = np.array(list(common1), np.int64)
+                atoms2 = np.array([ mapping1[atom1] for atom1 in atoms1 ], np.int64) # indices into system2
+                indices = molecule1_indices_array[atoms1] # indices into system
+                [sterics_particles['sigmaA'][indices], sterics_particles['epsilonA'][indices]] = [particles1['sigma'][atoms1], particles1['epsilon'][atoms1]]
+                [sterics_particles['sigmaB'][indices], sterics_particles['epsilonB'][indices]] = [particles2['sigma'][atoms2], particles2['epsilon'][atoms2]]
+                [electrostatics_particles['chargeA'][indices], electrostatics_particles['chargeB'][indices]] = [particles1['charge'][atoms1], particles2['charge'][atoms2]]
+
+                # Copy over parameters for molecule1 unique atoms.
+                atoms1 = np.array(list(unique1), np.int64)
+                indices = molecule1_indices_array[atoms1] # indices into system
+                [sterics_particles['sigmaA'][indices], sterics_particles['epsilonA'][indices]] = [particles1['sigma'][atoms1], particles1['epsilon'][atoms1]]
+                [sterics_particles['sigmaB'][indices], sterics_particles['epsilonB'][indices]] = [particles1['sigma'][atoms1], 0.0]
+                [electrostatics_particles['chargeA'][indices], electrostatics_particles['chargeB'][indices]] = [particles1['charge'][atoms1], 0.0]
+
+                # Copy over parameters for molecule2 unique atoms.
+                atoms2 = np.array(list(unique2), np.int64)
+                indices = molecule2_indices_array[atoms2] # indices into system
+                [sterics_particles['sigmaA'][indices], sterics_particles['epsilonA'][indices]] = [particles2['sigma'][atoms2], 0.0]
+                [sterics_particles['sigmaB'][indices], sterics_particles['epsilonB'][indices]] = [particles2['sigma'][atoms2], particles2['epsilon'][atoms2]]
+                [electrostatics_particles['chargeA'][indices], electrostatics_particles['chargeB'][indices]] = [0.0, particles2['charge'][atoms2]]
+
+                add_force_table(sterics_custom_nonbonded_force, sterics_particles, 'particles')
+                add_force_table(electrostatics_custom_nonbonded_force, electrostatics_particles, 'particles')
+
+            else:
+                #raise Exception("Force type %s unknown." % force_name)
+                pass
+
+        return [system, topology, positions]
+
+    def createTransformations(self, molecules, nworkers=None, softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2):
+        """\
+        Create the transformations from molecule1 to each of several molecules, yielding each as soon as it is built.
+
+        Parameters
+        ----------
+        molecules : list of openeye.oechem.OEMol
+            The target molecules.
+        nworkers : int, optional, default=None
+            The number of worker processes; one per CPU if None.  If 1, targets are processed in this process.
+        softcore_alpha : float, optional, default=0.5
+            Softcore parameter for Lennard-Jones softening.
+        softcore_beta : simtk.unit.Quantity with units compatible with angstrom**2
+            Softcore parameter for Coulomb interaction softening.
+
+        Yields
+        ------
+        index : int
+            The position of the target in `molecules`.
+        transformation : list of [system, topology, positions], or None
+            The transformation as returned by `createTransformation`, or None if it failed.
+
+        Notes
+        -----
+        Transformations are yielded in the order they finish, not in the order of `molecules`.  A failed target does
+        not abort the batch; its traceback is stored in `self.transformation_failures[index]`.  Workers are forked and
+        inherit the factory, so the reference is neither parameterized nor indexed again.  If the caller stops
+        iterating early, the remaining workers are terminated.  The MCSS statistics of every target are collected in
+        `self.mcss_searcher.statistics`.
+
+        """
+        options = dict(softcore_alpha=softcore_alpha, softcore_beta=softcore_beta)
+        arguments = [ (index, oe.OEWriteMolToBytes('.oeb', molecule)) for (index, molecule) in enumerate(molecules) ]
+        self.transformation_failures = dict()
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+
+        pool = None
+        if (nworkers > 1) and (len(arguments) > 1):
+            pool = multiprocessing.Pool(processes=min(nworkers, len(arguments)), initializer=_initialize_worker, initargs=(self, options))
+            results = pool.imap_unordered(_create_transformation, arguments, chunksize=1)
+        else:
+            _initialize_worker(self, options)
+            results = itertools.imap(_create_transformation, arguments)
+
+        completed = False
+        try:
+            for (index, result) in results:
+                self.mcss_searcher.statistics.extend(result['mcss_statistics'])
+                if 'error' in result:
+                    self.transformation_failures[index] = result['error']
+                    yield (index, None)
+                else:
+                    yield (index, [mm.XmlSerializer.deserialize(result['system']), result['topology'], result['positions']])
+            completed = True
+        finally:
+            if pool is not None:
+                if completed:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+
 def create_relative_alchemical_transformation(system, topology, positions, molecule1_indices_in_system, molecule1, molecule2,
-                                              softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2):
+                                              softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2, mapping_store=None, prefilter=None,
+                                              mcss_searcher=None):
     """
     Create an OpenMM System object to handle the alchemical transformation from molecule1 to molecule2.
 
@@ -62,6 +927,12 @@ def create_relative_alchemical_transformation(system, topology, positions, molec
        Softcore parameter for Lennard-Jones softening.
     softcore_beta : simtk.unit.Quantity with units compatible with angstrom**2
        Softcore parameter for Coulomb interaction softening.
+    mapping_store : examol.mapping_store.AtomMappingStore, optional, default=None
+       If specified, the atom mapping and overlay are reused from (or recorded in) this store.
+    prefilter : examol.fingerprints.FingerprintFilter, optional, default=None
+       If specified, dissimilar molecules are searched approximately or rejected before any exhaustive search.
+    mcss_searcher : examol.mcss.MCSSSearcher, optional, default=None
+       Bounds the time of the exhaustive MCSS search and records its statistics; the default searcher if None.
 
     Returns
     -------
@@ -70,610 +941,14 @@ def create_relative_alchemical_transformation(system, topology, positions, molec
     topology : system.openmm.Topology
        Topology corresponding to system.
 
-    """
+    Notes
+    -----
+    To transform one molecule into many, create a `RelativeTransformationFactory` once and call `createTransformations`.
 
-    # Copy molecules.
-    molecule1 = oe.OEMol(molecule1)
-    molecule2 = oe.OEMol(molecule2)
-
-    # Normalize molecules.
-    # TODO: May need to do more normalization here.
-    oe.OEPerceiveChiral(molecule1)
-    oe.OEPerceiveChiral(molecule2)
-
-    # Make copies to not destroy original objects.
-    import copy
-    system = copy.deepcopy(system)
-    topology = copy.deepcopy(topology)
-    positions = copy.deepcopy(positions)
-
-    # Create lists of corresponding atoms for common substructure and groups specific to molecules 1 and 2.
-    atomexpr = oe.OEExprOpts_DefaultAtoms
-    bondexpr = oe.OEExprOpts_BondOrder | oe.OEExprOpts_EqSingleDouble | oe.OEExprOpts_EqAromatic
-    mcss = oe.OEMCSSearch(molecule1, atomexpr, bondexpr, oe.OEMCSType_Exhaustive)
-    # This modifies scoring function to prefer keeping cycles complete.
-    mcss.SetMCSFunc( oe.OEMCSMaxAtomsCompleteCycles() )
-    # TODO: Set initial substructure size?
-    # mcss.SetMinAtoms( some_number )
-    # We only need one match.
-    mcss.SetMaxMatches(1)
-    # Determine common atoms in second molecule.
-    matches = [ match for match in mcss.Match(molecule2, True) ]
-    match = matches[0] # we only need the first match
-
-    # Align common substructure of molecule2 with molecule1.
-    overlay = True
-    rmat  = oe.OEDoubleArray(9)
-    trans = oe.OEDoubleArray(3)
-    rms = oe.OERMSD(mcss.GetPattern(), molecule2, match, overlay, rmat, trans)
-    if rms < 0.0:
-        raise Exception("RMS overlay failure")
-    oe.OERotate(molecule2, rmat)
-    oe.OETranslate(molecule2, trans)
-
-    # Make a list of the atoms in common, molecule1 only, and molecule2 only
-    common1 = list() # list of atom indices in molecule1 that also appear in molecule2
-    common2 = list() # list of atom indices in molecule2 that also appear in molecule1
-    unique1 = list() # list of atom indices in molecule1 that DO NOT appear in molecule2
-    unique2 = list() # list of atom indices in molecule2 that DO NOT appear in molecule1
-    mapping1 = dict() # mapping of atoms in molecule1 to molecule2
-    mapping2 = dict() # mapping of atoms in molecule2 to molecule1
-    for matchpair in match.GetAtoms():
-        index1 = matchpair.pattern.GetIdx()
-        index2 = matchpair.target.GetIdx()
-        mapping1[ index1 ] = index2
-        mapping2[ index2 ] = index1
-    all1 = frozenset(range(molecule1.NumAtoms()))
-    all2 = frozenset(range(molecule2.NumAtoms()))
-    common1 = frozenset(mapping1.keys())
-    common2 = frozenset(mapping2.keys())
-    unique1 = all1 - common1
-    unique2 = all2 - common2
-
-    # DEBUG
-    print "list of atoms common to both molecules:"
-    print "molecule1: %s" % str(common1)
-    print "molecule2: %s" % str(common2)
-    print "list of atoms unqiue to individual molecules:"
-    print "molecule1: %s" % str(unique1)
-    print "molecule2: %s" % str(unique2)
-    print "MAPPING FROM MOLECULE1 TO MOLECULE2"
-    for atom1 in mapping1.keys():
-        atom2 = mapping1[atom1]
-        print "%5d => %5d" % (atom1, atom2)
-
-    # Create OpenMM Topology and System objects for given molecules using GAFF/AM1-BCC.
-    # NOTE: This must generate the same forcefield parameters as occur in `system`.
-    [system1, topology1, positions1] = generate_openmm_system(molecule1)
-    [system2, topology2, positions2] = generate_openmm_system(molecule2)
-
-    #
-    # Start building combined OpenMM System object.
-    #
-
-    molecule1_atoms = [ atom for atom in molecule1.GetAtoms() ]
-    molecule2_atoms = [ atom for atom in molecule2.GetAtoms() ]
-
-    molecule2_indices_in_system = dict()
-
-    # Build mapping of common substructure for molecule 2.
-    for atom2 in common2:
-        molecule2_indices_in_system[atom2] = molecule1_indices_in_system[mapping2[atom2]]
-
-    # Find residue for molecule1.
-    residue = None
-    for atom in topology.atoms():
-        if atom.index in molecule1_indices_in_system:
-            residue = atom.residue
-            break
-
-    # Handle additional particles.
-    print "Adding particles from system2..."
-    for atom2 in unique2:
-        atom = molecule2_atoms[atom2]
-        name = atom.GetName()
-        atomic_number = atom.GetAtomicNum()
-        element = app.Element.getByAtomicNumber(atomic_number)
-        mass = system2.getParticleMass(atom2)
-        print [name, element, mass]
-        index = system.addParticle(mass)
-        molecule2_indices_in_system[atom2] = index
-
-        # TODO: Add new atoms to topology object as well.
-        topology.addAtom(name, element, residue)
-
-    # Turn molecule2_indices_in_system into list
-    molecule2_indices_in_system = [ molecule2_indices_in_system[atom2] for atom2 in range(molecule2.NumAtoms()) ]
-
-    print "Atom mappings into System object"
-    print "molecule1: %s" % str(molecule1_indices_in_system)
-    print "molecule2: %s" % str(molecule2_indices_in_system)
-
-    # Handle constraints.
-    # TODO: What happens if constraints change? Raise Exception then.
-    print "Adding constraints from system2..."
-    for index in range(system2.getNumConstraints()):
-        # Extract constraint distance from system2.
-        [atom2_i, atom2_j, distance] = system.getConstraintParameters(index)
-        # Map atoms from system2 into system.
-        atom_i = molecule2_indices_in_system[atom2_i]
-        atom_j = molecule2_indices_in_system[atom2_j]
-        # Add constraint to system.
-        system.addConstraint(atom_i, atom_j, distance)
-
-    # Create new positions array.
-    natoms = positions.shape[0] + len(unique2) # new number of atoms
-    positions = unit.Quantity(np.resize(positions/positions.unit, [natoms,3]), positions.unit)
-    for atom2 in unique2:
-        (x, y, z) = molecule2.GetCoords(molecule2_atoms[atom2])
-        index = molecule2_indices_in_system[atom2]
-        positions[index,0] = x * unit.angstrom
-        positions[index,1] = y * unit.angstrom
-        positions[index,2] = z * unit.angstrom
-
-    # Build a list of Force objects in system.
-    forces = [ system.getForce(index) for index in range(system.getNumForces()) ]
-    forces1 = { system1.getForce(index).__class__.__name__ : system1.getForce(index) for index in range(system1.getNumForces()) }
-    forces2 = { system2.getForce(index).__class__.__name__ : system2.getForce(index) for index in range(system2.getNumForces()) }
-
-    # Process forces.
-    for force in forces:
-        # Get force name.
-        force_name = force.__class__.__name__
-        force1 = forces1[force_name]
-        force2 = forces2[force_name]
-        print force_name
-        if force_name == 'HarmonicBondForce':
-            #
-            # Process HarmonicBondForce
-            #
-
-            # Create index of bonds in system, system1, and system2.
-            def unique(*args):
-                if args[0] > args[-1]:
-                    return tuple(reversed(args))
-                else:
-                    return tuple(args)
-
-            def index_bonds(force):
-                bonds = dict()
-                for index in range(force.getNumBonds()):
-                    [atom_i, atom_j, length, K] = force.getBondParameters(index)
-                    key = unique(atom_i, atom_j) # unique tuple, possibly in reverse order
-                    bonds[key] = index
-                return bonds
-
-            bonds  = index_bonds(force)   # index of bonds for system
-            bonds1 = index_bonds(force1)  # index of bonds for system1
-            bonds2 = index_bonds(force2)  # index of bonds for system2
-
-            # Find bonds that are unique to each molecule.
-            print "Finding bonds unique to each molecule..."
-            unique_bonds1 = [ bonds1[atoms] for atoms in bonds1 if not set(atoms).issubset(common1) ]
-            unique_bonds2 = [ bonds2[atoms] for atoms in bonds2 if not set(atoms).issubset(common2) ]
-
-            # Build list of bonds shared among all molecules.
-            print "Building a list of shared bonds..."
-            shared_bonds = list()
-            for atoms2 in bonds2:
-                if set(atoms2).issubset(common2):
-                    atoms  = tuple(molecule2_indices_in_system[atom2] for atom2 in atoms2)
-                    atoms1 = tuple(mapping2[atom2] for atom2 in atoms2)
-                    # Find bond index terms.
-                    index  = bonds[unique(*atoms)]
-                    index1 = bonds1[unique(*atoms1)]
-                    index2 = bonds2[unique(*atoms2)]
-                    # Store.
-                    shared_bonds.append( (index, index1, index2) )
-
-            # Add bonds that are unique to molecule2.
-            print "Adding bonds unique to molecule2..."
-            for index2 in unique_bonds2:
-                [atom2_i, atom2_j, length2, K2] = force2.getBondParameters(index2)
-                atom_i = molecule2_indices_in_system[atom2_i]
-                atom_j = molecule2_indices_in_system[atom2_j]
-                force.addBond(atom_i, atom_j, length2, K2)
-
-            # Create a CustomBondForce to handle interpolated bond parameters.
-            print "Creating CustomBondForce..."
-            energy_expression  = '(K/2)*(r-length)^2;'
-            energy_expression += 'K = (1-lambda)*K1 + lambda*K2;' # linearly interpolate spring constant
-            energy_expression += 'length = (1-lambda)*length1 + lambda*length2;' # linearly interpolate bond length
-            custom_force = mm.CustomBondForce(energy_expression)
-            custom_force.addGlobalParameter('lambda', 0.0)
-            custom_force.addPerBondParameter('length1') # molecule1 bond length
-            custom_force.addPerBondParameter('K1') # molecule1 spring constant
-            custom_force.addPerBondParameter('length2') # molecule2 bond length
-            custom_force.addPerBondParameter('K2') # molecule2 spring constant
-            system.addForce(custom_force)
-
-            # Process bonds that are shared by molecule1 and molecule2.
-            print "Translating shared bonds to CustomBondForce..."
-            for (index, index1, index2) in shared_bonds:
-                # Zero out standard bond force.
-                [atom_i, atom_j, length, K] = force.getBondParameters(index)
-                force.setBondParameters(index, atom_i, atom_j, length, K*0.0)
-                # Create interpolated bond parameters.
-                [atom1_i, atom1_j, length1, K1] = force1.getBondParameters(index1)
-                [atom2_i, atom2_j, length2, K2] = force2.getBondParameters(index2)
-                custom_force.addBond(atom_i, atom_j, [length1, K1, length2, K2])
-
-        if force_name == 'HarmonicAngleForce':
-            #
-            # Process HarmonicAngleForce
-            #
-
-            # Create index of angles in system, system1, and system2.
-            def unique(*args):
-                if args[0] > args[-1]:
-                    return tuple(reversed(args))
-                else:
-                    return tuple(args)
-
-            def index_angles(force):
-                angles = dict()
-                for index in range(force.getNumAngles()):
-                    [atom_i, atom_j, atom_k, angle, K] = force.getAngleParameters(index)
-                    key = unique(atom_i, atom_j, atom_k) # unique tuple, possibly in reverse order
-                    angles[key] = index
-                return angles
-
-            angles  = index_angles(force)   # index of angles for system
-            angles1 = index_angles(force1)  # index of angles for system1
-            angles2 = index_angles(force2)  # index of angles for system2
-
-            # Find angles that are unique to each molecule.
-            print "Finding angles unique to each molecule..."
-            unique_angles1 = [ angles1[atoms] for atoms in angles1 if not set(atoms).issubset(common1) ]
-            unique_angles2 = [ angles2[atoms] for atoms in angles2 if not set(atoms).issubset(common2) ]
-
-            # Build list of angles shared among all molecules.
-            print "Building a list of shared angles..."
-            shared_angles = list()
-            for atoms2 in angles2:
-                if set(atoms2).issubset(common2):
-                    atoms  = tuple(molecule2_indices_in_system[atom2] for atom2 in atoms2)
-                    atoms1 = tuple(mapping2[atom2] for atom2 in atoms2)
-                    # Find angle index terms.
-                    index  = angles[unique(*atoms)]
-                    index1 = angles1[unique(*atoms1)]
-                    index2 = angles2[unique(*atoms2)]
-                    # Store.
-                    shared_angles.append( (index, index1, index2) )
-
-            # Add angles that are unique to molecule2.
-            print "Adding angles unique to molecule2..."
-            for index2 in unique_angles2:
-                [atom2_i, atom2_j, atom2_k, theta2, K2] = force2.getAngleParameters(index2)
-                atom_i = molecule2_indices_in_system[atom2_i]
-                atom_j = molecule2_indices_in_system[atom2_j]
-                atom_k = molecule2_indices_in_system[atom2_k]
-                force.addAngle(atom_i, atom_j, atom_k, theta2, K2)
-
-            # Create a CustomAngleForce to handle interpolated angle parameters.
-            print "Creating CustomAngleForce..."
-            energy_expression  = '(K/2)*(theta-theta0)^2;'
-            energy_expression += 'K = (1-lambda)*K_1 + lambda*K_2;' # linearly interpolate spring constant
-            energy_expression += 'theta0 = (1-lambda)*theta0_1 + lambda*theta0_2;' # linearly interpolate equilibrium angle
-            custom_force = mm.CustomAngleForce(energy_expression)
-            custom_force.addGlobalParameter('lambda', 0.0)
-            custom_force.addPerAngleParameter('theta0_1') # molecule1 equilibrium angle
-            custom_force.addPerAngleParameter('K_1') # molecule1 spring constant
-            custom_force.addPerAngleParameter('theta0_2') # molecule2 equilibrium angle
-            custom_force.addPerAngleParameter('K_2') # molecule2 spring constant
-            system.addForce(custom_force)
-
-            # Process angles that are shared by molecule1 and molecule2.
-            print "Translating shared angles to CustomAngleForce..."
-            for (index, index1, index2) in shared_angles:
-                # Zero out standard angle force.
-                [atom_i, atom_j, atom_k, theta0, K] = force.getAngleParameters(index)
-                force.setAngleParameters(index, atom_i, atom_j, atom_k, theta0, K*0.0)
-                # Create interpolated angle parameters.
-                [atom1_i, atom1_j, atom1_k, theta1, K1] = force1.getAngleParameters(index1)
-                [atom2_i, atom2_j, atom2_k, theta2, K2] = force2.getAngleParameters(index2)
-                custom_force.addAngle(atom_i, atom_j, atom_k, [theta1, K1, theta2, K2])
-
-        if force_name == 'PeriodicTorsionForce':
-            #
-            # Process PeriodicTorsionForce
-            # TODO: Match up periodicities and deal with multiple terms per torsion
-            #
-
-            # Create index of torsions in system, system1, and system2.
-            def unique(*args):
-                if args[0] > args[-1]:
-                    return tuple(reversed(args))
-                else:
-                    return tuple(args)
-
-            def index_torsions(force):
-                torsions = dict()
-                for index in range(force.getNumTorsions()):
-                    [atom_i, atom_j, atom_k, atom_l, periodicity, phase, K] = force.getTorsionParameters(index)
-                    key = unique(atom_i, atom_j, atom_k, atom_l) # unique tuple, possibly in reverse order
-                    torsions[key] = index
-                return torsions
-
-            torsions  = index_torsions(force)   # index of torsions for system
-            torsions1 = index_torsions(force1)  # index of torsions for system1
-            torsions2 = index_torsions(force2)  # index of torsions for system2
-
-            # Find torsions that are unique to each molecule.
-            print "Finding torsions unique to each molecule..."
-            unique_torsions1 = [ torsions1[atoms] for atoms in torsions1 if not set(atoms).issubset(common1) ]
-            unique_torsions2 = [ torsions2[atoms] for atoms in torsions2 if not set(atoms).issubset(common2) ]
-
-            # Build list of torsions shared among all molecules.
-            print "Building a list of shared torsions..."
-            shared_torsions = list()
-            for atoms2 in torsions2:
-                if set(atoms2).issubset(common2):
-                    atoms  = tuple(molecule2_indices_in_system[atom2] for atom2 in atoms2)
-                    atoms1 = tuple(mapping2[atom2] for atom2 in atoms2)
-                    # Find torsion index terms.
-                    try:
-                        index  = torsions[unique(*atoms)]
-                        index1 = torsions1[unique(*atoms1)]
-                        index2 = torsions2[unique(*atoms2)]
-                    except Exception as e:
-                        print e
-                        print "torsions :  %s" % str(unique(*atoms))
-                        print "torsions1:  %s" % str(unique(*atoms1))
-                        print "torsions2:  %s" % str(unique(*atoms2))
-                        raise Exception("Error occurred in building a list of torsions common to all molecules.")
-
-                    # Store.
-                    shared_torsions.append( (index, index1, index2) )
-
-            # Add torsions that are unique to molecule2.
-            print "Adding torsions unique to molecule2..."
-            for index2 in unique_torsions2:
-                [atom2_i, atom2_j, atom2_k, atom2_l, periodicity2, phase2, K2] = force2.getTorsionParameters(index2)
-                atom_i = molecule2_indices_in_system[atom2_i]
-                atom_j = molecule2_indices_in_system[atom2_j]
-                atom_k = molecule2_indices_in_system[atom2_k]
-                atom_l = molecule2_indices_in_system[atom2_l]
-                force.addTorsion(atom_i, atom_j, atom_k, atom_l, periodicity2, phase2, K2)
-
-            # Create a CustomTorsionForce to handle interpolated torsion parameters.
-            print "Creating CustomTorsionForce..."
-            energy_expression  = '(1-lambda)*U1 + lambda*U2;'
-            energy_expression += 'U1 = K1*(1+cos(periodicity1*theta-phase1));'
-            energy_expression += 'U2 = K2*(1+cos(periodicity2*theta-phase2));'
-            custom_force = mm.CustomTorsionForce(energy_expression)
-            custom_force.addGlobalParameter('lambda', 0.0)
-            custom_force.addPerTorsionParameter('periodicity1') # molecule1 periodicity
-            custom_force.addPerTorsionParameter('phase1') # molecule1 phase
-            custom_force.addPerTorsionParameter('K1') # molecule1 spring constant
-            custom_force.addPerTorsionParameter('periodicity2') # molecule2 periodicity
-            custom_force.addPerTorsionParameter('phase2') # molecule2 phase
-            custom_force.addPerTorsionParameter('K2') # molecule2 spring constant
-            system.addForce(custom_force)
-
-            # Process torsions that are shared by molecule1 and molecule2.
-            print "Translating shared torsions to CustomTorsionForce..."
-            for (index, index1, index2) in shared_torsions:
-                # Zero out standard torsion force.
-                [atom_i, atom_j, atom_k, atom_l, periodicity, phase, K] = force.getTorsionParameters(index)
-                force.setTorsionParameters(index, atom_i, atom_j, atom_k, atom_l, periodicity, phase, K*0.0)
-                # Create interpolated torsion parameters.
-                [atom1_i, atom1_j, atom1_k, atom1_l, periodicity1, phase1, K1] = force1.getTorsionParameters(index1)
-                [atom2_i, atom2_j, atom2_k, atom2_l, periodicity2, phase2, K2] = force2.getTorsionParameters(index2)
-                custom_force.addTorsion(atom_i, atom_j, atom_k, atom_l, [periodicity1, phase1, K1, periodicity2, phase2, K2])
-
-        if force_name == 'NonbondedForce':
-            #
-            # Process NonbondedForce
-            #
-
-            # Add nonbonded entries for molecule2 to ensure total number of particle entries is correct.
-            for atom in unique2:
-                [charge, sigma, epsilon] = force2.getParticleParameters(atom)
-                force.addParticle(charge, sigma, epsilon)
-
-            # Zero out nonbonded entries for molecule1.
-            for atom in molecule1_indices_in_system:
-                [charge, sigma, epsilon] = force.getParticleParameters(atom)
-                force.setParticleParameters(atom, 0*charge, sigma, 0*epsilon)
-            # Zero out nonbonded entries for molecule2.
-            for atom in molecule2_indices_in_system:
-                [charge, sigma, epsilon] = force.getParticleParameters(atom)
-                force.setParticleParameters(atom, 0*charge, sigma, 0*epsilon)
-
-            # Create index of exceptions in system, system1, and system2.
-            def unique(*args):
-                if args[0] > args[-1]:
-                    return tuple(reversed(args))
-                else:
-                    return tuple(args)
-
-            def index_exceptions(force):
-                exceptions = dict()
-                for index in range(force.getNumExceptions()):
-                    [atom_i, atom_j, chargeProd, sigma, epsilon] = force.getExceptionParameters(index)
-                    key = unique(atom_i, atom_j) # unique tuple, possibly in reverse order
-                    exceptions[key] = index
-                return exceptions
-
-            exceptions  = index_exceptions(force)   # index of exceptions for system
-            exceptions1 = index_exceptions(force1)  # index of exceptions for system1
-            exceptions2 = index_exceptions(force2)  # index of exceptions for system2
-
-            # Find exceptions that are unique to each molecule.
-            print "Finding exceptions unique to each molecule..."
-            unique_exceptions1 = [ exceptions1[atoms] for atoms in exceptions1 if not set(atoms).issubset(common1) ]
-            unique_exceptions2 = [ exceptions2[atoms] for atoms in exceptions2 if not set(atoms).issubset(common2) ]
-
-            # Build list of exceptions shared among all molecules.
-            print "Building a list of shared exceptions..."
-            shared_exceptions = list()
-            for atoms2 in exceptions2:
-                if set(atoms2).issubset(common2):
-                    atoms  = tuple(molecule2_indices_in_system[atom2] for atom2 in atoms2)
-                    atoms1 = tuple(mapping2[atom2] for atom2 in atoms2)
-                    # Find exception index terms.
-                    index  = exceptions[unique(*atoms)]
-                    index1 = exceptions1[unique(*atoms1)]
-                    index2 = exceptions2[unique(*atoms2)]
-                    # Store.
-                    shared_exceptions.append( (index, index1, index2) )
-
-            # Add exceptions that are unique to molecule2.
-            print "Adding exceptions unique to molecule2..."
-            for index2 in unique_exceptions2:
-                [atom2_i, atom2_j, chargeProd, sigma, epsilon] = force2.getExceptionParameters(index2)
-                atom_i = molecule2_indices_in_system[atom2_i]
-                atom_j = molecule2_indices_in_system[atom2_j]
-                force.addException(atom_i, atom_j, chargeProd, sigma, epsilon)
-
-            # Create list of alchemically modified atoms in system.
-            alchemical_atom_indices = list(set(molecule1_indices_in_system).union(set(molecule2_indices_in_system)))
-
-            # Create atom groups.
-            natoms = system.getNumParticles()
-            atomset1 = set(alchemical_atom_indices) # only alchemically-modified atoms
-            atomset2 = set(range(system.getNumParticles())) # all atoms, including alchemical region
-
-            # CustomNonbondedForce energy expression.
-            sterics_energy_expression = ""
-            electrostatics_energy_expression = ""
-
-            # Create a CustomNonbondedForce to handle alchemically interpolated nonbonded parameters.
-            # Select functional form based on nonbonded method.
-            method = force.getNonbondedMethod()
-            if method in [mm.NonbondedForce.NoCutoff]:
-                # soft-core Lennard-Jones
-                sterics_energy_expression += "U_sterics = 4*epsilon*x*(x-1.0); x1 = (sigma/reff_sterics)^6;"
-                # soft-core Coulomb
-                electrostatics_energy_expression += "U_electrostatics = ONE_4PI_EPS0*chargeprod/reff_electrostatics;"
-            elif method in [mm.NonbondedForce.CutoffPeriodic, mm.NonbondedForce.CutoffNonPeriodic]:
-                # soft-core Lennard-Jones
-                sterics_energy_expression += "U_sterics = 4*epsilon*x*(x-1.0); x = (sigma/reff_sterics)^6;"
-                # reaction-field electrostatics
-                epsilon_solvent = force.getReactionFieldDielectric()
-                r_cutoff = force.getCutoffDistance()
-                electrostatics_energy_expression += "U_electrostatics = ONE_4PI_EPS0*chargeprod*(reff_electrostatics^(-1) + k_rf*reff_electrostatics^2 - c_rf);"
-                k_rf = r_cutoff**(-3) * ((epsilon_solvent - 1) / (2*epsilon_solvent + 1))
-                c_rf = r_cutoff**(-1) * ((3*epsilon_solvent) / (2*epsilon_solvent + 1))
-                electrostatics_energy_expression += "k_rf = %f;" % (k_rf / k_rf.in_unit_system(unit.md_unit_system).unit)
-                electrostatics_energy_expression += "c_rf = %f;" % (c_rf / c_rf.in_unit_system(unit.md_unit_system).unit)
-            elif method in [mm.NonbondedForce.PME, mm.NonbondedForce.Ewald]:
-                # soft-core Lennard-Jones
-                sterics_energy_expression += "U_sterics = 4*epsilon*x*(x-1.0); x = (sigma/reff_sterics)^6;"
-                # Ewald direct-space electrostatics
-                [alpha_ewald, nx, ny, nz] = force.getPMEParameters()
-                if alpha_ewald == 0.0:
-                    # If alpha is 0.0, alpha_ewald is computed by OpenMM from from the error tolerance.
-                    delta = force.getEwaldErrorTolerance()
-                    r_cutoff = force.getCutoffDistance()
-                    alpha_ewald = np.sqrt(-np.log(2*delta)) / r_cutoff
-                electrostatics_energy_expression += "U_electrostatics = ONE_4PI_EPS0*chargeprod*erfc(alpha_ewald*reff_electrostatics)/reff_electrostatics;"
-                electrostatics_energy_expression += "alpha_ewald = %f;" % (alpha_ewald / alpha_ewald.in_unit_system(unit.md_unit_system).unit)
-                # TODO: Handle reciprocal-space electrostatics
-            else:
-                raise Exception("Nonbonded method %s not supported yet." % str(method))
-
-            # Add additional definitions common to all methods.
-            sterics_energy_expression += "epsilon = (1-lambda)*epsilonA + lambda*epsilonB;" #interpolation
-            sterics_energy_expression += "reff_sterics = sigma*((softcore_alpha*lambda_alpha + (r/sigma)^6))^(1/6);" # effective softcore distance for sterics
-            sterics_energy_expression += "softcore_alpha = %f;" % softcore_alpha
-            # TODO: We may have to ensure that softcore_degree is 1 if we are close to an alchemically-eliminated endpoint.
-            sterics_energy_expression += "lambda_alpha = lambda*(1-lambda);"
-            electrostatics_energy_expression += "chargeProd = (1-lambda)*chargeProdA + lambda*chargeProdB;" #interpolation
-            electrostatics_energy_expression += "reff_electrostatics = sqrt(softcore_beta*lambda_beta + r^2);" # effective softcore distance for electrostatics
-            electrostatics_energy_expression += "softcore_beta = %f;" % (softcore_beta / softcore_beta.in_unit_system(unit.md_unit_system).unit)
-            electrostatics_energy_expression += "ONE_4PI_EPS0 = %f;" % ONE_4PI_EPS0 # already in OpenMM units
-            # TODO: We may have to ensure that softcore_degree is 1 if we are close to an alchemically-eliminated endpoint.
-            sterics_energy_expression += "lambda_beta = lambda*(1-lambda);"
-
-            # Define mixing rules.
-            sterics_mixing_rules = ""
-            sterics_mixing_rules += "epsilonA = sqrt(epsilonA1*epsilonA2);" # mixing rule for epsilon
-            sterics_mixing_rules += "epsilonB = sqrt(epsilonB1*epsilonB2);" # mixing rule for epsilon
-            sterics_mixing_rules += "sigmaA = 0.5*(sigmaA1 + sigmaA2);" # mixing rule for sigma
-            sterics_mixing_rules += "sigmaB = 0.5*(sigmaB1 + sigmaB2);" # mixing rule for sigma
-            electrostatics_mixing_rules = ""
-            electrostatics_mixing_rules += "chargeprodA = chargeA1*chargeA2;" # mixing rule for charges
-            electrostatics_mixing_rules += "chargeprodB = chargeB1*chargeB2;" # mixing rule for charges
-
-            # Create CustomNonbondedForce to handle interactions between alchemically-modified atoms and rest of system.
-            electrostatics_custom_nonbonded_force = mm.CustomNonbondedForce("U_electrostatics;" + electrostatics_energy_expression + electrostatics_mixing_rules)
-            electrostatics_custom_nonbonded_force.addGlobalParameter("lambda", 0.0);
-            electrostatics_custom_nonbonded_force.addPerParticleParameter("chargeA") # partial charge initial
-            electrostatics_custom_nonbonded_force.addPerParticleParameter("chargeB") # partial charge final
-            sterics_custom_nonbonded_force = mm.CustomNonbondedForce("U_sterics;" + sterics_energy_expression + sterics_mixing_rules)
-            sterics_custom_nonbonded_force.addGlobalParameter("lambda", 0.0);
-            sterics_custom_nonbonded_force.addPerParticleParameter("sigmaA") # Lennard-Jones sigma initial
-            sterics_custom_nonbonded_force.addPerParticleParameter("epsilonA") # Lennard-Jones epsilon initial
-            sterics_custom_nonbonded_force.addPerParticleParameter("sigmaB") # Lennard-Jones sigma final
-            sterics_custom_nonbonded_force.addPerParticleParameter("epsilonB") # Lennard-Jones epsilon final
-
-            # Restrict interaction evaluation to be between alchemical atoms and rest of environment.
-            # TODO: Exclude intra-alchemical region if we are separately handling that through a separate CustomNonbondedForce for decoupling.
-            sterics_custom_nonbonded_force.addInteractionGroup(atomset1, atomset2)
-            electrostatics_custom_nonbonded_force.addInteractionGroup(atomset1, atomset2)
-
-            # Add exclusions between unique parts of molecule1 and molecule2 so they do not interact.
-            print "Add exclusions between unique parts of molecule1 and molecule2 that should not interact..."
-            for atom1_i in unique1:
-                for atom2_j in unique2:
-                    atom_i = molecule1_indices_in_system[atom1_i]
-                    atom_j = molecule2_indices_in_system[atom2_j]
-                    electrostatics_custom_nonbonded_force.addExclusion(atom_i, atom_j)
-                    sterics_custom_nonbonded_force.addExclusion(atom_i, atom_j)
-
-            # Add custom forces to system.
-            system.addForce(sterics_custom_nonbonded_force)
-            system.addForce(electrostatics_custom_nonbonded_force)
-
-            # Create CustomBondForce to handle exceptions for both kinds of interactions.
-            #custom_bond_force = mm.CustomBondForce("U_sterics + U_electrostatics;" + sterics_energy_expression + electrostatics_energy_expression)
-            #custom_bond_force.addGlobalParameter("lambda", 0.0);
-            #custom_bond_force.addPerBondParameter("chargeprodA") # charge product
-            #custom_bond_force.addPerBondParameter("sigmaA") # Lennard-Jones effective sigma
-            #custom_bond_force.addPerBondParameter("epsilonA") # Lennard-Jones effective epsilon
-            #custom_bond_force.addPerBondParameter("chargeprodB") # charge product
-            #custom_bond_force.addPerBondParameter("sigmaB") # Lennard-Jones effective sigma
-            #custom_bond_force.addPerBondParameter("epsilonB") # Lennard-Jones effective epsilon
-            #system.addForce(custom_bond_force)
-
-            # Copy over all Nonbonded parameters for normal atoms to Custom*Force objects.
-            for particle_index in range(force.getNumParticles()):
-                # Retrieve parameters.
-                [charge, sigma, epsilon] = force.getParticleParameters(particle_index)
-                # Add parameters to custom force handling interactions between alchemically-modified atoms and rest of system.
-                sterics_custom_nonbonded_force.addParticle([sigma, epsilon, sigma, epsilon])
-                electrostatics_custom_nonbonded_force.addParticle([charge, charge])
-
-            # Copy over parameters for common substructure.
-            for atom1 in common1:
-                atom2 = mapping1[atom1] # index into system2
-                index = molecule1_indices_in_system[atom1] # index into system
-                [charge1, sigma1, epsilon1] = force1.getParticleParameters(atom1)
-                [charge2, sigma2, epsilon2] = force2.getParticleParameters(atom2)
-                sterics_custom_nonbonded_force.setParticleParameters(index, [sigma1, epsilon1, sigma2, epsilon2])
-                electrostatics_custom_nonbonded_force.setParticleParameters(index, [charge1, charge2])
-
-            # Copy over parameters for molecule1 unique atoms.
-            for atom1 in unique1:
-                index = molecule1_indices_in_system[atom1] # index into system
-                [charge1, sigma1, epsilon1] = force1.getParticleParameters(atom1)
-                sterics_custom_nonbonded_force.setParticleParameters(index, [sigma1, epsilon1, sigma1, 0*epsilon1])
-                electrostatics_custom_nonbonded_force.setParticleParameters(index, [charge1, 0*charge1])
-
-            # Copy over parameters for molecule2 unique atoms.
-            for atom2 in unique2:
-                index = molecule2_indices_in_system[atom2] # index into system
-                [charge2, sigma2, epsilon2] = force2.getParticleParameters(atom2)
-                sterics_custom_nonbonded_force.setParticleParameters(index, [sigma2, 0*epsilon2, sigma2, epsilon2])
-                electrostatics_custom_nonbonded_force.setParticleParameters(index, [0*charge2, charge2])
-
-        else:
-            #raise Exception("Force type %s unknown." % force_name)
-            pass
-
-    return [system, topology, positions]
+    """
+    factory = RelativeTransformationFactory(system, topology, positions, molecule1_indices_in_system, molecule1, mapping_store=mapping_store,
+                                            prefilter=prefilter, mcss_searcher=mcss_searcher)
+    return factory.createTransformation(molecule2, softcore_alpha=softcore_alpha, softcore_beta=softcore_beta, verbose=True)
 
 if __name__ == '__main__':
     # Create two test molecules.
@@ -704,24 +979,22 @@ if __name__ == '__main__':
     temperature = 300.0 * unit.kelvin
     collision_rate = 20.0 / unit.picoseconds
     timestep = 1.0 * unit.femtoseconds
-    integrator = mm.LangevinIntegrator(temperature, collision_rate, timestep)
-    context = mm.Context(system, integrator)
-    context.setPositions(positions)
     niterations = 100
-    filename = 'trajectory.pdb'
+
+    # Space lambda values evenly in thermodynamic length, reusing pilot statistics from earlier runs.
+    optimizer = LambdaScheduleOptimizer(system, positions, temperature, parameter='lambda', cache=LambdaScheduleCache('lambda-schedules'))
+    lambda_values = optimizer.getSchedule(niterations, verbose=True)[::-1]
+
+    # Run the protocol, resuming from 'run.checkpoint' if a previous run was interrupted.
+    filename = 'trajectory.dcd'
     print "Writing out trajectory to %s ..." % filename
-    outfile = open(filename, 'w')
-    app.PDBFile.writeHeader(topology, file=outfile)
-    for iteration in range(niterations):
-        lambda_value = 1.0 - float(iteration) / float(niterations - 1)
-        context.setParameter('lambda', lambda_value)
-        integrator.step(100)
-        state = context.getState(getPositions=True, getEnergy=True)
-        print "Iteration %5d / %5d : lambda %8.5f : potential %8.3f kcal/mol" % (iteration, niterations, lambda_value, state.getPotentialEnergy() / unit.kilocalories_per_mole)
-        positions = state.getPositions()
-        app.PDBFile.writeModel(topology, positions, file=outfile, modelIndex=(iteration+1))
-    app.PDBFile.writeFooter(topology, file=outfile)
-    outfile.close()
-    del context, integrator
+    runner = AlchemicalRunner(system, positions, lambda_values, 'run.checkpoint', parameter='lambda', nsteps_per_iteration=100,
+                              checkpoint_interval=10, temperature=temperature, collision_rate=collision_rate, timestep=timestep,
+                              topology=topology, trajectory_filename=filename, energy_directory='energies', report_stride=10)
+    runner.run()
+    runner.close()
+    energies = load_energy_store('energies')
+    for (iteration, lambda_value, potential_energy) in zip(energies['iteration'], energies['lambda'], energies['potential_energy']):
+        print "Iteration %5d / %5d : lambda %8.5f : potential %8.3f kcal/mol" % (iteration, niterations, lambda_value, potential_energy * unit.kilojoules_per_mole / unit.kilocalories_per_mole)
 
 
@@ -3,17 +3,22 @@ import numpy as np
 from openmoltools import openeye
 import os
 import cirpy
+from examol.mcss import get_default_mcss_searcher
 
 class DualTopology(object):
     """
     Intended to aid in the creation of dual topologies and corresponding forcefields
 
     Constructor:
-      DualTopology(cas_or_aa, min_atoms=6) 
+      DualTopology(cas_or_aa, min_atoms=6, prefilter=None, mcss_searcher=None) 
         Arguments:
           cas_or_aa (list of strings) molecules identified by cas number, or amino acid by name to combine into dual topology
         Optional:
           min_atoms (int) the minimum number of common atoms to constitute a substructure match (default: 6)
+          prefilter (examol.fingerprints.FingerprintFilter) routes dissimilar pairs to the approximate MCSS search, or
+            rejects them, before any exhaustive search (default: None, every search is exhaustive)
+          mcss_searcher (examol.mcss.MCSSSearcher) bounds the time of each exhaustive MCSS search, falling back to the
+            approximate search, and records mode, time and match size of every search (default: None, the default searcher)
 
     Currently has the ability to determine a common substructure, and build a v0.2 dual topology containing
     correct atom types and bonds in one lump (no N1 N2 differentiation).
@@ -48,6 +53,10 @@ class DualTopology(object):
         used as an identifier for input group of molecules
       self.min_atoms (int) 
         minimum number of common atoms to constitute a substructure match (default: 6)
+      self.prefilter (FingerprintFilter) 
+        fingerprint pre-filter choosing the MCSS search type for each pair, or None
+      self.mcss_searcher (MCSSSearcher) 
+        time-bounded MCSS searcher recording statistics of every search
       self.common_substructure (OEMol) 
         openeye molecule representing the common substructure
       self.dual_topology (OEMol) 
@@ -70,7 +79,7 @@ class DualTopology(object):
       cirpy (just copy it into here) (also probably won't need it at all with normal inputs from a system)
     """
 
-    def __init__(self, cas_or_aa, min_atoms=6):
+    def __init__(self, cas_or_aa, min_atoms=6, prefilter=None, mcss_searcher=None):
         """
         Initialize using cas numbers OR amino acid name
         Requires openmoltools.openeye and cirpy
@@ -80,6 +89,8 @@ class DualTopology(object):
 
         Optional Arguments
             min_atoms (int) - a minimum number of atoms for substructure match (default: 6)
+            prefilter (FingerprintFilter) - fingerprint pre-filter choosing the MCSS search type for each pair (default: None)
+            mcss_searcher (MCSSSearcher) - time-bounded MCSS searcher recording statistics of every search (default: None, the default searcher)
 
         Creates class variables:
             self.cas_or_aa (list of strings) 
@@ -92,6 +103,10 @@ class DualTopology(object):
               used as an identifier for input group of molecules
             self.min_atoms (int) 
               minimum number of common atoms to constitute a substructure match (default: 6)
+            self.prefilter (FingerprintFilter) 
+              fingerprint pre-filter choosing the MCSS search type for each pair, or None
+            self.mcss_searcher (MCSSSearcher) 
+              time-bounded MCSS searcher recording statistics of every search
 
         """
 
@@ -106,6 +121,10 @@ class DualTopology(object):
             self.ligands.append(ligand)
         self.title = self.cas_or_aa[0]+"_and_analogs"
         self.min_atoms = min_atoms
+        self.prefilter = prefilter
+        if mcss_searcher is None:
+            mcss_searcher = get_default_mcss_searcher()
+        self.mcss_searcher = mcss_searcher
         self.common_substructure = None
         self.dual_topology = None
         self.each_molecule_N = []
@@ -142,12 +161,13 @@ class DualTopology(object):
 
         # Now delete bits that don't match every other ligand.
         for ligand in ligands[1:]:
-        
-            # Create an OEMCSSearch from this molecule.
-            mcss = oechem.OEMCSSearch(ligand, atomexpr, bondexpr, oechem.OEMCSType_Exhaustive)
 
-            # ignore substructures smaller than 6 atoms
-            mcss.SetMinAtoms(min_atoms)
+            # choose the search type from fingerprint similarity, if a pre-filter was given
+            mcss_type = self._getSearchType(ligand, common_substructure)
+
+            # Create a time-bounded MCSS search from this molecule, ignoring substructures smaller than 6 atoms;
+            # an exhaustive search that runs out of time falls back to the approximate search
+            mcss = self.mcss_searcher.createSearch(ligand, atomexpr, bondexpr, mcss_type=mcss_type, min_atoms=min_atoms)
 
             # perform match
             for match in mcss.Match(common_substructure):
@@ -219,10 +239,9 @@ class DualTopology(object):
         # aromaticity value
         bondexpr = oechem.OEExprOpts_DefaultBonds
 
-        # Create a new OEMCSSearch object, using the common substructure as the pattern molecule
+        # Create a new time-bounded MCSS search, using the common substructure as the pattern molecule
         # all atoms that don't match will be unique to that ligand
-        mcss = oechem.OEMCSSearch(common_substructure, atomexpr, bondexpr, oechem.OEMCSType_Exhaustive)
-        mcss.SetMinAtoms(min_atoms)
+        mcss = self.mcss_searcher.createSearch(common_substructure, atomexpr, bondexpr, mcss_type=oechem.OEMCSType_Exhaustive, min_atoms=min_atoms)
 
         # Create intermediate dictionary to translate from atoms in the common substructure to the new 
         # dual topology
@@ -243,9 +262,12 @@ class DualTopology(object):
             old_index = new_index
             # start a new mapping dictionary between this ligand and the dual topology
             ligand_to_dual = {}
+
+            # choose the search type from fingerprint similarity, if a pre-filter was given
+            mcss_type = self._getSearchType(common_substructure, ligand)
              
             # perform match
-            for match in mcss.Match(ligand):
+            for match in mcss.Match(ligand, mcss_type=mcss_type):
                 nmatched = match.NumAtoms()
             
                 # build list of matched atoms in common substructure
@@ -286,6 +308,29 @@ class DualTopology(object):
         # return the common substructure
         self.dual_topology = dual_topology
 
+    def _getSearchType(self, pattern, target):
+        """
+        Choose the MCSS search type for a pair of molecules using self.prefilter
+
+        Arguments
+            pattern (OEMol) - the pattern molecule of the search
+            target (OEMol) - the target molecule of the search
+
+        Returns
+            oechem.OEMCSType_Exhaustive if there is no pre-filter or the pair is similar enough,
+            otherwise oechem.OEMCSType_Approximate
+
+        Raises an Exception if the pre-filter rejects the pair
+
+        """
+        if self.prefilter is None:
+            return oechem.OEMCSType_Exhaustive
+        mcss_type = self.prefilter.getSearchType(pattern, target)
+        if mcss_type is None:
+            raise Exception("%s was rejected by the fingerprint pre-filter: similarity %.3f is below %.3f" %
+                            (target.GetTitle(), self.prefilter.getSimilarity(pattern, target), self.prefilter.reject_threshold))
+        return mcss_type
+
     def savePDBandFFXML(self, pdb_filename=None, ffxml_filename=None):
         """
         Creates a .pdb file representative of the dual topology and a corresponding .xml file.
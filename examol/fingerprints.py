@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Fingerprint similarity pre-filter for MCSS searches.
+
+Exhaustive MCSS searches (`OEMCSType_Exhaustive`) can take minutes on large, flexible or dissimilar pairs of
+molecules.  `FingerprintFilter` computes a path, circular or tree fingerprint once per molecule, stores it as a packed
+NumPy bit array, and computes Tanimoto similarities with vectorized popcounts.  Before a search, the similarity of the
+pair decides whether the exhaustive search runs, whether the approximate search (`OEMCSType_Approximate`) runs instead,
+or whether the pair is rejected without searching.
+
+Example
+-------
+
+>>> prefilter = FingerprintFilter(fptype='circular', exhaustive_threshold=0.3, reject_threshold=0.1)
+>>> prefilter.addMolecules(ligands)
+>>> similarities = prefilter.getSimilarities(ligands)
+>>> mcss_type = prefilter.getSearchType(ligands[0], ligands[1]) # None if the pair is rejected
+>>> (prefilter.nexhaustive, prefilter.napproximate, prefilter.nrejected)
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import openeye.oechem as oe
+import openeye.oegraphsim as oegraphsim
+import numpy as np
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+POPCOUNTS = np.array([ bin(byte).count('1') for byte in range(256) ], np.uint8) # number of set bits in each byte value
+
+BLOCK_SIZE = 64 # rows of fingerprints compared at once in get_tanimoto_similarities, to bound temporary memory
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def make_fingerprint(molecule, fptype='circular', nbits=2048):
+    """
+    Compute the fingerprint of a molecule as a packed bit array.
+
+    Parameters
+    ----------
+    molecule : openeye.oechem.OEMol
+        The molecule.
+    fptype : str, optional, default='circular'
+        'path' (paths of 0-5 bonds), 'circular' (radius 0-2) or 'tree' (trees of 0-4 bonds), with OEGraphSim default atom and bond types.
+    nbits : int, optional, default=2048
+        The length of the fingerprint; must be a multiple of 8.
+
+    Returns
+    -------
+    fingerprint : numpy.ndarray of uint8, shape (nbits/8,)
+        The fingerprint bits, packed with numpy.packbits.
+
+    """
+    fp = oegraphsim.OEFingerPrint()
+    if fptype == 'path':
+        oegraphsim.OEMakePathFP(fp, molecule, nbits, 0, 5, oegraphsim.OEFPAtomType_DefaultPathAtom, oegraphsim.OEFPBondType_DefaultPathBond)
+    elif fptype == 'circular':
+        oegraphsim.OEMakeCircularFP(fp, molecule, nbits, 0, 2, oegraphsim.OEFPAtomType_DefaultCircularAtom, oegraphsim.OEFPBondType_DefaultCircularBond)
+    elif fptype == 'tree':
+        oegraphsim.OEMakeTreeFP(fp, molecule, nbits, 0, 4, oegraphsim.OEFPAtomType_DefaultTreeAtom, oegraphsim.OEFPBondType_DefaultTreeBond)
+    else:
+        raise Exception("Fingerprint type '%s' unknown; must be 'path', 'circular' or 'tree'." % fptype)
+    bits = np.array([ fp.IsBitOn(bit) for bit in range(nbits) ], np.bool_)
+    return np.packbits(bits)
+
+def get_tanimoto_similarities(fingerprints1, fingerprints2=None):
+    """
+    Compute the Tanimoto similarities of packed fingerprints.
+
+    Parameters
+    ----------
+    fingerprints1 : numpy.ndarray of uint8, shape (n1, nbytes)
+        Packed fingerprints.
+    fingerprints2 : numpy.ndarray of uint8, shape (n2, nbytes), optional, default=None
+        Packed fingerprints to compare against; fingerprints1 if None.
+
+    Returns
+    -------
+    similarities : numpy.ndarray of float, shape (n1, n2)
+        Tanimoto similarities; 1.0 for two empty fingerprints.
+
+    """
+    fingerprints1 = np.atleast_2d(fingerprints1)
+    fingerprints2 = fingerprints1 if (fingerprints2 is None) else np.atleast_2d(fingerprints2)
+    counts1 = POPCOUNTS[fingerprints1].sum(axis=1, dtype=np.int64)
+    counts2 = POPCOUNTS[fingerprints2].sum(axis=1, dtype=np.int64)
+
+    similarities = np.ones([fingerprints1.shape[0], fingerprints2.shape[0]], np.float64)
+    for start in range(0, fingerprints1.shape[0], BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, fingerprints1.shape[0])
+        intersections = POPCOUNTS[fingerprints1[start:stop,np.newaxis,:] & fingerprints2[np.newaxis,:,:]].sum(axis=2, dtype=np.int64)
+        unions = counts1[start:stop,np.newaxis] + counts2[np.newaxis,:] - intersections
+        nonempty = (unions > 0)
+        similarities[start:stop][nonempty] = intersections[nonempty] / unions[nonempty].astype(np.float64)
+    return similarities
+
+################################################################################
+# FINGERPRINT FILTER
+################################################################################
+
+class FingerprintFilter(object):
+    """\
+    Route MCSS searches by fingerprint similarity: exhaustive for similar pairs, approximate or rejected for dissimilar ones.
+
+    """
+    def __init__(self, fptype='circular', nbits=2048, exhaustive_threshold=0.3, reject_threshold=None):
+        """\
+        Create a fingerprint filter.
+
+        Parameters
+        ----------
+        fptype : str, optional, default='circular'
+            The fingerprint type; see `make_fingerprint`.
+        nbits : int, optional, default=2048
+            The length of the fingerprints.
+        exhaustive_threshold : float, optional, default=0.3
+            Pairs with at least this Tanimoto similarity are searched exhaustively; less similar pairs use the approximate search.
+        reject_threshold : float, optional, default=None
+            If specified, pairs with less than this Tanimoto similarity are rejected without searching.
+
+        """
+        self.fptype = fptype
+        self.nbits = nbits
+        self.exhaustive_threshold = exhaustive_threshold
+        self.reject_threshold = reject_threshold
+
+        # Packed fingerprints keyed by canonical isomeric SMILES, since fingerprints depend only on the molecular graph.
+        self._fingerprints = dict()
+
+        # Routing statistics.
+        self.nexhaustive = 0
+        self.napproximate = 0
+        self.nrejected = 0
+
+        return
+
+    def getFingerprint(self, molecule):
+        """\
+        Return the packed fingerprint of a molecule, computing it if necessary.
+
+        """
+        key = oe.OECreateIsoSmiString(molecule)
+        if key not in self._fingerprints:
+            self._fingerprints[key] = make_fingerprint(molecule, fptype=self.fptype, nbits=self.nbits)
+        return self._fingerprints[key]
+
+    def addMolecules(self, molecules):
+        """\
+        Compute the fingerprints of several molecules.
+
+        Parameters
+        ----------
+        molecules : list of openeye.oechem.OEMol
+            The molecules.
+
+        Returns
+        -------
+        fingerprints : numpy.ndarray of uint8, shape (nmolecules, nbits/8)
+            The packed fingerprints, one row per molecule.
+
+        """
+        return np.array([ self.getFingerprint(molecule) for molecule in molecules ], np.uint8).reshape([len(molecules), self.nbits // 8])
+
+    def getSimilarity(self, molecule1, molecule2):
+        """\
+        Return the Tanimoto similarity of two molecules.
+
+        """
+        return get_tanimoto_similarities(self.getFingerprint(molecule1), self.getFingerprint(molecule2))[0,0]
+
+    def getSimilarities(self, molecules1, molecules2=None):
+        """\
+        Return the Tanimoto similarities of every molecule in molecules1 with every molecule in molecules2 (molecules1 if None).
+
+        """
+        fingerprints1 = self.addMolecules(molecules1)
+        fingerprints2 = None if (molecules2 is None) else self.addMolecules(molecules2)
+        return get_tanimoto_similarities(fingerprints1, fingerprints2)
+
+    def getSearchType(self, molecule1, molecule2):
+        """\
+        Choose how to search for the common substructure of two molecules.
+
+        Parameters
+        ----------
+        molecule1 : openeye.oechem.OEMol
+            The pattern molecule.
+        molecule2 : openeye.oechem.OEMol
+            The target molecule.
+
+        Returns
+        -------
+        mcss_type : int or None
+            oechem.OEMCSType_Exhaustive or oechem.OEMCSType_Approximate, or None if the pair is rejected.
+
+        """
+        similarity = self.getSimilarity(molecule1, molecule2)
+        if (self.reject_threshold is not None) and (similarity < self.reject_threshold):
+            self.nrejected += 1
+            return None
+        if similarity < self.exhaustive_threshold:
+            self.napproximate += 1
+            return oe.OEMCSType_Approximate
+        self.nexhaustive += 1
+        return oe.OEMCSType_Exhaustive
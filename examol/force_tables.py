@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+Bulk conversion of OpenMM force terms to and from NumPy structured arrays.
+
+Reading terms with `getBondParameters` and friends wraps every parameter in a `Quantity`, and adding terms
+with unit-wrapped parameters converts them back one at a time.  A force table holds all terms of one kind
+(bonds, angles, torsions, particles, exceptions or exclusions) of a force as a structured array, with the
+atom indices of each term in the `atoms` field and each parameter, unit-stripped in OpenMM (md_unit_system)
+units, in a field of its own.  Tables are read in a single pass through the unwrapped accessors, manipulated
+with NumPy, and written back with plain floats.
+
+Example
+-------
+
+Copy the bonds of a molecule into a merged system, offsetting the atom indices.
+
+>>> bonds = get_force_table(molecule_system.getForce(0))
+>>> bonds['atoms'] += offset
+>>> add_force_table(system.getForce(0), bonds)
+
+Route terms into a Custom*Force with different parameters, matching fields by name.
+
+>>> add_force_table(custom_bond_force, convert_force_table(bonds, custom_bond_force, variant=variant))
+
+Fields of standard forces are named after the parameter names used throughout examol
+(`length`, `theta0`, `periodicity`, `phase`, `K`, `charge`, `sigma`, `epsilon`, `chargeProd`);
+fields of Custom*Force tables are named after their per-term parameters.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import sys
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+# Layout of the term kinds of each supported force: kind : (count method, get method, add method, set method, number of atoms, parameters).
+# Parameters are a list of field names for standard forces, or the method returning per-term parameter names for Custom*Force classes.
+FORCE_TABLE_LAYOUTS = {
+    'HarmonicBondForce'    : { 'bonds'      : ('getNumBonds', 'getBondParameters', 'addBond', 'setBondParameters', 2, ['length', 'K']) },
+    'HarmonicAngleForce'   : { 'angles'     : ('getNumAngles', 'getAngleParameters', 'addAngle', 'setAngleParameters', 3, ['theta0', 'K']) },
+    'PeriodicTorsionForce' : { 'torsions'   : ('getNumTorsions', 'getTorsionParameters', 'addTorsion', 'setTorsionParameters', 4, ['periodicity', 'phase', 'K']) },
+    'NonbondedForce'       : { 'particles'  : ('getNumParticles', 'getParticleParameters', 'addParticle', 'setParticleParameters', 0, ['charge', 'sigma', 'epsilon']),
+                               'exceptions' : ('getNumExceptions', 'getExceptionParameters', 'addException', 'setExceptionParameters', 2, ['chargeProd', 'sigma', 'epsilon']) },
+    'CustomBondForce'      : { 'bonds'      : ('getNumBonds', 'getBondParameters', 'addBond', 'setBondParameters', 2, 'getPerBondParameterName') },
+    'CustomAngleForce'     : { 'angles'     : ('getNumAngles', 'getAngleParameters', 'addAngle', 'setAngleParameters', 3, 'getPerAngleParameterName') },
+    'CustomTorsionForce'   : { 'torsions'   : ('getNumTorsions', 'getTorsionParameters', 'addTorsion', 'setTorsionParameters', 4, 'getPerTorsionParameterName') },
+    'CustomNonbondedForce' : { 'particles'  : ('getNumParticles', 'getParticleParameters', 'addParticle', 'setParticleParameters', 0, 'getPerParticleParameterName'),
+                               'exclusions' : ('getNumExclusions', 'getExclusionParticles', 'addExclusion', 'setExclusionParticles', 2, []) },
+    }
+
+INTEGER_FIELDS = ['periodicity'] # fields of standard forces stored as integers
+
+# The SWIG module behind the OpenMM Python wrappers; its accessors return plain floats in OpenMM units.
+# The wrappers are used instead if it cannot be found.
+_openmm = getattr(sys.modules[mm.HarmonicBondForce.__module__], '_openmm', None)
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_force_table_kinds(force):
+    """
+    Return the term kinds supported for a force, such as ['particles', 'exceptions'] for NonbondedForce.
+
+    """
+    force_name = force.__class__.__name__
+    if force_name not in FORCE_TABLE_LAYOUTS:
+        raise Exception("Force '%s' has no table layout; supported forces are %s." % (force_name, str(sorted(FORCE_TABLE_LAYOUTS.keys()))))
+    return sorted(FORCE_TABLE_LAYOUTS[force_name].keys())
+
+def _get_layout(force, kind):
+    """
+    Return (kind, count method, get method, add method, set method, number of atoms, parameter names, is custom) for a force.
+
+    """
+    kinds = get_force_table_kinds(force)
+    if kind is None:
+        if len(kinds) > 1:
+            raise Exception("Force '%s' has several term kinds %s; one must be specified." % (force.__class__.__name__, str(kinds)))
+        kind = kinds[0]
+    elif kind not in kinds:
+        raise Exception("Force '%s' has no terms of kind '%s'; kinds are %s." % (force.__class__.__name__, kind, str(kinds)))
+    [count_method, get_method, add_method, set_method, natoms, parameters] = FORCE_TABLE_LAYOUTS[force.__class__.__name__][kind]
+    is_custom = not isinstance(parameters, list)
+    if is_custom:
+        get_parameter_name = getattr(force, parameters)
+        nparameters = getattr(force, parameters.replace('get', 'getNum', 1).replace('Name', 's'))()
+        parameters = [ get_parameter_name(index) for index in range(nparameters) ]
+    return (kind, count_method, get_method, add_method, set_method, natoms, parameters, is_custom)
+
+def get_force_table_dtype(force, kind=None):
+    """
+    Return the structured dtype of the table of a kind of term of a force.
+
+    Parameters
+    ----------
+    force : simtk.openmm.Force
+        One of the forces in FORCE_TABLE_LAYOUTS.
+    kind : str, optional, default=None
+        The kind of term; may be omitted for forces with a single kind.
+
+    Returns
+    -------
+    dtype : numpy.dtype
+        An `atoms` field of shape (natoms,) int64 for terms involving atoms, followed by one field per parameter.
+
+    """
+    [kind, count_method, get_method, add_method, set_method, natoms, parameters, is_custom] = _get_layout(force, kind)
+    fields = [ ('atoms', np.int64, (natoms,)) ] if natoms else list()
+    for name in parameters:
+        fields.append((name, np.int64 if ((not is_custom) and (name in INTEGER_FIELDS)) else np.float64))
+    return np.dtype(fields)
+
+def create_force_table(force, nterms, kind=None):
+    """
+    Return a zero-filled table of `nterms` terms with the layout of a kind of term of a force.
+
+    """
+    return np.zeros([nterms], get_force_table_dtype(force, kind))
+
+def _strip_units(value):
+    # OpenMM returns parameters in md_unit_system, so units can be dropped without conversion.
+    return value._value if isinstance(value, unit.Quantity) else value
+
+def get_force_table(force, kind=None):
+    """
+    Read all terms of a kind from a force into a table.
+
+    Parameters
+    ----------
+    force : simtk.openmm.Force
+        One of the forces in FORCE_TABLE_LAYOUTS.
+    kind : str, optional, default=None
+        The kind of term; may be omitted for forces with a single kind.
+
+    Returns
+    -------
+    table : numpy.ndarray with dtype `get_force_table_dtype(force, kind)`
+        table[index] holds term `index` of the force.
+
+    """
+    [kind, count_method, get_method, add_method, set_method, natoms, parameters, is_custom] = _get_layout(force, kind)
+    nterms = getattr(force, count_method)()
+    table = create_force_table(force, nterms, kind)
+    if nterms == 0:
+        return table
+
+    accessor = getattr(_openmm, '%s_%s' % (force.__class__.__name__, get_method), None) if (_openmm is not None) else None
+    if accessor is not None:
+        terms = [ accessor(force, index) for index in range(nterms) ]
+    else:
+        get_term = getattr(force, get_method)
+        terms = [ get_term(index) for index in range(nterms) ]
+    if is_custom:
+        # Custom*Force accessors return the per-term parameters as a trailing sequence, which is empty for forces without any.
+        terms = [ list(term[:natoms]) + list(term[natoms]) for term in terms ] if natoms else [ list(term) for term in terms ]
+    if accessor is None:
+        terms = [ [ _strip_units(value) for value in term ] for term in terms ]
+
+    values = np.array(terms, np.float64).reshape([nterms, natoms + len(parameters)])
+    if natoms:
+        table['atoms'] = values[:,:natoms]
+    for (index, name) in enumerate(parameters):
+        table[name] = values[:,natoms+index]
+    return table
+
+def _get_term_arguments(table, natoms, parameters, is_custom):
+    """
+    Return the positional arguments of the add and set methods for each term of a table, as Python scalars.
+
+    """
+    columns = [ table['atoms'][:,index].tolist() for index in range(natoms) ]
+    if is_custom:
+        if parameters:
+            columns.append([ list(term) for term in zip(*[ table[name].tolist() for name in parameters ]) ])
+        elif not natoms:
+            columns.append([ [] for index in range(len(table)) ])
+    else:
+        columns += [ table[name].tolist() for name in parameters ]
+    return zip(*columns)
+
+def add_force_table(force, table, kind=None):
+    """
+    Add all terms of a table to a force.
+
+    Parameters
+    ----------
+    force : simtk.openmm.Force
+        One of the forces in FORCE_TABLE_LAYOUTS.
+    table : numpy.ndarray with dtype `get_force_table_dtype(force, kind)`
+        The terms to add.
+    kind : str, optional, default=None
+        The kind of term; may be omitted for forces with a single kind.
+
+    Returns
+    -------
+    indices : numpy.ndarray of (nterms,) int
+        The indices of the added terms in the force.
+
+    """
+    [kind, count_method, get_method, add_method, set_method, natoms, parameters, is_custom] = _get_layout(force, kind)
+    if table.dtype != get_force_table_dtype(force, kind):
+        raise Exception("Table dtype %s does not match the '%s' layout %s of force '%s'." % (str(table.dtype), kind, str(get_force_table_dtype(force, kind)), force.__class__.__name__))
+    add_term = getattr(force, add_method)
+    return np.array([ add_term(*arguments) for arguments in _get_term_arguments(table, natoms, parameters, is_custom) ], np.int64)
+
+def set_force_table(force, indices, table, kind=None):
+    """
+    Overwrite terms of a force with the rows of a table.
+
+    Parameters
+    ----------
+    force : simtk.openmm.Force
+        One of the forces in FORCE_TABLE_LAYOUTS.
+    indices : numpy.ndarray of (nterms,) int
+        The indices of the terms to overwrite.
+    table : numpy.ndarray with dtype `get_force_table_dtype(force, kind)`
+        table[n] holds the new term `indices[n]`.
+    kind : str, optional, default=None
+        The kind of term; may be omitted for forces with a single kind.
+
+    """
+    [kind, count_method, get_method, add_method, set_method, natoms, parameters, is_custom] = _get_layout(force, kind)
+    if len(indices) != len(table):
+        raise Exception("%d term indices were given for a table of %d terms." % (len(indices), len(table)))
+    set_term = getattr(force, set_method)
+    for (index, arguments) in zip(np.asarray(indices).tolist(), _get_term_arguments(table, natoms, parameters, is_custom)):
+        set_term(index, *arguments)
+
+def convert_force_table(table, force, kind=None, **values):
+    """
+    Create a table with the layout of a force from another table, copying fields by name.
+
+    Parameters
+    ----------
+    table : numpy.ndarray
+        The source table.
+    force : simtk.openmm.Force
+        The force whose layout the new table has.
+    kind : str, optional, default=None
+        The kind of term; may be omitted for forces with a single kind.
+    values : dict
+        Values (scalars or arrays) for fields of the new table, taking precedence over fields of `table`.
+
+    Returns
+    -------
+    converted : numpy.ndarray with dtype `get_force_table_dtype(force, kind)`
+        The converted table.
+
+    """
+    converted = create_force_table(force, len(table), kind)
+    for name in converted.dtype.names:
+        if name in values:
+            converted[name] = values[name]
+        elif name in table.dtype.names:
+            converted[name] = table[name]
+        else:
+            raise Exception("Field '%s' of force '%s' is neither in the source table nor given a value." % (name, force.__class__.__name__))
+    return converted
+
+def get_canonical_atoms(table):
+    """
+    Return the atom indices of each term, reversed where the first index exceeds the last, so that a term and its reverse coincide.
+
+    """
+    atoms = table['atoms'].copy()
+    reverse = atoms[:,0] > atoms[:,-1]
+    atoms[reverse] = atoms[reverse,::-1]
+    return atoms
+
+def index_force_table(table):
+    """
+    Index the terms of a table by their canonical atom tuples.
+
+    Returns
+    -------
+    index : dict of tuple : int
+        index[atoms] is the row of the term on canonical atoms `atoms`, the last such row if there are several.
+
+    """
+    return dict(zip([ tuple(atoms) for atoms in get_canonical_atoms(table).tolist() ], range(len(table))))
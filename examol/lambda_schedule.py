@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+"""
+Adaptive lambda schedules from short pilot simulations.
+
+A uniform lambda schedule wastes states where the free energy is flat and starves regions where it changes fast.
+`LambdaScheduleOptimizer` runs short pilot simulations of an alchemical System at a few lambda values, estimates
+the variance of dU/dlambda at each, and places the requested number of states at equal increments of thermodynamic
+length
+
+    L(lambda) = integral from 0 to lambda of sqrt(Var[du/dlambda']) dlambda'
+
+where u is the reduced potential, so that neighboring states have roughly equal phase-space overlap.
+
+The pilot statistics (not the schedules) are cached per transformation, keyed on the serialized System, so that
+production runs can derive a schedule with any number of states without repeating the pilots.
+
+Example
+-------
+
+A hybrid System from `create_relative_alchemical_transformation`, controlled by the global parameter `lambda`:
+
+>>> cache = LambdaScheduleCache('~/.examol/lambda-schedules')
+>>> optimizer = LambdaScheduleOptimizer(system, positions, 300*unit.kelvin, parameter='lambda', cache=cache)
+>>> lambda_values = optimizer.getSchedule(nstates=12)
+
+A variant of a merged topology from `AlchemicalMergedTopologyFactory`; the label distinguishes the variants in the cache:
+
+>>> set_lambda = lambda context, value: set_alchemical_state(context, variant=3, alchemical_lambda=value)
+>>> optimizer = LambdaScheduleOptimizer(system, positions, 300*unit.kelvin, set_lambda=set_lambda, label='variant 3', cache=cache)
+>>> lambda_values = optimizer.getSchedule(nstates=12)
+
+Notes
+-----
+* dU/dlambda is estimated by central finite differences, since alchemical forces do not provide parameter derivatives.
+* Pilots are run in order of increasing lambda, each starting from the final positions of the previous one.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import errno
+import pickle
+import hashlib
+import tempfile
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.alchemical_state import set_context_parameter
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def compute_thermodynamic_length(lambda_values, du_dlambda_variance):
+    """
+    Compute the cumulative thermodynamic length along a path sampled at a few lambda values.
+
+    Parameters
+    ----------
+    lambda_values : list of float
+        Increasing lambda values at which the variance was estimated.
+    du_dlambda_variance : list of float
+        Variance of the reduced dU/dlambda at each lambda value.
+
+    Returns
+    -------
+    length : numpy.array of float
+        length[i] is the thermodynamic length from lambda_values[0] to lambda_values[i] (trapezoidal rule).
+
+    """
+    lambda_values = np.asarray(lambda_values, np.float64)
+    speed = np.sqrt(np.maximum(np.asarray(du_dlambda_variance, np.float64), 0.0))
+    increments = 0.5 * (speed[1:] + speed[:-1]) * np.diff(lambda_values)
+    return np.concatenate([[0.0], np.cumsum(increments)])
+
+def optimize_lambda_schedule(lambda_values, du_dlambda_variance, nstates):
+    """
+    Place `nstates` lambda values at equal increments of thermodynamic length.
+
+    Parameters
+    ----------
+    lambda_values : list of float
+        Increasing lambda values at which the variance was estimated; the schedule spans the same range.
+    du_dlambda_variance : list of float
+        Variance of the reduced dU/dlambda at each lambda value.
+    nstates : int
+        The number of states in the schedule, including both endpoints.
+
+    Returns
+    -------
+    schedule : numpy.array of float
+        Increasing lambda values.  If the thermodynamic length vanishes, the schedule is uniform.
+
+    """
+    if nstates < 2:
+        raise Exception("A lambda schedule needs at least two states; %d requested." % nstates)
+    lambda_values = np.asarray(lambda_values, np.float64)
+    length = compute_thermodynamic_length(lambda_values, du_dlambda_variance)
+    if not (length[-1] > 0.0):
+        return np.linspace(lambda_values[0], lambda_values[-1], nstates)
+
+    # Invert the piecewise-linear cumulative length; flat segments are given a small slope so the inverse is single-valued.
+    length += 1.0e-6 * length[-1] * (lambda_values - lambda_values[0]) / (lambda_values[-1] - lambda_values[0])
+    schedule = np.interp(np.linspace(0.0, length[-1], nstates), length, lambda_values)
+    schedule[0] = lambda_values[0]
+    schedule[-1] = lambda_values[-1]
+    return schedule
+
+################################################################################
+# LAMBDA SCHEDULE CACHE
+################################################################################
+
+class LambdaScheduleCache(object):
+    """\
+    On-disk cache of pilot statistics, keyed on the serialized System and pilot options.
+
+    """
+    def __init__(self, directory):
+        """\
+        Open (creating if necessary) a lambda schedule cache.
+
+        Parameters
+        ----------
+        directory : str
+            Directory in which cache entries are stored.
+
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Hit/miss counters for this process.
+        self.nhits = 0
+        self.nmisses = 0
+
+        return
+
+    def makeKey(self, system, **options):
+        """\
+        Compute the key for an alchemical System and pilot options.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The alchemical System.
+        options : dict
+            Pilot options, with values that have stable string representations.
+
+        Returns
+        -------
+        key : str
+            Hex digest identifying the cache entry.
+
+        """
+        description = repr([ mm.XmlSerializer.serialize(system), sorted(options.items()), mm.Platform.getOpenMMVersion() ])
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def _entryPath(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        """\
+        Retrieve an entry.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `makeKey`.
+
+        Returns
+        -------
+        entry : dict or None
+            The stored entry, or None if there is no entry for `key`.
+
+        """
+        try:
+            with open(self._entryPath(key), 'rb') as infile:
+                entry = pickle.load(infile)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.nmisses += 1
+            return None
+
+        self.nhits += 1
+        return entry
+
+    def put(self, key, **entry):
+        """\
+        Store an entry.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `makeKey`.
+        entry : dict
+            Picklable items to store.
+
+        """
+        # Write to a temporary file in the cache directory, then atomically rename into place.
+        (fd, temporary_filename) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                pickle.dump(entry, outfile, protocol=2)
+            os.rename(temporary_filename, self._entryPath(key))
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+
+        return
+
+################################################################################
+# LAMBDA SCHEDULE OPTIMIZER
+################################################################################
+
+class LambdaScheduleOptimizer(object):
+    """\
+    Optimize the lambda schedule of an alchemical System from the variance of dU/dlambda in pilot simulations.
+
+    """
+    def __init__(self, system, positions, temperature, parameter='lambda', set_lambda=None, label=None,
+                 npilot=11, nequilibration_steps=500, nsamples=50, nsteps_per_sample=100,
+                 timestep=1.0*unit.femtoseconds, collision_rate=5.0/unit.picoseconds, finite_difference=1.0e-3,
+                 minimize=True, platform=None, cache=None, context_cache=None):
+        """\
+        Set up pilot simulations; nothing is run until the pilot statistics are needed.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The alchemical System, with lambda running from 0 to 1.
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with nanometers
+            Initial positions for the first pilot.
+        temperature : simtk.unit.Quantity with units compatible with kelvin
+            The temperature.
+        parameter : str, optional, default='lambda'
+            The global context parameter controlling the transformation.  Ignored if `set_lambda` is given.
+            `alchemical_lambda` and `alchemical_variant` are set through `set_alchemical_state`, keeping merged Systems
+            built with variant_selection='tabulated' in sync.
+        set_lambda : callable, optional, default=None
+            set_lambda(context, value) sets the lambda value of a Context, for transformations controlled by more than a
+            single context parameter (such as `set_alchemical_state` for a variant of a merged topology).
+        label : str, optional, default=None
+            Additional identity of the transformation for the cache, required when `set_lambda` selects one of several
+            transformations of the same System.
+        npilot : int, optional, default=11
+            The number of pilot simulations, at uniformly spaced lambda values.
+        nequilibration_steps : int, optional, default=500
+            Steps of dynamics at each pilot lambda before sampling.
+        nsamples : int, optional, default=50
+            The number of dU/dlambda samples at each pilot lambda.
+        nsteps_per_sample : int, optional, default=100
+            Steps of dynamics between samples.
+        timestep : simtk.unit.Quantity with units compatible with femtoseconds, optional, default=1 fs
+            Pilot Langevin timestep.
+        collision_rate : simtk.unit.Quantity with units compatible with 1/picoseconds, optional, default=5/ps
+            Pilot Langevin collision rate.
+        finite_difference : float, optional, default=1e-3
+            Lambda increment for finite-difference estimates of dU/dlambda.
+        minimize : bool, optional, default=True
+            If True, minimize the energy at the first pilot lambda before equilibration.
+        platform : simtk.openmm.Platform, optional, default=None
+            Platform for the pilot simulations; the fastest available if None.
+        cache : LambdaScheduleCache, optional, default=None
+            If given, pilot statistics are read from and stored to this cache.
+        context_cache : ContextCache, optional, default=None
+            If given, the pilot Context is taken from this cache, so that repeated pilots of the same System reuse it.
+
+        """
+        if (parameter is None) and (set_lambda is None):
+            raise Exception("Either a context parameter or a set_lambda function must be specified.")
+        if npilot < 2:
+            raise Exception("At least two pilot simulations are needed; %d requested." % npilot)
+
+        self.system = system
+        self.positions = positions
+        self.temperature = temperature
+        self.parameter = parameter
+        self.set_lambda = set_lambda
+        self.label = label
+        self.npilot = npilot
+        self.nequilibration_steps = nequilibration_steps
+        self.nsamples = nsamples
+        self.nsteps_per_sample = nsteps_per_sample
+        self.timestep = timestep
+        self.collision_rate = collision_rate
+        self.finite_difference = finite_difference
+        self.minimize = minimize
+        self.platform = platform
+        self.cache = cache
+        self.context_cache = context_cache
+
+        kB = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA
+        self.kT = kB * temperature
+
+        # Pilot statistics, filled in by `runPilot`.
+        self.pilot_lambdas = np.linspace(0.0, 1.0, npilot)
+        self.du_dlambda_mean = None
+        self.du_dlambda_variance = None
+
+        return
+
+    def _cacheKey(self):
+        """\
+        Return the cache key of this transformation and pilot protocol.
+
+        """
+        return self.cache.makeKey(self.system, parameter=(None if self.set_lambda else self.parameter), label=self.label,
+                                  npilot=self.npilot, nequilibration_steps=self.nequilibration_steps, nsamples=self.nsamples,
+                                  nsteps_per_sample=self.nsteps_per_sample, temperature=self.temperature / unit.kelvin,
+                                  timestep=self.timestep / unit.femtoseconds, collision_rate=self.collision_rate * unit.picoseconds,
+                                  finite_difference=self.finite_difference, minimize=self.minimize)
+
+    def _setLambda(self, context, value):
+        if self.set_lambda is not None:
+            self.set_lambda(context, value)
+        else:
+            set_context_parameter(context, self.parameter, value)
+
+    def _computeDerivative(self, context, value):
+        """\
+        Return the reduced dU/dlambda at `value` and the current positions, leaving lambda set to `value`.
+
+        Central differences are used in the interior, one-sided differences at the ends of [0, 1].
+
+        """
+        lower = max(0.0, value - self.finite_difference)
+        upper = min(1.0, value + self.finite_difference)
+        self._setLambda(context, lower)
+        lower_energy = context.getState(getEnergy=True).getPotentialEnergy()
+        self._setLambda(context, upper)
+        upper_energy = context.getState(getEnergy=True).getPotentialEnergy()
+        self._setLambda(context, value)
+        return ((upper_energy - lower_energy) / self.kT) / (upper - lower)
+
+    def runPilot(self, verbose=False):
+        """\
+        Estimate the mean and variance of dU/dlambda at each pilot lambda, from the cache if possible.
+
+        Parameters
+        ----------
+        verbose : bool, optional, default=False
+            If True, print the statistics at each pilot lambda.
+
+        """
+        if self.cache is not None:
+            entry = self.cache.get(self._cacheKey())
+            if entry is not None:
+                self.du_dlambda_mean = entry['du_dlambda_mean']
+                self.du_dlambda_variance = entry['du_dlambda_variance']
+                return
+
+        integrator = mm.LangevinIntegrator(self.temperature, self.collision_rate, self.timestep)
+        if self.context_cache is not None:
+            [context, integrator] = self.context_cache.getContext(self.system, integrator, platform=self.platform)
+        elif self.platform is not None:
+            context = mm.Context(self.system, integrator, self.platform)
+        else:
+            context = mm.Context(self.system, integrator)
+        context.setPositions(self.positions)
+        context.setVelocitiesToTemperature(self.temperature)
+
+        du_dlambda_mean = np.zeros([self.npilot], np.float64)
+        du_dlambda_variance = np.zeros([self.npilot], np.float64)
+        samples = np.zeros([self.nsamples], np.float64)
+        for (index, lambda_value) in enumerate(self.pilot_lambdas):
+            self._setLambda(context, lambda_value)
+            if self.minimize and (index == 0):
+                mm.LocalEnergyMinimizer.minimize(context)
+            integrator.step(self.nequilibration_steps)
+            for sample in range(self.nsamples):
+                integrator.step(self.nsteps_per_sample)
+                samples[sample] = self._computeDerivative(context, lambda_value)
+            du_dlambda_mean[index] = samples.mean()
+            du_dlambda_variance[index] = samples.var(ddof=1) if (self.nsamples > 1) else 0.0
+            if verbose:
+                print("Pilot %5d / %5d : lambda %8.5f : <du/dlambda> %12.3f : std %12.3f" % (index+1, self.npilot, lambda_value, du_dlambda_mean[index], np.sqrt(du_dlambda_variance[index])))
+        del context, integrator
+
+        self.du_dlambda_mean = du_dlambda_mean
+        self.du_dlambda_variance = du_dlambda_variance
+        if self.cache is not None:
+            self.cache.put(self._cacheKey(), pilot_lambdas=self.pilot_lambdas, du_dlambda_mean=du_dlambda_mean, du_dlambda_variance=du_dlambda_variance)
+
+        return
+
+    @property
+    def thermodynamic_length(self):
+        """\
+        The total thermodynamic length of the transformation, running the pilots if necessary.
+
+        """
+        if self.du_dlambda_variance is None:
+            self.runPilot()
+        return compute_thermodynamic_length(self.pilot_lambdas, self.du_dlambda_variance)[-1]
+
+    def getSchedule(self, nstates, verbose=False):
+        """\
+        Return an optimized lambda schedule, running the pilots if necessary.
+
+        Parameters
+        ----------
+        nstates : int
+            The number of states in the schedule, including lambda = 0 and lambda = 1.
+        verbose : bool, optional, default=False
+            If True, print pilot statistics as they are collected.
+
+        Returns
+        -------
+        lambda_values : numpy.array of float
+            Increasing lambda values from 0 to 1.
+
+        """
+        if self.du_dlambda_variance is None:
+            self.runPilot(verbose=verbose)
+        return optimize_lambda_schedule(self.pilot_lambdas, self.du_dlambda_variance, nstates)
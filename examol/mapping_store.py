@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Persistent SQLite store of atom mappings between pairs of molecules.
+
+Relative transformations need a mapping between the atoms of two molecules, found with an exhaustive MCSS search,
+and an overlay of the second molecule onto the first.  `AtomMappingStore` records each mapping, together with the
+overlay transform, in a local SQLite database keyed on the canonical isomeric SMILES of both molecules and the
+options of the search, so that reruns, restarts and the reverse transformation reuse it instead of searching again.
+
+Example
+-------
+
+>>> store = AtomMappingStore('~/.examol/mappings.sqlite')
+>>> record = store.getMapping(molecule1, molecule2, options)
+>>> if record is None:
+...     store.putMapping(molecule1, molecule2, options, mapping, rotation=rotation, translation=translation, rmsd=rmsd)
+>>> records = store.getMappingsInvolving(molecule1)
+
+Notes
+-----
+* Mappings are stored in terms of canonical atom positions, so they can be applied to any atom ordering of the
+  same molecules.  As for `examol.mcss.MCSSMemo`, symmetric atoms may be tie-broken differently, in which case a
+  stored mapping is returned as an equivalent mapping related by symmetry.
+* The overlay transform is only returned when both molecules have the conformations it was computed for, and only
+  in the direction it was stored; otherwise 'rotation' and 'translation' are None and the caller overlays the
+  molecules using the returned mapping, which is cheap compared with the search.
+* The database may be shared by concurrent processes.  Each process opens its own connection, so a store can be
+  passed to forked workers.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import errno
+import json
+import sqlite3
+import hashlib
+
+import openeye.oechem as oe
+
+from examol.mcss import get_canonical_typed_graph
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS mappings (
+                 smiles1 TEXT NOT NULL,
+                 smiles2 TEXT NOT NULL,
+                 options TEXT NOT NULL,
+                 mapping TEXT NOT NULL,
+                 coordinates1 TEXT,
+                 coordinates2 TEXT,
+                 rotation TEXT,
+                 translation TEXT,
+                 rmsd REAL,
+                 PRIMARY KEY (smiles1, smiles2, options))""",
+          "CREATE INDEX IF NOT EXISTS mappings_smiles2 ON mappings (smiles2)"] # the primary key also indexes smiles1
+
+COORDINATE_DECIMALS = 3 # conformations are compared after rounding coordinates (in angstroms) to this many decimals
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_mapping_key(molecule):
+    """
+    Return the strings and canonical atom order that identify a molecule in the store.
+
+    Parameters
+    ----------
+    molecule : openeye.oechem.OEMol
+        The molecule.
+
+    Returns
+    -------
+    smiles : str
+        Canonical isomeric SMILES.
+    coordinates : str
+        Hex digest of the coordinates in canonical atom order, identifying the conformation.
+    canonical_atoms : list of openeye.oechem.OEAtomBase
+        The atoms of `molecule` in canonical order.
+
+    """
+    smiles = oe.OECreateIsoSmiString(molecule)
+    [graph, canonical_atoms] = get_canonical_typed_graph(molecule)
+    coordinates = [ tuple([ round(x, COORDINATE_DECIMALS) for x in molecule.GetCoords(atom) ]) for atom in canonical_atoms ]
+    coordinates = hashlib.sha256(repr(coordinates).encode('utf-8')).hexdigest()
+    return [smiles, coordinates, canonical_atoms]
+
+################################################################################
+# ATOM MAPPING STORE
+################################################################################
+
+class AtomMappingStore(object):
+    """\
+    SQLite-backed store of atom mappings and overlay transforms between pairs of molecules.
+
+    """
+    def __init__(self, filename):
+        """\
+        Open (creating if necessary) an atom mapping store.
+
+        Parameters
+        ----------
+        filename : str
+            The SQLite database file.
+
+        """
+        self.filename = os.path.abspath(os.path.expanduser(filename))
+        try:
+            os.makedirs(os.path.dirname(self.filename))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Connections are opened lazily, once per process.
+        self._connection = None
+        self._pid = None
+        with self._connect() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+        # Hit/miss counters for this process.
+        self.nhits = 0
+        self.nmisses = 0
+
+        return
+
+    def __getstate__(self):
+        # Connections cannot be pickled; the receiving process opens its own.
+        state = dict(self.__dict__)
+        state.update(_connection=None, _pid=None)
+        return state
+
+    def _connect(self):
+        """\
+        Return the connection of this process to the database, opening it if necessary.
+
+        """
+        if (self._connection is None) or (self._pid != os.getpid()):
+            self._connection = sqlite3.connect(self.filename, timeout=60.0)
+            self._pid = os.getpid()
+        return self._connection
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM mappings").fetchone()[0]
+
+    def getMapping(self, molecule1, molecule2, options):
+        """\
+        Return the stored mapping from molecule1 to molecule2, looking up the reverse mapping if necessary.
+
+        Parameters
+        ----------
+        molecule1 : openeye.oechem.OEMol
+            The first molecule (the pattern of the search).
+        molecule2 : openeye.oechem.OEMol
+            The second molecule (the target of the search).
+        options : tuple
+            Hashable description of every option that affects the search (atom and bond expressions, search type, scoring function, ...).
+
+        Returns
+        -------
+        record : dict or None
+            None if neither direction is stored.  Otherwise a dict with
+            'mapping' : dict mapping atom indices of molecule1 to atom indices of molecule2;
+            'rotation', 'translation' : lists of 9 and 3 floats overlaying molecule2 onto molecule1 (as for `OERotate` and
+            `OETranslate`), or None if the transform does not apply to these conformations or this direction;
+            'rmsd' : float or None, the RMSD of the stored overlay.
+
+        """
+        [smiles1, coordinates1, atoms1] = get_mapping_key(molecule1)
+        [smiles2, coordinates2, atoms2] = get_mapping_key(molecule2)
+        connection = self._connect()
+        query = "SELECT mapping, coordinates1, coordinates2, rotation, translation, rmsd FROM mappings WHERE smiles1=? AND smiles2=? AND options=?"
+
+        row = connection.execute(query, (smiles1, smiles2, repr(options))).fetchone()
+        if row is not None:
+            [pairs, stored_coordinates1, stored_coordinates2, rotation, translation, rmsd] = row
+            pairs = json.loads(pairs)
+            same_conformations = (stored_coordinates1 == coordinates1) and (stored_coordinates2 == coordinates2) and (rotation is not None)
+        else:
+            # The reverse mapping is equally valid once inverted, but its overlay moves the other molecule.
+            row = connection.execute(query, (smiles2, smiles1, repr(options))).fetchone()
+            if row is None:
+                self.nmisses += 1
+                return None
+            pairs = [ (position1, position2) for (position2, position1) in json.loads(row[0]) ]
+            same_conformations = False
+
+        self.nhits += 1
+        record = dict(mapping=dict([ (atoms1[position1].GetIdx(), atoms2[position2].GetIdx()) for (position1, position2) in pairs ]),
+                      rotation=None, translation=None, rmsd=None)
+        if same_conformations:
+            record.update(rotation=json.loads(rotation), translation=json.loads(translation), rmsd=rmsd)
+        return record
+
+    def putMapping(self, molecule1, molecule2, options, mapping, rotation=None, translation=None, rmsd=None):
+        """\
+        Store the mapping from molecule1 to molecule2, replacing any mapping stored for the same molecules and options.
+
+        Parameters
+        ----------
+        molecule1 : openeye.oechem.OEMol
+            The first molecule (the pattern of the search).
+        molecule2 : openeye.oechem.OEMol
+            The second molecule (the target of the search), in the conformation it had before being overlaid.
+        options : tuple
+            Hashable description of every option that affects the search.
+        mapping : dict of int : int
+            Mapping of atom indices of molecule1 to atom indices of molecule2.
+        rotation : sequence of 9 float, optional, default=None
+            Rotation matrix overlaying molecule2 onto molecule1, as passed to `OERotate`.
+        translation : sequence of 3 float, optional, default=None
+            Translation overlaying molecule2 onto molecule1, as passed to `OETranslate` after the rotation.
+        rmsd : float, optional, default=None
+            RMSD of the overlay.
+
+        """
+        [smiles1, coordinates1, atoms1] = get_mapping_key(molecule1)
+        [smiles2, coordinates2, atoms2] = get_mapping_key(molecule2)
+        position1 = dict([ (atom.GetIdx(), position) for (position, atom) in enumerate(atoms1) ])
+        position2 = dict([ (atom.GetIdx(), position) for (position, atom) in enumerate(atoms2) ])
+        pairs = sorted([ (position1[index1], position2[index2]) for (index1, index2) in mapping.items() ])
+
+        if rotation is not None:
+            rotation = json.dumps([ float(x) for x in rotation ])
+            translation = json.dumps([ float(x) for x in translation ])
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (smiles1, smiles2, repr(options), json.dumps(pairs), coordinates1, coordinates2, rotation, translation, rmsd))
+        return
+
+    def getMappingsInvolving(self, molecule):
+        """\
+        Return all stored mappings in which a molecule takes part, in either direction.
+
+        Parameters
+        ----------
+        molecule : openeye.oechem.OEMol or str
+            The molecule, or its canonical isomeric SMILES.
+
+        Returns
+        -------
+        records : list of dict
+            One dict per stored mapping, with 'smiles1', 'smiles2', 'options' (the repr of the options) and 'mapping',
+            a list of (canonical position in molecule1, canonical position in molecule2) pairs.
+
+        """
+        smiles = molecule if isinstance(molecule, str) else oe.OECreateIsoSmiString(molecule)
+        rows = self._connect().execute("SELECT smiles1, smiles2, options, mapping FROM mappings WHERE smiles1=? "
+                                       "UNION SELECT smiles1, smiles2, options, mapping FROM mappings WHERE smiles2=?", (smiles, smiles)).fetchall()
+        return [ dict(smiles1=smiles1, smiles2=smiles2, options=options, mapping=[ tuple(pair) for pair in json.loads(pairs) ])
+                 for (smiles1, smiles2, options, pairs) in rows ]
+
+    def clear(self):
+        """\
+        Remove all mappings.
+
+        """
+        with self._connect() as connection:
+            connection.execute("DELETE FROM mappings")
+        return
@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+"""
+Shared maximum common substructure (MCSS) utilities.
+
+Every MCSS search in the package goes through `MCSSSearcher`.  Exhaustive searches (`OEMCSType_Exhaustive`) can take
+minutes or more on a pathological pair of molecules, and cannot be interrupted once OEChem has started them, so each
+exhaustive search runs in a forked child process with a wall-clock budget.  A search that runs out of budget is killed
+and repeated with the approximate search (`OEMCSType_Approximate`).  Callers that know their molecules are small can
+opt out of the cost of forking with `fork_min_atoms`, at the price of running those searches without a budget.  The
+searcher records the search mode used, the time spent and the match size of recent pairs, so that
+slow ligands can be found and fixed.
+
+Common-core detection repeats the same pairwise MCSS searches every time a merged topology is rebuilt, and
+whenever overlapping subsets of a ligand library are processed.  `MCSSMemo` memoizes the outcome of each
+search between a pair of molecules, keyed on canonical atom-typed representations of both molecules and
+the match options, in memory and optionally on disk.
+
+Example
+-------
+
+>>> searcher = MCSSSearcher(timeout=30.0)
+>>> mcss = searcher.createSearch(pattern, oe.OEExprOpts_DefaultAtoms, oe.OEExprOpts_DefaultBonds, min_atoms=6)
+>>> for match in mcss.Match(target, True):
+...     nmatched = match.NumAtoms()
+>>> searcher.writeStatistics('mcss_statistics.txt')
+>>> slowest = searcher.getSlowestSearches(10)
+
+>>> memo = MCSSMemo(directory='~/.examol/mcss')
+>>> matched_atoms = memo.getMatchedAtoms(pattern, target, options, search)
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import time
+import errno
+import pickle
+import collections
+import select
+import signal
+import hashlib
+import tempfile
+import traceback
+
+try:
+    import openeye.oechem as oe
+except ImportError:
+    oe = None
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+DEFAULT_MCSS_TIMEOUT = 60.0 # wall-clock budget (in seconds) of each exhaustive MCSS search of the default searcher
+
+DEFAULT_MAX_MCSS_STATISTICS = 10000 # number of most recent statistics records kept by the default searcher
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_canonical_typed_graph(molecule):
+    """
+    Compute a canonical representation of a molecule that includes atom and bond types.
+
+    Parameters
+    ----------
+    molecule : openeye.oechem.OEMol
+        The molecule, typically carrying GAFF (or other) atom types and integer bond types.
+
+    Returns
+    -------
+    graph : tuple
+        (atoms, bonds), where atoms is a tuple of (atomic number, atom type, formal charge) in canonical order and
+        bonds is a sorted tuple of (i, j, integer bond type, bond order) in terms of canonical atom positions.
+    canonical_atoms : list of openeye.oechem.OEAtomBase
+        The atoms of `molecule` in canonical order, so that canonical positions can be mapped back onto `molecule`.
+
+    Notes
+    -----
+    Canonical ordering is determined from the molecular graph; atom types are then recorded in that order.
+    Identical typed molecules that differ only in the tie-breaking of symmetric atoms may receive different
+    representations, which only costs a redundant search.
+
+    """
+    source_atoms = [ atom for atom in molecule.GetAtoms() ]
+    canonical_molecule = oe.OEMol(molecule)
+    tag = oe.OEGetTag('examol_source_position')
+    for (position, atom) in enumerate(canonical_molecule.GetAtoms()):
+        atom.SetIntData(tag, position)
+    oe.OECanonicalOrderAtoms(canonical_molecule)
+    oe.OECanonicalOrderBonds(canonical_molecule)
+
+    atoms = [ atom for atom in canonical_molecule.GetAtoms() ]
+    canonical_position = dict([ (atom.GetIdx(), position) for (position, atom) in enumerate(atoms) ])
+    atom_descriptors = tuple([ (atom.GetAtomicNum(), atom.GetType(), atom.GetFormalCharge()) for atom in atoms ])
+    bond_descriptors = list()
+    for bond in canonical_molecule.GetBonds():
+        i = canonical_position[bond.GetBgnIdx()]
+        j = canonical_position[bond.GetEndIdx()]
+        bond_descriptors.append((min(i,j), max(i,j), bond.GetIntType(), bond.GetOrder()))
+    graph = (atom_descriptors, tuple(sorted(bond_descriptors)))
+
+    canonical_atoms = [ source_atoms[atom.GetIntData(tag)] for atom in atoms ]
+    return [graph, canonical_atoms]
+
+def call_with_timeout(function, timeout):
+    """
+    Call a function in a forked child process, killing the child if it runs for longer than a wall-clock budget.
+
+    Parameters
+    ----------
+    function : callable
+        Called without arguments in the child process; its return value must be picklable.
+    timeout : float or None
+        The budget in seconds.  If None, `function` is called in this process without a budget.
+
+    Returns
+    -------
+    completed : bool
+        False if the budget ran out.
+    value : object
+        The return value of `function`, or None if the budget ran out.
+
+    Notes
+    -----
+    Forking shares the state of this process with the child, so nothing but the return value has to be pickled, and
+    the call also works inside daemonic worker processes, which cannot start `multiprocessing` children.  An exception
+    raised by `function` is raised again here, with the traceback of the child in its message; a child that dies
+    without sending a result (for instance, killed by the out-of-memory killer) raises an Exception describing how it
+    ended.  Only the calling thread exists in the child, so `function` must not need locks held by other threads.
+
+    """
+    if timeout is None:
+        return [True, function()]
+
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Child process: send the result and exit immediately, without running any cleanup inherited from the parent.
+        try:
+            os.close(read_fd)
+            try:
+                result = ('value', function())
+            except Exception:
+                result = ('error', traceback.format_exc())
+            data = pickle.dumps(result, protocol=2)
+            while data:
+                data = data[os.write(write_fd, data):]
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    deadline = time.time() + timeout
+    chunks = list()
+    completed = False
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0.0:
+                break
+            try:
+                (ready, writable, exceptional) = select.select([read_fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                break
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                completed = True
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(read_fd)
+        if not completed:
+            os.kill(pid, signal.SIGKILL)
+        (pid, exit_status) = os.waitpid(pid, 0)
+
+    if not completed:
+        return [False, None]
+    try:
+        (status, value) = pickle.loads(b''.join(chunks))
+    except (EOFError, ValueError, pickle.UnpicklingError):
+        if os.WIFSIGNALED(exit_status):
+            raise Exception("Child process was killed by signal %d before returning a result." % os.WTERMSIG(exit_status))
+        raise Exception("Child process exited with status %d without returning a complete result." % os.WEXITSTATUS(exit_status))
+    if status == 'error':
+        raise Exception("Function failed in child process:\n%s" % value)
+    return [True, value]
+
+################################################################################
+# MCSS MEMO
+################################################################################
+
+class MCSSMemo(object):
+    """\
+    Memoized outcomes of pairwise MCSS searches, in memory with an optional on-disk layer.
+
+    """
+    def __init__(self, directory=None):
+        """\
+        Create an MCSS memo.
+
+        Parameters
+        ----------
+        directory : str, optional, default=None
+            If specified, results are also stored in (and read from) this directory, so they persist across
+            processes and runs.  Entries are written atomically, so the directory can be shared by concurrent processes.
+
+        """
+        self.directory = None
+        if directory is not None:
+            self.directory = os.path.abspath(os.path.expanduser(directory))
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        self._results = dict()
+        self.nhits = 0
+        self.nmisses = 0
+
+        return
+
+    def _read(self, key):
+        """\
+        Return the stored result for `key` from memory or disk, or raise KeyError.
+
+        """
+        if key in self._results:
+            return self._results[key]
+        if self.directory is not None:
+            try:
+                with open(os.path.join(self.directory, key + '.pickle'), 'rb') as infile:
+                    result = pickle.load(infile)
+                self._results[key] = result
+                return result
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+        raise KeyError(key)
+
+    def _write(self, key, result):
+        """\
+        Store `result` for `key` in memory and, if enabled, atomically on disk.
+
+        """
+        self._results[key] = result
+        if self.directory is None:
+            return
+        (fd, temporary_filename) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                pickle.dump(result, outfile, protocol=2)
+            os.rename(temporary_filename, os.path.join(self.directory, key + '.pickle'))
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+        return
+
+    def getMatchedAtoms(self, pattern, target, options, search):
+        """\
+        Return the atoms of `target` matched by an MCSS search of `pattern` against `target`, searching only if this pair has not been seen.
+
+        Parameters
+        ----------
+        pattern : openeye.oechem.OEMol
+            The pattern molecule of the search.
+        target : openeye.oechem.OEMol
+            The target molecule of the search, whose matched atoms are returned.
+        options : tuple
+            Hashable description of every option that affects the search (atom and bond expressions, minimum atoms, scoring function, ...).
+        search : callable
+            Called without arguments on a miss; must return the list of matched atoms of `target`, or None if there is no match.
+
+        Returns
+        -------
+        matched_atoms : list of openeye.oechem.OEAtomBase or None
+            The matched atoms of `target`, or None if there is no match.
+
+        """
+        [pattern_graph, pattern_atoms] = get_canonical_typed_graph(pattern)
+        [target_graph, target_atoms] = get_canonical_typed_graph(target)
+        key = hashlib.sha256(repr((pattern_graph, target_graph, options)).encode('utf-8')).hexdigest()
+
+        try:
+            positions = self._read(key)
+            self.nhits += 1
+        except KeyError:
+            self.nmisses += 1
+            matched_atoms = search()
+            if matched_atoms is None:
+                positions = None
+            else:
+                target_position = dict([ (atom.GetIdx(), position) for (position, atom) in enumerate(target_atoms) ])
+                positions = sorted([ target_position[atom.GetIdx()] for atom in matched_atoms ])
+            self._write(key, positions)
+
+        if positions is None:
+            return None
+        return [ target_atoms[position] for position in positions ]
+
+################################################################################
+# TIME-BOUNDED MCSS SEARCH
+################################################################################
+
+def get_molecule_label(molecule):
+    """
+    Return the title of a molecule, or its isomeric SMILES if it has no title.
+
+    """
+    title = molecule.GetTitle()
+    if title:
+        return title
+    return oe.OECreateIsoSmiString(molecule)
+
+class MCSSSearcher(object):
+    """\
+    Create MCSS searches with a wall-clock budget on exhaustive searches, and record statistics of the searches.
+
+    """
+    def __init__(self, timeout=DEFAULT_MCSS_TIMEOUT, fallback=True, fork_min_atoms=None, max_statistics=None):
+        """\
+        Create an MCSS searcher.
+
+        Parameters
+        ----------
+        timeout : float or None, optional, default=DEFAULT_MCSS_TIMEOUT
+            The wall-clock budget of each exhaustive search, in seconds.  If None, searches run in this process without a budget.
+        fallback : bool, optional, default=True
+            If True, an exhaustive search that runs out of budget is repeated with the approximate search; if False,
+            an Exception is raised instead.
+        fork_min_atoms : int, optional, default=None
+            If specified, exhaustive searches in which the pattern or the target has fewer atoms (hydrogens included) run
+            in this process without a budget.  If None, every exhaustive search runs within the budget.
+        max_statistics : int, optional, default=None
+            If specified, only the statistics of this many most recent searches are kept.
+
+        """
+        self.timeout = timeout
+        self.fallback = fallback
+        self.fork_min_atoms = fork_min_atoms
+
+        # One dict per search, in the order the searches were run; see `BoundedMCSSearch.Match`.
+        self.statistics = collections.deque(maxlen=max_statistics)
+
+        return
+
+    def createSearch(self, pattern, atomexpr, bondexpr, mcss_type=None, min_atoms=None, complete_cycles=False):
+        """\
+        Create a search with a pattern molecule, to be matched against any number of targets.
+
+        Parameters
+        ----------
+        pattern : openeye.oechem.OEMol
+            The pattern molecule.
+        atomexpr : int
+            The atom expression options (oechem.OEExprOpts_*).
+        bondexpr : int
+            The bond expression options (oechem.OEExprOpts_*).
+        mcss_type : int, optional, default=None
+            The default search type of `BoundedMCSSearch.Match`; oechem.OEMCSType_Exhaustive if None.
+        min_atoms : int, optional, default=None
+            If specified, substructures with fewer atoms are not matched.
+        complete_cycles : bool, optional, default=False
+            If True, the scoring function prefers keeping cycles complete (oechem.OEMCSMaxAtomsCompleteCycles).
+
+        Returns
+        -------
+        mcss : BoundedMCSSearch
+            The search.
+
+        """
+        if mcss_type is None:
+            mcss_type = oe.OEMCSType_Exhaustive
+        return BoundedMCSSearch(self, pattern, atomexpr, bondexpr, mcss_type, min_atoms, complete_cycles)
+
+    def getSlowestSearches(self, nsearches=10):
+        """\
+        Return the statistics of the slowest searches, slowest first.
+
+        """
+        return sorted(self.statistics, key=lambda record: -record['time'])[:nsearches]
+
+    def writeStatistics(self, filename):
+        """\
+        Write the recorded statistics, one tab-separated line per search, after a header line.
+
+        Parameters
+        ----------
+        filename : str
+            The file to write.
+
+        """
+        with open(filename, 'w') as outfile:
+            outfile.write("# pattern\ttarget\trequested\tmode\tforked\ttimed_out\ttime\tnmatched\n")
+            for record in self.statistics:
+                outfile.write("%(pattern)s\t%(target)s\t%(requested)s\t%(mode)s\t%(forked)s\t%(timed_out)s\t%(time).3f\t%(nmatched)d\n" % record)
+        return
+
+class BoundedMCSSearch(object):
+    """\
+    An MCSS search of one pattern molecule, with the `Match` and `GetPattern` methods of oechem.OEMCSSearch.
+
+    Only the first (best) match is searched for.  Exhaustive searches run in a forked child process within the budget
+    of the searcher, unless the searcher has a `fork_min_atoms` gate that the pattern or the target falls below; other
+    searches, including fallbacks, run in this process.
+
+    """
+    def __init__(self, searcher, pattern, atomexpr, bondexpr, mcss_type, min_atoms=None, complete_cycles=False):
+        """\
+        Create a search; see `MCSSSearcher.createSearch`.
+
+        """
+        self.searcher = searcher
+        self.mcss_type = mcss_type
+        self._options = (atomexpr, bondexpr, min_atoms, complete_cycles)
+        self._pattern_label = get_molecule_label(pattern)
+        self._pattern_atom_count = pattern.NumAtoms()
+
+        # OEChem searches, keyed by search type; the first one also provides the pattern atoms of every match.
+        self._pattern = oe.OEMol(pattern)
+        self._searches = dict()
+        self._searches[mcss_type] = self._createSearch(self._pattern, mcss_type)
+        self._pattern_atoms = dict([ (atom.GetIdx(), atom) for atom in self.GetPattern().GetAtoms() ])
+
+        # Search mode ('exhaustive' or 'approximate') used by the last call to `Match`.
+        self.mode = None
+
+        return
+
+    def _createSearch(self, pattern, mcss_type):
+        """\
+        Create the OEChem search of the given type.
+
+        """
+        (atomexpr, bondexpr, min_atoms, complete_cycles) = self._options
+        mcss = oe.OEMCSSearch(pattern, atomexpr, bondexpr, mcss_type)
+        if min_atoms is not None:
+            mcss.SetMinAtoms(min_atoms)
+        if complete_cycles:
+            mcss.SetMCSFunc( oe.OEMCSMaxAtomsCompleteCycles() )
+        mcss.SetMaxMatches(1)
+        return mcss
+
+    def _getSearch(self, mcss_type):
+        """\
+        Return the OEChem search of the given type, creating it if necessary.
+
+        """
+        if mcss_type not in self._searches:
+            self._searches[mcss_type] = self._createSearch(self._pattern, mcss_type)
+        return self._searches[mcss_type]
+
+    def GetPattern(self):
+        """\
+        Return the pattern molecule of the search, whose atoms are the pattern atoms of every match.
+
+        """
+        return self._searches[self.mcss_type].GetPattern()
+
+    def Match(self, target, unique=False, mcss_type=None):
+        """\
+        Search for the common substructure of the pattern and a target molecule.
+
+        Parameters
+        ----------
+        target : openeye.oechem.OEMol
+            The target molecule.
+        unique : bool, optional, default=False
+            If True, only unique matches are returned, as for oechem.OEMCSSearch.Match.
+        mcss_type : int, optional, default=None
+            The search type for this target; the default type of the search if None.  Any type other than
+            oechem.OEMCSType_Exhaustive is run as an approximate search.
+
+        Returns
+        -------
+        matches : list of openeye.oechem.OEMatch
+            The best match, or an empty list if there is none.
+
+        Notes
+        -----
+        A statistics record is appended to `self.searcher.statistics`, with the 'pattern' and 'target' labels (titles,
+        or isomeric SMILES), the 'requested' and actual search 'mode' ('exhaustive' or 'approximate'), whether the
+        exhaustive search was 'forked' and whether it 'timed_out', the wall-clock 'time' in seconds, and the number of
+        atoms matched, 'nmatched'.
+
+        """
+        if mcss_type is None:
+            mcss_type = self.mcss_type
+        requested = 'exhaustive' if (mcss_type == oe.OEMCSType_Exhaustive) else 'approximate'
+
+        initial_time = time.time()
+        [completed, forked, timed_out] = [False, False, False]
+        if requested == 'exhaustive':
+            # Searches below the (opt-in) size gate of the searcher are not worth the cost of forking.
+            timeout = self.searcher.timeout
+            fork_min_atoms = self.searcher.fork_min_atoms
+            if (fork_min_atoms is not None) and (min(self._pattern_atom_count, target.NumAtoms()) < fork_min_atoms):
+                timeout = None
+            forked = (timeout is not None)
+            mcss = self._getSearch(oe.OEMCSType_Exhaustive)
+            [completed, pairs] = call_with_timeout(lambda: self._matchPairs(mcss, target, unique), timeout)
+            timed_out = not completed
+        if not completed:
+            if timed_out and not self.searcher.fallback:
+                self._record(target, requested, requested, forked, timed_out, initial_time, None)
+                raise Exception("Exhaustive MCSS search of %s against %s exceeded %.1f s." %
+                                (self._pattern_label, get_molecule_label(target), self.searcher.timeout))
+            mcss = self._getSearch(oe.OEMCSType_Approximate if timed_out else mcss_type)
+            pairs = self._matchPairs(mcss, target, unique)
+        self.mode = 'approximate' if (timed_out or (requested == 'approximate')) else 'exhaustive'
+        self._record(target, requested, self.mode, forked, timed_out, initial_time, pairs)
+
+        if pairs is None:
+            return []
+        target_atoms = dict([ (atom.GetIdx(), atom) for atom in target.GetAtoms() ])
+        match = oe.OEMatch()
+        for (pattern_index, target_index) in pairs:
+            match.AddPair(self._pattern_atoms[pattern_index], target_atoms[target_index])
+        return [match]
+
+    def _matchPairs(self, mcss, target, unique):
+        """\
+        Run an OEChem search, returning the (pattern atom index, target atom index) pairs of the first match, or None.
+
+        """
+        for match in mcss.Match(target, unique):
+            return [ (matchpair.pattern.GetIdx(), matchpair.target.GetIdx()) for matchpair in match.GetAtoms() ]
+        return None
+
+    def _record(self, target, requested, mode, forked, timed_out, initial_time, pairs):
+        """\
+        Append the statistics of a search to the searcher.
+
+        """
+        self.searcher.statistics.append(dict(pattern=self._pattern_label, target=get_molecule_label(target), requested=requested,
+                                             mode=mode, forked=forked, timed_out=timed_out, time=time.time() - initial_time,
+                                             nmatched=(len(pairs) if (pairs is not None) else 0)))
+        return
+
+_default_mcss_searcher = None
+
+def get_default_mcss_searcher():
+    """
+    Return the searcher shared by every MCSS search for which no searcher is specified.
+
+    Returns
+    -------
+    searcher : MCSSSearcher
+        The default searcher, with a budget of DEFAULT_MCSS_TIMEOUT seconds and approximate fallback, created on first use.
+        It keeps the statistics of the DEFAULT_MAX_MCSS_STATISTICS most recent searches.
+
+    """
+    global _default_mcss_searcher
+    if _default_mcss_searcher is None:
+        _default_mcss_searcher = MCSSSearcher(max_statistics=DEFAULT_MAX_MCSS_STATISTICS)
+    return _default_mcss_searcher
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+Expanded-ensemble sampling over the variants and lambda values of a merged topology.
+
+A single simulation of a merged-topology System (see `AlchemicalMergedTopologyFactory`) explores a whole
+library: molecular dynamics is alternated with moves in (`alchemical_variant`, `alchemical_lambda`) space.
+Reduced potentials are cached between moves at fixed positions, and the state path and the evaluated reduced
+potentials are stored in preallocated arrays.
+
+Example
+-------
+
+>>> factory = AlchemicalMergedTopologyFactory(environment_system, environment_topology, environment_positions, valence_layout='force_groups')
+>>> variant_indices = factory.addMolecules(molecules)
+>>> [system, topology, positions] = factory.generateMergedTopology(reference_molecule=molecules[0])
+>>> integrator = openmm.LangevinIntegrator(300*unit.kelvin, 5/unit.picoseconds, 1*unit.femtoseconds)
+>>> context = openmm.Context(system, integrator)
+>>> context.setPositions(positions)
+>>> sampler = ExpandedEnsembleSampler(context, integrator, range(1, len(molecules)+1), [0.0, 0.5, 1.0], 300*unit.kelvin,
+...                                   valence_layout='force_groups', factory=factory)
+>>> sampler.run(niterations=1000)
+>>> sampler.save('expanded-ensemble.npz')
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+from simtk import unit
+import numpy as np
+
+from examol.multitopology.multitopology import select_variant, set_alchemical_state, get_environment_force_groups, get_alchemical_force_groups
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+MOVE_SCHEMES = ['gibbs', 'metropolis'] # supported schemes for updating the variant and lambda
+
+################################################################################
+# EXPANDED ENSEMBLE SAMPLER
+################################################################################
+
+class ExpandedEnsembleSampler(object):
+    """\
+    Expanded-ensemble sampler over (variant, lambda) states of a merged-topology System.
+
+    Each iteration runs `nsteps_per_iteration` steps of dynamics, then updates the variant at fixed lambda and
+    the lambda value at fixed variant.  With move_scheme='gibbs', each update samples from the conditional
+    distribution over all variants (or lambda values); with 'metropolis', a single new variant (or neighboring
+    lambda value) is proposed and accepted with the Metropolis criterion.
+
+    Notes
+    -----
+    With valence_layout='force_groups', the valence terms of inactive variants are not integrated, so their atoms drift.
+    The `factory` is therefore required, and all inactive variants are re-placed onto the core with `AlchemicalMergedTopologyFactory.alignVariant`
+    after every round of dynamics, before state updates.  Their coordinates do not enter the energy of the current state,
+    but the re-placement is deterministic rather than sampled, so detailed balance only holds approximately in this case.
+
+    """
+    def __init__(self, context, integrator, variants, lambda_values, temperature, log_weights=None,
+                 nsteps_per_iteration=500, move_scheme='gibbs', valence_layout='shared', factory=None,
+                 variant_index=0, lambda_index=0, random_seed=None):
+        """\
+        Create an expanded-ensemble sampler.
+
+        Parameters
+        ----------
+        context : simtk.openmm.Context
+            The Context of the merged System, with positions set.
+        integrator : simtk.openmm.Integrator
+            The integrator of `context`, used to propagate dynamics at fixed state.
+        variants : list of int
+            The values of the `alchemical_variant` context parameter to sample over.
+        lambda_values : list of float
+            The values of the `alchemical_lambda` context parameter to sample over.
+        temperature : simtk.unit.Quantity with units compatible with kelvin
+            The temperature of the simulation.
+        log_weights : numpy.ndarray of (nvariants, nlambdas), optional, default=None
+            Log weights g added to the negative reduced potential of each state.  If None, all weights are zero.
+        nsteps_per_iteration : int, optional, default=500
+            The number of integrator steps between state updates.
+        move_scheme : str, optional, default='gibbs'
+            One of MOVE_SCHEMES.
+        valence_layout : str, optional, default='shared'
+            The valence layout the merged System was built with.
+        factory : AlchemicalMergedTopologyFactory, optional, default=None
+            The factory that generated the System; used to re-place inactive variants, and required, with valence_layout='force_groups'.
+            Variant `variants[k]` is taken to be factory variant index `variants[k]-1`.
+        variant_index : int, optional, default=0
+            The index into `variants` of the initial variant.
+        lambda_index : int, optional, default=0
+            The index into `lambda_values` of the initial lambda value.
+        random_seed : int, optional, default=None
+            Seed for the random number generator used for state updates.
+
+        """
+        if move_scheme not in MOVE_SCHEMES:
+            raise Exception("Move scheme '%s' unknown; must be one of %s." % (move_scheme, str(MOVE_SCHEMES)))
+        if (valence_layout == 'force_groups') and (factory is None):
+            raise Exception("valence_layout='force_groups' requires the factory that generated the System, to re-place inactive variants.")
+
+        self.context = context
+        self.integrator = integrator
+        self.variants = list(variants)
+        self.lambda_values = np.array(lambda_values, np.float64)
+        self.nvariants = len(self.variants)
+        self.nlambdas = len(self.lambda_values)
+        self.kT = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA * temperature
+        self.nsteps_per_iteration = nsteps_per_iteration
+        self.move_scheme = move_scheme
+        self.valence_layout = valence_layout
+        self.factory = factory
+        self.random_state = np.random.RandomState(random_seed)
+
+        if log_weights is None:
+            log_weights = np.zeros([self.nvariants, self.nlambdas], np.float64)
+        self.log_weights = np.array(log_weights, np.float64)
+        if self.log_weights.shape != (self.nvariants, self.nlambdas):
+            raise Exception("log_weights must have shape (%d, %d)." % (self.nvariants, self.nlambdas))
+
+        # Current state.
+        self.variant_index = variant_index
+        self.lambda_index = lambda_index
+        self._applyState()
+
+        # Reduced potentials at the current positions, keyed by (variant_index, lambda_index).
+        self._energy_cache = dict()
+        self._environment_energy = None
+
+        # Acceptance statistics.
+        self.nvariant_proposed = 0
+        self.nvariant_accepted = 0
+        self.nlambda_proposed = 0
+        self.nlambda_accepted = 0
+
+        # Storage for the state path and reduced potentials, grown by doubling.
+        self.niterations = 0
+        self._states = np.zeros([0, 2], np.int32)
+        self._variant_energies = np.zeros([0, self.nvariants], np.float64)
+        self._lambda_energies = np.zeros([0, self.nlambdas], np.float64)
+
+        return
+
+    @property
+    def states(self):
+        """The (variant_index, lambda_index) state after each iteration, as a (niterations, 2) array view."""
+        return self._states[:self.niterations]
+
+    @property
+    def variant_energies(self):
+        """Reduced potentials of all variants at the lambda value after each iteration (NaN where not evaluated)."""
+        return self._variant_energies[:self.niterations]
+
+    @property
+    def lambda_energies(self):
+        """Reduced potentials of all lambda values at the variant after each iteration (NaN where not evaluated)."""
+        return self._lambda_energies[:self.niterations]
+
+    def getStateCounts(self):
+        """\
+        Return the number of iterations that ended in each state, as a (nvariants, nlambdas) array.
+
+        """
+        counts = np.zeros([self.nvariants, self.nlambdas], np.int64)
+        np.add.at(counts, (self.states[:,0], self.states[:,1]), 1)
+        return counts
+
+    def _applyState(self):
+        """\
+        Set the context parameters (and integrated force groups) for the current state.
+
+        """
+        select_variant(self.context, self.integrator, self.variants[self.variant_index], valence_layout=self.valence_layout)
+        set_alchemical_state(self.context, alchemical_lambda=self.lambda_values[self.lambda_index])
+
+    def _invalidateCache(self):
+        """\
+        Discard cached reduced potentials after the positions have changed.
+
+        """
+        self._energy_cache = dict()
+        self._environment_energy = None
+
+    def _computeReducedPotential(self, variant_index, lambda_index):
+        """\
+        Return the reduced potential of a state at the current positions, using the cache where possible.
+
+        The context parameters are left modified; call `_applyState` before continuing dynamics.
+
+        """
+        key = (variant_index, lambda_index)
+        if key not in self._energy_cache:
+            # Variant-independent terms are evaluated once per set of positions.
+            if self._environment_energy is None:
+                state = self.context.getState(getEnergy=True, groups=get_environment_force_groups(self.valence_layout))
+                self._environment_energy = state.getPotentialEnergy() / self.kT
+            variant = self.variants[variant_index]
+            set_alchemical_state(self.context, variant=variant, alchemical_lambda=self.lambda_values[lambda_index])
+            state = self.context.getState(getEnergy=True, groups=get_alchemical_force_groups(variant, self.valence_layout))
+            self._energy_cache[key] = self._environment_energy + state.getPotentialEnergy() / self.kT
+        return self._energy_cache[key]
+
+    def _sample(self, current, candidates, compute_log_probability):
+        """\
+        Select a new index among `candidates` with the configured move scheme.
+
+        Parameters
+        ----------
+        current : int
+            The current index.
+        candidates : list of int
+            Indices that may be proposed (for Metropolis moves) or sampled from (for Gibbs moves); includes `current`.
+        compute_log_probability : function
+            Returns the unnormalized log probability of an index.
+
+        Returns
+        -------
+        [new, nproposed, naccepted] : [int, int, int]
+            The new index and the number of proposals made and accepted.
+
+        """
+        if self.move_scheme == 'gibbs':
+            log_p = np.array([ compute_log_probability(index) for index in candidates ])
+            p = np.exp(log_p - log_p.max())
+            p /= p.sum()
+            new = candidates[self.random_state.choice(len(candidates), p=p)]
+            return [new, 1, int(new != current)]
+
+        proposals = [ index for index in candidates if index != current ]
+        if len(proposals) == 0:
+            return [current, 0, 0]
+        proposed = proposals[self.random_state.randint(len(proposals))]
+        log_acceptance = compute_log_probability(proposed) - compute_log_probability(current)
+        if (log_acceptance >= 0.0) or (self.random_state.rand() < np.exp(log_acceptance)):
+            return [proposed, 1, 1]
+        return [current, 1, 0]
+
+    def updateVariant(self):
+        """\
+        Update the variant at fixed lambda.
+
+        """
+        def compute_log_probability(variant_index):
+            return self.log_weights[variant_index, self.lambda_index] - self._computeReducedPotential(variant_index, self.lambda_index)
+
+        [new, nproposed, naccepted] = self._sample(self.variant_index, range(self.nvariants), compute_log_probability)
+        self.nvariant_proposed += nproposed
+        self.nvariant_accepted += naccepted
+        self.variant_index = new
+        self._applyState()
+
+    def _alignInactiveVariants(self):
+        """\
+        Re-place inactive variants onto the core, since their valence terms were not integrated.
+
+        """
+        inactive = [ variant - 1 for (index, variant) in enumerate(self.variants) if index != self.variant_index ]
+        if len(inactive) > 0:
+            positions = self.context.getState(getPositions=True).getPositions(asNumpy=True)
+            self.context.setPositions(self.factory.alignVariant(positions, inactive))
+
+    def updateLambda(self):
+        """\
+        Update the lambda value at fixed variant.
+
+        With move_scheme='metropolis', only neighboring lambda values are proposed.
+
+        """
+        def compute_log_probability(lambda_index):
+            return self.log_weights[self.variant_index, lambda_index] - self._computeReducedPotential(self.variant_index, lambda_index)
+
+        candidates = range(self.nlambdas)
+        if self.move_scheme == 'metropolis':
+            candidates = [ index for index in [self.lambda_index-1, self.lambda_index, self.lambda_index+1] if 0 <= index < self.nlambdas ]
+        [new, nproposed, naccepted] = self._sample(self.lambda_index, candidates, compute_log_probability)
+        self.nlambda_proposed += nproposed
+        self.nlambda_accepted += naccepted
+        self.lambda_index = new
+        self._applyState()
+
+    def _reserve(self, niterations):
+        """\
+        Ensure storage for at least `niterations` iterations, doubling capacity when growing.
+
+        """
+        capacity = self._states.shape[0]
+        if niterations <= capacity:
+            return
+        capacity = max(niterations, 2*capacity)
+        for name in ['_states', '_variant_energies', '_lambda_energies']:
+            old = getattr(self, name)
+            new = np.empty([capacity, old.shape[1]], old.dtype)
+            new[:self.niterations] = old[:self.niterations]
+            setattr(self, name, new)
+
+    def _record(self):
+        """\
+        Store the current state and the cached reduced potentials of its row and column of states.
+
+        """
+        self._reserve(self.niterations + 1)
+        iteration = self.niterations
+        self._states[iteration] = [self.variant_index, self.lambda_index]
+        self._variant_energies[iteration] = np.nan
+        self._lambda_energies[iteration] = np.nan
+        for ((variant_index, lambda_index), u) in self._energy_cache.items():
+            if lambda_index == self.lambda_index:
+                self._variant_energies[iteration, variant_index] = u
+            if variant_index == self.variant_index:
+                self._lambda_energies[iteration, lambda_index] = u
+        self.niterations += 1
+
+    def run(self, niterations=1, verbose=False):
+        """\
+        Run iterations of dynamics followed by variant and lambda updates.
+
+        Parameters
+        ----------
+        niterations : int, optional, default=1
+            The number of iterations to run.
+        verbose : bool, optional, default=False
+            If True, print the state after every iteration.
+
+        """
+        for iteration in range(niterations):
+            self.integrator.step(self.nsteps_per_iteration)
+            if self.valence_layout == 'force_groups':
+                self._alignInactiveVariants()
+            self._invalidateCache()
+            self.updateVariant()
+            self.updateLambda()
+            self._record()
+            if verbose:
+                print("Iteration %8d : variant %5d : lambda %8.5f" % (self.niterations, self.variants[self.variant_index], self.lambda_values[self.lambda_index]))
+
+    def save(self, filename):
+        """\
+        Write the state path, reduced potentials, and sampler settings to a compressed NumPy .npz file.
+
+        """
+        np.savez_compressed(filename, states=self.states, variant_energies=self.variant_energies, lambda_energies=self.lambda_energies,
+                            variants=np.array(self.variants), lambda_values=self.lambda_values, log_weights=self.log_weights)
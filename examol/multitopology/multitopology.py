@@ -46,27 +46,50 @@ TODO
 # IMPORTS
 ################################################################################
 
-from openmoltools import openeye
+# OpenEye and openmoltools are only needed for molecule handling, so that `add_molecule_to_system` and the other
+# System-level tools can be used without them.
+try:
+    from openmoltools import openeye
+    from openmoltools import amber
+except ImportError:
+    openeye = amber = None
+try:
+    import openeye.oechem as oe
+except ImportError:
+    oe = None
 
-import openeye.oechem as oe
 import simtk.openmm as mm
 from simtk import unit
 import simtk.openmm.app as app
 import numpy as np
+import os
 import tempfile
 import commands
 import copy
+import warnings
+import traceback
+import multiprocessing
+
+from examol.positions import PositionBuffer
+from examol.parameterization_cache import get_option_name
+from examol.charges import ChargeService
+from examol.mcss import MCSSMemo, get_default_mcss_searcher
+from examol.snapshots import SystemSnapshot
+from examol.force_tables import get_force_table, add_force_table, create_force_table, convert_force_table
+from examol.alchemical_state import compute_variant_lambdas, get_variant_table, set_alchemical_state
 
 ################################################################################
 # UTILITY TESTING SUBROUTINES
 ################################################################################
 
-def assign_am1bcc_charges(molecule):
+def assign_am1bcc_charges(molecule, charge_service=None):
     """
     Parameters
     ----------
     molecule : openeye.oechem.OEMol
         The molecule for which AM1-BCC charges are to be assigned
+    charge_service : examol.charges.ChargeService, optional, default=None
+        The service used to assign (and cache) charges.  If None, charges are computed with the canonical 800-conformer recipe without caching.
 
     Returns
     -------
@@ -79,30 +102,59 @@ def assign_am1bcc_charges(molecule):
     https://docs.eyesopen.com/toolkits/cookbook/python/modeling/am1-bcc.html
 
     """
+    if charge_service is None:
+        charge_service = ChargeService(mode='am1bccsym', max_confs=800)
+    return charge_service.assignCharges(molecule)
 
-    # Create a copy.
-    molecule = molecule.CreateCopy()
-
-    # Expand conformations.
-    from openeye import oeomega
-    omega = oeomega.OEOmega()
-    omega.SetIncludeInput(False)
-    omega.SetCanonOrder(False)
-    omega.SetSampleHydrogens(True)
-    eWindow = 15.0
-    omega.SetEnergyWindow(eWindow)
-    omega.SetMaxConfs(800)
-    omega.SetRMSThreshold(1.0)
-    omega(molecule)
+def load_gaff_molecule(molecule, gaff_mol2_filename):
+    """
+    Create a copy of a molecule with the GAFF atom and bond types assigned by antechamber.
 
-    # Assign partial charges.
-    from openeye import oequacpac
-    from openeye.oequacpac import OEAssignPartialCharges, OECharges_AM1BCCSym
-    OEAssignPartialCharges(molecule, OECharges_AM1BCCSym)
+    Parameters
+    ----------
+    molecule : openeye.oechem.OEMol
+        The molecule that was written (in atom order) to the mol2 file typed by antechamber.
+    gaff_mol2_filename : str
+        The GAFF mol2 file written by antechamber.
 
-    return molecule
+    Returns
+    -------
+    gaff_molecule : openeye.oechem.OEMol
+        A copy of `molecule` with GAFF atom types (str) and GAFF bond types (int, see GAFF_BOND_TYPES).
 
-def parameterize_molecule(molecule, implicitSolvent=app.OBC1, constraints=None, cleanup=True, verbose=False):
+    """
+    gaff_molecule = oe.OEMol(molecule)
+    atoms = [ atom for atom in gaff_molecule.GetAtoms() ]
+    atom_positions = dict([ (atom.GetIdx(), position) for (position, atom) in enumerate(atoms) ])
+
+    # Read the atom and bond sections of the mol2 file, which list atoms in the order they were written.
+    atom_types = list()
+    bond_types = dict()
+    section = None
+    for line in open(gaff_mol2_filename):
+        if line.startswith('@<TRIPOS>'):
+            section = line.strip()
+            continue
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        if section == '@<TRIPOS>ATOM':
+            atom_types.append(fields[5])
+        elif section == '@<TRIPOS>BOND':
+            bond_types[frozenset([int(fields[1])-1, int(fields[2])-1])] = fields[3]
+    if len(atom_types) != len(atoms):
+        raise Exception("GAFF mol2 file '%s' has %d atoms, but molecule has %d." % (gaff_mol2_filename, len(atom_types), len(atoms)))
+
+    # Overwrite atom and bond types.
+    for (atom, atom_type) in zip(atoms, atom_types):
+        atom.SetType(atom_type)
+    for bond in gaff_molecule.GetBonds():
+        bond_type = bond_types[frozenset([atom_positions[bond.GetBgnIdx()], atom_positions[bond.GetEndIdx()]])]
+        bond.SetIntType(GAFF_BOND_TYPES[bond_type])
+
+    return gaff_molecule
+
+def parameterize_molecule(molecule, implicitSolvent=app.OBC1, constraints=None, cleanup=True, verbose=False, cache=None):
     """
     Parameterize the specified molecule for AMBER.
 
@@ -114,8 +166,12 @@ def parameterize_molecule(molecule, implicitSolvent=app.OBC1, constraints=None,
         The implicit solvent model to use; one of [None, HCT, OBC1, OBC2, GBn, GBn2]
     constraints : default=None
         Constraints to use; one of [None, HBonds, AllBonds, HAngles]
-    cleanup : bool, optional, default=False
+    cleanup : bool, optional, default=True
         If True, work done in a temporary working directory will be deleted.
+    verbose : bool, optional, default=False
+        If True, progress is printed.
+    cache : examol.parameterization_cache.ParameterizationCache, optional, default=None
+        If specified, a previous parameterization of the same molecule with the same options is reused, and new parameterizations are stored.
 
     Returns
     -------
@@ -128,41 +184,59 @@ def parameterize_molecule(molecule, implicitSolvent=app.OBC1, constraints=None,
     gaff_molecule : oechem.OEMol
         The OEMol molecule with GAFF atom and bond types.
 
+    Notes
+    -----
+    The partial charges already assigned to `molecule` are used; requires antechamber and tleap from AmberTools.
+
     """
-    # Create molecule and geometry.
-    molecule = openeye.iupac_to_oemol(iupac_name)
+    # Reuse a previous parameterization of this molecule, if available.
+    if cache is not None:
+        key = cache.makeKey(molecule, function='parameterize_molecule', charge_model=None,
+                            implicitSolvent=get_option_name(implicitSolvent), constraints=get_option_name(constraints))
+        entry = cache.get(key)
+        if entry is not None:
+            gaff_molecule = oe.OEMol()
+            oe.OEReadMolFromBytes(gaff_molecule, '.oeb', entry['molecule'])
+            gaff_molecule.SetCoords(molecule.GetCoords())
+            positions = unit.Quantity(np.array([ molecule.GetCoords(atom) for atom in molecule.GetAtoms() ]), unit.angstroms)
+            return [entry['system'], entry['topology'], positions, gaff_molecule]
+
     # Create a a temporary directory.
     working_directory = tempfile.mkdtemp()
     old_directory = os.getcwd()
     os.chdir(working_directory)
-    # Parameterize molecule for AMBER (currently using old machinery for convenience)
-    # TODO: Replace this with gaff2xml stuff
-    amber_prmtop_filename = 'molecule.prmtop'
-    amber_inpcrd_filename = 'molecule.inpcrd'
-    amber_off_filename = 'molecule.off'
-    oldmmtools.parameterizeForAmber(molecule, amber_prmtop_filename, amber_inpcrd_filename, charge_model=None, offfile=amber_off_filename)
-    # Read in the molecule with GAFF atom and bond types
-    print "Overwriting OEMol with GAFF atom and bond types..."
-    gaff_molecule = oldmmtools.loadGAFFMolecule(molecule, amber_off_filename)
-
-    # Load positions.
-    inpcrd = app.AmberInpcrdFile(amber_inpcrd_filename)
-    positions = inpcrd.getPositions()
-
-    # Load system (with GB parameters).
-    prmtop = app.AmberPrmtopFile(amber_prmtop_filename)
-    system = prmtop.createSystem(implicitSolvent=implicitSolvent, constraints=constraints)
-
-    # Clean up temporary files.
-    os.chdir(old_directory)
-    if cleanup:
-        commands.getoutput('rm -r %s' % working_directory)
-    else:
-        print "Work done in %s..." % working_directory
+    try:
+        # Parameterize molecule for AMBER with GAFF, keeping the partial charges it already carries.
+        openeye.molecule_to_mol2(molecule, tripos_mol2_filename='molecule.mol2')
+        [gaff_mol2_filename, frcmod_filename] = amber.run_antechamber('molecule', 'molecule.mol2', charge_method=None)
+        [amber_prmtop_filename, amber_inpcrd_filename] = amber.run_tleap('molecule', gaff_mol2_filename, frcmod_filename)
+        # Read in the molecule with GAFF atom and bond types
+        if verbose: print "Overwriting OEMol with GAFF atom and bond types..."
+        gaff_molecule = load_gaff_molecule(molecule, gaff_mol2_filename)
+
+        # Load positions.
+        inpcrd = app.AmberInpcrdFile(amber_inpcrd_filename)
+        positions = inpcrd.getPositions(asNumpy=True)
+
+        # Load topology and system (with GB parameters).
+        prmtop = app.AmberPrmtopFile(amber_prmtop_filename)
+        topology = prmtop.topology
+        system = prmtop.createSystem(implicitSolvent=implicitSolvent, constraints=constraints)
+    finally:
+        # Clean up temporary files.
+        os.chdir(old_directory)
+        if cleanup:
+            commands.getoutput('rm -r %s' % working_directory)
+        else:
+            print "Work done in %s..." % working_directory
+
+    # Store new parameterization.
+    if cache is not None:
+        cache.put(key, system, topology, positions, molecule=oe.OEWriteMolToBytes('.oeb', gaff_molecule))
 
     return [system, topology, positions, gaff_molecule]
 
-def create_molecule(iupac_name):
+def create_molecule(iupac_name, charge_service=None):
     """
     Create an OEMol molecule from an IUPAC name.
 
@@ -170,6 +244,8 @@ def create_molecule(iupac_name):
     ----------
     iupac_name : str
         The IUPAC name of the molecule to be created.
+    charge_service : examol.charges.ChargeService, optional, default=None
+        The service used to assign (and cache) charges; see `assign_am1bcc_charges`.
 
     Returns
     -------
@@ -182,22 +258,70 @@ def create_molecule(iupac_name):
 
     # Assign AM1-BCC charges using canonical scheme.
     # TODO: Replace wit updated gaff2xml scheme.
-    molecule = assign_am1bcc_charges(molecule)
-
-    # Assign conformations.
-    from openeye import oeomega
-    omega = oeomega.OEOmega()
-    omega.SetMaxConfs(1)
-    omega(molecule)
+    molecule = assign_am1bcc_charges(molecule, charge_service=charge_service)
+
+    # Assign conformations, reusing the lowest-energy conformer generated during charging if there is one.
+    if molecule.GetDimension() != 3:
+        from openeye import oeomega
+        omega = oeomega.OEOmega()
+        omega.SetMaxConfs(1)
+        omega(molecule)
+    title = molecule.GetTitle()
+    molecule = oe.OEMol(molecule.GetActive())
+    molecule.SetTitle(title)
 
     return molecule
 
+def _parameterize_variant(arguments):
+    """
+    Parameterize a single molecule; used as a worker by `AlchemicalMergedTopologyFactory.addMolecules`.
+
+    Parameters
+    ----------
+    arguments : tuple of (molecule_bytes, implicitSolvent, constraints, cache)
+        The molecule serialized in OEB format, and the options passed to `parameterize_molecule`.
+
+    Returns
+    -------
+    result : dict
+        On success, contains 'system' (the System serialized to XML), 'topology', 'positions', and 'molecule'
+        (the GAFF-typed molecule serialized in OEB format).  On failure, contains only 'error', the formatted traceback.
+
+    """
+    (molecule_bytes, implicitSolvent, constraints, cache) = arguments
+    try:
+        molecule = oe.OEMol()
+        oe.OEReadMolFromBytes(molecule, '.oeb', molecule_bytes)
+        [system, topology, positions, gaff_molecule] = parameterize_molecule(molecule, implicitSolvent=implicitSolvent, constraints=constraints, cache=cache)
+        return dict(system=mm.XmlSerializer.serialize(system), topology=topology, positions=positions,
+                    molecule=oe.OEWriteMolToBytes('.oeb', gaff_molecule))
+    except Exception:
+        return dict(error=traceback.format_exc())
+
 ################################################################################
 # MODULE CONSTANTS
 ################################################################################
 
 ONE_4PI_EPS0 = 138.935456 # OpenMM constant for Coulomb interactions (openmm/platforms/reference/include/SimTKOpenMMRealType.h) in OpenMM units
 
+NONBONDED_LAYOUTS = ['exclusions', 'interaction_groups'] # supported ways of keeping variants from interacting with each other
+
+VALENCE_LAYOUTS = ['shared', 'force_groups'] # supported ways of storing the valence terms of variants
+
+MAX_FORCE_GROUPS = 32 # number of force groups supported by OpenMM
+
+ENVIRONMENT_FORCE_GROUP = 0 # force group of terms that do not depend on alchemical_variant or alchemical_lambda
+
+ALCHEMICAL_FORCE_GROUP = 1 # force group of the shared alchemical Custom*Force objects
+
+ENVIRONMENT_VARIANT = -1 # value of the per-particle `variant` parameter of environment particles in the CustomNonbondedForce
+
+VARIANT_SELECTIONS = ['tabulated', 'delta'] # supported ways for the CustomNonbondedForce to select the active variant
+
+GAFF_BOND_TYPES = { '1' : 1, '2' : 2, '3' : 3, 'am' : 4, 'ar' : 5, 'du' : 6, 'un' : 7, 'nc' : 8 } # integer bond types for the mol2 bond types assigned by antechamber
+
+VALENCE_FORCE_NAMES = ['CustomBondForce', 'CustomAngleForce', 'CustomTorsionForce', 'HarmonicBondForce', 'HarmonicAngleForce', 'PeriodicTorsionForce']
+
 ################################################################################
 # ALCHEMICAL FACTORIES
 ################################################################################
@@ -233,12 +357,31 @@ class AlchemicalMergedTopologyFactory(object):
     ...    variant_index = factory.addMoleculeVariant(gaff_molecule, system, topology, positions)
     >>> [system, topology, positions] = factory.generateMergedTopology(reference_molecule=molecules[0])
 
+    Alternatively, the factory can parameterize the molecules itself, using several worker processes.
+
+    >>> factory = AlchemicalMergedTopologyFactory(environment_system, environment_topology, environment_positions)
+    >>> variant_indices = factory.addMolecules(molecules, nworkers=4)
+    >>> [system, topology, positions] = factory.generateMergedTopology(reference_molecule=molecules[0])
+
     Createa a system and set context parameters.
 
     >>> integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
     >>> context = openmm.Context(system, integrator)
-    >>> context.setParameter('alchemical_variant', 1) # select first molecule
-    >>> context.setParameter('alchemical_lambda', 1.0) # turn molecule on fully
+    >>> set_alchemical_state(context, variant=1) # select first molecule
+    >>> set_alchemical_state(context, alchemical_lambda=1.0) # turn molecule on fully
+
+    With valence_layout='force_groups', the integrator can skip the valence terms of inactive variants.
+    When switching variants, the newly active variant is re-placed onto the current core first.
+
+    >>> factory = AlchemicalMergedTopologyFactory(environment_system, environment_topology, environment_positions, valence_layout='force_groups')
+    >>> variant_indices = factory.addMolecules(molecules)
+    >>> [system, topology, positions] = factory.generateMergedTopology(reference_molecule=molecules[0])
+    >>> integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+    >>> context = openmm.Context(system, integrator)
+    >>> context.setPositions(positions)
+    >>> select_variant(context, integrator, 2, valence_layout='force_groups') # select second molecule
+    >>> positions = context.getState(getPositions=True).getPositions(asNumpy=True)
+    >>> context.setPositions(factory.alignVariant(positions, 1))
 
     Notes
     -----
@@ -273,7 +416,8 @@ class AlchemicalMergedTopologyFactory(object):
 
     """
     def __init__(self, environment_system, environment_topology, environment_positions,
-                       softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2):
+                       softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2, incremental=False, nonbonded_layout='exclusions',
+                       mcss_memo=None, valence_layout='shared', mcss_searcher=None, variant_selection='delta'):
         """\
         Create a factory for generating merged topologies.
 
@@ -289,26 +433,127 @@ class AlchemicalMergedTopologyFactory(object):
             The softcore parameter for Lennard-Jones softening.
         softcore_beta : simtk.unit.Quantity with units compatible with length**2, optional, default = 12*angstroms**2
             The softcore parameter for electrostatics softening.
+        incremental : bool, optional, default=False
+            If True, variants added after the first call to `generateMergedTopology` are appended to the existing merged
+            System/Topology/positions instead of triggering a full rebuild.  A full rebuild only happens when a new variant
+            does not contain the whole common core; these rebuilds are counted in `nrebuilds`.
+        nonbonded_layout : str, optional, default='exclusions'
+            How nonbonded interactions between variants are removed; one of NONBONDED_LAYOUTS.
+            See `add_molecule_to_system` for details.
+        mcss_memo : examol.mcss.MCSSMemo, optional, default=None
+            Memo of pairwise MCSS results used for common-core detection.  Share one memo between factories (or give it a
+            directory) to skip searches already done for other builds or library subsets.  If None, a new in-memory memo is used.
+        valence_layout : str, optional, default='shared'
+            How the valence terms and core restraints of variants are stored; one of VALENCE_LAYOUTS.
+            See `add_molecule_to_system` for details.
+        mcss_searcher : examol.mcss.MCSSSearcher, optional, default=None
+            Runs every MCSS search of the factory and records its search mode, time and match size; the default searcher if None.
+        variant_selection : str, optional, default='delta'
+            How the softcore CustomNonbondedForce selects the active variant; one of VARIANT_SELECTIONS.
+            See `create_softcore_nonbonded_force` for details.  With 'tabulated', `alchemical_variant` and `alchemical_lambda`
+            must only be changed through `set_alchemical_state` (or drivers given these parameter names, which use it).
 
         """
-
-        # Make copies of environment to not destroy original objects.
-        self.environment_system = copy.deepcopy(environment_system)
-        self.environment_topology = copy.deepcopy(environment_topology)
-        self.environment_positions = copy.deepcopy(environment_positions)
+        if oe is None:
+            raise Exception("AlchemicalMergedTopologyFactory requires the OpenEye toolkit (openeye.oechem).")
+        if nonbonded_layout not in NONBONDED_LAYOUTS:
+            raise Exception("Nonbonded layout '%s' unknown; must be one of %s." % (nonbonded_layout, str(NONBONDED_LAYOUTS)))
+        if valence_layout not in VALENCE_LAYOUTS:
+            raise Exception("Valence layout '%s' unknown; must be one of %s." % (valence_layout, str(VALENCE_LAYOUTS)))
+        if variant_selection not in VARIANT_SELECTIONS:
+            raise Exception("Variant selection '%s' unknown; must be one of %s." % (variant_selection, str(VARIANT_SELECTIONS)))
+
+        # Keep an immutable snapshot of the environment so as not to destroy original objects; live copies are only made when generating.
+        self._environment = SystemSnapshot(environment_system, environment_topology, environment_positions)
 
         # Softcore defaults.
         self.softcore_alpha = softcore_alpha
         self.softcore_beta = softcore_beta
 
-        # Storage for molecule variants.
+        # Nonbonded layout for keeping variants from interacting with each other.
+        self.nonbonded_layout = nonbonded_layout
+
+        # Valence layout for variant terms.
+        self.valence_layout = valence_layout
+
+        # Variant selection of the softcore nonbonded force.
+        self.variant_selection = variant_selection
+
+        # Generation-time geometry of each variant, used to re-place variants onto the core; filled for valence_layout='force_groups'.
+        self._variant_geometries = dict()
+
+        # Memoized pairwise MCSS results for common-core detection.
+        if mcss_memo is None:
+            mcss_memo = MCSSMemo()
+        self.mcss_memo = mcss_memo
+
+        # Searcher for every MCSS search, recording statistics.
+        if mcss_searcher is None:
+            mcss_searcher = get_default_mcss_searcher()
+        self.mcss_searcher = mcss_searcher
+
+        # Storage for molecule variants, as immutable snapshots.
         self._molecules = list()
-        self._systems = list()
-        self._topologies = list()
-        self._positions = list()
+        self._snapshots = list()
+
+        # Incremental construction state.
+        self.incremental = incremental
+        self.nrebuilds = 0 # number of full rebuilds triggered by variants that shrink the common core
+        self._reference_molecule = None
+        self._merged = None # state of the most recently generated merged topology, or None if it must be rebuilt
+
+        # Tracebacks of molecules that failed to parameterize in the last call to addMolecules, keyed by position in the batch.
+        self.parameterization_failures = dict()
 
         return
 
+    @property
+    def environment_system(self):
+        """A new copy of the environment System."""
+        return self._environment.getSystem()
+
+    @property
+    def environment_topology(self):
+        """A new copy of the environment Topology."""
+        return self._environment.getTopology()
+
+    @property
+    def environment_positions(self):
+        """The environment positions (read-only)."""
+        return self._environment.getPositions()
+
+    def alignVariant(self, positions, variant_index):
+        """\
+        Re-place a variant onto the current core positions using its geometry at generation time.
+
+        With valence_layout='force_groups', the valence terms and core restraints of inactive variants are not evaluated, so
+        their atoms drift.  Call this after selecting a new variant (and before continuing dynamics) to superimpose the
+        variant's generation-time geometry onto the current positions of the core atoms.
+
+        Parameters
+        ----------
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with length
+            Positions of the merged System.
+        variant_index : int or list of int
+            The index (or indices) of the variant (as returned by `addMoleculeVariant`) to re-place.
+
+        Returns
+        -------
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with length
+            A copy of positions in which the atoms of the variants have been re-placed.
+
+        """
+        variant_indices = variant_index if isinstance(variant_index, (list, tuple, np.ndarray)) else [variant_index]
+        positions = np.array(positions.value_in_unit(unit.angstroms), np.float64)
+        for variant_index in variant_indices:
+            if variant_index not in self._variant_geometries:
+                raise Exception("No geometry stored for variant %d; generate the merged topology with valence_layout='force_groups' first." % variant_index)
+            geometry = self._variant_geometries[variant_index]
+            [rotation, translation] = get_superposition(geometry['positions'][geometry['core_atoms']], positions[geometry['core_targets']])
+            positions[geometry['atoms']] = np.dot(geometry['positions'], rotation) + translation
+
+        return unit.Quantity(positions, unit.angstroms)
+
     def _showMolecule(self, molecule):
         """\
         Show the molecule (for debugging).
@@ -361,44 +606,42 @@ class AlchemicalMergedTopologyFactory(object):
         # Show initial molecule.
         if verbose: self._showMolecule(common_substructure)
 
+        # Match options; these are part of the memo key.
+        from openeye.oechem import OEMCSType_Default, OEExprOpts_StringType, OEExprOpts_IntType
+        options = ('_determineCommonSubstructure', OEExprOpts_StringType, OEExprOpts_IntType, min_atoms, 'OEMCSMaxAtomsCompleteCycles')
+
         # Now delete bits that don't match every other ligand.
         for ligand in ligands[1:]:
             # get ligand name
             ligand_name = ligand.GetTitle()
 
-            # Create an OEMCSSearch from this molecule.
-            from openeye.oechem import OEMCSSearch, OEExprOpts_StringType, OEExprOpts_IntType
-            mcss = OEMCSSearch(ligand, OEExprOpts_StringType, OEExprOpts_IntType)
+            def search():
+                # Create an MCSS search from this molecule, ignoring substructures smaller than 4 atoms
+                # and modifying the scoring function to prefer keeping cycles complete.
+                mcss = self.mcss_searcher.createSearch(ligand, OEExprOpts_StringType, OEExprOpts_IntType, mcss_type=OEMCSType_Default,
+                                                       min_atoms=min_atoms, complete_cycles=True)
 
-            # ignore substructures smaller than 4 atoms
-            mcss.SetMinAtoms(min_atoms)
+                # perform match; we only need to consider one match
+                for match in mcss.Match(common_substructure):
+                    return [ matchpair.target for matchpair in match.GetAtoms() ]
+                return None
 
-            # This modifies scoring function to prefer keeping cycles complete.
-            from openeye.oechem import OEMCSMaxAtomsCompleteCycles
-            mcss.SetMCSFunc( OEMCSMaxAtomsCompleteCycles() )
+            # Reuse the result of an identical search, if one has been done before.
+            matched_atoms = self.mcss_memo.getMatchedAtoms(ligand, common_substructure, options, search)
+            if matched_atoms is None:
+                continue
 
-            # perform match
-            for match in mcss.Match(common_substructure):
-                nmatched = match.NumAtoms()
+            nmatched = len(matched_atoms)
+            if verbose: print "%(ligand_name)s : match size %(nmatched)d atoms" % vars()
 
-                if verbose: print "%(ligand_name)s : match size %(nmatched)d atoms" % vars()
+            # delete all unmatched atoms from common substructure
+            matched_indices = set([ atom.GetIdx() for atom in matched_atoms ])
+            for atom in common_substructure.GetAtoms():
+                if atom.GetIdx() not in matched_indices:
+                    common_substructure.DeleteAtom(atom)
 
-                # build list of matched atoms in common substructure
-                matched_atoms = list()
-                for matchpair in match.GetAtoms():
-                    atom = matchpair.target
-                    matched_atoms.append(atom)
-
-                # delete all unmatched atoms from common substructure
-                for atom in common_substructure.GetAtoms():
-                    if atom not in matched_atoms:
-                        common_substructure.DeleteAtom(atom)
-
-                # Show molecule after pruning.
-                if verbose: self._showMolecule(common_substructure)
-
-                # we only need to consider one match
-                break
+            # Show molecule after pruning.
+            if verbose: self._showMolecule(common_substructure)
 
         # Rename common substructure.
         common_substructure.SetTitle('core')
@@ -428,14 +671,94 @@ class AlchemicalMergedTopologyFactory(object):
         variant_index : int
             The variant index for this molecule.
 
+        Notes
+        -----
+        In incremental mode, if a merged topology has already been generated, the new variant is appended to it directly.
+        If the new variant does not contain the whole common core, the core must shrink and the merged topology is rebuilt
+        from scratch; a warning is issued and `nrebuilds` is incremented when this happens.
+
         """
         variant_index = len(self._molecules)
         self._molecules.append(molecule.CreateCopy())
-        self._systems.append(copy.deepcopy(system))
-        self._topologies.append(copy.deepcopy(topology))
-        self._positions.append(copy.deepcopy(positions))
+        self._snapshots.append(SystemSnapshot(system, topology, positions))
+
+        if self.incremental and (self._merged is not None):
+            match = self._matchCore(self._molecules[variant_index])
+            if match is not None:
+                # Core is unchanged, so only the new variant needs to be appended.
+                self._addVariantToMergedTopology(variant_index)
+            else:
+                # New variant shrinks the common core; everything must be rebuilt.
+                warnings.warn("Variant %d (%s) does not contain the full common core; rebuilding merged topology." % (variant_index, molecule.GetTitle()))
+                self.nrebuilds += 1
+                self._buildMergedTopology(self._reference_molecule)
+
         return variant_index
 
+    def addMolecules(self, molecules, nworkers=None, implicitSolvent=app.OBC1, constraints=None, cache=None, verbose=False):
+        """\
+        Parameterize molecules concurrently and add them as variants.
+
+        Parameters
+        ----------
+        molecules : list of openeye.oechem.OEMol
+            The molecules to parameterize and add, in the order their variants are to be added.
+        nworkers : int, optional, default=None
+            The number of worker processes.  If None, one worker per CPU is used.  If 1, molecules are parameterized in this process.
+        implicitSolvent : default=app.OBC1
+            The implicit solvent model passed to `parameterize_molecule`.
+        constraints : default=None
+            Constraints passed to `parameterize_molecule`.
+        cache : examol.parameterization_cache.ParameterizationCache, optional, default=None
+            If specified, passed to `parameterize_molecule` so that previously parameterized molecules are reused.
+            When nworkers > 1, hit/miss counters are updated in the worker processes rather than in `cache`.
+        verbose : bool, optional, default=False
+            If True, failures are printed as they are collected.
+
+        Returns
+        -------
+        variant_indices : list of int or None
+            variant_indices[i] is the variant index of molecules[i], or None if parameterization of molecules[i] failed.
+
+        Notes
+        -----
+        Variants are added in the order of `molecules` regardless of the order in which workers finish.
+        A failure to parameterize one molecule does not abort the batch; the traceback is stored in
+        `self.parameterization_failures[i]`, keyed by the position of the molecule in `molecules`.
+        Systems are returned from the workers serialized to XML.
+
+        """
+        self.parameterization_failures = dict()
+        if len(molecules) == 0:
+            return list()
+
+        arguments = [ (oe.OEWriteMolToBytes('.oeb', molecule), implicitSolvent, constraints, cache) for molecule in molecules ]
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        if nworkers > 1:
+            pool = multiprocessing.Pool(processes=min(nworkers, len(arguments)))
+            try:
+                results = pool.map(_parameterize_variant, arguments, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ _parameterize_variant(argument) for argument in arguments ]
+
+        variant_indices = list()
+        for (index, result) in enumerate(results):
+            if 'error' in result:
+                if verbose: print "Parameterization of molecule %d (%s) failed:\n%s" % (index, molecules[index].GetTitle(), result['error'])
+                self.parameterization_failures[index] = result['error']
+                variant_indices.append(None)
+                continue
+            gaff_molecule = oe.OEMol()
+            oe.OEReadMolFromBytes(gaff_molecule, '.oeb', result['molecule'])
+            system = mm.XmlSerializer.deserialize(result['system'])
+            variant_indices.append(self.addMoleculeVariant(gaff_molecule, system, result['topology'], result['positions']))
+
+        return variant_indices
+
     def generateMergedTopology(self, reference_molecule=None, verbose=False):
         """\
         Generate an alchemical merged topology for the added molecule variants.
@@ -456,17 +779,148 @@ class AlchemicalMergedTopologyFactory(object):
         positions: simtk.unit.Quantity of (natoms,3) with units compatible with length
             Positions corresponding to constructed system.
 
+        Notes
+        -----
+        In incremental mode, the merged topology from a previous call is returned without rebuilding if the reference molecule
+        is unchanged.  The returned System and Topology are then owned by the factory and will be extended in place by later
+        calls to `addMoleculeVariant`.  The returned positions are not: adding a variant may reallocate the position storage,
+        so positions must be fetched again with `generateMergedTopology` after adding variants.
+
+        """
+        if self.incremental and (self._merged is not None) and (reference_molecule is self._reference_molecule):
+            merged = self._merged
+            return [merged['system'], merged['topology'], merged['position_buffer'].getPositions()]
+
+        self._buildMergedTopology(reference_molecule, verbose=verbose)
+        merged = self._merged
+        if self.incremental:
+            return [merged['system'], merged['topology'], merged['position_buffer'].getPositions()]
+
+        # Discard construction state if we are not going to be extending this merged topology.
+        self._merged = None
+        return [merged['system'], merged['topology'], merged['position_buffer'].getPositions()]
+
+    def getVariantPositions(self, variant_index):
+        """\
+        Return the positions of a single variant within the most recently generated merged topology.
+
+        Only available in incremental mode, where the factory keeps the merged topology after generating it.
+
+        Parameters
+        ----------
+        variant_index : int
+            The variant index returned by `addMoleculeVariant`.
+
+        Returns
+        -------
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with length
+            A view into the merged positions; assigning into it modifies the merged positions in place.
+
+        """
+        if self._merged is None:
+            raise Exception("No merged topology available; call generateMergedTopology() with incremental=True first.")
+        merged = self._merged
+        return merged['position_buffer'].getBlock(merged['variant_blocks'][variant_index])
+
+    def _determineMinimumRMSCharges(self, common_substructure, molecules, min_atoms=4):
+        """\
+        Assign partial charges to a common substructure that best fit the charges of the corresponding atoms in all molecules.
+
+        The charge q_i of core atom i minimizes sum_m sum_i (q_i - q_mi)^2, where q_mi is the partial charge of the atom of
+        molecule m matched to core atom i, subject to the core carrying the total formal charge of its atoms.
+
+        Parameters
+        ----------
+        common_substructure : openeye.oechem.OEMol
+            The common substructure, as returned by `_determineCommonSubstructure`.
+        molecules : list of openeye.oechem.OEMol
+            The molecules (with GAFF atom and bond types and partial charges) that all contain the common substructure.
+        min_atoms : int, optional, default=4
+            Minimum number of atoms for substructure match
+
+        Returns
+        -------
+        core : openeye.oechem.OEMol
+            A copy of `common_substructure` with the fitted partial charges.
+
+        Provenance
+        ----------
+        This replaces determineMinimumRMSCharges from the mmtools repo.
+
+        """
+        core = common_substructure.CreateCopy()
+
+        from openeye.oechem import OEMCSType_Default, OEExprOpts_StringType, OEExprOpts_IntType
+        mcss = self.mcss_searcher.createSearch(core, OEExprOpts_StringType, OEExprOpts_IntType, mcss_type=OEMCSType_Default,
+                                               min_atoms=min_atoms, complete_cycles=True)
+
+        # Average the charges of corresponding atoms over all molecules.
+        charges = dict([ (atom.GetIdx(), 0.0) for atom in core.GetAtoms() ])
+        for molecule in molecules:
+            matched_atoms = None
+            for match in mcss.Match(molecule, True):
+                matched_atoms = [ (matchpair.pattern.GetIdx(), matchpair.target.GetPartialCharge()) for matchpair in match.GetAtoms() ]
+                break
+            if (matched_atoms is None) or (len(matched_atoms) != core.NumAtoms()):
+                raise Exception("Molecule %s does not contain the whole common substructure." % molecule.GetTitle())
+            for (index, charge) in matched_atoms:
+                charges[index] += charge / len(molecules)
+
+        # Spread the excess charge evenly, which is the constrained least-squares solution.
+        total_charge = sum([ atom.GetFormalCharge() for atom in core.GetAtoms() ])
+        excess_charge = (total_charge - sum(charges.values())) / core.NumAtoms()
+        for atom in core.GetAtoms():
+            atom.SetPartialCharge(charges[atom.GetIdx()] + excess_charge)
+
+        return core
+
+    def _matchCore(self, molecule):
+        """\
+        Match the current common core onto a variant molecule.
+
+        Parameters
+        ----------
+        molecule : openeye.oechem.OEMol
+            The molecule (with GAFF atom and bond types) to match the core onto.
+
+        Returns
+        -------
+        match : openeye.oechem.OEMatchBase or None
+            The match of the complete core onto `molecule`, or None if `molecule` does not contain the whole core.
+
+        """
+        core = self._merged['core']
+        mcss = self._merged['mcss']
+        for match in mcss.Match(molecule, True):
+            if match.NumAtoms() == core.NumAtoms():
+                return match
+            break
+        return None
+
+    def _buildMergedTopology(self, reference_molecule=None, verbose=False):
+        """\
+        Build the merged topology from scratch, storing all state needed to append further variants in `self._merged`.
+
+        Parameters
+        ----------
+        reference_molecule : openeye.oechem.OEMol, optional, default=None
+            If specified, a molecule whose positions the core is to be aligned.
+        verbose : bool, optional, default=False
+            If True, will print out lots of debug info.
+
         """
+        self._reference_molecule = reference_molecule
+
         # Copy molecules so as not to accidentally overwrite them.
         molecules = [ molecule.CreateCopy() for molecule in self._molecules ]
 
         # Determine common substructure using exact match of GAFF atom and bond types.
         if verbose: print "Determining common core substructure..."
-        core = oldmmtools.determineCommonSubstructure(molecules, verbose=True)
+        core = self._determineCommonSubstructure(molecules, verbose=verbose)
 
         # Find RMS-fit charges for common intermediate.
         if verbose: print "Determining RMS-fit charges for common intermediate..."
-        core = oldmmtools.determineMinimumRMSCharges(core, molecules)
+        core = self._determineMinimumRMSCharges(core, molecules)
 
         # DEBUG: Write out info for common core / scaffold.
         if verbose:
@@ -478,24 +932,184 @@ class AlchemicalMergedTopologyFactory(object):
             # Write out common substructure in GAFF format.
             filename = 'core.gaff.mol2'
             print "Writing common intermediate with GAFF atomtypes to %s" % filename
-            oldmmtools.writeMolecule(core, filename, preserve_atomtypes=True)
+            ofs = oe.oemolostream(filename)
+            ofs.SetFlavor(oe.OEFormat_MOL2, oe.OEOFlavor_MOL2_Forcefield) # preserve GAFF atom types
+            oe.OEWriteMolecule(ofs, core)
+            ofs.close()
+
+        # Align core to reference molecule, if specified.
+        if reference_molecule is not None:
+            atomexpr = oe.OEExprOpts_StringType # match GAFF atom type (str) exactly
+            bondexpr = oe.OEExprOpts_IntType # match GAFF bond type (int) exactly
+            mcss = self.mcss_searcher.createSearch(reference_molecule, atomexpr, bondexpr, mcss_type=oe.OEMCSType_Default,
+                                                   complete_cycles=True) # prefer keeping cycles complete.
+            match = mcss.Match(core, True)[0]
+            rmat  = oe.OEDoubleArray(9)
+            trans = oe.OEDoubleArray(3)
+            rms = oe.OERMSD(mcss.GetPattern(), core, match, True, rmat, trans)
+            if rms < 0.0:
+                raise Exception("RMS overlay failure")
+            oe.OERotate(core, rmat)
+            oe.OETranslate(core, trans)
 
         # Set up MCSS to detect overlap with common substructure.
         atomexpr = oe.OEExprOpts_StringType # match GAFF atom type (str) exactly
         bondexpr = oe.OEExprOpts_IntType # match GAFF bond type (int) exactly
         min_atoms = 4
-        mcss = oe.OEMCSSearch(core, atomexpr, bondexpr)
-        mcss.SetMinAtoms(min_atoms) # ensure a minimum number of atoms match
-        mcss.SetMCSFunc( oe.OEMCSMaxAtomsCompleteCycles() ) # prefer keeping cycles complete.
-        mcss.SetMaxMatches(1)
+        mcss = self.mcss_searcher.createSearch(core, atomexpr, bondexpr, mcss_type=oe.OEMCSType_Default,
+                                               min_atoms=min_atoms, # ensure a minimum number of atoms match
+                                               complete_cycles=True) # prefer keeping cycles complete.
+
+        # Start from copies of the environment.
+        system = self._environment.getSystem()
+        topology = self._environment.getTopology()
+
+        # Preallocate positions for the environment, the core, and every variant.
+        nparticles = system.getNumParticles() + core.NumAtoms() + sum([ snapshot.nparticles for snapshot in self._snapshots ])
+        position_buffer = PositionBuffer(nparticles)
+        position_buffer.addBlock(self._environment.getPositions())
+
+        self._merged = dict(core=core, mcss=mcss, system=system, topology=topology,
+                            position_buffer=position_buffer, variant_blocks=dict())
+
+        #
+        # Add core atoms and valence terms among core atoms, using the first variant as a template.
+        #
+
+        molecule = molecules[0]
+        match = self._matchCore(molecule)
+        reverse_mapping = dict()
+        for matchpair in match.GetAtoms():
+            reverse_mapping[matchpair.pattern.GetIdx()] = matchpair.target.GetIdx()
+        core_atoms = [ reverse_mapping[core_index] for core_index in range(core.NumAtoms()) ]
+        environment_atoms = range(self._environment.nparticles)
+        core_mapping = add_molecule_to_system(system, self._snapshots[0].getSystem(), core_atoms, variant=0,
+                                              nonbonded_layout=self.nonbonded_layout, environment_atoms=environment_atoms,
+                                              softcore_alpha=self.softcore_alpha, softcore_beta=self.softcore_beta,
+                                              variant_selection=self.variant_selection)
+
+        # add_molecule_to_system adds core particles in the atom order of the first molecule, not in core atom order,
+        # so core atoms are addressed through their system indices.
+        core_system_atoms = dict([ (core_index, core_mapping[reverse_mapping[core_index]]) for core_index in range(core.NumAtoms()) ])
+        atoms = [ atom for atom in core.GetAtoms() ]
+        atoms.sort(key=lambda atom: core_system_atoms[atom.GetIdx()])
+
+        # Add core to topology as a new residue, in the same order as the core particles.
+        chain = topology.addChain()
+        residue = topology.addResidue('COR', chain)
+        for atom in atoms:
+            element = app.Element.getByAtomicNumber(atom.GetAtomicNum())
+            topology.addAtom(atom.GetName(), element, residue)
+
+        # Append core positions, in the same order as the core particles.
+        core_positions = np.array([ core.GetCoords(atom) for atom in atoms ])
+        position_buffer.addBlock(unit.Quantity(core_positions, unit.angstroms))
+
+        # Create restraint force to keep corresponding core atoms from molecules near their corresponding core atoms.
+        restraint_force = create_core_restraint_force()
+        self._variant_geometries = dict()
+
+        self._merged.update(chain=chain, restraint_force=restraint_force, group_restraint_forces=dict(),
+                            core_system_atoms=core_system_atoms, atoms_to_exclude=list(core_mapping.values()), environment_atoms=environment_atoms)
+
+        #
+        # Now, process all molecules.
+        #
+
+        for variant_index in range(len(self._molecules)):
+            self._addVariantToMergedTopology(variant_index, verbose=verbose)
+
+        # Add restraint force to core atoms.
+        # NOTE: This is added after the alchemical Custom*Force objects so that add_molecule_to_system() finds those first.
+        system.addForce(restraint_force)
+
+        return
 
+    def _addVariantToMergedTopology(self, variant_index, verbose=False):
+        """\
+        Append a single variant to the current merged topology.
 
+        Parameters
+        ----------
+        variant_index : int
+            The index of the variant (as returned by `addMoleculeVariant`) to append.
+        verbose : bool, optional, default=False
+            If True, will print out lots of debug info.
+
+        """
+        merged = self._merged
+        molecule = self._molecules[variant_index].CreateCopy()
+        molecule_system = self._snapshots[variant_index].getSystem()
+        variant = variant_index + 1 # variant 0 is reserved for the core
 
-        return [system, topology, positions]
+        if verbose: print "Incorporating molecule %s as variant %d" % (molecule.GetTitle(), variant)
+
+        # Determine common atoms in this molecule.
+        match = self._matchCore(molecule)
+        core_atoms = list()
+        core_atoms_bond_mapping = dict()
+        for matchpair in match.GetAtoms():
+            core_index = matchpair.pattern.GetIdx()
+            molecule_index = matchpair.target.GetIdx()
+            core_atoms.append(molecule_index) # list of atoms in the molecule that correspond to core atoms
+            core_atoms_bond_mapping[molecule_index] = merged['core_system_atoms'][core_index] # index of corresponding core atom in system, for restraining
+
+        # Align molecule to overlay common core.
+        overlay = True
+        rmat  = oe.OEDoubleArray(9)
+        trans = oe.OEDoubleArray(3)
+        rms = oe.OERMSD(merged['mcss'].GetPattern(), molecule, match, overlay, rmat, trans)
+        if rms < 0.0:
+            raise Exception("RMS overlay failure")
+        if verbose: print "RMSD after overlay is %.3f A" % rms
+        oe.OERotate(molecule, rmat)
+        oe.OETranslate(molecule, trans)
+
+        # Append positions of new particles.
+        molecule_positions = np.array([ molecule.GetCoords(atom) for atom in molecule.GetAtoms() ])
+        merged['variant_blocks'][variant_index] = merged['position_buffer'].addBlock(unit.Quantity(molecule_positions, unit.angstroms))
+
+        # Add valence terms and nonbonded exclusions.
+        mapping = add_molecule_to_system(merged['system'], molecule_system, core_atoms, variant=variant, atoms_to_exclude=merged['atoms_to_exclude'],
+                                         nonbonded_layout=self.nonbonded_layout, environment_atoms=merged['environment_atoms'],
+                                         valence_layout=self.valence_layout)
+
+        # Add restraints to keep core atoms from this molecule near their corresponding core atoms.
+        # With valence_layout='force_groups', restraints go to a restraint force in the variant's force group.
+        restraint_force = merged['restraint_force']
+        if self.valence_layout == 'force_groups':
+            force_group = get_variant_force_group(variant)
+            if force_group not in merged['group_restraint_forces']:
+                restraint_force = create_core_restraint_force()
+                restraint_force.setForceGroup(force_group)
+                merged['system'].addForce(restraint_force)
+                merged['group_restraint_forces'][force_group] = restraint_force
+            restraint_force = merged['group_restraint_forces'][force_group]
+        for index in core_atoms:
+            restraint_force.addBond(mapping[index], core_atoms_bond_mapping[index], [])
+
+        # Remember the aligned geometry so the variant can be re-placed onto the core after its valence terms were skipped.
+        if self.valence_layout == 'force_groups':
+            self._variant_geometries[variant_index] = dict(atoms=np.array([ mapping[index] for index in range(molecule_system.getNumParticles()) ]),
+                                                           positions=molecule_positions.copy(),
+                                                           core_atoms=np.array(core_atoms),
+                                                           core_targets=np.array([ core_atoms_bond_mapping[index] for index in core_atoms ]))
+
+        # Add molecule to topology as a new residue.
+        residue = merged['topology'].addResidue('LIG', merged['chain'])
+        for atom in molecule.GetAtoms():
+            element = app.Element.getByAtomicNumber(atom.GetAtomicNum())
+            merged['topology'].addAtom(atom.GetName(), element, residue)
+
+        # Append to list of atoms to be excluded.
+        merged['atoms_to_exclude'] += mapping.values()
+
+        return
 
 def create_merged_topology(system, topology, positions,
                            molecules,
-                           softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2):
+                           softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2, nonbonded_layout='exclusions',
+                           nworkers=None, cache=None):
     """
     Create an OpenMM system that utilizes a merged topology that can interpolate between many small molecules sharing a common core.
 
@@ -503,6 +1117,8 @@ def create_merged_topology(system, topology, positions,
     -----
     * Currently, only one set of molecules is supported.
     * Residue mutations are not yet supported.
+    * This is a convenience wrapper that parameterizes `molecules` with `AlchemicalMergedTopologyFactory.addMolecules`
+      and builds the merged topology with `AlchemicalMergedTopologyFactory.generateMergedTopology`.
 
     Parameters
     ----------
@@ -518,6 +1134,13 @@ def create_merged_topology(system, topology, positions,
        Softcore parameter for Lennard-Jones softening.
     softcore_beta : simtk.unit.Quantity with units compatible with angstrom**2
        Softcore parameter for Coulomb interaction softening.
+    nonbonded_layout : str, optional, default='exclusions'
+       How nonbonded interactions between variants are removed; one of NONBONDED_LAYOUTS.
+       See `add_molecule_to_system` for details.
+    nworkers : int, optional, default=None
+       The number of worker processes used to parameterize the molecules; see `AlchemicalMergedTopologyFactory.addMolecules`.
+    cache : examol.parameterization_cache.ParameterizationCache, optional, default=None
+       If specified, previously parameterized molecules are reused.
 
     Returns
     -------
@@ -525,158 +1148,420 @@ def create_merged_topology(system, topology, positions,
        Modified version of system in which old system is recovered for global context paramaeter `lambda` = 0 and new molecule is substituted for `lambda` = 1.
     topology : system.openmm.Topology
        Topology corresponding to system.
+    positions : simtk.unit.Quantity of (natoms,3) with units compatible with length
+       Positions corresponding to system.
 
     """
+    factory = AlchemicalMergedTopologyFactory(system, topology, positions, softcore_alpha=softcore_alpha, softcore_beta=softcore_beta,
+                                              nonbonded_layout=nonbonded_layout)
+    factory.addMolecules(molecules, nworkers=nworkers, cache=cache)
+    if len(factory.parameterization_failures) > 0:
+        index = min(factory.parameterization_failures.keys())
+        raise Exception("Parameterization of molecule %d (%s) failed:\n%s" % (index, molecules[index].GetTitle(), factory.parameterization_failures[index]))
 
-    #
-    # First, process first molecule so we can add common substructure atoms to System along with valence terms among core atoms.
-    #
+    # The core keeps the coordinates of the first molecule.
+    return factory.generateMergedTopology()
 
-    # Use the first molecule as a reference molecule.
-    # TODO: Replace this with a different reference molecule.
-    molecule = molecules[0].CreateCopy()
-    gaff_molecule = gaff_molecules[0].CreateCopy()
+def get_term_arrays(force):
+    """
+    Extract the terms of a standard force into arrays of atom indices and unit-stripped parameters.
 
-    # Determine common atoms in second molecule.
-    matches = [ match for match in mcss.Match(gaff_molecule, True) ]
-    match = matches[0] # we only need the first match
+    Parameters
+    ----------
+    force : simtk.openmm.Force
+       A force with a single term kind in FORCE_TABLE_LAYOUTS, or NonbondedForce, for which exceptions are extracted.
 
-    # Make a list of the atoms in core.
-    reverse_mapping = dict()
-    print "molecule => core mapping"
-    for matchpair in match.GetAtoms():
-        core_index = matchpair.pattern.GetIdx()
-        molecule_index = matchpair.target.GetIdx()
-        print "%8d => %8d" % (molecule_index, core_index)
-        reverse_mapping[core_index] = molecule_index
-    # Make sure the list of atoms in molecule corresponds to the ordering of atoms within the core.
-    core_atoms = [ reverse_mapping[core_index] for core_index in range(core.NumAtoms()) ]
+    Returns
+    -------
+    indices : numpy.ndarray of (nterms, nindices) int
+       indices[term,:] are the atom indices of term `term`.
+    parameters : numpy.ndarray of (nterms, nparameters) float
+       parameters[term,:] are the parameters of term `term`, in OpenMM (md_unit_system) units.
 
-    # Create OpenMM Topology and System objects for given molecules using GAFF/AM1-BCC.
-    print "Generating OpenMM system for molecule..."
-    [molecule_system, molecule_topology, molecule_positions] = generate_openmm_system(molecule)
+    """
+    table = get_force_table(force, kind=('exceptions' if (force.__class__.__name__ == 'NonbondedForce') else None))
+    names = [ name for name in table.dtype.names if (name != 'atoms') ]
+    parameters = np.array([ table[name] for name in names ], np.float64).T.reshape([len(table), len(names)])
+    return [table['atoms'], parameters]
 
-    # TODO: Replace charges in molecule with RMS charges.
+def classify_core_terms(indices, core_atoms, nparticles):
+    """
+    Determine which terms involve only core atoms.
 
-    # Add core fragment to system.
-    core_mapping = add_molecule_to_system(system, molecule_system, core_atoms, variant=0)
+    Parameters
+    ----------
+    indices : numpy.ndarray of (nterms, nindices) int
+       Atom indices of each term, as returned by `get_term_arrays`.
+    core_atoms : list of int
+       The atom indices (within the same molecule) corresponding to core atoms.
+    nparticles : int
+       The number of particles in the molecule.
 
-    # Add molecule to topology as a new residue.
-    chain = topology.addChain()
-    residue = topology.addResidue('COR', chain)
-    atoms = [ atom for atom in molecule.GetAtoms() ] # build a list of all atoms in reference molecule
-    atoms = [ atoms[index] for index in core_atoms ] # select out only core atoms in proper order
-    for atom in atoms:
-        name = atom.GetName()
-        atomic_number = atom.GetAtomicNum()
-        element = app.Element.getByAtomicNumber(atomic_number)
-        topology.addAtom(name, element, residue)
+    Returns
+    -------
+    is_core_term : numpy.ndarray of (nterms,) bool
+       is_core_term[term] is True if all atoms of term `term` are core atoms.
 
-    # Append positions of new particles.
-    positions = unit.Quantity(np.append(positions/positions.unit, molecule_positions[core_atoms,:]/positions.unit, axis=0), positions.unit)
+    """
+    is_core_atom = np.zeros([nparticles], bool)
+    is_core_atom[list(core_atoms)] = True
+    return is_core_atom[indices].all(axis=1)
 
-    # Create a running list of atoms all variants should have interactions excluded with.
-    atoms_to_exclude = core_mapping.values()
+def get_variant_force_group(variant):
+    """
+    Return the force group holding the valence and softcore nonbonded terms of a variant in the 'force_groups' valence layout.
 
-    #
-    # Create restraint force to keep corresponding core atoms from molecules near their corresponding core atoms.
-    # TODO: Can we replace these with length-zero constraints or virtual particles if OpenMM supports this in the future?
-    #
+    Parameters
+    ----------
+    variant : int
+       The variant index (the value of the `alchemical_variant` context parameter), or 0 for the core.
 
-    K = 10.0 * unit.kilocalories_per_mole / unit.angstrom**2 # spring constant
-    energy_expression  = '(K/2) * r^2;'
-    energy_expression += 'K = %f;' % K.value_in_unit_system(unit.md_unit_system)
-    restraint_force = mm.CustomBondForce(energy_expression)
+    Returns
+    -------
+    force_group : int
+       ENVIRONMENT_FORCE_GROUP holds the environment and non-alchemical terms, ALCHEMICAL_FORCE_GROUP holds the shared
+       alchemical forces (core valence terms and the CustomNonbondedForce of core interactions); variants are distributed over
+       the remaining groups, each of which has its own valence forces, core restraints and CustomNonbondedForce.
+       Libraries with more than MAX_FORCE_GROUPS-2 variants share groups, so variants in the same group are evaluated together.
 
-    #
-    # Now, process all molecules.
-    #
+    """
+    if variant == 0:
+        return ALCHEMICAL_FORCE_GROUP
+    return 2 + (variant - 1) % (MAX_FORCE_GROUPS - 2)
 
-    variants = list()
+def get_variant_force_groups(variant):
+    """
+    Return the set of force groups that must be evaluated when `variant` is active in the 'force_groups' valence layout.
 
-    variant = 1
-    for (molecule, gaff_molecule) in zip(molecules, gaff_molecules):
-        print ""
-        print "*******************************************************"
-        print "Incorporating molecule %s" % molecule.GetTitle()
-        print "*******************************************************"
-        print ""
+    """
+    return set([ENVIRONMENT_FORCE_GROUP, ALCHEMICAL_FORCE_GROUP, get_variant_force_group(variant)])
 
-        # Determine common atoms in second molecule.
-        matches = [ match for match in mcss.Match(gaff_molecule, True) ]
-        print matches
-        match = matches[0] # we only need the first match
+def select_variant(context, integrator, variant, valence_layout='shared'):
+    """
+    Make a variant active, restricting the integrator to the force groups it needs.
 
-        # Make a list of the atoms in core.
-        core_atoms = list()
-        core_atoms_bond_mapping = dict()
-        print "molecule => core mapping"
-        for matchpair in match.GetAtoms():
-            core_index = matchpair.pattern.GetIdx()
-            molecule_index = matchpair.target.GetIdx()
-            core_atoms.append(molecule_index) # list of atoms in the molecule that correspond to core atoms
-            print "%8d => %8d" % (molecule_index, core_index)
-            core_atoms_bond_mapping[molecule_index] = core_mapping[core_index] # index of corresponding core atom in system, for restraining
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+       The Context of the merged System.
+    integrator : simtk.openmm.Integrator
+       The integrator of `context`.
+    variant : int
+       The variant index (the value of the `alchemical_variant` context parameter) to make active.
+    valence_layout : str, optional, default='shared'
+       The valence layout the merged System was built with.  With 'force_groups', only the groups returned by
+       `get_variant_force_groups(variant)` are integrated; this requires OpenMM's Integrator.setIntegrationForceGroups.
 
-        # Align molecule to overlay common core.
-        overlay = True
-        rmat  = oe.OEDoubleArray(9)
-        trans = oe.OEDoubleArray(3)
-        rms = oe.OERMSD(mcss.GetPattern(), gaff_molecule, match, overlay, rmat, trans)
-        if rms < 0.0:
-            raise Exception("RMS overlay failure")
-        print "RMSD after overlay is %.3f A" % rms
-        oe.OERotate(gaff_molecule, rmat)
-        oe.OETranslate(gaff_molecule, trans)
+    """
+    set_alchemical_state(context, variant=variant)
+    if valence_layout == 'force_groups':
+        integrator.setIntegrationForceGroups(get_variant_force_groups(variant))
 
-        # Transfer positions to regular molecule with Tripos atom types.
-        gaff_atoms = [ atom for atom in gaff_molecule.GetAtoms() ]
-        atoms = [ atom for atom in molecule.GetAtoms() ]
-        for (source_atom, dest_atom) in zip(gaff_atoms, atoms):
-            molecule.SetCoords(atom, gaff_molecule.GetCoords(atom))
+def get_environment_force_groups(valence_layout='shared'):
+    """
+    Return the set of force groups whose energy does not depend on `alchemical_variant` or `alchemical_lambda`.
 
-        # Create OpenMM Topology and System objects for given molecules using GAFF/AM1-BCC.
-        print "Generating OpenMM system for molecule..."
-        [molecule_system, molecule_topology, molecule_positions] = generate_openmm_system(molecule)
+    """
+    if valence_layout == 'force_groups':
+        return set([ENVIRONMENT_FORCE_GROUP])
+    return set(range(MAX_FORCE_GROUPS)) - set([ALCHEMICAL_FORCE_GROUP])
 
-        # Append positions of new particles.
-        positions = unit.Quantity(np.append(positions/positions.unit, molecule_positions/positions.unit, axis=0), positions.unit)
+def get_alchemical_force_groups(variant, valence_layout='shared'):
+    """
+    Return the set of force groups whose energy must be evaluated for `variant`, in addition to `get_environment_force_groups`.
 
-        # Add valence terms only.
-        mapping = add_molecule_to_system(system, molecule_system, core_atoms, variant=variant, atoms_to_exclude=atoms_to_exclude)
+    """
+    if valence_layout == 'force_groups':
+        return get_variant_force_groups(variant) - get_environment_force_groups(valence_layout)
+    return set([ALCHEMICAL_FORCE_GROUP])
 
-        # DEBUG
-        print "Atom mappings into System object:"
-        print mapping
+def compute_variant_reduced_potentials(context, variants, temperature, alchemical_lambda=None, valence_layout='shared'):
+    """
+    Compute the reduced potential of every variant at the current positions.
 
-        # Add restraints to keep core atoms from this molecule near their corresponding core atoms.
-        for index in core_atoms:
-            restraint_force.addBond(mapping[index], core_atoms_bond_mapping[index], [])
+    The energy of ENVIRONMENT_FORCE_GROUP, which does not depend on the variant or lambda, is computed once.
+    With valence_layout='force_groups', the energy of ALCHEMICAL_FORCE_GROUP (core valence terms and core softcore
+    interactions), which is the same for every variant other than the core, is also computed once, so each variant
+    only costs the evaluation of its own force group.  With valence_layout='shared', all alchemical terms of all
+    variants are in ALCHEMICAL_FORCE_GROUP and are evaluated for each variant; this is a convenience over setting
+    `alchemical_variant` by hand, and only saves the environment evaluations.
 
-        # Add molecule to topology as a new residue.
-        # TODO: Can we simplify this by copying from molecule_topology instead?
-        residue = topology.addResidue('LIG', chain)
-        for atom in atoms:
-            name = atom.GetName()
-            atomic_number = atom.GetAtomicNum()
-            element = app.Element.getByAtomicNumber(atomic_number)
-            topology.addAtom(name, element, residue)
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+       The Context of the merged System.  Its `alchemical_variant` and `alchemical_lambda` parameters are restored on return.
+    variants : list of int
+       The variant indices (values of the `alchemical_variant` context parameter) to evaluate.
+    temperature : simtk.unit.Quantity with units compatible with kelvin
+       The temperature used to compute reduced potentials.
+    alchemical_lambda : float, optional, default=None
+       The value of `alchemical_lambda` to evaluate at, or None to use the current value.
+    valence_layout : str, optional, default='shared'
+       The valence layout the merged System was built with.
 
-        # Increment variant index.
-        variant += 1
+    Returns
+    -------
+    u_k : numpy.ndarray of (nvariants,) float
+       u_k[k] is the reduced potential of variant variants[k].
 
-        # Append to list of atoms to be excluded.
-        atoms_to_exclude += mapping.values()
+    Notes
+    -----
+    With valence_layout='force_groups', the potential of a variant is that of `get_variant_force_groups(variant)`, i.e. the
+    Hamiltonian actually integrated after `select_variant`; the pV contribution of barostatted simulations is not included.
+    See examples/benchmarks/variant_energy_benchmark.py for timings of both layouts.
+
+    """
+    kT = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA * temperature
+    initial_variant = context.getParameter('alchemical_variant')
+    initial_lambda = context.getParameter('alchemical_lambda')
+    if alchemical_lambda is not None:
+        set_alchemical_state(context, alchemical_lambda=alchemical_lambda)
+
+    # Variant-independent terms are evaluated once.
+    environment_energy = context.getState(getEnergy=True, groups=get_environment_force_groups(valence_layout)).getPotentialEnergy()
+
+    # Core terms couple with 1-alchemical_lambda whichever variant other than the core is selected, so they are evaluated once.
+    core_energy = None
+
+    u_k = np.zeros([len(variants)], np.float64)
+    for (k, variant) in enumerate(variants):
+        set_alchemical_state(context, variant=variant)
+        if (valence_layout == 'force_groups') and (variant):
+            if core_energy is None:
+                core_energy = context.getState(getEnergy=True, groups=set([ALCHEMICAL_FORCE_GROUP])).getPotentialEnergy()
+            alchemical_energy = core_energy + context.getState(getEnergy=True, groups=set([get_variant_force_group(variant)])).getPotentialEnergy()
+        else:
+            alchemical_energy = context.getState(getEnergy=True, groups=get_alchemical_force_groups(variant, valence_layout)).getPotentialEnergy()
+        u_k[k] = (environment_energy + alchemical_energy) / kT
+
+    set_alchemical_state(context, variant=initial_variant, alchemical_lambda=initial_lambda)
+
+    return u_k
+
+def get_superposition(mobile, target):
+    """
+    Find the rigid transformation that best superimposes mobile onto target (Kabsch algorithm).
+
+    Parameters
+    ----------
+    mobile : numpy.ndarray of (natoms,3)
+       The coordinates to move.
+    target : numpy.ndarray of (natoms,3)
+       The coordinates to superimpose onto.
+
+    Returns
+    -------
+    rotation : numpy.ndarray of (3,3)
+       Rotation matrix acting on row vectors.
+    translation : numpy.ndarray of (3,)
+       Translation applied after rotation, so that np.dot(mobile, rotation) + translation ~= target.
+
+    """
+    mobile_center = mobile.mean(axis=0)
+    target_center = target.mean(axis=0)
+    covariance = np.dot((mobile - mobile_center).T, target - target_center)
+    [U, S, Vt] = np.linalg.svd(covariance)
+    # Avoid reflections.
+    D = np.diag([1.0, 1.0, np.sign(np.linalg.det(np.dot(U, Vt)))])
+    rotation = np.dot(np.dot(U, D), Vt)
+    translation = target_center - np.dot(mobile_center, rotation)
+    return [rotation, translation]
+
+def create_core_restraint_force():
+    """
+    Create the CustomBondForce that keeps core-corresponding atoms of variants near their core atoms.
+
+    """
+    # TODO: Can we replace these with length-zero constraints or virtual particles if OpenMM supports this in the future?
+    K = 10.0 * unit.kilocalories_per_mole / unit.angstrom**2 # spring constant
+    energy_expression  = '(K/2) * r^2;'
+    energy_expression += 'K = %f;' % K.value_in_unit_system(unit.md_unit_system)
+    return mm.CustomBondForce(energy_expression)
+
+def create_alchemical_valence_forces():
+    """
+    Create the Custom*Force objects that interpolate valence terms among core atoms.
+
+    Returns
+    -------
+    forces : list of simtk.openmm.Force
+       CustomBondForce, CustomAngleForce and CustomTorsionForce, with a per-term `variant` parameter.
+       A term is scaled by (1-alchemical_lambda) for the core (variant 0) and by alchemical_lambda for the active variant.
+
+    """
+    energy_expression  = 'lambda*(K/2)*(r-length)^2;'
+    energy_expression += 'lambda = (1-alchemical_lambda)*delta(variant) + alchemical_lambda*delta(variant-alchemical_variant);'
+    bond_force = mm.CustomBondForce(energy_expression)
+    bond_force.addGlobalParameter('alchemical_lambda', 0.0)
+    bond_force.addGlobalParameter('alchemical_variant', 0.0)
+    bond_force.addPerBondParameter('variant')
+    bond_force.addPerBondParameter('length')
+    bond_force.addPerBondParameter('K')
+
+    energy_expression  = 'lambda*(K/2)*(theta-theta0)^2;'
+    energy_expression += 'lambda = (1-alchemical_lambda)*delta(variant) + alchemical_lambda*delta(variant-alchemical_variant);'
+    angle_force = mm.CustomAngleForce(energy_expression)
+    angle_force.addGlobalParameter('alchemical_lambda', 0.0)
+    angle_force.addGlobalParameter('alchemical_variant', 0.0)
+    angle_force.addPerAngleParameter('variant')
+    angle_force.addPerAngleParameter('theta0')
+    angle_force.addPerAngleParameter('K')
+
+    energy_expression  = 'lambda*K*(1+cos(periodicity*theta-phase));'
+    energy_expression += 'lambda = (1-alchemical_lambda)*delta(variant) + alchemical_lambda*delta(variant-alchemical_variant);'
+    torsion_force = mm.CustomTorsionForce(energy_expression)
+    torsion_force.addGlobalParameter('alchemical_lambda', 0.0)
+    torsion_force.addGlobalParameter('alchemical_variant', 0.0)
+    torsion_force.addPerTorsionParameter('variant')
+    torsion_force.addPerTorsionParameter('periodicity')
+    torsion_force.addPerTorsionParameter('phase')
+    torsion_force.addPerTorsionParameter('K')
+
+    return [bond_force, angle_force, torsion_force]
+
+def create_softcore_nonbonded_force(nonbonded_force, softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2, variant_selection='delta'):
+    """
+    Create the CustomNonbondedForce handling softcore interactions between alchemical particles and the environment.
+
+    Each particle carries a `variant` parameter: ENVIRONMENT_VARIANT for the environment, 0 for the core, and the variant index otherwise.
+    A particle is coupled with lambda = 1 (environment), 1 - alchemical_lambda (core, or 1 if `alchemical_variant` is 0),
+    alchemical_lambda (the variant selected by `alchemical_variant`) or 0 (other variants), as for the alchemical valence terms.
+    A pair interacts through softcore Lennard-Jones and Coulomb with the product of the couplings of its particles.
+    Environment-environment pairs are left to the NonbondedForce; `add_molecule_to_system` adds interaction groups so
+    that they are not evaluated at all.
+
+    Parameters
+    ----------
+    nonbonded_force : simtk.openmm.NonbondedForce
+       The NonbondedForce whose nonbonded method, cutoff and electrostatics treatment are mirrored.
+       NoCutoff, CutoffNonPeriodic/CutoffPeriodic (reaction field) and PME/Ewald (direct space only) are supported.
+    softcore_alpha : float, optional, default=0.5
+       Softcore parameter for Lennard-Jones softening.
+    softcore_beta : simtk.unit.Quantity with units compatible with angstrom**2, optional, default=12*angstrom**2
+       Softcore parameter for Coulomb softening.
+    variant_selection : str, optional, default='delta'
+       'delta' computes the coupling of every pair from `alchemical_variant` and `alchemical_lambda` with delta() arithmetic.
+       'tabulated' looks up the coupling of each particle in the Discrete1DFunction `variant_lambda`, indexed by variant,
+       which must be kept in sync with the context parameters through `set_alchemical_state`.
+       On the CPU platform the per-pair costs differ by less than the softcore terms themselves (the table is faster with a cutoff,
+       slower without), while refreshing the table costs about two energy evaluations (see examples/benchmarks/softcore_nonbonded_benchmark.py).
+
+    Returns
+    -------
+    custom_force : simtk.openmm.CustomNonbondedForce
+       The force, with no particles; use `resize_variant_table` as variants are added.
+
+    """
+    if variant_selection not in VARIANT_SELECTIONS:
+        raise Exception("Variant selection '%s' unknown; must be one of %s." % (variant_selection, str(VARIANT_SELECTIONS)))
+
+    # Select electrostatics functional form based on nonbonded method.
+    method = nonbonded_force.getNonbondedMethod()
+    if method in [mm.NonbondedForce.NoCutoff]:
+        electrostatics_energy_expression = "U_electrostatics = ONE_4PI_EPS0*lambda*chargeprod/reff_electrostatics;"
+    elif method in [mm.NonbondedForce.CutoffPeriodic, mm.NonbondedForce.CutoffNonPeriodic]:
+        # reaction-field electrostatics
+        epsilon_solvent = nonbonded_force.getReactionFieldDielectric()
+        r_cutoff = nonbonded_force.getCutoffDistance()
+        k_rf = r_cutoff**(-3) * ((epsilon_solvent - 1) / (2*epsilon_solvent + 1))
+        c_rf = r_cutoff**(-1) * ((3*epsilon_solvent) / (2*epsilon_solvent + 1))
+        electrostatics_energy_expression  = "U_electrostatics = lambda*ONE_4PI_EPS0*chargeprod*(reff_electrostatics^(-1) + k_rf*reff_electrostatics^2 - c_rf);"
+        electrostatics_energy_expression += "k_rf = %f;" % k_rf.value_in_unit_system(unit.md_unit_system)
+        electrostatics_energy_expression += "c_rf = %f;" % c_rf.value_in_unit_system(unit.md_unit_system)
+    elif method in [mm.NonbondedForce.PME, mm.NonbondedForce.Ewald]:
+        # Ewald direct-space electrostatics; the reciprocal-space contribution of alchemical particles is not included.
+        [alpha_ewald, nx, ny, nz] = nonbonded_force.getPMEParameters()
+        alpha_ewald = alpha_ewald.value_in_unit_system(unit.md_unit_system)
+        if alpha_ewald == 0.0:
+            # If alpha is 0.0, alpha_ewald is computed by OpenMM from from the error tolerance.
+            delta = nonbonded_force.getEwaldErrorTolerance()
+            r_cutoff = nonbonded_force.getCutoffDistance().value_in_unit_system(unit.md_unit_system)
+            alpha_ewald = np.sqrt(-np.log(2*delta)) / r_cutoff
+        electrostatics_energy_expression  = "U_electrostatics = lambda*ONE_4PI_EPS0*chargeprod*erfc(alpha_ewald*reff_electrostatics)/reff_electrostatics;"
+        electrostatics_energy_expression += "alpha_ewald = %f;" % alpha_ewald
+    else:
+        raise Exception("Nonbonded method %s not supported yet." % str(method))
+
+    # Softcore Lennard-Jones and common definitions.
+    energy_expression  = "select(alchemical, U_sterics + U_electrostatics, 0);"
+    energy_expression += "U_sterics = lambda*4*epsilon*x*(x-1.0); x = (sigma/reff_sterics)^6;"
+    energy_expression += electrostatics_energy_expression
+    energy_expression += "reff_sterics = sigma*((softcore_alpha*(1.-lambda) + (r/sigma)^6))^(1/6);" # effective softcore distance for sterics
+    energy_expression += "softcore_alpha = %f;" % softcore_alpha
+    energy_expression += "reff_electrostatics = sqrt(softcore_beta*(1.-lambda) + r^2);" # effective softcore distance for electrostatics
+    energy_expression += "softcore_beta = %f;" % softcore_beta.value_in_unit_system(unit.md_unit_system)
+    energy_expression += "ONE_4PI_EPS0 = %f;" % ONE_4PI_EPS0 # already in OpenMM units
+
+    # Variant selection.
+    if variant_selection == 'tabulated':
+        energy_expression += "lambda = variant_lambda(variant1+1)*variant_lambda(variant2+1);"
+    else:
+        energy_expression += "lambda = lambda1*lambda2;"
+        energy_expression += "lambda1 = step(-0.5-variant1) + (1-alchemical_lambda)*delta(variant1) + alchemical_lambda*delta(variant1-alchemical_variant);"
+        energy_expression += "lambda2 = step(-0.5-variant2) + (1-alchemical_lambda)*delta(variant2) + alchemical_lambda*delta(variant2-alchemical_variant);"
+    energy_expression += "alchemical = step(variant1+variant2+1.5);" # zero only for environment-environment pairs
+
+    # Mixing rules.
+    energy_expression += "epsilon = sqrt(epsilon1*epsilon2);" # mixing rule for epsilon
+    energy_expression += "sigma = 0.5*(sigma1 + sigma2);" # mixing rule for sigma
+    energy_expression += "chargeprod = charge1*charge2;" # mixing rule for charges
+
+    custom_force = mm.CustomNonbondedForce(energy_expression)
+    custom_force.addGlobalParameter('alchemical_lambda', 0.0)
+    custom_force.addGlobalParameter('alchemical_variant', 0.0)
+    custom_force.addPerParticleParameter('variant')
+    custom_force.addPerParticleParameter('charge')
+    custom_force.addPerParticleParameter('sigma')
+    custom_force.addPerParticleParameter('epsilon')
+    if variant_selection == 'tabulated':
+        # Table indexed by variant+1, i.e. environment, core, then variants; sized for the core until variants are added.
+        custom_force.addTabulatedFunction('variant_lambda', mm.Discrete1DFunction(compute_variant_lambdas(2, 0, 0.0)))
+
+    # Set periodicity and cutoff parameters corresponding to the NonbondedForce, since all nonbonded forces must agree on them.
+    if method in [mm.NonbondedForce.Ewald, mm.NonbondedForce.PME, mm.NonbondedForce.CutoffPeriodic]:
+        custom_force.setNonbondedMethod(mm.CustomNonbondedForce.CutoffPeriodic)
+    else:
+        custom_force.setNonbondedMethod(method)
+    custom_force.setCutoffDistance(nonbonded_force.getCutoffDistance())
+    custom_force.setUseSwitchingFunction(nonbonded_force.getUseSwitchingFunction())
+    custom_force.setSwitchingDistance(nonbonded_force.getSwitchingDistance())
+    custom_force.setUseLongRangeCorrection(False)
+
+    return custom_force
 
-    print "Done!"
+def resize_variant_table(force, variant):
+    """
+    Grow the variant table of a CustomNonbondedForce created by `create_softcore_nonbonded_force` to include `variant`.
 
-    # Add restraint force to core atoms.
-    # NOTE: This cannot be added to system earlier because of dict lookup for 'CustomBondForce' in add_valence_terms().
-    system.addForce(restraint_force)
+    """
+    table = get_variant_table(force)
+    if (table is None) or (variant + 2 <= len(table.getFunctionParameters())):
+        return
+    table.setFunctionParameters(compute_variant_lambdas(variant + 2, 0, 0.0))
 
-    return [system, topology, positions]
+def copy_softcore_nonbonded_force(force):
+    """
+    Create a CustomNonbondedForce with the energy expression, parameters, variant table and cutoff settings of `force`, but no particles.
 
-def add_molecule_to_system(system, molecule_system, core_atoms, variant, atoms_to_exclude=[]):
+    """
+    custom_force = mm.CustomNonbondedForce(force.getEnergyFunction())
+    for index in range(force.getNumGlobalParameters()):
+        custom_force.addGlobalParameter(force.getGlobalParameterName(index), force.getGlobalParameterDefaultValue(index))
+    for index in range(force.getNumPerParticleParameters()):
+        custom_force.addPerParticleParameter(force.getPerParticleParameterName(index))
+    table = get_variant_table(force)
+    if table is not None:
+        custom_force.addTabulatedFunction('variant_lambda', mm.Discrete1DFunction(table.getFunctionParameters()))
+    custom_force.setNonbondedMethod(force.getNonbondedMethod())
+    custom_force.setCutoffDistance(force.getCutoffDistance())
+    custom_force.setUseSwitchingFunction(force.getUseSwitchingFunction())
+    custom_force.setSwitchingDistance(force.getSwitchingDistance())
+    custom_force.setUseLongRangeCorrection(force.getUseLongRangeCorrection())
+    return custom_force
+
+def add_molecule_to_system(system, molecule_system, core_atoms, variant, atoms_to_exclude=[],
+                           nonbonded_layout='exclusions', environment_atoms=None, valence_layout='shared',
+                           softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2, variant_selection='delta'):
     """
     Add the valence terms for the molecule from molecule_system.
 
@@ -690,13 +1575,60 @@ def add_molecule_to_system(system, molecule_system, core_atoms, variant, atoms_t
        The list of atom indices within molecule_system corresponding to core atoms.
     variant : int
        The variant index of this molecule if not a core fragment, or 0 if this is a core fragment and only core atoms are to be added.
+    atoms_to_exclude : list of int, optional, default=[]
+       Atoms in `system` (core and previous variants) that the new atoms must not interact with.
+       Only used if nonbonded_layout='exclusions'.
+    nonbonded_layout : str, optional, default='exclusions'
+       How nonbonded interactions between the new atoms and the core or other variants are removed.
+       'exclusions' adds a NonbondedForce exception and a CustomNonbondedForce exclusion for every pair of new atom and atom in `atoms_to_exclude`,
+       so the number of exclusions grows quadratically with the number of variants.  The CustomNonbondedForce is restricted to
+       pairs involving alchemical atoms by one interaction group, which is extended with the new atoms.
+       'interaction_groups' instead adds two CustomNonbondedForce interaction groups, pairing the new atoms with `environment_atoms`
+       and with each other, so the new atoms never interact with the core or other variants by construction and no exclusions
+       between them are needed.  Exclusions from the exceptions of the molecule itself are still added.
+       Both layouts evaluate the same pairs and give the same energy.
+    environment_atoms : list of int, optional, default=None
+       Atoms in `system` belonging to the environment.  Required if nonbonded_layout='interaction_groups'.
+    valence_layout : str, optional, default='shared'
+       Where the valence terms of a variant (variant > 0) are stored.
+       'shared' adds them to the Custom*Force objects shared by all variants and to the standard valence forces of `system`,
+       so every term of every variant is evaluated on every step.
+       'force_groups' adds them to separate force objects in force group `get_variant_force_group(variant)`, together with a
+       CustomNonbondedForce holding the softcore interactions of the variant with the environment and within itself,
+       so that an integrator restricted to `get_variant_force_groups(variant)` (see `select_variant`) skips both the valence
+       and the softcore nonbonded terms of inactive variants.  Every CustomNonbondedForce holds all particles and exclusions,
+       which OpenMM requires, so this layout is best combined with nonbonded_layout='interaction_groups'.
+       In both layouts, the shared Custom*Force objects (holding core terms) and the shared CustomNonbondedForce are placed in
+       ALCHEMICAL_FORCE_GROUP, so that variant-independent terms can be evaluated separately (see `compute_variant_reduced_potentials`).
+       The first CustomBondForce of a group is taken to be its alchemical bond force, so forces such as core restraints
+       may only be added to a group after its first variant.
+    softcore_alpha : float, optional, default=0.5
+       Softcore parameter for Lennard-Jones softening.  Only used when the CustomNonbondedForce is created.
+    softcore_beta : simtk.unit.Quantity with units compatible with angstrom**2, optional, default=12*angstrom**2
+       Softcore parameter for Coulomb softening.  Only used when the CustomNonbondedForce is created.
+    variant_selection : str, optional, default='delta'
+       How the CustomNonbondedForce selects the active variant; one of VARIANT_SELECTIONS.
+       See `create_softcore_nonbonded_force` for details.  Only used when the CustomNonbondedForce is created.
 
     Returns
     -------
     mapping : dict of int
        mapping[index] is the atom index in `system` corresponding to atom `index` within `molecule_system`.
 
+    Notes
+    -----
+    With nonbonded_layout='interaction_groups', all alchemical particles carry zero charge and epsilon in the NonbondedForce,
+    so omitting NonbondedForce exceptions between the core and variants, or between variants, does not change the energy
+    (see examples/benchmarks/nonbonded_layout_benchmark.py).  Such pairs are still evaluated by the NonbondedForce, so
+    two alchemical particles must never occupy exactly the same position.
+
     """
+    if nonbonded_layout not in NONBONDED_LAYOUTS:
+        raise Exception("Nonbonded layout '%s' unknown; must be one of %s." % (nonbonded_layout, str(NONBONDED_LAYOUTS)))
+    if (nonbonded_layout == 'interaction_groups') and (environment_atoms is None):
+        raise Exception("environment_atoms must be specified for nonbonded layout 'interaction_groups'.")
+    if valence_layout not in VALENCE_LAYOUTS:
+        raise Exception("Valence layout '%s' unknown; must be one of %s." % (valence_layout, str(VALENCE_LAYOUTS)))
 
     def _createCustomNonbondedForce(self, system, molecule_system, softcore_alpha=0.5, softcore_beta=12*unit.angstrom**2):
         """
@@ -859,65 +1791,37 @@ def add_molecule_to_system(system, molecule_system, core_atoms, variant, atoms_t
         return
 
     # Build dict of forces.
+    # If several forces share a class name, the first one is used, so that forces added later (such as restraints) are not mistaken for alchemical forces.
     def create_force_dict(system):
-        return { system.getForce(index).__class__.__name__ : system.getForce(index) for index in range(system.getNumForces()) }
+        forces = dict()
+        for index in range(system.getNumForces()):
+            force = system.getForce(index)
+            forces.setdefault(force.__class__.__name__, force)
+        return forces
 
     molecule_forces = create_force_dict(molecule_system)
     forces          = create_force_dict(system)
 
     # Create Custom*Force classes if necessary.
-    if 'CustomBondForce' not in forces:
-        energy_expression  = 'lambda*(K/2)*(r-length)^2;'
-        energy_expression += 'lambda = (1-alchemical_lambda)*delta(variant) + alchemical_lambda*delta(variant-alchemical_variant);'
-        custom_force = mm.CustomBondForce(energy_expression)
-        custom_force.addGlobalParameter('alchemical_lambda', 0.0)
-        custom_force.addGlobalParameter('alchemical_variant', 0.0)
-        custom_force.addPerBondParameter('variant')
-        custom_force.addPerBondParameter('length')
-        custom_force.addPerBondParameter('K')
-        system.addForce(custom_force)
-        forces['CustomBondForce'] = custom_force
-    if 'CustomAngleForce' not in forces:
-        energy_expression  = 'lambda*(K/2)*(theta-theta0)^2;'
-        energy_expression += 'lambda = (1-alchemical_lambda)*delta(variant) + alchemical_lambda*delta(variant-alchemical_variant);'
-        custom_force = mm.CustomAngleForce(energy_expression)
-        custom_force.addGlobalParameter('alchemical_lambda', 0.0)
-        custom_force.addGlobalParameter('alchemical_variant', 0.0)
-        custom_force.addPerAngleParameter('variant')
-        custom_force.addPerAngleParameter('theta0')
-        custom_force.addPerAngleParameter('K')
-        system.addForce(custom_force)
-        forces['CustomAngleForce'] = custom_force
-    if 'CustomTorsionForce' not in forces:
-        energy_expression  = 'lambda*K*(1+cos(periodicity*theta-phase));'
-        energy_expression += 'lambda = (1-alchemical_lambda)*delta(variant) + alchemical_lambda*delta(variant-alchemical_variant);'
-        custom_force = mm.CustomTorsionForce(energy_expression)
-        custom_force.addGlobalParameter('alchemical_lambda', 0.0)
-        custom_force.addGlobalParameter('alchemical_variant', 0.0)
-        custom_force.addPerTorsionParameter('variant')
-        custom_force.addPerTorsionParameter('periodicity')
-        custom_force.addPerTorsionParameter('phase')
-        custom_force.addPerTorsionParameter('K')
-        system.addForce(custom_force)
-        forces['CustomTorsionForce'] = custom_force
+    for custom_force in create_alchemical_valence_forces():
+        if custom_force.__class__.__name__ not in forces:
+            custom_force.setForceGroup(ALCHEMICAL_FORCE_GROUP)
+            system.addForce(custom_force)
+            forces[custom_force.__class__.__name__] = custom_force
     if 'CustomNonbondedForce' not in forces:
-        # DEBUG
-        # TODO: Create proper CustomNonbondedForce here.
-        energy_expression = "0.0;"
-        custom_force = mm.CustomNonbondedForce(energy_expression)
-        custom_force.addGlobalParameter('alchemical_lambda', 0.0)
-        custom_force.addGlobalParameter('alchemical_variant', 0.0)
-        custom_force.addPerParticleParameter('variant')
-        custom_force.addPerParticleParameter('charge')
-        custom_force.addPerParticleParameter('sigma')
-        custom_force.addPerParticleParameter('epsilon')
+        custom_force = create_softcore_nonbonded_force(forces['NonbondedForce'], softcore_alpha=softcore_alpha, softcore_beta=softcore_beta,
+                                                       variant_selection=variant_selection)
+        custom_force.setForceGroup(ALCHEMICAL_FORCE_GROUP)
         system.addForce(custom_force)
         forces['CustomNonbondedForce'] = custom_force
 
-        # Add parameters for existing particles.
-        for index in range(system.getNumParticles()):
-            [charge, sigma, epsilon] = forces['NonbondedForce'].getParticleParameters(index)
-            custom_force.addParticle([0, charge, sigma, epsilon])
+        # Add parameters for existing particles, which all belong to the environment.
+        particles = get_force_table(forces['NonbondedForce'], 'particles')
+        add_force_table(custom_force, convert_force_table(particles, custom_force, 'particles', variant=ENVIRONMENT_VARIANT), 'particles')
+
+        # Exclusions must match the NonbondedForce exceptions on all platforms but Reference.
+        exceptions = get_force_table(forces['NonbondedForce'], 'exceptions')
+        add_force_table(custom_force, convert_force_table(exceptions, custom_force, 'exclusions'), 'exclusions')
 
     # Add particles to system.
     mapping = dict() # mapping[index_in_molecule] = index_in_system
@@ -925,7 +1829,7 @@ def add_molecule_to_system(system, molecule_system, core_atoms, variant, atoms_t
         # Add all atoms, unless we're adding the core, in which case we just add core atoms.
         if (variant) or (index_in_molecule in core_atoms):
             # TODO: We may want to make masses lighter.
-            index_in_system = system.addParticle(system.getParticleMass(index_in_molecule))
+            index_in_system = system.addParticle(molecule_system.getParticleMass(index_in_molecule))
             mapping[index_in_molecule] = index_in_system
 
     # Constraints are not supported.
@@ -933,60 +1837,106 @@ def add_molecule_to_system(system, molecule_system, core_atoms, variant, atoms_t
     if (molecule_system.getNumConstraints() > 0):
         raise Exception("Constraints are not supported for alchemically modified molecule.")
 
+    # Map molecule atom indices into system atom indices in bulk.
+    mapping_array = -np.ones([molecule_system.getNumParticles()], np.int64)
+    mapping_array[mapping.keys()] = mapping.values()
+
+    # Select the forces receiving valence terms and the nonbonded interactions of the new atoms.
+    # With valence_layout='force_groups', a variant uses the alchemical and standard valence forces and the CustomNonbondedForce
+    # of its own force group, which are created when the first variant of that group is added.
+    valence_forces = forces
+    variant_nonbonded_force = forces['CustomNonbondedForce']
+    if (valence_layout == 'force_groups') and (variant):
+        force_group = get_variant_force_group(variant)
+        valence_forces = dict()
+        for index in range(system.getNumForces()):
+            force = system.getForce(index)
+            if (force.getForceGroup() == force_group) and (force.__class__.__name__ in VALENCE_FORCE_NAMES + ['CustomNonbondedForce']):
+                valence_forces.setdefault(force.__class__.__name__, force)
+        if len(valence_forces) == 0:
+            for force in create_alchemical_valence_forces() + [mm.HarmonicBondForce(), mm.HarmonicAngleForce(), mm.PeriodicTorsionForce()]:
+                force.setForceGroup(force_group)
+                system.addForce(force)
+                valence_forces[force.__class__.__name__] = force
+
+            # Every CustomNonbondedForce holds every particle and exclusion; only its interaction groups differ.
+            custom_force = copy_softcore_nonbonded_force(forces['CustomNonbondedForce'])
+            add_force_table(custom_force, get_force_table(forces['CustomNonbondedForce'], 'particles'), 'particles')
+            add_force_table(custom_force, get_force_table(forces['CustomNonbondedForce'], 'exclusions'), 'exclusions')
+            custom_force.setForceGroup(force_group)
+            system.addForce(custom_force)
+            valence_forces['CustomNonbondedForce'] = custom_force
+        variant_nonbonded_force = valence_forces['CustomNonbondedForce']
+
+    # New particles and exclusions go to every CustomNonbondedForce, whose variant tables must make room for this variant.
+    custom_nonbonded_forces = [ force for force in system.getForces() if isinstance(force, mm.CustomNonbondedForce) ]
+    for custom_force in custom_nonbonded_forces:
+        resize_variant_table(custom_force, variant)
+
     # Process forces.
     # Valence terms involving only core atoms are created as Custom*Force classes where lambda=0 activates the "core" image and lambda=1 activates the "variant" image.
+    # Terms are read into tables and classified as core or variant terms in a single vectorized pass per force, then added in bulk.
     for (force_name, force) in molecule_forces.iteritems():
-        print force_name
-        if force_name == 'HarmonicBondForce':
-            for index in range(force.getNumBonds()):
-                [atom_i, atom_j, length, K] = force.getBondParameters(index)
-                if set([atom_i, atom_j]).issubset(core_atoms):
-                    forces['CustomBondForce'].addBond(mapping[atom_i], mapping[atom_j], [variant, length, K])
-                elif (variant):
-                    forces[force_name].addBond(mapping[atom_i], mapping[atom_j], length, K)
-
-        elif force_name == 'HarmonicAngleForce':
-            for index in range(force.getNumAngles()):
-                [atom_i, atom_j, atom_k, theta0, K] = force.getAngleParameters(index)
-                if set([atom_i, atom_j, atom_k]).issubset(core_atoms):
-                    forces['CustomAngleForce'].addAngle(mapping[atom_i], mapping[atom_j], mapping[atom_k], [variant, theta0, K])
-                elif (variant):
-                    forces[force_name].addAngle(mapping[atom_i], mapping[atom_j], mapping[atom_k], theta0, K)
-
-        elif force_name == 'PeriodicTorsionForce':
-            for index in range(force.getNumTorsions()):
-                [atom_i, atom_j, atom_k, atom_l, periodicity, phase, K] = force.getTorsionParameters(index)
-                if set([atom_i, atom_j, atom_k, atom_l]).issubset(core_atoms):
-                    forces['CustomTorsionForce'].addTorsion(mapping[atom_i], mapping[atom_j], mapping[atom_k], mapping[atom_l], [variant, periodicity, phase, K])
-                elif (variant):
-                    forces[force_name].addTorsion(mapping[atom_i], mapping[atom_j], mapping[atom_k], mapping[atom_l], periodicity, phase, K)
+        if force_name in ['HarmonicBondForce', 'HarmonicAngleForce', 'PeriodicTorsionForce']:
+            custom_force_name = { 'HarmonicBondForce' : 'CustomBondForce', 'HarmonicAngleForce' : 'CustomAngleForce', 'PeriodicTorsionForce' : 'CustomTorsionForce' }[force_name]
+            table = get_force_table(force)
+            is_core_term = classify_core_terms(table['atoms'], core_atoms, molecule_system.getNumParticles())
+            table['atoms'] = mapping_array[table['atoms']]
+            custom_force = valence_forces[custom_force_name]
+            add_force_table(custom_force, convert_force_table(table[is_core_term], custom_force, variant=variant))
+            if (variant):
+                add_force_table(valence_forces[force_name], table[~is_core_term])
 
         elif force_name == 'NonbondedForce':
-            for index in range(force.getNumParticles()):
-                # TODO: Nonbonded terms will have to be handled as CustomNonbondedForce terms.
-                [charge, sigma, epsilon] = force.getParticleParameters(index)
-                if set([index]).issubset(core_atoms):
-                    forces[force_name].addParticle(0.0*charge, sigma, 0.0*epsilon)
-                    forces['CustomNonbondedForce'].addParticle([variant, charge, sigma, epsilon])
-                elif (variant):
-                    forces[force_name].addParticle(0.0*charge, sigma, 0.0*epsilon)
-                    forces['CustomNonbondedForce'].addParticle([variant, charge, sigma, epsilon])
-
-            for index in range(force.getNumExceptions()):
-                [atom_i, atom_j, chargeProd, sigma, epsilon] = force.getExceptionParameters(index)
-                if set([atom_i, atom_j]).issubset(core_atoms):
-                    # TODO: Nonbonded exceptions will have to be handled as CustomBondForce terms.
-                    forces[force_name].addException(mapping[atom_i], mapping[atom_j], 0.0 * unit.elementary_charge**2, 1.0 * unit.angstrom, 0.0 * unit.kilocalories_per_mole)
-                elif (variant):
-                    forces[force_name].addException(mapping[atom_i], mapping[atom_j], chargeProd, sigma, epsilon)
+            # TODO: Nonbonded terms will have to be handled as CustomNonbondedForce terms.
+            # Particles are added in molecule order, so only particles that were added to the system are transferred.
+            particles = get_force_table(force, 'particles')[sorted(mapping.keys())]
+            custom_particles = convert_force_table(particles, forces['CustomNonbondedForce'], 'particles', variant=variant)
+            for custom_force in custom_nonbonded_forces:
+                add_force_table(custom_force, custom_particles, 'particles')
+            add_force_table(forces[force_name], convert_force_table(particles, forces[force_name], 'particles', charge=0.0, epsilon=0.0), 'particles')
+
+            exceptions = get_force_table(force, 'exceptions')
+            is_core_term = classify_core_terms(exceptions['atoms'], core_atoms, molecule_system.getNumParticles())
+            exceptions['atoms'] = mapping_array[exceptions['atoms']]
+            # TODO: Nonbonded exceptions will have to be handled as CustomBondForce terms.
+            exceptions[is_core_term] = convert_force_table(exceptions[is_core_term], forces[force_name], 'exceptions', chargeProd=0.0, sigma=0.1, epsilon=0.0) # zero in OpenMM units
+            if not (variant):
+                exceptions = exceptions[is_core_term]
+            else:
+                # Core exceptions precede variant exceptions.
+                exceptions = np.concatenate([exceptions[is_core_term], exceptions[~is_core_term]])
+            add_force_table(forces[force_name], exceptions, 'exceptions')
+            exclusions = convert_force_table(exceptions, forces['CustomNonbondedForce'], 'exclusions')
+            for custom_force in custom_nonbonded_forces:
+                add_force_table(custom_force, exclusions, 'exclusions')
 
         # TODO: Add GB force processing.
 
-    # Add exclusions to previous variants and core.
-    for atom_i in mapping.values():
-        for atom_j in atoms_to_exclude:
-            forces['NonbondedForce'].addException(atom_i, atom_j, 0.0 * unit.elementary_charge**2, 1.0 * unit.angstrom, 0.0 * unit.kilocalories_per_mole)
-            forces['CustomNonbondedForce'].addExclusion(atom_i, atom_j)
+    if nonbonded_layout == 'exclusions':
+        # Add exclusions to previous variants and core.
+        exceptions = create_force_table(forces['NonbondedForce'], len(mapping) * len(atoms_to_exclude), 'exceptions')
+        exceptions['atoms'] = np.array([ [atom_i, atom_j] for atom_i in mapping.values() for atom_j in atoms_to_exclude ], np.int64).reshape([-1, 2])
+        exceptions['sigma'] = 0.1 # nm
+        add_force_table(forces['NonbondedForce'], exceptions, 'exceptions')
+        exclusions = convert_force_table(exceptions, forces['CustomNonbondedForce'], 'exclusions')
+        for custom_force in custom_nonbonded_forces:
+            add_force_table(custom_force, exclusions, 'exclusions')
+
+        # Restrict the CustomNonbondedForce to pairs involving alchemical atoms, so environment-environment pairs are never evaluated.
+        custom_force = variant_nonbonded_force
+        alchemical_atoms = set(mapping.values())
+        if custom_force.getNumInteractionGroups() == 0:
+            custom_force.addInteractionGroup(alchemical_atoms, range(system.getNumParticles()))
+        else:
+            alchemical_atoms.update(custom_force.getInteractionGroupParameters(0)[0])
+            custom_force.setInteractionGroupParameters(0, alchemical_atoms, range(system.getNumParticles()))
+    elif nonbonded_layout == 'interaction_groups':
+        # Let the new atoms interact with the environment and among themselves (core with core, or within the variant),
+        # but not with the core or other variants.
+        new_atoms = set(mapping.values())
+        variant_nonbonded_force.addInteractionGroup(new_atoms, set(environment_atoms))
+        variant_nonbonded_force.addInteractionGroup(new_atoms, new_atoms)
 
     print system.getNumParticles(), forces['NonbondedForce'].getNumParticles()
 
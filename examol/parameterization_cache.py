@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Persistent, content-addressed cache for molecule parameterization results.
+
+Parameterizing a molecule (GAFF atom typing, antechamber, AM1-BCC charges, ffxml generation and
+`ForceField.createSystem`) is expensive and is repeated every time the same ligand appears.  This module
+stores the serialized System, Topology and positions produced for a molecule on disk, keyed on the
+molecule's canonical isomeric SMILES, its atom ordering and partial charges, the parameterization options
+and the versions of the tools involved, so that later runs and other processes can reuse them.
+
+Example
+-------
+
+>>> cache = ParameterizationCache('~/.examol/parameters', max_size=1024**3)
+>>> [system, topology, positions] = generate_openmm_system(molecule, cache=cache)
+>>> (cache.nhits, cache.nmisses)
+
+Notes
+-----
+* Entries are written to a temporary file and renamed into place, so readers never see partial entries.
+* Writers and eviction are serialized across processes with an exclusive lock on a lock file in the cache directory.
+* Least-recently-used entries are evicted once the total size of the cache exceeds `max_size`; each hit refreshes the
+  modification time of its entry.
+* The key does not include the geometry of the molecule.  Callers should take positions from the molecule they pass in;
+  the stored positions are those of the molecule that was originally parameterized.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import errno
+import fcntl
+import pickle
+import hashlib
+import tempfile
+
+try:
+    import openeye.oechem as oe
+except ImportError:
+    oe = None
+
+import simtk.openmm as mm
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_tool_versions():
+    """
+    Return the versions of the toolkits whose output is cached.
+
+    Returns
+    -------
+    versions : list of (str, str)
+        (tool, version) pairs.
+
+    """
+    versions = [ ('openeye', oe.OEChemGetRelease()), ('openmm', mm.Platform.getOpenMMVersion()) ]
+    try:
+        import openmoltools
+        versions.append(('openmoltools', getattr(openmoltools, '__version__', 'unknown')))
+    except ImportError:
+        pass
+    return versions
+
+def get_option_name(option):
+    """
+    Return a stable name for an OpenMM app option such as app.OBC1 or app.HBonds, or None.
+
+    """
+    if option is None:
+        return None
+    return option.__class__.__name__
+
+def get_molecule_key(molecule):
+    """
+    Return strings identifying a molecule and its atom ordering.
+
+    Parameters
+    ----------
+    molecule : openeye.oechem.OEMol
+        The molecule.
+
+    Returns
+    -------
+    smiles : str
+        Canonical isomeric SMILES.
+    ordered_smiles : str
+        Canonical isomeric SMILES with explicit hydrogens and atom maps recording the input atom order,
+        so that molecules with the same SMILES but different atom orderings are not confused.
+    charges : tuple of float
+        Partial charges in input atom order, rounded to 1e-6 e, since parameterization may use the charges of the input molecule.
+
+    """
+    smiles = oe.OECreateIsoSmiString(molecule)
+    ordered_molecule = oe.OEMol(molecule)
+    for atom in ordered_molecule.GetAtoms():
+        atom.SetMapIdx(atom.GetIdx() + 1)
+    flags = oe.OESMILESFlag_Canonical | oe.OESMILESFlag_ISOMERIC | oe.OESMILESFlag_AtomMaps | oe.OESMILESFlag_Hydrogens
+    ordered_smiles = oe.OECreateSmiString(ordered_molecule, flags)
+    charges = tuple([ round(atom.GetPartialCharge(), 6) for atom in molecule.GetAtoms() ])
+    return [smiles, ordered_smiles, charges]
+
+################################################################################
+# PARAMETERIZATION CACHE
+################################################################################
+
+class ParameterizationCache(object):
+    """\
+    On-disk LRU cache of serialized System, Topology and positions, safe for concurrent use by processes on one machine.
+
+    """
+    def __init__(self, directory, max_size=1024**3):
+        """\
+        Open (creating if necessary) a parameterization cache.
+
+        Parameters
+        ----------
+        directory : str
+            Directory in which cache entries are stored.
+        max_size : int, optional, default=1024**3
+            Maximum total size of cache entries in bytes.  Least-recently-used entries are evicted beyond this.
+
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_size = max_size
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Hit/miss counters for this process.
+        self.nhits = 0
+        self.nmisses = 0
+
+        return
+
+    def makeKey(self, molecule, **options):
+        """\
+        Compute the content-addressed key for a molecule and parameterization options.
+
+        Parameters
+        ----------
+        molecule : openeye.oechem.OEMol
+            The molecule to be parameterized.
+        options : dict
+            Parameterization options (charge model, implicit solvent, constraints, ...), with values that have stable string representations.
+
+        Returns
+        -------
+        key : str
+            Hex digest identifying the cache entry.
+
+        """
+        [smiles, ordered_smiles, charges] = get_molecule_key(molecule)
+        description = repr([ smiles, ordered_smiles, charges, sorted(options.items()), get_tool_versions() ])
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def _entryPath(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        """\
+        Retrieve an entry.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `makeKey`.
+
+        Returns
+        -------
+        entry : dict or None
+            The stored entry with 'system' deserialized, or None if there is no entry for `key`.
+
+        """
+        filename = self._entryPath(key)
+        try:
+            with open(filename, 'rb') as infile:
+                entry = pickle.load(infile)
+            os.utime(filename, None) # mark as recently used
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            # Missing, concurrently evicted, or unreadable entries are all treated as misses.
+            self.nmisses += 1
+            return None
+
+        self.nhits += 1
+        entry['system'] = mm.XmlSerializer.deserialize(entry['system'])
+        return entry
+
+    def put(self, key, system, topology, positions, **extra):
+        """\
+        Store an entry, evicting least-recently-used entries if the cache exceeds its size cap.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `makeKey`.
+        system : simtk.openmm.System
+            The parameterized System; stored serialized to XML.
+        topology : simtk.openmm.app.Topology
+            The Topology corresponding to `system`.
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with length
+            Positions of the parameterized molecule.
+        extra : dict
+            Additional picklable items to store with the entry.
+
+        """
+        entry = dict(extra)
+        entry.update(system=mm.XmlSerializer.serialize(system), topology=topology, positions=positions)
+
+        # Write to a temporary file in the cache directory, then atomically rename into place.
+        (fd, temporary_filename) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                pickle.dump(entry, outfile, protocol=2)
+            with self._lock():
+                os.rename(temporary_filename, self._entryPath(key))
+                self._evict()
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+
+        return
+
+    def _lock(self):
+        """\
+        Return a context manager holding an exclusive inter-process lock on the cache directory.
+
+        """
+        return _FileLock(os.path.join(self.directory, '.lock'))
+
+    def _evict(self):
+        """\
+        Remove least-recently-used entries until the cache is within its size cap.  Must be called with the lock held.
+
+        """
+        entries = list()
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.pickle'):
+                continue
+            filename = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+
+        total_size = sum([ size for (mtime, size, filename) in entries ])
+        for (mtime, size, filename) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total_size -= size
+
+        return
+
+    def clear(self):
+        """\
+        Remove all entries.
+
+        """
+        with self._lock():
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.pickle'):
+                    os.remove(os.path.join(self.directory, filename))
+        return
+
+class _FileLock(object):
+    """\
+    Exclusive advisory lock on a file, usable as a context manager.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.filename, 'a')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+        return False
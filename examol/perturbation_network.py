@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+"""
+Plan networks of relative transformations over a ligand library.
+
+Choosing which ligand pairs to transform by hand does not scale: N ligands give N(N-1)/2 candidate edges.
+`PerturbationNetworkPlanner` scores candidate pairs by the size of the common substructure found with the same MCSS
+search that `RelativeTransformationFactory` uses, in parallel worker processes, and builds a connected network from
+the best-scoring edges: a maximum-similarity spanning tree, plus cycle-closing edges so that every ligand is
+connected to at least `min_degree` others and free energies can be checked around closed cycles.
+
+Every pair is first given a pre-score from the element composition of both ligands.  The pre-score is an upper bound
+on the MCSS score, so pairs whose pre-score is below `min_score` never need an MCSS search, and only the
+`nneighbors` best pre-scored partners of each ligand are searched, which keeps the number of searches linear in the
+number of ligands.  More pairs are searched only if the network would otherwise be disconnected.
+
+Example
+-------
+
+>>> planner = PerturbationNetworkPlanner(ligands, nworkers=8, mapping_store=AtomMappingStore('mappings.sqlite'))
+>>> edges = planner.plan()
+>>> write_edge_list('network.txt', edges, names=[ ligand.GetTitle() for ligand in ligands ])
+>>> for (reference, targets) in get_transformation_batches(edges):
+...     factory = RelativeTransformationFactory(system, topology, positions, indices, ligands[reference])
+...     for (index, transformation) in factory.createTransformations([ ligands[target] for target in targets ]):
+...         pass
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import traceback
+import itertools
+import multiprocessing
+
+import openeye.oechem as oe
+import numpy as np
+
+from examol.dualtopology.create_relative_transformation import create_mapping_search, MAPPING_OPTIONS, APPROXIMATE_MAPPING_OPTIONS
+from examol.mcss import get_default_mcss_searcher
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_prescores(molecules):
+    """
+    Compute an upper bound on the MCSS score of every pair of molecules from their element compositions.
+
+    Two molecules can have at most min(n1(Z), n2(Z)) common atoms of each element Z, so the MCSS score
+    ncommon / (n1 + n2 - ncommon) of a pair is at most the score obtained with that many common atoms.
+
+    Parameters
+    ----------
+    molecules : list of openeye.oechem.OEMol
+        The molecules.
+
+    Returns
+    -------
+    prescores : numpy.ndarray of float, shape (nmolecules, nmolecules)
+        prescores[i,j] is the upper bound for molecules i and j; the diagonal is zero.
+
+    """
+    atomic_numbers = [ [ atom.GetAtomicNum() for atom in molecule.GetAtoms() ] for molecule in molecules ]
+    elements = sorted(set(itertools.chain(*atomic_numbers)))
+    compositions = np.zeros([len(molecules), len(elements)], np.int64)
+    for (index, numbers) in enumerate(atomic_numbers):
+        for number in numbers:
+            compositions[index, elements.index(number)] += 1
+
+    natoms = compositions.sum(axis=1)
+    prescores = np.zeros([len(molecules), len(molecules)], np.float64)
+    for index in range(len(molecules)):
+        ncommon = np.minimum(compositions[index], compositions).sum(axis=1)
+        prescores[index] = ncommon / np.maximum(natoms[index] + natoms - ncommon, 1).astype(np.float64)
+    np.fill_diagonal(prescores, 0.0)
+    return prescores
+
+def build_perturbation_network(nmolecules, scores, min_degree=2):
+    """
+    Build a network from scored pairs: a maximum-score spanning forest plus cycle-closing edges.
+
+    Parameters
+    ----------
+    nmolecules : int
+        The number of molecules.
+    scores : dict of (int, int) : float
+        Scores of the candidate edges, keyed by (i, j) with i < j.
+    min_degree : int, optional, default=2
+        Cycle-closing edges are added, best first, to molecules connected to fewer than this many others.
+
+    Returns
+    -------
+    edges : list of (int, int, float)
+        The edges (i, j, score) of the network, spanning tree edges first.
+    components : numpy.ndarray of int, shape (nmolecules,)
+        The connected component of each molecule; the network is connected if all are equal.
+
+    """
+    # Kruskal's algorithm with a union-find forest.
+    parents = np.arange(nmolecules)
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    candidates = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    edges = list()
+    remaining = list()
+    for ((i, j), score) in candidates:
+        (root_i, root_j) = (find(i), find(j))
+        if root_i != root_j:
+            parents[root_i] = root_j
+            edges.append((i, j, score))
+        else:
+            remaining.append((i, j, score))
+
+    # Each remaining edge joins two already-connected molecules and so closes a cycle.
+    degrees = np.zeros([nmolecules], np.int64)
+    for (i, j, score) in edges:
+        degrees[[i,j]] += 1
+    for (i, j, score) in remaining:
+        if (degrees[i] < min_degree) or (degrees[j] < min_degree):
+            edges.append((i, j, score))
+            degrees[[i,j]] += 1
+
+    components = np.array([ find(index) for index in range(nmolecules) ])
+    return [edges, components]
+
+def get_transformation_batches(edges):
+    """
+    Orient the edges of a network into batches that share a reference molecule.
+
+    Each batch can be built with one `RelativeTransformationFactory`, so molecules with many edges are chosen as
+    references first to keep the number of factories small.
+
+    Parameters
+    ----------
+    edges : list of (int, int, float)
+        The edges of the network.
+
+    Returns
+    -------
+    batches : list of (int, list of int)
+        (reference, targets) pairs covering every edge once.
+
+    """
+    neighbors = dict()
+    for (i, j, score) in edges:
+        neighbors.setdefault(i, set()).add(j)
+        neighbors.setdefault(j, set()).add(i)
+
+    batches = list()
+    while neighbors:
+        reference = max(sorted(neighbors), key=lambda index: len(neighbors[index]))
+        targets = sorted(neighbors.pop(reference))
+        for target in targets:
+            neighbors[target].discard(reference)
+            if not neighbors[target]:
+                del neighbors[target]
+        batches.append((reference, targets))
+    return batches
+
+def write_edge_list(filename, edges, names=None):
+    """
+    Write the edges of a network, one 'molecule1 molecule2 score' line per edge.
+
+    Parameters
+    ----------
+    filename : str
+        The file to write.
+    edges : list of (int, int, float)
+        The edges of the network.
+    names : list of str, optional, default=None
+        Names of the molecules; their indices are written if None.
+
+    """
+    with open(filename, 'w') as outfile:
+        for (i, j, score) in edges:
+            if names is not None:
+                (i, j) = (names[i], names[j])
+            outfile.write("%s %s %.6f\n" % (i, j, score))
+    return
+
+def _initialize_worker(molecules, mcss_searcher):
+    """
+    Store the molecules of the library and the MCSS searcher in a worker process.
+
+    """
+    global _worker_molecules, _worker_searcher
+    _worker_molecules = molecules
+    _worker_searcher = mcss_searcher
+
+def _score_pairs(arguments):
+    """
+    Search for the common substructure of one pattern molecule with several targets.
+
+    Parameters
+    ----------
+    arguments : tuple of (int, list of int)
+        The index of the pattern molecule and the indices of the target molecules.
+
+    Returns
+    -------
+    results : tuple of (int, list of tuple, list of dict)
+        The pattern index; (target, mapping, mode) for each target, where mapping is a dict of pattern atom indices to
+        target atom indices, None if there is no common substructure, or the formatted traceback if the search failed,
+        and mode is the search mode used ('exhaustive' or 'approximate'); and the MCSS statistics records of the
+        searches, which are moved out of the searcher of the worker.
+
+    """
+    (pattern, targets) = arguments
+    try:
+        mcss = create_mapping_search(_worker_molecules[pattern], mcss_searcher=_worker_searcher)
+    except Exception:
+        return (pattern, [ (target, traceback.format_exc(), None) for target in targets ], list())
+    # Record the statistics of these searches separately from those the searcher already holds.
+    [statistics, _worker_searcher.statistics] = [_worker_searcher.statistics, list()]
+    results = list()
+    try:
+        for target in targets:
+            try:
+                mapping = None
+                for match in mcss.Match(_worker_molecules[target], True):
+                    mapping = dict([ (matchpair.pattern.GetIdx(), matchpair.target.GetIdx()) for matchpair in match.GetAtoms() ])
+                    break
+                results.append((target, mapping, mcss.mode))
+            except Exception:
+                results.append((target, traceback.format_exc(), None))
+    finally:
+        [records, _worker_searcher.statistics] = [_worker_searcher.statistics, statistics]
+    return (pattern, results, records)
+
+################################################################################
+# PERTURBATION NETWORK PLANNER
+################################################################################
+
+class PerturbationNetworkPlanner(object):
+    """\
+    Score ligand pairs in parallel and plan a connected network of relative transformations.
+
+    """
+    def __init__(self, molecules, nworkers=None, nneighbors=10, min_score=0.1, min_degree=2, mapping_store=None,
+                 mcss_searcher=None):
+        """\
+        Create a planner for a library of molecules.
+
+        Parameters
+        ----------
+        molecules : list of openeye.oechem.OEMol
+            The ligands.
+        nworkers : int, optional, default=None
+            The number of worker processes; one per CPU if None.  If 1, pairs are scored in this process.
+        nneighbors : int, optional, default=10
+            The number of best pre-scored partners of each molecule for which an MCSS search is run.
+        min_score : float, optional, default=0.1
+            Pairs scoring below this (common atoms over atoms in either molecule) are not used as edges.
+        min_degree : int, optional, default=2
+            Cycle-closing edges are added to molecules connected to fewer than this many others.
+        mapping_store : examol.mapping_store.AtomMappingStore, optional, default=None
+            If specified, the mapping of each searched pair is recorded, so that transformations along the planned edges
+            reuse it instead of searching again.
+        mcss_searcher : examol.mcss.MCSSSearcher, optional, default=None
+            Bounds the time of each exhaustive MCSS search, falling back to the approximate search, and collects the
+            statistics of every search; the default searcher if None.
+
+        """
+        self.molecules = [ oe.OEMol(molecule) for molecule in molecules ]
+        self.nworkers = nworkers if (nworkers is not None) else multiprocessing.cpu_count()
+        self.nneighbors = nneighbors
+        self.min_score = min_score
+        self.min_degree = min_degree
+        self.mapping_store = mapping_store
+        if mcss_searcher is None:
+            mcss_searcher = get_default_mcss_searcher()
+        self.mcss_searcher = mcss_searcher
+
+        self.prescores = None
+        # MCSS scores of searched pairs, keyed by (i, j) with i < j; 0.0 if there is no common substructure.
+        self.scores = dict()
+        # Tracebacks of pairs whose search failed, keyed by (i, j).
+        self.scoring_failures = dict()
+
+        return
+
+    def scorePairs(self, pairs):
+        """\
+        Run the MCSS search for pairs that have not been scored yet, in worker processes.
+
+        Parameters
+        ----------
+        pairs : iterable of (int, int)
+            Pairs (i, j) with i < j; molecule i is the pattern of the search.
+
+        Returns
+        -------
+        nscored : int
+            The number of pairs searched.
+
+        """
+        tasks = dict()
+        for (i, j) in pairs:
+            if ((i, j) not in self.scores) and ((i, j) not in self.scoring_failures):
+                tasks.setdefault(i, list()).append(j)
+        tasks = sorted(tasks.items(), key=lambda task: -len(task[1])) # longest tasks first, for load balance
+        if not tasks:
+            return 0
+
+        pool = None
+        if (self.nworkers > 1) and (len(tasks) > 1):
+            pool = multiprocessing.Pool(processes=min(self.nworkers, len(tasks)), initializer=_initialize_worker, initargs=(self.molecules, self.mcss_searcher))
+            results = pool.imap_unordered(_score_pairs, tasks, chunksize=1)
+        else:
+            _initialize_worker(self.molecules, self.mcss_searcher)
+            results = itertools.imap(_score_pairs, tasks)
+
+        nscored = 0
+        try:
+            for (i, pattern_results, records) in results:
+                self.mcss_searcher.statistics.extend(records)
+                for (j, mapping, mode) in pattern_results:
+                    nscored += 1
+                    if isinstance(mapping, str):
+                        self.scoring_failures[(i, j)] = mapping
+                        continue
+                    if mapping is None:
+                        self.scores[(i, j)] = 0.0
+                        continue
+                    ncommon = len(mapping)
+                    self.scores[(i, j)] = ncommon / float(self.molecules[i].NumAtoms() + self.molecules[j].NumAtoms() - ncommon)
+                    if self.mapping_store is not None:
+                        mapping_options = APPROXIMATE_MAPPING_OPTIONS if (mode == 'approximate') else MAPPING_OPTIONS
+                        self.mapping_store.putMapping(self.molecules[i], self.molecules[j], mapping_options, mapping)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        return nscored
+
+    def plan(self, verbose=False):
+        """\
+        Score candidate pairs and build the network.
+
+        Parameters
+        ----------
+        verbose : bool, optional, default=False
+            If True, print progress.
+
+        Returns
+        -------
+        edges : list of (int, int, float)
+            The edges (i, j, score) of the network, with i < j.
+
+        """
+        nmolecules = len(self.molecules)
+        if self.prescores is None:
+            self.prescores = get_prescores(self.molecules)
+
+        # Pairs that cannot reach min_score are never searched.
+        prescores = self.prescores.copy()
+        np.fill_diagonal(prescores, -1.0)
+        prescores[prescores < self.min_score] = -1.0
+
+        # Search the best pre-scored partners of each molecule.
+        order = np.argsort(-prescores, axis=1, kind='mergesort')[:,:self.nneighbors]
+        pairs = set([ (min(index, partner), max(index, partner)) for index in range(nmolecules) for partner in order[index] if prescores[index, partner] >= 0.0 ])
+        nexpansions = 0
+        while True:
+            nscored = self.scorePairs(pairs)
+            if verbose: print("Searched %d pairs (%d in total, %d failed)." % (nscored, len(self.scores), len(self.scoring_failures)))
+            for pair in itertools.chain(self.scores, self.scoring_failures):
+                prescores[pair] = prescores[pair[::-1]] = -1.0
+
+            scores = dict([ (pair, score) for (pair, score) in self.scores.items() if (score > 0.0) and (score >= self.min_score) ])
+            [edges, components] = build_perturbation_network(nmolecules, scores, min_degree=self.min_degree)
+            labels = np.unique(components)
+            if len(labels) == 1:
+                break
+
+            # Search the best pre-scored pairs joining each component but the largest to the rest, doubling their number each round.
+            nexpansions += 1
+            largest = labels[np.argmax([ np.sum(components == label) for label in labels ])]
+            pairs = set()
+            for label in labels:
+                if label == largest:
+                    continue
+                members = np.where(components == label)[0]
+                others = np.where(components != label)[0]
+                candidates = prescores[np.ix_(members, others)]
+                for position in np.argsort(-candidates, axis=None, kind='mergesort')[:self.nneighbors * 2**nexpansions]:
+                    (member, other) = np.unravel_index(position, candidates.shape)
+                    if candidates[member, other] >= 0.0:
+                        pairs.add((min(members[member], others[other]), max(members[member], others[other])))
+            if not pairs:
+                raise Exception("No network connects all molecules: molecules %s cannot be connected to the rest with a score of at least %f." %
+                                (str(np.where(components != largest)[0].tolist()), self.min_score))
+
+        if verbose: print("Network has %d edges for %d molecules." % (len(edges), nmolecules))
+        return edges
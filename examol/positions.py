@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Preallocated position storage for building merged and hybrid systems.
+
+Example
+-------
+
+Reserve space for an environment and two molecules, fill it block by block, and wrap it in units once.
+
+>>> buffer = PositionBuffer(environment_positions.shape[0] + 12 + 15)
+>>> environment_block = buffer.addBlock(environment_positions)
+>>> block = buffer.addBlock(molecule_positions)
+>>> positions = buffer.getPositions()
+
+The coordinates of a single block can later be read or overwritten in place.
+
+>>> buffer.getBlock(block)[:,2] += 15.0 * unit.angstroms
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+from simtk import unit
+import numpy as np
+
+################################################################################
+# POSITION BUFFER
+################################################################################
+
+class PositionBuffer(object):
+    """\
+    Contiguous float64 position storage that is filled through per-block views.
+
+    The buffer is allocated once for the expected final number of particles, so that appending blocks
+    does not copy previously added positions.  If more particles are added than were reserved, capacity
+    is doubled, so appends remain amortized constant time.
+
+    Notes
+    -----
+    Views and Quantity objects returned by `getBlock` and `getPositions` refer to the current storage.
+    If the buffer has to grow, they no longer alias the buffer and must be requested again.
+
+    """
+    def __init__(self, nparticles, length_unit=unit.angstroms):
+        """\
+        Allocate a position buffer.
+
+        Parameters
+        ----------
+        nparticles : int
+            The expected final number of particles.
+        length_unit : simtk.unit.Unit, optional, default=unit.angstroms
+            The unit positions are stored in.
+
+        """
+        self.length_unit = length_unit
+        self._array = np.zeros([max(nparticles, 1), 3], np.float64)
+        self._nparticles = 0
+        self._blocks = list() # list of (start, stop) particle ranges
+
+        return
+
+    def __len__(self):
+        return self._nparticles
+
+    @property
+    def nblocks(self):
+        """The number of blocks added so far."""
+        return len(self._blocks)
+
+    def _reserve(self, nparticles):
+        """\
+        Ensure there is room for `nparticles` more particles, growing the storage if needed.
+
+        """
+        capacity = self._array.shape[0]
+        required = self._nparticles + nparticles
+        if required > capacity:
+            array = np.zeros([max(required, 2*capacity), 3], np.float64)
+            array[:self._nparticles,:] = self._array[:self._nparticles,:]
+            self._array = array
+        return
+
+    def addBlock(self, positions=None, nparticles=None):
+        """\
+        Append a block of particles.
+
+        Parameters
+        ----------
+        positions : simtk.unit.Quantity of (n,3) with units compatible with length, optional, default=None
+            The positions of the new particles.  If None, `nparticles` zero positions are reserved.
+        nparticles : int, optional, default=None
+            The number of particles to reserve if `positions` is None.
+
+        Returns
+        -------
+        block_index : int
+            The index of the new block, for use with `getBlock` and `setBlock`.
+
+        """
+        if positions is not None:
+            positions = np.asarray(positions.value_in_unit(self.length_unit), np.float64)
+            nparticles = positions.shape[0]
+        elif nparticles is None:
+            raise Exception("Either positions or nparticles must be specified.")
+
+        self._reserve(nparticles)
+        start = self._nparticles
+        stop = start + nparticles
+        if positions is not None:
+            self._array[start:stop,:] = positions
+        self._nparticles = stop
+        self._blocks.append((start, stop))
+
+        return len(self._blocks) - 1
+
+    def getBlockRange(self, block_index):
+        """\
+        Return the (start, stop) particle range of a block.
+
+        """
+        return self._blocks[block_index]
+
+    def getBlock(self, block_index):
+        """\
+        Return the positions of a block without copying.
+
+        Parameters
+        ----------
+        block_index : int
+            The block index returned by `addBlock`.
+
+        Returns
+        -------
+        positions : simtk.unit.Quantity of (n,3) with units compatible with length
+            A Quantity wrapping a view into the buffer; assigning into it modifies the buffer.
+
+        """
+        (start, stop) = self._blocks[block_index]
+        return unit.Quantity(self._array[start:stop,:], self.length_unit)
+
+    def getBlockArray(self, block_index):
+        """\
+        Return the positions of a block as a unitless view, in units of `length_unit`.
+
+        Parameters
+        ----------
+        block_index : int
+            The block index returned by `addBlock`.
+
+        Returns
+        -------
+        array : numpy.ndarray of (n,3) float64
+            A view into the buffer; assigning into it modifies the buffer.
+
+        """
+        (start, stop) = self._blocks[block_index]
+        return self._array[start:stop,:]
+
+    def setBlock(self, block_index, positions):
+        """\
+        Overwrite the positions of a block in place.
+
+        Parameters
+        ----------
+        block_index : int
+            The block index returned by `addBlock`.
+        positions : simtk.unit.Quantity of (n,3) with units compatible with length
+            The new positions; must have the same number of particles as the block.
+
+        """
+        (start, stop) = self._blocks[block_index]
+        self._array[start:stop,:] = positions.value_in_unit(self.length_unit)
+        return
+
+    def getPositions(self):
+        """\
+        Return all positions added so far, wrapped in units without copying.
+
+        Returns
+        -------
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with length
+            A Quantity wrapping a view into the buffer.
+
+        """
+        return unit.Quantity(self._array[:self._nparticles,:], self.length_unit)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""
+Multi-process Hamiltonian replica exchange over lambda.
+
+`ReplicaExchangeSampler` starts one worker process per lambda state, each holding its own Context on the CPU
+platform at a fixed lambda value.  Configurations (positions, velocities and box vectors) live in shared memory
+slots; a shared permutation records which slot each state is currently simulating, so an accepted exchange only
+swaps two entries of the permutation and no configuration is ever serialized.  After each round of dynamics every
+worker evaluates the reduced potential of its configuration at the other states and writes it to a shared energy
+matrix, from which the driver attempts exchanges between neighboring states.
+
+The driver works with any System whose lambda is a global context parameter (such as `lambda` for
+`create_relative_alchemical_transformation`) or is set through a callable (such as `set_alchemical_state` for a
+variant of a merged topology).
+
+Example
+-------
+
+>>> sampler = ReplicaExchangeSampler(system, positions, lambda_values, 300*unit.kelvin, parameter='lambda')
+>>> sampler.run(niterations=1000)
+>>> sampler.acceptance_rates
+>>> sampler.ns_per_day_per_core
+>>> sampler.close()
+
+For a variant of a merged topology:
+
+>>> set_lambda = lambda context, value: set_alchemical_state(context, variant=3, alchemical_lambda=value)
+>>> sampler = ReplicaExchangeSampler(system, positions, lambda_values, 300*unit.kelvin, set_lambda=set_lambda)
+
+Notes
+-----
+* Workers are forked, so `set_lambda` may be any callable, including a lambda function.
+* Control messages between driver and workers are small tuples sent through pipes; all arrays are shared.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import time
+import traceback
+import multiprocessing
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.alchemical_state import set_context_parameter
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+ENERGY_TARGETS = ['neighbors', 'all'] # states at which each replica's reduced potential is evaluated
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def _shared_array(typecode, shape):
+    """
+    Allocate a zeroed shared-memory array and return it with a NumPy view of it.
+
+    """
+    raw = multiprocessing.RawArray(typecode, int(np.prod(shape)))
+    dtype = { 'd' : np.float64, 'i' : np.int32 }[typecode]
+    return [raw, np.frombuffer(raw, dtype=dtype).reshape(shape)]
+
+def _replica_worker(state, system_xml, lambda_values, parameter, set_lambda, temperature, collision_rate, timestep,
+                    random_seed, threads, platform_name, energy_targets, shared, connection):
+    """
+    Simulate whichever configuration is assigned to `state`, on request from the driver.
+
+    """
+    try:
+        nstates = len(lambda_values)
+        positions = np.frombuffer(shared['positions'], dtype=np.float64).reshape([nstates, -1, 3])
+        velocities = np.frombuffer(shared['velocities'], dtype=np.float64).reshape([nstates, -1, 3])
+        box_vectors = np.frombuffer(shared['box_vectors'], dtype=np.float64).reshape([nstates, 3, 3])
+        permutation = np.frombuffer(shared['permutation'], dtype=np.int32)
+        energies = np.frombuffer(shared['energies'], dtype=np.float64).reshape([nstates, nstates])
+
+        system = mm.XmlSerializer.deserialize(system_xml)
+        periodic = system.usesPeriodicBoundaryConditions()
+        integrator = mm.LangevinIntegrator(temperature, collision_rate, timestep)
+        integrator.setRandomNumberSeed(random_seed)
+        platform = mm.Platform.getPlatformByName(platform_name)
+        properties = { 'Threads' : str(threads) } if (platform_name == 'CPU') else dict()
+        context = mm.Context(system, integrator, platform, properties)
+        kT = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA * temperature
+
+        def set_state(value):
+            if set_lambda is not None:
+                set_lambda(context, value)
+            else:
+                set_context_parameter(context, parameter, value)
+
+        if energy_targets == 'all':
+            targets = range(nstates)
+        else:
+            targets = range(max(0, state-1), min(nstates, state+2))
+
+        connection.send(('ready',))
+        while True:
+            command = connection.recv()
+            if command[0] == 'stop':
+                break
+
+            # Load the configuration currently assigned to this state.
+            (nsteps, initialize_velocities) = command[1:]
+            slot = permutation[state]
+            if periodic:
+                context.setPeriodicBoxVectors(*box_vectors[slot])
+            context.setPositions(positions[slot])
+            set_state(lambda_values[state])
+            if initialize_velocities:
+                context.setVelocitiesToTemperature(temperature, random_seed)
+            else:
+                context.setVelocities(velocities[slot])
+
+            integrator.step(nsteps)
+
+            # Store the configuration back in its slot.
+            openmm_state = context.getState(getPositions=True, getVelocities=True)
+            positions[slot] = openmm_state.getPositions(asNumpy=True) / unit.nanometers
+            velocities[slot] = openmm_state.getVelocities(asNumpy=True) / (unit.nanometers / unit.picoseconds)
+            if periodic:
+                box_vectors[slot] = openmm_state.getPeriodicBoxVectors(asNumpy=True) / unit.nanometers
+
+            # Evaluate the reduced potential at the target states; other entries are left as NaN.
+            energies[state,:] = np.nan
+            for target in targets:
+                set_state(lambda_values[target])
+                energies[state,target] = context.getState(getEnergy=True).getPotentialEnergy() / kT
+            set_state(lambda_values[state])
+
+            connection.send(('done',))
+
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+
+    return
+
+################################################################################
+# REPLICA EXCHANGE SAMPLER
+################################################################################
+
+class ReplicaExchangeSampler(object):
+    """\
+    Hamiltonian replica exchange over lambda with one worker process per state and configurations in shared memory.
+
+    """
+    def __init__(self, system, positions, lambda_values, temperature, parameter='lambda', set_lambda=None,
+                 nsteps_per_iteration=500, timestep=1.0*unit.femtoseconds, collision_rate=5.0/unit.picoseconds,
+                 threads_per_replica=1, energy_targets='neighbors', platform_name='CPU', random_seed=None):
+        """\
+        Start the worker processes.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The alchemical System.
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with nanometers
+            Initial positions, used for every replica.
+        lambda_values : list of float
+            The lambda value of each state; exchanges are attempted between neighbors in this list.
+        temperature : simtk.unit.Quantity with units compatible with kelvin
+            The temperature of all states.
+        parameter : str, optional, default='lambda'
+            The global context parameter holding lambda.  Ignored if `set_lambda` is given.
+            `alchemical_lambda` and `alchemical_variant` are set through `set_alchemical_state`, keeping merged Systems
+            built with variant_selection='tabulated' in sync.
+        set_lambda : callable, optional, default=None
+            set_lambda(context, value) sets the lambda value of a Context.
+        nsteps_per_iteration : int, optional, default=500
+            Steps of dynamics between exchange attempts.
+        timestep : simtk.unit.Quantity with units compatible with femtoseconds, optional, default=1 fs
+            Langevin timestep.
+        collision_rate : simtk.unit.Quantity with units compatible with 1/picoseconds, optional, default=5/ps
+            Langevin collision rate.
+        threads_per_replica : int, optional, default=1
+            CPU platform threads per worker.
+        energy_targets : str, optional, default='neighbors'
+            One of ENERGY_TARGETS.  'neighbors' evaluates only what exchanges need; 'all' fills the full reduced
+            potential matrix every iteration (for MBAR analysis) at the cost of one energy evaluation per state per replica.
+        platform_name : str, optional, default='CPU'
+            The platform of the worker Contexts.
+        random_seed : int, optional, default=None
+            Seed for exchanges and worker integrators; drawn at random if None.
+
+        """
+        if energy_targets not in ENERGY_TARGETS:
+            raise Exception("Energy targets '%s' unknown; must be one of %s." % (energy_targets, str(ENERGY_TARGETS)))
+        if len(lambda_values) < 2:
+            raise Exception("Replica exchange needs at least two states; %d given." % len(lambda_values))
+
+        self.lambda_values = list(lambda_values)
+        self.nstates = len(lambda_values)
+        self.temperature = temperature
+        self.nsteps_per_iteration = nsteps_per_iteration
+        self.timestep = timestep
+        self.threads_per_replica = threads_per_replica
+        if random_seed is None:
+            random_seed = np.random.randint(1, 2**31 - self.nstates)
+        self.random_state = np.random.RandomState(random_seed)
+
+        # Shared configuration slots, one per replica, all starting from `positions`.
+        natoms = system.getNumParticles()
+        self._shared = dict()
+        [self._shared['positions'], self._positions] = _shared_array('d', [self.nstates, natoms, 3])
+        [self._shared['velocities'], self._velocities] = _shared_array('d', [self.nstates, natoms, 3])
+        [self._shared['box_vectors'], self._box_vectors] = _shared_array('d', [self.nstates, 3, 3])
+        [self._shared['permutation'], self._permutation] = _shared_array('i', [self.nstates])
+        [self._shared['energies'], self._energies] = _shared_array('d', [self.nstates, self.nstates])
+        self._positions[:] = np.array(positions / unit.nanometers)
+        self._box_vectors[:] = np.array([ vector / unit.nanometers for vector in system.getDefaultPeriodicBoxVectors() ])
+        self._permutation[:] = np.arange(self.nstates)
+
+        # Start workers.
+        system_xml = mm.XmlSerializer.serialize(system)
+        self._connections = list()
+        self._workers = list()
+        for state in range(self.nstates):
+            (driver_connection, worker_connection) = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_replica_worker, args=(state, system_xml, self.lambda_values, parameter, set_lambda,
+                                                                           temperature, collision_rate, timestep, random_seed + state,
+                                                                           threads_per_replica, platform_name, energy_targets,
+                                                                           self._shared, worker_connection))
+            worker.daemon = True
+            worker.start()
+            self._connections.append(driver_connection)
+            self._workers.append(worker)
+        self._collect()
+
+        # Statistics.
+        self.niterations = 0
+        self.nproposed = np.zeros([self.nstates-1], np.int64) # nproposed[i] counts attempts between states i and i+1
+        self.naccepted = np.zeros([self.nstates-1], np.int64)
+        self.dynamics_time = 0.0 # wall time spent waiting for workers, in seconds
+        self.elapsed_time = 0.0 # wall time spent in `run`, in seconds
+        self.replica_states = list() # replica_states[iteration][replica] is the state of replica (slot) `replica`
+        self.reduced_potentials = list() # reduced_potentials[iteration][state,target] is u_target of the configuration at `state`
+
+        return
+
+    def _collect(self):
+        """\
+        Wait for a reply from every worker, raising worker exceptions in the driver.
+
+        """
+        for (state, connection) in enumerate(self._connections):
+            reply = connection.recv()
+            if reply[0] == 'error':
+                self.close()
+                raise Exception("Replica worker for state %d failed:\n%s" % (state, reply[1]))
+
+    def _attemptExchanges(self):
+        """\
+        Attempt exchanges between neighboring states, alternating between even and odd pairs on successive iterations.
+
+        """
+        u = self._energies
+        for i in range(self.niterations % 2, self.nstates - 1, 2):
+            j = i + 1
+            log_acceptance = -(u[i,j] + u[j,i] - u[i,i] - u[j,j])
+            self.nproposed[i] += 1
+            if (log_acceptance >= 0.0) or (self.random_state.rand() < np.exp(log_acceptance)):
+                self._permutation[[i,j]] = self._permutation[[j,i]]
+                self.naccepted[i] += 1
+
+    def run(self, niterations=1, verbose=False):
+        """\
+        Run iterations of dynamics in all workers followed by exchange attempts.
+
+        Parameters
+        ----------
+        niterations : int, optional, default=1
+            The number of iterations to run.
+        verbose : bool, optional, default=False
+            If True, print acceptance rates after every iteration.
+
+        """
+        initial_time = time.time()
+        for iteration in range(niterations):
+            dynamics_time = time.time()
+            for connection in self._connections:
+                connection.send(('run', self.nsteps_per_iteration, (self.niterations == 0)))
+            self._collect()
+            self.dynamics_time += time.time() - dynamics_time
+
+            self.reduced_potentials.append(self._energies.copy())
+            self._attemptExchanges()
+            self.niterations += 1
+            self.replica_states.append(np.argsort(self._permutation))
+            if verbose:
+                print("Iteration %8d : acceptance %s" % (self.niterations, ' '.join([ '%5.3f' % rate for rate in self.acceptance_rates ])))
+        self.elapsed_time += time.time() - initial_time
+
+        return
+
+    @property
+    def acceptance_rates(self):
+        """\
+        The fraction of accepted exchanges between each pair of neighboring states.
+
+        """
+        return self.naccepted / np.maximum(self.nproposed, 1).astype(np.float64)
+
+    @property
+    def ns_per_day(self):
+        """\
+        Aggregate simulation throughput of all replicas in ns/day of wall time spent in `run`.
+
+        """
+        if self.elapsed_time == 0.0:
+            return 0.0
+        simulated_time = self.niterations * self.nstates * self.nsteps_per_iteration * self.timestep
+        return (simulated_time / unit.nanoseconds) / (self.elapsed_time / 86400.0)
+
+    @property
+    def ns_per_day_per_core(self):
+        """\
+        Aggregate throughput divided by the number of CPU threads used by the workers.
+
+        """
+        return self.ns_per_day / (self.nstates * self.threads_per_replica)
+
+    def getPositions(self, state):
+        """\
+        Return a copy of the configuration currently at `state`.
+
+        """
+        return unit.Quantity(self._positions[self._permutation[state]].copy(), unit.nanometers)
+
+    def close(self):
+        """\
+        Stop the worker processes.
+
+        """
+        for (connection, worker) in zip(self._connections, self._workers):
+            if worker.is_alive():
+                try:
+                    connection.send(('stop',))
+                except (IOError, OSError):
+                    pass
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._connections = list()
+        self._workers = list()
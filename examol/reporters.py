@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+"""
+Buffered binary trajectory and energy reporting for alchemical simulations.
+
+Writing a text PDB model after a full `getState(getPositions=True, getEnergy=True)` on every iteration
+dominates the cost of short alchemical iterations and produces very large files.  `AlchemicalReporter`
+instead fetches positions only on output iterations (every `stride` iterations), buffers frames in memory,
+and writes them in blocks to a DCD or AMBER NetCDF trajectory.  Per-iteration scalars (iteration, lambda,
+variant, potential energy) are buffered into columns and appended in chunks to an `EnergyStore`.
+
+Example
+-------
+
+>>> reporter = AlchemicalReporter(context, topology, 'trajectory.dcd', 'energies', stride=10)
+>>> for iteration in range(niterations):
+...     context.setParameter('lambda', lambda_values[iteration])
+...     integrator.step(nsteps_per_iteration)
+...     reporter.report(iteration, lambda_values[iteration])
+>>> reporter.close()
+>>> energies = load_energy_store('energies')
+>>> energies['potential_energy']
+
+Notes
+-----
+* An energy store is a directory holding one raw binary file per column plus a `columns.txt` header listing column
+  names and NumPy dtypes.  Each flush appends one chunk to every column file.
+* The NetCDF format requires the netCDF4 package; DCD output uses `simtk.openmm.app.DCDFile`.
+* `AlchemicalReporter.getCheckpoint` flushes all buffers and returns the sizes of the outputs; passing it back as
+  `checkpoint` reopens the outputs and discards anything written after it, so that a restarted run continues them exactly.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import errno
+import struct
+
+import simtk.openmm.app as app
+from simtk import unit
+import numpy as np
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+TRAJECTORY_FORMATS = ['dcd', 'netcdf'] # supported binary trajectory formats
+
+ENERGY_COLUMNS = [('iteration', np.int64), ('lambda', np.float64), ('variant', np.int32), ('potential_energy', np.float64)] # columns recorded by AlchemicalReporter; energies in kJ/mol
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_trajectory_format(filename):
+    """
+    Return the trajectory format implied by the extension of `filename`.
+
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.dcd':
+        return 'dcd'
+    elif extension in ['.nc', '.netcdf']:
+        return 'netcdf'
+    raise Exception("Cannot infer trajectory format from filename '%s'; must be one of %s." % (filename, str(TRAJECTORY_FORMATS)))
+
+def load_energy_store(directory):
+    """
+    Read all columns of an energy store.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of an `EnergyStore`.
+
+    Returns
+    -------
+    columns : dict of str : numpy.array
+        columns[name] holds all values recorded for column `name`.
+
+    """
+    columns = dict()
+    with open(os.path.join(directory, 'columns.txt'), 'r') as infile:
+        for line in infile:
+            [name, dtype] = line.split()
+            columns[name] = np.fromfile(os.path.join(directory, name + '.bin'), dtype=np.dtype(dtype))
+    return columns
+
+################################################################################
+# ENERGY STORE
+################################################################################
+
+class EnergyStore(object):
+    """\
+    Append-only columnar store of per-iteration scalars, buffered in memory and written in chunks.
+
+    """
+    def __init__(self, directory, columns, chunk_size=1024, nrows=None):
+        """\
+        Create a new energy store, replacing any previous one in `directory`, or reopen an existing one.
+
+        Parameters
+        ----------
+        directory : str
+            Directory holding the column files.
+        columns : list of (str, numpy.dtype)
+            Column names and types.
+        chunk_size : int, optional, default=1024
+            The number of rows buffered before they are appended to the column files.
+        nrows : int, optional, default=None
+            If given, reopen the existing store in `directory` and discard all rows after the first `nrows`.
+
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.names = [ name for (name, dtype) in columns ]
+        self.chunk_size = chunk_size
+        self._buffers = dict([ (name, np.zeros([chunk_size], dtype)) for (name, dtype) in columns ])
+        self._nbuffered = 0
+        self.nrows = 0
+
+        if nrows is not None:
+            # Check the header and truncate column files to the requested number of rows.
+            with open(os.path.join(self.directory, 'columns.txt'), 'r') as infile:
+                stored_columns = [ tuple(line.split()) for line in infile ]
+            if stored_columns != [ (name, np.dtype(dtype).str) for (name, dtype) in columns ]:
+                raise Exception("Energy store in '%s' has columns %s, not %s." % (self.directory, str(stored_columns), str(columns)))
+            for (name, dtype) in columns:
+                with open(self._columnPath(name), 'r+b') as outfile:
+                    outfile.truncate(nrows * np.dtype(dtype).itemsize)
+            self.nrows = nrows
+            return
+
+        # Write the header and truncate column files.
+        with open(os.path.join(self.directory, 'columns.txt'), 'w') as outfile:
+            for (name, dtype) in columns:
+                outfile.write('%s %s\n' % (name, np.dtype(dtype).str))
+        for name in self.names:
+            open(self._columnPath(name), 'wb').close()
+
+        return
+
+    def _columnPath(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def append(self, **values):
+        """\
+        Append a row; columns not given are recorded as zero.
+
+        """
+        for (name, value) in values.items():
+            self._buffers[name][self._nbuffered] = value
+        self._nbuffered += 1
+        self.nrows += 1
+        if self._nbuffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """\
+        Append buffered rows to the column files.
+
+        """
+        if self._nbuffered == 0:
+            return
+        for name in self.names:
+            with open(self._columnPath(name), 'ab') as outfile:
+                self._buffers[name][:self._nbuffered].tofile(outfile)
+            self._buffers[name][:] = 0
+        self._nbuffered = 0
+
+    def close(self):
+        """\
+        Flush buffered rows.
+
+        """
+        self.flush()
+
+################################################################################
+# TRAJECTORY WRITERS
+################################################################################
+
+class _DCDWriter(object):
+    """\
+    Write frames to a DCD file with `simtk.openmm.app.DCDFile`.
+
+    """
+    def __init__(self, filename, topology, timestep, stride, checkpoint=None):
+        if checkpoint is None:
+            self._file = open(filename, 'wb')
+            self._dcd = app.DCDFile(self._file, topology, timestep, interval=stride)
+            self.nframes = 0
+            return
+
+        # Discard frames written after the checkpoint and correct the frame count in the header before appending.
+        self._file = open(filename, 'r+b')
+        self._file.truncate(checkpoint['size'])
+        self._file.seek(8)
+        self._file.write(struct.pack('<i', checkpoint['nframes']))
+        self._file.flush()
+        self._dcd = app.DCDFile(self._file, topology, timestep, interval=stride, append=True)
+        self.nframes = checkpoint['nframes']
+
+    def write(self, positions, box_vectors):
+        """\
+        Write a block of frames; positions and box vectors are arrays in angstroms, box vectors may be None.
+
+        """
+        for index in range(positions.shape[0]):
+            periodic_box_vectors = None
+            if box_vectors is not None:
+                periodic_box_vectors = unit.Quantity(box_vectors[index], unit.angstroms)
+            self._dcd.writeModel(unit.Quantity(positions[index], unit.angstroms), periodicBoxVectors=periodic_box_vectors)
+        self.nframes += positions.shape[0]
+        self._file.flush()
+
+    def getCheckpoint(self):
+        self._file.seek(0, os.SEEK_END)
+        return dict(nframes=self.nframes, size=self._file.tell())
+
+    def close(self):
+        self._file.close()
+
+class _NetCDFWriter(object):
+    """\
+    Write frames to an AMBER NetCDF trajectory with the netCDF4 package.
+
+    """
+    def __init__(self, filename, topology, timestep, stride, checkpoint=None):
+        if netCDF4 is None:
+            raise Exception("NetCDF trajectories require the netCDF4 package.")
+        self._frame_time = (timestep * stride) / unit.picoseconds
+        if checkpoint is not None:
+            # The frame dimension cannot shrink; frames after the checkpoint are overwritten as the run continues.
+            self._dataset = netCDF4.Dataset(filename, 'a')
+            self._time = self._dataset.variables['time']
+            self._coordinates = self._dataset.variables['coordinates']
+            self._cell_lengths = self._dataset.variables.get('cell_lengths')
+            self._cell_angles = self._dataset.variables.get('cell_angles')
+            self.nframes = checkpoint['nframes']
+            return
+        self._dataset = netCDF4.Dataset(filename, 'w', format='NETCDF3_64BIT_OFFSET')
+        self._dataset.Conventions = 'AMBER'
+        self._dataset.ConventionVersion = '1.0'
+        self._dataset.program = 'examol'
+        self._dataset.createDimension('frame', None)
+        self._dataset.createDimension('atom', topology.getNumAtoms())
+        self._dataset.createDimension('spatial', 3)
+        self._dataset.createDimension('cell_spatial', 3)
+        self._dataset.createDimension('cell_angular', 3)
+        self._dataset.createDimension('label', 5)
+        self._dataset.createVariable('spatial', 'c', ('spatial',))[:] = np.array(list('xyz'))
+        self._dataset.createVariable('cell_spatial', 'c', ('cell_spatial',))[:] = np.array(list('abc'))
+        self._dataset.createVariable('cell_angular', 'c', ('cell_angular', 'label'))[:] = np.array([list('alpha'), list('beta '), list('gamma')])
+        self._time = self._dataset.createVariable('time', 'f4', ('frame',))
+        self._time.units = 'picosecond'
+        self._coordinates = self._dataset.createVariable('coordinates', 'f4', ('frame', 'atom', 'spatial'))
+        self._coordinates.units = 'angstrom'
+        self._cell_lengths = None
+        self._cell_angles = None
+        self.nframes = 0
+
+    def write(self, positions, box_vectors):
+        """\
+        Write a block of frames; positions and box vectors are arrays in angstroms, box vectors may be None.
+
+        """
+        nframes = positions.shape[0]
+        frames = slice(self.nframes, self.nframes + nframes)
+        self._coordinates[frames] = positions
+        self._time[frames] = self._frame_time * np.arange(self.nframes + 1, self.nframes + nframes + 1)
+        if box_vectors is not None:
+            if self._cell_lengths is None:
+                self._cell_lengths = self._dataset.createVariable('cell_lengths', 'f8', ('frame', 'cell_spatial'))
+                self._cell_lengths.units = 'angstrom'
+                self._cell_angles = self._dataset.createVariable('cell_angles', 'f8', ('frame', 'cell_angular'))
+                self._cell_angles.units = 'degree'
+            lengths = np.sqrt((box_vectors**2).sum(axis=2))
+            def angle(i, j):
+                return np.degrees(np.arccos((box_vectors[:,i,:] * box_vectors[:,j,:]).sum(axis=1) / (lengths[:,i] * lengths[:,j])))
+            self._cell_lengths[frames] = lengths
+            self._cell_angles[frames] = np.array([angle(1, 2), angle(0, 2), angle(0, 1)]).T
+        self.nframes += nframes
+        self._dataset.sync()
+
+    def getCheckpoint(self):
+        return dict(nframes=self.nframes)
+
+    def close(self):
+        self._dataset.close()
+
+################################################################################
+# ALCHEMICAL REPORTER
+################################################################################
+
+class AlchemicalReporter(object):
+    """\
+    Report positions every `stride` iterations to a binary trajectory and energies every iteration to an `EnergyStore`.
+
+    """
+    def __init__(self, context, topology, trajectory_filename, energy_directory, stride=10, buffer_size=100, chunk_size=1024,
+                 timestep=None, trajectory_format=None, checkpoint=None):
+        """\
+        Open the trajectory and energy store.
+
+        Parameters
+        ----------
+        context : simtk.openmm.Context
+            The Context being simulated.
+        topology : simtk.openmm.app.Topology
+            The Topology of the simulated System.
+        trajectory_filename : str
+            The trajectory file to create.
+        energy_directory : str
+            The directory of the `EnergyStore` to create.
+        stride : int, optional, default=10
+            Positions are written on iterations that are multiples of `stride`.
+        buffer_size : int, optional, default=100
+            The number of frames held in memory before they are written.
+        chunk_size : int, optional, default=1024
+            The number of energy rows held in memory before they are written.
+        timestep : simtk.unit.Quantity with units compatible with picoseconds, optional, default=None
+            Simulated time per iteration, recorded in the trajectory; the integrator step size if None.
+        trajectory_format : str, optional, default=None
+            One of TRAJECTORY_FORMATS; inferred from the extension of `trajectory_filename` if None.
+        checkpoint : dict, optional, default=None
+            If given, a checkpoint from `getCheckpoint`; the existing outputs are continued from that point.
+
+        """
+        if trajectory_format is None:
+            trajectory_format = get_trajectory_format(trajectory_filename)
+        if trajectory_format not in TRAJECTORY_FORMATS:
+            raise Exception("Trajectory format '%s' unknown; must be one of %s." % (trajectory_format, str(TRAJECTORY_FORMATS)))
+        if timestep is None:
+            timestep = context.getIntegrator().getStepSize()
+
+        self.context = context
+        self.stride = stride
+        self.buffer_size = buffer_size
+        self.periodic = context.getSystem().usesPeriodicBoundaryConditions()
+
+        writers = { 'dcd' : _DCDWriter, 'netcdf' : _NetCDFWriter }
+        self._writer = writers[trajectory_format](trajectory_filename, topology, timestep, stride,
+                                                  checkpoint=(checkpoint['trajectory'] if checkpoint else None))
+        self.energies = EnergyStore(energy_directory, ENERGY_COLUMNS, chunk_size=chunk_size,
+                                    nrows=(checkpoint['nrows'] if checkpoint else None))
+
+        # Frame buffers, in angstroms.
+        natoms = context.getSystem().getNumParticles()
+        self._positions = np.zeros([buffer_size, natoms, 3], np.float32)
+        self._box_vectors = np.zeros([buffer_size, 3, 3], np.float64) if self.periodic else None
+        self._nbuffered = 0
+        self.nframes = checkpoint['nframes'] if checkpoint else 0
+
+        return
+
+    def report(self, iteration, lambda_value, variant=0):
+        """\
+        Record the current state; positions are only retrieved from the Context on output iterations.
+
+        Parameters
+        ----------
+        iteration : int
+            The iteration number.
+        lambda_value : float
+            The current lambda value.
+        variant : int, optional, default=0
+            The current variant, for merged topologies.
+
+        """
+        write_frame = (iteration % self.stride == 0)
+        state = self.context.getState(getEnergy=True, getPositions=write_frame)
+        self.energies.append(iteration=iteration, variant=variant, potential_energy=state.getPotentialEnergy() / unit.kilojoules_per_mole,
+                             **{'lambda' : lambda_value})
+        if write_frame:
+            self._positions[self._nbuffered] = state.getPositions(asNumpy=True) / unit.angstroms
+            if self.periodic:
+                self._box_vectors[self._nbuffered] = state.getPeriodicBoxVectors(asNumpy=True) / unit.angstroms
+            self._nbuffered += 1
+            self.nframes += 1
+            if self._nbuffered == self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        """\
+        Write buffered frames and energy rows.
+
+        """
+        if self._nbuffered > 0:
+            box_vectors = self._box_vectors[:self._nbuffered] if self.periodic else None
+            self._writer.write(self._positions[:self._nbuffered], box_vectors)
+            self._nbuffered = 0
+        self.energies.flush()
+
+    def getCheckpoint(self):
+        """\
+        Flush buffers and return the sizes of the outputs, for use as `checkpoint` when reopening them.
+
+        """
+        self.flush()
+        return dict(nrows=self.energies.nrows, nframes=self.nframes, trajectory=self._writer.getCheckpoint())
+
+    def close(self):
+        """\
+        Flush buffers and close the trajectory.
+
+        """
+        self.flush()
+        self._writer.close()
+        self.energies.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
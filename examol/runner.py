@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+Alchemical simulation runner with checkpoint/restart.
+
+`AlchemicalRunner` drives Langevin dynamics of an alchemical System through a protocol of lambda values (and,
+for merged topologies, variants), one iteration per protocol entry.  Every `checkpoint_interval` iterations it
+writes the serialized Context state (positions, velocities, parameters and the integrator's random number
+generator state), the integrator seed, and the positions of the reporter outputs to a checkpoint file.
+Constructing a runner with an existing checkpoint file resumes the run from the last checkpoint, so that a
+preempted run continues exactly as if it had not been interrupted.
+
+Example
+-------
+
+>>> runner = AlchemicalRunner(system, positions, lambda_values, 'run.checkpoint', parameter='lambda',
+...                           topology=topology, trajectory_filename='trajectory.dcd', energy_directory='energies')
+>>> runner.run()
+>>> runner.checkpoint_times.mean(), runner.iteration_times.mean()
+
+For a merged topology, the protocol also selects variants:
+
+>>> set_state = lambda context, lambda_value, variant: set_alchemical_state(context, variant=variant, alchemical_lambda=lambda_value)
+>>> runner = AlchemicalRunner(system, positions, lambda_values, 'run.checkpoint', variants=variants, set_state=set_state)
+
+Notes
+-----
+* Restarts are exact only on the same platform, device and OpenMM version, since Context checkpoints are not portable.
+* The checkpoint file is written to a temporary file and renamed into place, so a preemption during checkpointing
+  leaves the previous checkpoint intact.
+* `suggestCheckpointInterval` uses the measured checkpoint and iteration costs to choose an interval for a given overhead.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.reporters import AlchemicalReporter
+from examol.alchemical_state import set_context_parameter
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+CHECKPOINT_VERSION = 1 # version of the checkpoint file layout
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_protocol_hash(system, lambda_values, variants, nsteps_per_iteration):
+    """
+    Return a digest identifying a System and protocol, so that checkpoints from a different run are rejected.
+
+    """
+    description = repr([ mm.XmlSerializer.serialize(system), [ float(value) for value in lambda_values ],
+                         (None if variants is None else [ int(variant) for variant in variants ]), nsteps_per_iteration ])
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+################################################################################
+# ALCHEMICAL RUNNER
+################################################################################
+
+class AlchemicalRunner(object):
+    """\
+    Run an alchemical protocol with periodic checkpoints, resuming from the last checkpoint if one exists.
+
+    """
+    def __init__(self, system, positions, lambda_values, checkpoint_filename, variants=None, parameter='lambda', set_state=None,
+                 nsteps_per_iteration=500, checkpoint_interval=100, temperature=300.0*unit.kelvin, collision_rate=5.0/unit.picoseconds,
+                 timestep=1.0*unit.femtoseconds, random_seed=None, platform=None,
+                 topology=None, trajectory_filename=None, energy_directory=None, report_stride=10):
+        """\
+        Create the Context, restoring it from `checkpoint_filename` if that file exists.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The alchemical System.
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with nanometers
+            Initial positions; ignored when resuming from a checkpoint.
+        lambda_values : list of float
+            The lambda value of each iteration.
+        checkpoint_filename : str
+            The checkpoint file to write, and to resume from if it exists.
+        variants : list of int, optional, default=None
+            The variant of each iteration, for merged topologies.
+        parameter : str, optional, default='lambda'
+            The global context parameter set to the lambda value of each iteration.  Ignored if `set_state` is given.
+            `alchemical_lambda` and `alchemical_variant` are set through `set_alchemical_state`, keeping merged Systems
+            built with variant_selection='tabulated' in sync.
+        set_state : callable, optional, default=None
+            set_state(context, lambda_value, variant) sets the alchemical state of the Context for an iteration.
+        nsteps_per_iteration : int, optional, default=500
+            Steps of dynamics per iteration.
+        checkpoint_interval : int, optional, default=100
+            Iterations between checkpoints.  A checkpoint is always written at the end of `run`.
+        temperature : simtk.unit.Quantity with units compatible with kelvin, optional, default=300 K
+            Langevin temperature.
+        collision_rate : simtk.unit.Quantity with units compatible with 1/picoseconds, optional, default=5/ps
+            Langevin collision rate.
+        timestep : simtk.unit.Quantity with units compatible with femtoseconds, optional, default=1 fs
+            Langevin timestep.
+        random_seed : int, optional, default=None
+            Seed for the integrator and initial velocities; drawn at random if None.  The seed in use is stored in checkpoints.
+        platform : simtk.openmm.Platform, optional, default=None
+            Platform for the Context; the fastest available if None.
+        topology : simtk.openmm.app.Topology, optional, default=None
+            The Topology of `system`, required for trajectory output.
+        trajectory_filename : str, optional, default=None
+            If given, positions are written every `report_stride` iterations and energies every iteration with an `AlchemicalReporter`.
+        energy_directory : str, optional, default=None
+            The energy store of the reporter; required if `trajectory_filename` is given.
+        report_stride : int, optional, default=10
+            Iterations between trajectory frames.
+
+        """
+        if (variants is not None) and (len(variants) != len(lambda_values)):
+            raise Exception("The protocol has %d lambda values but %d variants." % (len(lambda_values), len(variants)))
+        if (trajectory_filename is not None) and ((topology is None) or (energy_directory is None)):
+            raise Exception("Trajectory output requires a topology and an energy directory.")
+
+        self.system = system
+        self.lambda_values = lambda_values
+        self.variants = variants
+        self.parameter = parameter
+        self.set_state = set_state
+        self.checkpoint_filename = os.path.abspath(checkpoint_filename)
+        self.nsteps_per_iteration = nsteps_per_iteration
+        self.checkpoint_interval = checkpoint_interval
+        self.protocol_hash = get_protocol_hash(system, lambda_values, variants, nsteps_per_iteration)
+
+        # Read the checkpoint, if any, before creating the integrator so that the same seed is used.
+        checkpoint = None
+        if os.path.exists(self.checkpoint_filename):
+            with open(self.checkpoint_filename, 'rb') as infile:
+                checkpoint = pickle.load(infile)
+            if checkpoint['version'] != CHECKPOINT_VERSION:
+                raise Exception("Checkpoint '%s' has version %d; expected %d." % (self.checkpoint_filename, checkpoint['version'], CHECKPOINT_VERSION))
+            if checkpoint['protocol_hash'] != self.protocol_hash:
+                raise Exception("Checkpoint '%s' belongs to a different System or protocol." % self.checkpoint_filename)
+            random_seed = checkpoint['random_seed']
+        elif random_seed is None:
+            random_seed = np.random.randint(1, 2**31 - 1)
+        self.random_seed = int(random_seed)
+
+        self.integrator = mm.LangevinIntegrator(temperature, collision_rate, timestep)
+        self.integrator.setRandomNumberSeed(self.random_seed)
+        if platform is not None:
+            self.context = mm.Context(system, self.integrator, platform)
+        else:
+            self.context = mm.Context(system, self.integrator)
+
+        if checkpoint is not None:
+            self.context.loadCheckpoint(checkpoint['context'])
+            self.iteration = checkpoint['iteration']
+        else:
+            self.context.setPositions(positions)
+            self.context.setVelocitiesToTemperature(temperature, self.random_seed)
+            self.iteration = 0
+        self.restarted = (checkpoint is not None)
+        self._checkpoint_iteration = self.iteration if self.restarted else None
+
+        self.reporter = None
+        if trajectory_filename is not None:
+            self.reporter = AlchemicalReporter(self.context, topology, trajectory_filename, energy_directory, stride=report_stride,
+                                               timestep=nsteps_per_iteration*timestep,
+                                               checkpoint=(checkpoint['reporter'] if checkpoint else None))
+
+        # Wall-clock costs of this process, in seconds, for tuning the checkpoint interval.
+        self._checkpoint_times = list()
+        self._iteration_times = list()
+
+        return
+
+    @property
+    def niterations(self):
+        """\
+        The total number of iterations in the protocol.
+
+        """
+        return len(self.lambda_values)
+
+    @property
+    def checkpoint_times(self):
+        """\
+        Wall-clock time (in seconds) of each checkpoint written by this process.
+
+        """
+        return np.array(self._checkpoint_times)
+
+    @property
+    def iteration_times(self):
+        """\
+        Wall-clock time (in seconds) of each iteration run by this process.
+
+        """
+        return np.array(self._iteration_times)
+
+    def _setState(self, iteration):
+        variant = self.variants[iteration] if (self.variants is not None) else 0
+        if self.set_state is not None:
+            self.set_state(self.context, self.lambda_values[iteration], variant)
+        else:
+            set_context_parameter(self.context, self.parameter, self.lambda_values[iteration])
+        return variant
+
+    def checkpoint(self):
+        """\
+        Write a checkpoint of the current iteration, replacing the previous one.
+
+        """
+        initial_time = time.time()
+        checkpoint = dict(version=CHECKPOINT_VERSION, protocol_hash=self.protocol_hash, iteration=self.iteration,
+                          random_seed=self.random_seed, context=self.context.createCheckpoint(),
+                          reporter=(self.reporter.getCheckpoint() if self.reporter else None))
+
+        # Write to a temporary file in the same directory, then atomically rename into place.
+        (fd, temporary_filename) = tempfile.mkstemp(dir=os.path.dirname(self.checkpoint_filename), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                pickle.dump(checkpoint, outfile, protocol=2)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.rename(temporary_filename, self.checkpoint_filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+        self._checkpoint_iteration = self.iteration
+        self._checkpoint_times.append(time.time() - initial_time)
+
+        return
+
+    def run(self, niterations=None, verbose=False):
+        """\
+        Run the remaining iterations of the protocol, or at most `niterations` of them, then checkpoint.
+
+        Parameters
+        ----------
+        niterations : int, optional, default=None
+            The maximum number of iterations to run; all remaining iterations if None.
+        verbose : bool, optional, default=False
+            If True, print progress and checkpoint costs.
+
+        """
+        final_iteration = self.niterations
+        if niterations is not None:
+            final_iteration = min(final_iteration, self.iteration + niterations)
+
+        while self.iteration < final_iteration:
+            initial_time = time.time()
+            variant = self._setState(self.iteration)
+            self.integrator.step(self.nsteps_per_iteration)
+            if self.reporter is not None:
+                self.reporter.report(self.iteration, self.lambda_values[self.iteration], variant=variant)
+            self.iteration += 1
+            self._iteration_times.append(time.time() - initial_time)
+            if verbose:
+                print("Iteration %8d / %8d : lambda %8.5f : variant %5d" % (self.iteration, self.niterations, self.lambda_values[self.iteration-1], variant))
+
+            if self.iteration % self.checkpoint_interval == 0:
+                self.checkpoint()
+                if verbose:
+                    print("Checkpoint written in %.3f s" % self._checkpoint_times[-1])
+
+        if self._checkpoint_iteration != self.iteration:
+            self.checkpoint()
+
+        return
+
+    def suggestCheckpointInterval(self, max_overhead=0.01):
+        """\
+        Return the smallest checkpoint interval whose measured cost stays within a fraction of the simulation time.
+
+        Parameters
+        ----------
+        max_overhead : float, optional, default=0.01
+            The acceptable ratio of checkpoint time to simulation time.
+
+        Returns
+        -------
+        interval : int or None
+            The suggested number of iterations between checkpoints, or None if no checkpoints or iterations have been timed yet.
+
+        """
+        if (len(self._checkpoint_times) == 0) or (len(self._iteration_times) == 0):
+            return None
+        return max(1, int(np.ceil(self.checkpoint_times.mean() / (max_overhead * self.iteration_times.mean()))))
+
+    def close(self):
+        """\
+        Close the reporter outputs and release the Context.
+
+        """
+        if self.reporter is not None:
+            self.reporter.close()
+            self.reporter = None
+        del self.context, self.integrator
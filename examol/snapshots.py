@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Immutable snapshots of System/Topology/positions triples.
+
+Factories that need to keep an environment or molecule around until they generate a new System used to
+deep-copy the live OpenMM objects, which doubles memory for large environments before any work starts.
+A `SystemSnapshot` instead keeps the System serialized to XML, the Topology pickled, and the positions in
+a read-only array; live copies are only created when `getSystem`, `getTopology` or `getPositions` is called.
+
+Example
+-------
+
+>>> snapshot = SystemSnapshot(system, topology, positions)
+>>> system = snapshot.getSystem() # a new, independent System
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import pickle
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+################################################################################
+# SYSTEM SNAPSHOT
+################################################################################
+
+class SystemSnapshot(object):
+    """\
+    Immutable snapshot of a System, its Topology, and positions.
+
+    """
+    def __init__(self, system, topology=None, positions=None, length_unit=unit.nanometers):
+        """\
+        Take a snapshot.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The System; stored serialized to XML.
+        topology : simtk.openmm.app.Topology, optional, default=None
+            The Topology corresponding to system; stored pickled.
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with length, optional, default=None
+            The positions; stored as a read-only float64 array in `length_unit`.
+        length_unit : simtk.unit.Unit, optional, default=unit.nanometers
+            The unit positions are stored in.
+
+        """
+        self.nparticles = system.getNumParticles()
+        self._system = mm.XmlSerializer.serialize(system)
+        self._topology = pickle.dumps(topology, protocol=2) if (topology is not None) else None
+        self._positions = None
+        self.length_unit = length_unit
+        if positions is not None:
+            self._positions = np.array(positions.value_in_unit(length_unit), np.float64)
+            self._positions.flags.writeable = False
+
+        return
+
+    def getSystem(self):
+        """\
+        Return a new System deserialized from the snapshot.
+
+        """
+        return mm.XmlSerializer.deserialize(self._system)
+
+    def getTopology(self):
+        """\
+        Return a new Topology unpickled from the snapshot, or None if no topology was stored.
+
+        """
+        if self._topology is None:
+            return None
+        return pickle.loads(self._topology)
+
+    def getPositions(self):
+        """\
+        Return the stored positions without copying, or None if no positions were stored.
+
+        Returns
+        -------
+        positions : simtk.unit.Quantity of (natoms,3) with units compatible with length
+            A Quantity wrapping the read-only snapshot array; copy it before modifying.
+
+        """
+        if self._positions is None:
+            return None
+        return unit.Quantity(self._positions, self.length_unit)
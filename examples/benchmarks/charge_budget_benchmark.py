@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Accuracy-versus-time tradeoff of AM1-BCC conformer budgets in `ChargeService`.
+
+For each molecule, charges are computed with the canonical recipe (AM1BCCSym over up to 800 conformers) as the
+reference, and with reduced budgets and the ELF10 scheme.  For each setting the wall-clock time and the RMS and
+maximum absolute deviation of the charges from the reference are reported.  The time of a cache hit is also shown.
+
+Requires an OpenEye license.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import time
+
+import numpy as np
+from openmoltools import openeye
+
+from examol.charges import ChargeService
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def get_charges(molecule):
+    """
+    Return the partial charges of a molecule as an array.
+
+    """
+    return np.array([ atom.GetPartialCharge() for atom in molecule.GetAtoms() ])
+
+def time_charge_assignment(service, molecule):
+    """
+    Return [charges, elapsed time in seconds] for assigning charges to `molecule` with `service`.
+
+    """
+    initial_time = time.time()
+    charged_molecule = service.assignCharges(molecule)
+    elapsed_time = time.time() - initial_time
+    return [get_charges(charged_molecule), elapsed_time]
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    molecule_names = ['toluene', 'methoxytoluene', 'aspirin', 'ibuprofen', 'imatinib']
+    settings = [ ('am1bccsym', 800), ('am1bccsym', 100), ('am1bccsym', 20), ('am1bccsym', 1),
+                 ('am1bccelf10', 800), ('am1bccelf10', 200) ]
+
+    print("%16s %12s %9s %10s %10s %10s" % ('molecule', 'mode', 'max_confs', 'time (s)', 'RMS (e)', 'max (e)'))
+    for name in molecule_names:
+        molecule = openeye.iupac_to_oemol(name)
+        for (index, (mode, max_confs)) in enumerate(settings):
+            service = ChargeService(mode=mode, max_confs=max_confs)
+            [charges, elapsed_time] = time_charge_assignment(service, molecule)
+            if index == 0:
+                reference_charges = charges
+            deviation = charges - reference_charges
+            print("%16s %12s %9d %10.2f %10.4f %10.4f" % (name, mode, max_confs, elapsed_time, np.sqrt(np.mean(deviation**2)), np.abs(deviation).max()))
+        # Time a cache hit with the last service.
+        [charges, elapsed_time] = time_charge_assignment(service, molecule)
+        print("%16s %12s %9s %10.2f" % (name, mode, 'cached', elapsed_time))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Benchmark the cost of `AlchemicalRunner` checkpoints against the cost of an iteration.
+
+For synthetic environments of increasing size, a short protocol is run with a checkpoint after every
+iteration, and the mean checkpoint and iteration times are reported together with the checkpoint file size
+and the interval `suggestCheckpointInterval` recommends for a 1% overhead.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import sys
+import shutil
+import tempfile
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.runner import AlchemicalRunner
+from synthetic import create_environment_system
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+NPARTICLES = [1000, 10000, 100000]
+NITERATIONS = 10
+NSTEPS_PER_ITERATION = 100
+MAX_OVERHEAD = 0.01
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    platform_name = sys.argv[1] if (len(sys.argv) > 1) else 'CPU'
+    platform = mm.Platform.getPlatformByName(platform_name)
+
+    print("%10s %16s %16s %14s %10s" % ('particles', 'checkpoint (ms)', 'iteration (ms)', 'size (MB)', 'interval'))
+    for nparticles in NPARTICLES:
+        [system, positions] = create_environment_system(nparticles, nonbonded_method=mm.NonbondedForce.CutoffNonPeriodic)
+        # A lambda-dependent restraint stands in for the alchemical terms.
+        force = mm.CustomExternalForce('lambda*0.5*K*((x-x0)^2 + (y-y0)^2 + (z-z0)^2); K = 100.0')
+        force.addGlobalParameter('lambda', 0.0)
+        for parameter in ['x0', 'y0', 'z0']:
+            force.addPerParticleParameter(parameter)
+        for (index, position) in enumerate(positions / unit.nanometers):
+            force.addParticle(index, list(position))
+        system.addForce(force)
+
+        directory = tempfile.mkdtemp()
+        try:
+            checkpoint_filename = os.path.join(directory, 'run.checkpoint')
+            runner = AlchemicalRunner(system, positions, np.linspace(0.0, 1.0, NITERATIONS), checkpoint_filename,
+                                      nsteps_per_iteration=NSTEPS_PER_ITERATION, checkpoint_interval=1, platform=platform)
+            runner.run()
+            size = os.path.getsize(checkpoint_filename) / 1024.0**2
+            print("%10d %16.3f %16.3f %14.2f %10d" % (nparticles, runner.checkpoint_times.mean() * 1.0e3, runner.iteration_times.mean() * 1.0e3,
+                                                    size, runner.suggestCheckpointInterval(max_overhead=MAX_OVERHEAD)))
+            runner.close()
+        finally:
+            shutil.rmtree(directory)
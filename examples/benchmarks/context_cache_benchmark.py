@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark `ContextCache` against creating a new Context for every energy evaluation.
+
+For synthetic environments of increasing size, the time to fingerprint the System (from its parameter arrays, and from its serialized XML), to create
+a Context, and to fetch the cached Context on a hit are reported, together with the memory measured for the
+cached Context.  Repeated evaluations of a revisited System pay the fingerprint and lookup instead of Context
+creation.
+
+A merged System, with alchemical Custom*Force objects and core restraints, is then cached with exact=False; the
+script exits with an exception if revisiting it misses the cache or if adding a restraint leaves its fingerprint unchanged.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import sys
+import time
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.context_cache import ContextCache, get_system_fingerprint
+from synthetic import create_environment_system, create_variant_series
+from variant_force_group_benchmark import build_merged_system
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+NPARTICLES = [1000, 10000, 100000]
+NREPEATS = 5
+NVARIANTS = 10
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def time_call(function, nrepeats):
+    """
+    Return the mean wall-clock time (in seconds) of `nrepeats` calls of `function`.
+
+    """
+    initial_time = time.time()
+    for repeat in range(nrepeats):
+        function()
+    return (time.time() - initial_time) / nrepeats
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    platform_name = sys.argv[1] if (len(sys.argv) > 1) else 'CPU'
+    platform = mm.Platform.getPlatformByName(platform_name)
+    integrator = mm.VerletIntegrator(1.0*unit.femtoseconds)
+
+    print("%10s %18s %18s %14s %14s %12s" % ('particles', 'parameters (ms)', 'XML hash (ms)', 'create (ms)', 'hit (ms)', 'memory (MB)'))
+    for nparticles in NPARTICLES:
+        [system, positions] = create_environment_system(nparticles, nonbonded_method=mm.NonbondedForce.CutoffNonPeriodic)
+
+        fingerprint_time = time_call(lambda: get_system_fingerprint(system, exact=False), NREPEATS)
+        exact_time = time_call(lambda: get_system_fingerprint(system, exact=True), NREPEATS)
+
+        def create():
+            context = mm.Context(system, mm.VerletIntegrator(1.0*unit.femtoseconds), platform)
+            context.setPositions(positions)
+            context.getState(getEnergy=True)
+        create_time = time_call(create, NREPEATS)
+
+        cache = ContextCache(capacity=1)
+        def fetch():
+            [context, cached_integrator] = cache.getContext(system, integrator, platform=platform)
+            context.setPositions(positions)
+            context.getState(getEnergy=True)
+        fetch()
+        hit_time = time_call(fetch, NREPEATS)
+
+        print("%10d %18.3f %18.3f %14.3f %14.3f %12.1f" % (nparticles, fingerprint_time * 1.0e3, exact_time * 1.0e3, create_time * 1.0e3,
+                                                           hit_time * 1.0e3, cache.memory / 1024.0**2))
+        print("%10s hits %d, misses %d, evictions %d" % ('', cache.nhits, cache.nmisses, cache.nevictions))
+        cache.clear()
+
+    # Merged Systems hold Custom*Force objects with and without per-term parameters.
+    [environment_system, environment_positions] = create_environment_system(NPARTICLES[0], nonbonded_method=mm.NonbondedForce.CutoffNonPeriodic)
+    [system, positions] = build_merged_system(environment_system, environment_positions, create_variant_series(NVARIANTS), 'shared')
+    cache = ContextCache(capacity=1, exact=False)
+    for repeat in range(2):
+        [context, cached_integrator] = cache.getContext(system, integrator, platform=platform)
+    if (cache.nhits, cache.nmisses) != (1, 1):
+        raise Exception("Expected 1 hit and 1 miss for a revisited merged System, got %d hits and %d misses." % (cache.nhits, cache.nmisses))
+    fingerprint = get_system_fingerprint(system, exact=False)
+    restraint_force = [ force for force in system.getForces() if isinstance(force, mm.CustomBondForce) and (force.getNumPerBondParameters() == 0) ][-1]
+    restraint_force.addBond(0, 1, [])
+    if get_system_fingerprint(system, exact=False) == fingerprint:
+        raise Exception("Adding a core restraint did not change the fingerprint of the merged System.")
+    print("%10d merged System of %d variants: fingerprint %.3f ms" % (system.getNumParticles(), NVARIANTS,
+                                                                       time_call(lambda: get_system_fingerprint(system, exact=False), NREPEATS) * 1.0e3))
+    cache.clear()
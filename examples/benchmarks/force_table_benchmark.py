@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Benchmark copying force terms one at a time with unit-wrapped parameters against bulk force tables.
+
+For each kind of term of a 50,000-atom united-atom alkane (about 50,000 terms of each kind), the terms are
+copied into an empty force of the same class, either with the per-term accessors used by the original
+system-building code or with `get_force_table` / `add_force_table`, and the times and speedup are reported.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import time
+
+import simtk.openmm as mm
+import numpy as np
+
+from examol.force_tables import get_force_table, add_force_table
+from synthetic import create_alkane_system
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+NCARBONS = 50000
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def copy_per_term(force, kind):
+    """
+    Copy the terms of a kind into a new force one at a time, with unit-wrapped parameters.
+
+    """
+    target = force.__class__()
+    if kind == 'bonds':
+        for index in range(force.getNumBonds()):
+            [atom_i, atom_j, length, K] = force.getBondParameters(index)
+            target.addBond(atom_i, atom_j, length, K)
+    elif kind == 'angles':
+        for index in range(force.getNumAngles()):
+            [atom_i, atom_j, atom_k, theta0, K] = force.getAngleParameters(index)
+            target.addAngle(atom_i, atom_j, atom_k, theta0, K)
+    elif kind == 'torsions':
+        for index in range(force.getNumTorsions()):
+            [atom_i, atom_j, atom_k, atom_l, periodicity, phase, K] = force.getTorsionParameters(index)
+            target.addTorsion(atom_i, atom_j, atom_k, atom_l, periodicity, phase, K)
+    elif kind == 'particles':
+        for index in range(force.getNumParticles()):
+            [charge, sigma, epsilon] = force.getParticleParameters(index)
+            target.addParticle(charge, sigma, epsilon)
+    elif kind == 'exceptions':
+        for index in range(force.getNumExceptions()):
+            [atom_i, atom_j, chargeProd, sigma, epsilon] = force.getExceptionParameters(index)
+            target.addException(atom_i, atom_j, chargeProd, sigma, epsilon)
+    return target
+
+def copy_table(force, kind):
+    """
+    Copy the terms of a kind into a new force with one table read and one bulk add.
+
+    """
+    target = force.__class__()
+    add_force_table(target, get_force_table(force, kind), kind)
+    return target
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    [system, positions] = create_alkane_system(NCARBONS)
+    forces = { system.getForce(index).__class__.__name__ : system.getForce(index) for index in range(system.getNumForces()) }
+
+    print("%32s %10s %14s %14s %8s" % ('force', 'terms', 'per-term (s)', 'table (s)', 'speedup'))
+    for (force_name, kind) in [('HarmonicBondForce', 'bonds'), ('HarmonicAngleForce', 'angles'), ('PeriodicTorsionForce', 'torsions'),
+                               ('NonbondedForce', 'particles'), ('NonbondedForce', 'exceptions')]:
+        force = forces[force_name]
+        initial_time = time.time()
+        per_term_copy = copy_per_term(force, kind)
+        per_term_time = time.time() - initial_time
+
+        initial_time = time.time()
+        table_copy = copy_table(force, kind)
+        table_time = time.time() - initial_time
+
+        # Both copies must hold the same terms.
+        if not np.all(get_force_table(per_term_copy, kind) == get_force_table(table_copy, kind)):
+            raise Exception("Per-term and table copies of %s %s differ." % (force_name, kind))
+
+        print("%32s %10d %14.3f %14.3f %8.2f" % ('%s %s' % (force_name, kind), len(get_force_table(force, kind)), per_term_time, table_time, per_term_time / table_time))
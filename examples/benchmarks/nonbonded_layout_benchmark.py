@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Benchmark the nonbonded layouts supported by `add_molecule_to_system`.
+
+For an increasing number of variants, a merged topology is built with each layout in NONBONDED_LAYOUTS,
+and the number of NonbondedForce exceptions, CustomNonbondedForce exclusions and interaction groups is
+reported together with the time needed to create a Context on the Reference platform.
+
+Both layouts must describe the same physics, so before timing, the energies of a small merged system built with
+each layout are compared over every (variant, lambda) state.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import time
+import copy
+
+import numpy as np
+import simtk.openmm as mm
+from simtk import unit
+
+from examol.multitopology.multitopology import add_molecule_to_system, set_alchemical_state, NONBONDED_LAYOUTS
+from synthetic import create_environment_system, create_variant_series
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def build_merged_system(environment_system, variants, nonbonded_layout):
+    """
+    Add a core and all variants to a copy of the environment using the specified nonbonded layout.
+
+    Parameters
+    ----------
+    environment_system : simtk.openmm.System
+        The environment System.
+    variants : list of [system, positions, core_atoms]
+        Variants as returned by `create_variant_series`.
+    nonbonded_layout : str
+        One of NONBONDED_LAYOUTS.
+
+    Returns
+    -------
+    system : simtk.openmm.System
+        The merged System.
+
+    """
+    system = copy.deepcopy(environment_system)
+    environment_atoms = range(system.getNumParticles())
+    [molecule_system, molecule_positions, core_atoms] = variants[0]
+    core_mapping = add_molecule_to_system(system, molecule_system, core_atoms, variant=0,
+                                          nonbonded_layout=nonbonded_layout, environment_atoms=environment_atoms)
+    atoms_to_exclude = list(core_mapping.values())
+    for (variant, [molecule_system, molecule_positions, core_atoms]) in enumerate(variants):
+        mapping = add_molecule_to_system(system, molecule_system, core_atoms, variant=variant+1, atoms_to_exclude=atoms_to_exclude,
+                                         nonbonded_layout=nonbonded_layout, environment_atoms=environment_atoms)
+        atoms_to_exclude += mapping.values()
+    return system
+
+def get_merged_positions(environment_positions, variants, displacement=0.3*unit.angstroms):
+    """
+    Build positions for a merged System created by `build_merged_system`.
+
+    Parameters
+    ----------
+    environment_positions : simtk.unit.Quantity of (natoms,3) with units compatible with angstroms
+        The positions of the environment.
+    variants : list of [system, positions, core_atoms]
+        Variants as returned by `create_variant_series`.
+    displacement : simtk.unit.Quantity with units compatible with angstroms, optional, default=0.3 A
+        Variant `n` is displaced by `n` times this along x, so that no two alchemical particles coincide.
+
+    Returns
+    -------
+    positions : simtk.unit.Quantity of (natoms,3) with units compatible with angstroms
+        Positions of the environment, the core (taken from the first variant) and every variant.
+
+    """
+    [molecule_system, molecule_positions, core_atoms] = variants[0]
+    blocks = [ environment_positions / unit.angstroms, (molecule_positions / unit.angstroms)[core_atoms,:] ]
+    for (variant, [molecule_system, molecule_positions, core_atoms]) in enumerate(variants):
+        block = np.array(molecule_positions / unit.angstroms)
+        block[:,0] += (variant + 1) * (displacement / unit.angstroms)
+        blocks.append(block)
+    return unit.Quantity(np.concatenate(blocks), unit.angstroms)
+
+def compute_state_energies(system, positions, nvariants, lambdas=[0.0, 0.5, 1.0], platform_name='Reference'):
+    """
+    Compute the potential energy of a merged System in every (variant, lambda) state.
+
+    Returns
+    -------
+    energies : numpy.ndarray of float, shape (nvariants, nlambdas)
+        energies[variant-1, index] is the energy (in kJ/mol) with `alchemical_variant` = variant and `alchemical_lambda` = lambdas[index].
+
+    """
+    integrator = mm.VerletIntegrator(1.0 * unit.femtoseconds)
+    context = mm.Context(system, integrator, mm.Platform.getPlatformByName(platform_name))
+    context.setPositions(positions)
+    energies = np.zeros([nvariants, len(lambdas)], np.float64)
+    for variant in range(1, nvariants+1):
+        for (index, alchemical_lambda) in enumerate(lambdas):
+            set_alchemical_state(context, variant=variant, alchemical_lambda=alchemical_lambda)
+            energies[variant-1, index] = context.getState(getEnergy=True).getPotentialEnergy() / unit.kilojoules_per_mole
+    del context, integrator
+    return energies
+
+def check_layout_energies(environment_system, environment_positions, variants, tolerance=1.0e-6):
+    """
+    Check that every layout in NONBONDED_LAYOUTS gives the same energy in every (variant, lambda) state.
+
+    Raises an Exception if the energies of two layouts differ by more than `tolerance` kJ/mol.
+
+    """
+    positions = get_merged_positions(environment_positions, variants)
+    energies = dict()
+    for nonbonded_layout in NONBONDED_LAYOUTS:
+        system = build_merged_system(environment_system, variants, nonbonded_layout)
+        energies[nonbonded_layout] = compute_state_energies(system, positions, len(variants))
+    reference_layout = NONBONDED_LAYOUTS[0]
+    for nonbonded_layout in NONBONDED_LAYOUTS[1:]:
+        error = np.abs(energies[nonbonded_layout] - energies[reference_layout]).max()
+        if error > tolerance:
+            raise Exception("Nonbonded layouts '%s' and '%s' differ by up to %.6f kJ/mol." % (reference_layout, nonbonded_layout, error))
+    return
+
+def time_context_creation(system, platform_name='Reference'):
+    """
+    Return the wall-clock time (in seconds) needed to create a Context for `system`.
+
+    """
+    integrator = mm.VerletIntegrator(1.0 * unit.femtoseconds)
+    platform = mm.Platform.getPlatformByName(platform_name)
+    initial_time = time.time()
+    context = mm.Context(system, integrator, platform)
+    elapsed_time = time.time() - initial_time
+    del context, integrator
+    return elapsed_time
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    [environment_system, environment_positions] = create_environment_system(100)
+
+    # Both layouts must give the same energies before their costs are compared.
+    check_layout_energies(environment_system, environment_positions, create_variant_series(3))
+    print("Nonbonded layouts %s give identical energies." % str(NONBONDED_LAYOUTS))
+
+    results = list()
+    for nvariants in [10, 50, 100, 200]:
+        variants = create_variant_series(nvariants)
+        for nonbonded_layout in NONBONDED_LAYOUTS:
+            initial_time = time.time()
+            system = build_merged_system(environment_system, variants, nonbonded_layout)
+            build_time = time.time() - initial_time
+            forces = { system.getForce(index).__class__.__name__ : system.getForce(index) for index in range(system.getNumForces()) }
+            nexceptions = forces['NonbondedForce'].getNumExceptions()
+            nexclusions = forces['CustomNonbondedForce'].getNumExclusions()
+            ngroups = forces['CustomNonbondedForce'].getNumInteractionGroups()
+            context_time = time_context_creation(system)
+            results.append((nvariants, nonbonded_layout, system.getNumParticles(), nexceptions, nexclusions, ngroups, build_time, context_time))
+
+    print("%9s %20s %10s %12s %12s %8s %10s %10s" % ('nvariants', 'layout', 'particles', 'exceptions', 'exclusions', 'groups', 'build (s)', 'context (s)'))
+    for result in results:
+        print("%9d %20s %10d %12d %12d %8d %10.3f %10.3f" % result)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Benchmark `ReplicaExchangeSampler` exchange acceptance and throughput per core.
+
+A synthetic Lennard-Jones environment is given a lambda-dependent harmonic restraint of a few particles to their
+lattice sites, standing in for the alchemical terms of a hybrid System.  Replica exchange is run with an
+increasing number of lambda states, one CPU thread per replica, and the mean exchange acceptance and the
+aggregate and per-core throughput are reported.  Per-core throughput stays flat as replicas are added only
+while there are at least as many cores as replicas.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import sys
+import multiprocessing
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.replica_exchange import ReplicaExchangeSampler
+from synthetic import create_environment_system
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+NREPLICAS = [2, 4, 8]
+NPARTICLES = 1000
+NRESTRAINED = 10
+NITERATIONS = 20
+NSTEPS_PER_ITERATION = 250
+TEMPERATURE = 300.0 * unit.kelvin
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def create_restrained_system(nparticles, nrestrained):
+    """
+    Create a synthetic environment whose first `nrestrained` particles are restrained to their lattice sites with strength `lambda`.
+
+    """
+    [system, positions] = create_environment_system(nparticles, nonbonded_method=mm.NonbondedForce.CutoffNonPeriodic)
+    force = mm.CustomExternalForce('lambda*0.5*K*((x-x0)^2 + (y-y0)^2 + (z-z0)^2); K = 100.0')
+    force.addGlobalParameter('lambda', 0.0)
+    for parameter in ['x0', 'y0', 'z0']:
+        force.addPerParticleParameter(parameter)
+    for (index, position) in enumerate(positions[:nrestrained] / unit.nanometers):
+        force.addParticle(index, list(position))
+    system.addForce(force)
+    return [system, positions]
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    platform_name = sys.argv[1] if (len(sys.argv) > 1) else 'CPU'
+    [system, positions] = create_restrained_system(NPARTICLES, NRESTRAINED)
+    print("%d cores available" % multiprocessing.cpu_count())
+
+    print("%9s %12s %12s %14s" % ('replicas', 'acceptance', 'ns/day', 'ns/day/core'))
+    for nreplicas in NREPLICAS:
+        sampler = ReplicaExchangeSampler(system, positions, np.linspace(0.0, 1.0, nreplicas), TEMPERATURE, parameter='lambda',
+                                         nsteps_per_iteration=NSTEPS_PER_ITERATION, platform_name=platform_name, random_seed=0)
+        try:
+            sampler.run(NITERATIONS)
+            print("%9d %12.3f %12.3f %14.3f" % (nreplicas, sampler.acceptance_rates.mean(), sampler.ns_per_day, sampler.ns_per_day_per_core))
+        finally:
+            sampler.close()
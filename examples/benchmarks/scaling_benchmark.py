@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+Scaling benchmark for merged-topology construction.
+
+Merged topologies are built from synthetic alkane variant series (see `synthetic.py`) at increasing library
+sizes with each of the construction entry points of `examol.multitopology.multitopology`:
+
+* add_molecule_to_system : the core and every variant System are added to the environment System directly
+  (stages 'core' and 'variants'); needs no OpenEye toolkit.
+* generateMergedTopology : every variant is added to an `AlchemicalMergedTopologyFactory` with `addMoleculeVariant`
+  (stage 'add'), which then builds the merged topology, including common-core detection and charge fitting
+  (stage 'generate').  The variants are given as OEMol copies of the synthetic united-atom alkanes, so a licensed
+  OpenEye toolkit is needed but no parameterization is done.
+* create_merged_topology : alkanes of the same lengths, created with `create_molecule`, are parameterized and merged
+  (stage 'create').  A ParameterizationCache shared by all library sizes means that each alkane is parameterized once;
+  this needs a licensed OpenEye toolkit and AmberTools.
+
+Entry points whose requirements are missing are reported as skipped.  Each entry point and library size is built in
+a fresh interpreter so that peak resident memory can be attributed to it.  Wall time per stage, peak memory,
+particle/exception/exclusion counts and Context creation time (stage 'context') are printed as a table and written
+as JSON, together with the versions used, so that results can be compared between versions of examol.
+
+Usage
+-----
+
+python scaling_benchmark.py [output.json] [platform] [nonbonded_layout]
+
+The default layout is 'interaction_groups'; the number of exclusions in the 'exclusions' layout grows
+quadratically with the number of variants, which makes the 1000-variant builds take many minutes.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+
+import simtk.openmm as mm
+import simtk.openmm.app as app
+from simtk import unit
+
+from examol.positions import PositionBuffer
+from examol.multitopology.multitopology import add_molecule_to_system, create_core_restraint_force, oe
+from synthetic import create_environment_system, create_variant_series
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+NVARIANTS = [10, 100, 1000]
+NENVIRONMENT = 1000
+NCORE = 4
+MAX_EXTRA = 4
+
+ENTRY_POINTS = ['add_molecule_to_system', 'generateMergedTopology', 'create_merged_topology']
+
+ALKANE_NAMES = { 5 : 'pentane', 6 : 'hexane', 7 : 'heptane', 8 : 'octane' } # by number of carbons in the synthetic series
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in MB.
+
+    """
+    # ru_maxrss is reported in kB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def get_versions():
+    """
+    Return the versions of examol (git revision), OpenMM, OpenEye and Python used for the benchmark.
+
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=directory, stderr=devnull).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = 'unknown'
+    openeye = oe.OEChemGetRelease() if (oe is not None) else None
+    return dict(examol=revision, openmm=mm.Platform.getOpenMMVersion(), openeye=openeye, python=platform.python_version())
+
+def get_missing_requirement(entry_point):
+    """
+    Return a description of what `entry_point` needs that is not available, or None if it can be run.
+
+    """
+    if entry_point == 'add_molecule_to_system':
+        return None
+    if (oe is None) or (not oe.OEChemIsLicensed()):
+        return 'a licensed OpenEye toolkit'
+    if entry_point == 'create_merged_topology':
+        directories = os.environ.get('PATH', '').split(os.pathsep)
+        if not any([ os.access(os.path.join(directory, 'antechamber'), os.X_OK) for directory in directories ]):
+            return 'AmberTools'
+    return None
+
+def create_environment():
+    """
+    Create the synthetic environment System, with a Topology of one atom per particle, and its positions.
+
+    """
+    [environment_system, environment_positions] = create_environment_system(NENVIRONMENT)
+    environment_topology = app.Topology()
+    residue = environment_topology.addResidue('ENV', environment_topology.addChain())
+    for index in range(environment_system.getNumParticles()):
+        environment_topology.addAtom('E%d' % index, app.Element.getBySymbol('C'), residue)
+    return [environment_system, environment_topology, environment_positions]
+
+def create_variant_molecule(variant, molecule_system, molecule_positions, core_atoms):
+    """
+    Create an OEMol of a synthetic united-atom alkane variant, for use with `AlchemicalMergedTopologyFactory`.
+
+    Core atoms are typed 'c3' and the other atoms after the number of non-core atoms, so that the common core found by
+    the factory is the synthetic core.
+
+    """
+    nonbonded_force = [ force for force in molecule_system.getForces() if isinstance(force, mm.NonbondedForce) ][0]
+    positions = molecule_positions.value_in_unit(unit.angstroms)
+    nextra = molecule_system.getNumParticles() - len(core_atoms)
+    molecule = oe.OEMol()
+    molecule.SetTitle('alkane%d' % variant)
+    atoms = list()
+    for index in range(molecule_system.getNumParticles()):
+        atom = molecule.NewAtom(6)
+        atom.SetName('C%d' % index)
+        atom.SetType('c3' if (index in core_atoms) else 'x%d' % nextra)
+        [charge, sigma, epsilon] = nonbonded_force.getParticleParameters(index)
+        atom.SetPartialCharge(charge / unit.elementary_charge)
+        molecule.SetCoords(atom, tuple(positions[index]))
+        atoms.append(atom)
+    for index in range(len(atoms) - 1):
+        bond = molecule.NewBond(atoms[index], atoms[index+1], 1)
+        bond.SetIntType(1)
+    molecule.SetDimension(3)
+    return molecule
+
+def count_terms(system):
+    """
+    Return the particle, force, exception, exclusion and interaction group counts of a merged System.
+
+    """
+    nonbonded_force = [ force for force in system.getForces() if isinstance(force, mm.NonbondedForce) ][0]
+    custom_nonbonded_forces = [ force for force in system.getForces() if isinstance(force, mm.CustomNonbondedForce) ]
+    return dict(particles=system.getNumParticles(),
+                forces=system.getNumForces(),
+                exceptions=nonbonded_force.getNumExceptions(),
+                exclusions=sum([ force.getNumExclusions() for force in custom_nonbonded_forces ]),
+                interaction_groups=sum([ force.getNumInteractionGroups() for force in custom_nonbonded_forces ]))
+
+def build_with_add_molecule_to_system(nvariants, nonbonded_layout, timings):
+    """
+    Build a merged System by adding the core and every variant with `add_molecule_to_system`.
+
+    """
+    [system, topology, environment_positions] = create_environment()
+    variants = create_variant_series(nvariants, ncore=NCORE, max_extra=MAX_EXTRA)
+    environment_atoms = range(system.getNumParticles())
+    position_buffer = PositionBuffer(system.getNumParticles() + NCORE + sum([ variant_system.getNumParticles() for [variant_system, variant_positions, core_atoms] in variants ]))
+    position_buffer.addBlock(environment_positions)
+
+    initial_time = time.time()
+    [molecule_system, molecule_positions, core_atoms] = variants[0]
+    core_mapping = add_molecule_to_system(system, molecule_system, core_atoms, variant=0,
+                                          nonbonded_layout=nonbonded_layout, environment_atoms=environment_atoms)
+    position_buffer.addBlock(molecule_positions[sorted(core_atoms)])
+    timings['core'] = time.time() - initial_time
+
+    initial_time = time.time()
+    restraint_force = create_core_restraint_force()
+    atoms_to_exclude = list(core_mapping.values())
+    for (variant_index, [molecule_system, molecule_positions, core_atoms]) in enumerate(variants):
+        position_buffer.addBlock(molecule_positions)
+        mapping = add_molecule_to_system(system, molecule_system, core_atoms, variant=variant_index+1, atoms_to_exclude=atoms_to_exclude,
+                                         nonbonded_layout=nonbonded_layout, environment_atoms=environment_atoms)
+        for index in core_atoms:
+            restraint_force.addBond(mapping[index], core_mapping[index], [])
+        atoms_to_exclude += mapping.values()
+    system.addForce(restraint_force)
+    timings['variants'] = time.time() - initial_time
+
+    return [system, position_buffer.getPositions()]
+
+def build_with_generateMergedTopology(nvariants, nonbonded_layout, timings):
+    """
+    Build a merged System with `AlchemicalMergedTopologyFactory.generateMergedTopology`.
+
+    """
+    from examol.multitopology.multitopology import AlchemicalMergedTopologyFactory
+
+    [environment_system, environment_topology, environment_positions] = create_environment()
+    variants = create_variant_series(nvariants, ncore=NCORE, max_extra=MAX_EXTRA)
+    molecules = [ create_variant_molecule(variant, molecule_system, molecule_positions, core_atoms)
+                  for (variant, [molecule_system, molecule_positions, core_atoms]) in enumerate(variants) ]
+
+    initial_time = time.time()
+    factory = AlchemicalMergedTopologyFactory(environment_system, environment_topology, environment_positions, nonbonded_layout=nonbonded_layout)
+    for (molecule, [molecule_system, molecule_positions, core_atoms]) in zip(molecules, variants):
+        factory.addMoleculeVariant(molecule, molecule_system, None, molecule_positions)
+    timings['add'] = time.time() - initial_time
+
+    initial_time = time.time()
+    [system, topology, positions] = factory.generateMergedTopology()
+    timings['generate'] = time.time() - initial_time
+
+    return [system, positions]
+
+def build_with_create_merged_topology(nvariants, nonbonded_layout, timings, cache_directory):
+    """
+    Build a merged System with `create_merged_topology`, parameterizing alkanes through a ParameterizationCache.
+
+    """
+    from examol.multitopology.multitopology import create_merged_topology, create_molecule
+    from examol.parameterization_cache import ParameterizationCache
+
+    [environment_system, environment_topology, environment_positions] = create_environment()
+    alkanes = dict([ (ncarbons, create_molecule(name)) for (ncarbons, name) in ALKANE_NAMES.items() ])
+    molecules = [ alkanes[NCORE + 1 + (variant % MAX_EXTRA)] for variant in range(nvariants) ]
+
+    initial_time = time.time()
+    [system, topology, positions] = create_merged_topology(environment_system, environment_topology, environment_positions, molecules,
+                                                           nonbonded_layout=nonbonded_layout, cache=ParameterizationCache(cache_directory))
+    timings['create'] = time.time() - initial_time
+
+    return [system, positions]
+
+def build(entry_point, nvariants, platform_name='CPU', nonbonded_layout='interaction_groups', cache_directory=None):
+    """
+    Build a merged topology for a synthetic library of `nvariants` variants with one entry point, timing each stage.
+
+    Parameters
+    ----------
+    entry_point : str
+        One of ENTRY_POINTS.
+    nvariants : int
+        The number of variants in the library.
+    platform_name : str, optional, default='CPU'
+        The platform used to create the Context.
+    nonbonded_layout : str, optional, default='interaction_groups'
+        One of NONBONDED_LAYOUTS.
+    cache_directory : str, optional, default=None
+        The ParameterizationCache directory used by 'create_merged_topology'.
+
+    Returns
+    -------
+    result : dict
+        Stage timings (in seconds), counts, and peak memory (in MB).
+
+    """
+    baseline_rss = peak_rss()
+    timings = dict()
+    if entry_point == 'add_molecule_to_system':
+        [system, positions] = build_with_add_molecule_to_system(nvariants, nonbonded_layout, timings)
+    elif entry_point == 'generateMergedTopology':
+        [system, positions] = build_with_generateMergedTopology(nvariants, nonbonded_layout, timings)
+    elif entry_point == 'create_merged_topology':
+        [system, positions] = build_with_create_merged_topology(nvariants, nonbonded_layout, timings, cache_directory)
+    else:
+        raise Exception("Entry point '%s' unknown; must be one of %s." % (entry_point, str(ENTRY_POINTS)))
+
+    initial_time = time.time()
+    integrator = mm.VerletIntegrator(1.0 * unit.femtoseconds)
+    context = mm.Context(system, integrator, mm.Platform.getPlatformByName(platform_name))
+    context.setPositions(positions)
+    timings['context'] = time.time() - initial_time
+    del context, integrator
+
+    return dict(entry_point=entry_point, nvariants=nvariants, platform=platform_name, nonbonded_layout=nonbonded_layout,
+                timings=timings, counts=count_terms(system), peak_rss=peak_rss() - baseline_rss)
+
+def run(entry_point, nvariants, platform_name, nonbonded_layout, cache_directory):
+    """
+    Run `build` in a fresh interpreter so that peak memory is not polluted by earlier builds.
+
+    """
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', entry_point, str(nvariants),
+                                      platform_name, nonbonded_layout, cache_directory])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--child'):
+        print(json.dumps(build(sys.argv[2], int(sys.argv[3]), sys.argv[4], sys.argv[5], sys.argv[6])))
+        sys.exit(0)
+
+    filename = sys.argv[1] if (len(sys.argv) > 1) else 'scaling_benchmark.json'
+    platform_name = sys.argv[2] if (len(sys.argv) > 2) else 'CPU'
+    nonbonded_layout = sys.argv[3] if (len(sys.argv) > 3) else 'interaction_groups'
+
+    results = list()
+    skipped = dict()
+    cache_directory = tempfile.mkdtemp()
+    try:
+        print("%-24s %9s %10s %12s %12s %-40s %10s %10s %12s" % ('entry point', 'nvariants', 'particles', 'exceptions', 'exclusions',
+            'stages (s)', 'ctx (s)', 'total (s)', 'peak RSS (MB)'))
+        for entry_point in ENTRY_POINTS:
+            missing = get_missing_requirement(entry_point)
+            if missing is not None:
+                skipped[entry_point] = "requires %s" % missing
+                print("%-24s skipped: %s" % (entry_point, skipped[entry_point]))
+                continue
+            for nvariants in NVARIANTS:
+                result = run(entry_point, nvariants, platform_name, nonbonded_layout, cache_directory)
+                results.append(result)
+                [timings, counts] = [result['timings'], result['counts']]
+                stages = ' '.join([ '%s=%.3f' % (stage, timings[stage]) for stage in sorted(timings) if stage != 'context' ])
+                print("%-24s %9d %10d %12d %12d %-40s %10.3f %10.3f %12.1f" % (entry_point, nvariants, counts['particles'], counts['exceptions'],
+                    counts['exclusions'], stages, timings['context'], sum(timings.values()), result['peak_rss']))
+    finally:
+        shutil.rmtree(cache_directory)
+
+    with open(filename, 'w') as outfile:
+        json.dump(dict(versions=get_versions(), timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results, skipped=skipped),
+                  outfile, indent=2, sort_keys=True)
+    print("Results written to %s" % filename)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Benchmark the memory held by the merged-topology factory for its environment and variants.
+
+The factory used to deep-copy the environment System, Topology and positions (and every variant) on
+construction; it now stores `SystemSnapshot`s and only creates live objects when generating a merged
+topology. For an increasing environment size, each strategy is run in a fresh interpreter and the peak
+resident set size above the baseline (the caller's own objects) is reported, together with the time to
+store the objects and to recover a live System from them.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import sys
+import copy
+import time
+import resource
+import subprocess
+
+import simtk.openmm.app as app
+
+from examol.snapshots import SystemSnapshot
+from synthetic import create_environment_system, create_variant_series
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def create_environment_topology(nparticles):
+    """
+    Create a Topology with one single-atom residue per environment particle.
+
+    """
+    topology = app.Topology()
+    chain = topology.addChain()
+    for index in range(nparticles):
+        residue = topology.addResidue('ENV', chain)
+        topology.addAtom('AR', app.Element.getBySymbol('Ar'), residue)
+    return topology
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in MB.
+
+    """
+    # ru_maxrss is reported in kB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def measure(strategy, nparticles, nvariants):
+    """
+    Store an environment and variants with the given strategy and print peak RSS increase and timings.
+
+    Parameters
+    ----------
+    strategy : str
+        'deepcopy' or 'snapshot'.
+    nparticles : int
+        Number of environment particles.
+    nvariants : int
+        Number of molecule variants stored alongside the environment.
+
+    """
+    [system, positions] = create_environment_system(nparticles)
+    topology = create_environment_topology(nparticles)
+    variants = create_variant_series(nvariants)
+    baseline = peak_rss()
+
+    initial_time = time.time()
+    if strategy == 'deepcopy':
+        stored = [ copy.deepcopy(system), copy.deepcopy(topology), copy.deepcopy(positions) ]
+        stored_variants = [ [copy.deepcopy(variant_system), copy.deepcopy(variant_positions)] for [variant_system, variant_positions, core_atoms] in variants ]
+        store_time = time.time() - initial_time
+        initial_time = time.time()
+        live_system = copy.deepcopy(stored[0])
+    else:
+        stored = SystemSnapshot(system, topology, positions)
+        stored_variants = [ SystemSnapshot(variant_system, None, variant_positions) for [variant_system, variant_positions, core_atoms] in variants ]
+        store_time = time.time() - initial_time
+        initial_time = time.time()
+        live_system = stored.getSystem()
+    generate_time = time.time() - initial_time
+
+    print("%.1f %.3f %.3f" % (peak_rss() - baseline, store_time, generate_time))
+
+def run(strategy, nparticles, nvariants):
+    """
+    Run `measure` in a fresh interpreter so that peak RSS is not polluted by earlier measurements.
+
+    """
+    output = subprocess.check_output([sys.executable, __file__, strategy, str(nparticles), str(nvariants)])
+    return [ float(field) for field in output.split() ]
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        measure(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+        sys.exit(0)
+
+    nvariants = 10
+    print("%12s %10s %14s %12s %12s" % ('nparticles', 'strategy', 'peak RSS (MB)', 'store (s)', 'generate (s)'))
+    for nparticles in [1000, 10000, 100000]:
+        for strategy in ['deepcopy', 'snapshot']:
+            [rss, store_time, generate_time] = run(strategy, nparticles, nvariants)
+            print("%12d %10s %14.1f %12.3f %12.3f" % (nparticles, strategy, rss, store_time, generate_time))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Benchmark the per-pair cost of the two variant selections supported by `create_softcore_nonbonded_force`.
+
+A merged System is built from a synthetic alkane library for each nonbonded method (no cutoff, reaction
+field, and PME direct space) and each of VARIANT_SELECTIONS.  The CustomNonbondedForce is moved to its
+own force group and its energy is evaluated repeatedly on the CPU platform.  With variant_selection='delta'
+the coupling of both particles of every pair is recomputed from `alchemical_variant` with delta() arithmetic;
+with variant_selection='tabulated' it is looked up in a Discrete1DFunction that `set_alchemical_state`
+refreshes once per state change, whose cost is reported separately.
+
+Energies of both selections are compared for every variant at an intermediate lambda.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import sys
+import time
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.multitopology.multitopology import set_alchemical_state, VARIANT_SELECTIONS
+from synthetic import create_environment_system, create_variant_series
+from variant_force_group_benchmark import build_merged_system
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+NVARIANTS = 100
+NENVIRONMENT = 1000
+NEVALUATIONS = 50
+BOX_EDGE = 80.0 * unit.angstroms
+NONBONDED_METHODS = [('NoCutoff', mm.NonbondedForce.NoCutoff),
+                     ('ReactionField', mm.NonbondedForce.CutoffNonPeriodic),
+                     ('PME', mm.NonbondedForce.PME)]
+BENCHMARK_FORCE_GROUP = 31 # force group the CustomNonbondedForce is moved to
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def build_benchmark_system(nonbonded_method, variant_selection, variants):
+    """
+    Build a merged System whose CustomNonbondedForce is alone in BENCHMARK_FORCE_GROUP.
+
+    Returns
+    -------
+    system : simtk.openmm.System
+        The merged System.
+    positions : simtk.unit.Quantity of (natoms,3) with units compatible with angstroms
+        The merged positions.
+    npairs : int
+        The number of particle pairs considered by the CustomNonbondedForce (before any cutoff is applied).
+
+    """
+    [environment_system, environment_positions] = create_environment_system(NENVIRONMENT, nonbonded_method=nonbonded_method)
+    edge = BOX_EDGE / unit.nanometers
+    environment_system.setDefaultPeriodicBoxVectors(mm.Vec3(edge,0,0), mm.Vec3(0,edge,0), mm.Vec3(0,0,edge))
+    [system, positions] = build_merged_system(environment_system, environment_positions, variants, 'shared', variant_selection=variant_selection)
+
+    npairs = 0
+    for index in range(system.getNumForces()):
+        force = system.getForce(index)
+        if isinstance(force, mm.CustomNonbondedForce):
+            force.setForceGroup(BENCHMARK_FORCE_GROUP)
+            for group in range(force.getNumInteractionGroups()):
+                [set1, set2] = force.getInteractionGroupParameters(group)
+                npairs += len(set1) * len(set2)
+
+    return [system, positions, npairs]
+
+def measure_evaluation_time(context, nevaluations=NEVALUATIONS):
+    """
+    Return the mean time (in seconds) to evaluate the energy of BENCHMARK_FORCE_GROUP.
+
+    """
+    groups = set([BENCHMARK_FORCE_GROUP])
+    context.getState(getEnergy=True, groups=groups) # warm up
+    initial_time = time.time()
+    for evaluation in range(nevaluations):
+        context.getState(getEnergy=True, groups=groups)
+    return (time.time() - initial_time) / nevaluations
+
+def measure_update_time(context, nvariants, nupdates=NEVALUATIONS):
+    """
+    Return the mean time (in seconds) of `set_alchemical_state` switching between variants.
+
+    """
+    initial_time = time.time()
+    for update in range(nupdates):
+        set_alchemical_state(context, variant=1 + (update % nvariants))
+    return (time.time() - initial_time) / nupdates
+
+def compute_variant_energies(context, nvariants, alchemical_lambda=0.5):
+    """
+    Return the BENCHMARK_FORCE_GROUP energy (in kJ/mol) with each variant selected in turn.
+
+    """
+    set_alchemical_state(context, alchemical_lambda=alchemical_lambda)
+    energies = np.zeros([nvariants], np.float64)
+    for index in range(nvariants):
+        set_alchemical_state(context, variant=index+1)
+        state = context.getState(getEnergy=True, groups=set([BENCHMARK_FORCE_GROUP]))
+        energies[index] = state.getPotentialEnergy() / unit.kilojoules_per_mole
+    return energies
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    platform_name = sys.argv[1] if (len(sys.argv) > 1) else 'CPU'
+    variants = create_variant_series(NVARIANTS)
+
+    print("%14s %10s %12s %14s %14s %12s" % ('method', 'selection', 'pairs', 'eval (ms)', 'ns/pair', 'update (ms)'))
+    for (method_name, nonbonded_method) in NONBONDED_METHODS:
+        energies = dict()
+        for variant_selection in VARIANT_SELECTIONS:
+            [system, positions, npairs] = build_benchmark_system(nonbonded_method, variant_selection, variants)
+            integrator = mm.VerletIntegrator(1.0 * unit.femtoseconds)
+            context = mm.Context(system, integrator, mm.Platform.getPlatformByName(platform_name))
+            context.setPositions(positions)
+            set_alchemical_state(context, variant=1, alchemical_lambda=0.5)
+            evaluation_time = measure_evaluation_time(context)
+            update_time = measure_update_time(context, NVARIANTS)
+            energies[variant_selection] = compute_variant_energies(context, NVARIANTS)
+            print("%14s %10s %12d %14.3f %14.3f %12.3f" % (method_name, variant_selection, npairs, evaluation_time * 1.0e3,
+                                                           evaluation_time / npairs * 1.0e9, update_time * 1.0e3))
+            del context, integrator
+        deviation = np.abs(energies['tabulated'] - energies['delta']).max()
+        print("%14s max |dE| between selections: %.3e kJ/mol" % (method_name, deviation))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Synthetic OpenMM systems for benchmarking merged-topology construction without an OpenEye license.
+
+Molecules are united-atom linear alkanes built directly as OpenMM System objects, so that a series of
+variants sharing a common core can be generated in any number.  Variant `n` of a series shares its first
+`ncore` atoms with every other variant and carries `ncore + n % (max_extra+1)` atoms in total.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+################################################################################
+# MODULE CONSTANTS
+################################################################################
+
+BOND_LENGTH = 1.54 * unit.angstroms
+BOND_K = 620.0 * unit.kilocalories_per_mole / unit.angstroms**2
+ANGLE_THETA0 = 114.0 * unit.degrees
+ANGLE_K = 124.0 * unit.kilocalories_per_mole / unit.radians**2
+TORSION_K = 0.7 * unit.kilocalories_per_mole
+SIGMA = 3.95 * unit.angstroms
+EPSILON = 0.091 * unit.kilocalories_per_mole
+MASS = 14.0 * unit.amu
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def create_alkane_system(ncarbons, charge=0.0*unit.elementary_charge, nonbonded_method=mm.NonbondedForce.NoCutoff):
+    """
+    Create a united-atom linear alkane.
+
+    Parameters
+    ----------
+    ncarbons : int
+        The number of united atoms in the chain.
+    charge : simtk.unit.Quantity with units compatible with elementary_charge, optional, default=0
+        The partial charge placed on every united atom.
+    nonbonded_method : optional, default=mm.NonbondedForce.NoCutoff
+        The nonbonded method for the NonbondedForce.
+
+    Returns
+    -------
+    system : simtk.openmm.System
+        The System containing HarmonicBondForce, HarmonicAngleForce, PeriodicTorsionForce and NonbondedForce.
+    positions : simtk.unit.Quantity of (ncarbons,3) with units compatible with angstroms
+        An all-trans zig-zag geometry.
+
+    """
+    system = mm.System()
+    bond_force = mm.HarmonicBondForce()
+    angle_force = mm.HarmonicAngleForce()
+    torsion_force = mm.PeriodicTorsionForce()
+    nonbonded_force = mm.NonbondedForce()
+    nonbonded_force.setNonbondedMethod(nonbonded_method)
+
+    for index in range(ncarbons):
+        system.addParticle(MASS)
+        nonbonded_force.addParticle(charge, SIGMA, EPSILON)
+    for index in range(ncarbons-1):
+        bond_force.addBond(index, index+1, BOND_LENGTH, BOND_K)
+    for index in range(ncarbons-2):
+        angle_force.addAngle(index, index+1, index+2, ANGLE_THETA0, ANGLE_K)
+    for index in range(ncarbons-3):
+        torsion_force.addTorsion(index, index+1, index+2, index+3, 3, 0.0*unit.radians, TORSION_K)
+
+    # Exclude 1-2 and 1-3 interactions, scale 1-4 interactions.
+    bonds = [ (index, index+1) for index in range(ncarbons-1) ]
+    nonbonded_force.createExceptionsFromBonds(bonds, 0.8333, 0.5)
+
+    for force in [bond_force, angle_force, torsion_force, nonbonded_force]:
+        system.addForce(force)
+
+    # All-trans zig-zag geometry.
+    dx = BOND_LENGTH / unit.angstroms * np.sin(ANGLE_THETA0 / unit.radians / 2.0)
+    dy = BOND_LENGTH / unit.angstroms * np.cos(ANGLE_THETA0 / unit.radians / 2.0)
+    positions = np.zeros([ncarbons,3], np.float64)
+    positions[:,0] = dx * np.arange(ncarbons)
+    positions[1::2,1] = dy
+    positions = unit.Quantity(positions, unit.angstroms)
+
+    return [system, positions]
+
+def create_environment_system(nparticles, spacing=5.0*unit.angstroms, offset=15.0*unit.angstroms, nonbonded_method=mm.NonbondedForce.NoCutoff):
+    """
+    Create an environment of uncharged Lennard-Jones particles on a cubic lattice.
+
+    Parameters
+    ----------
+    nparticles : int
+        The number of environment particles.
+    spacing : simtk.unit.Quantity with units compatible with angstroms, optional, default=5 A
+        Lattice spacing.
+    offset : simtk.unit.Quantity with units compatible with angstroms, optional, default=15 A
+        Displacement of the lattice along z so that it does not overlap the molecules.
+    nonbonded_method : optional, default=mm.NonbondedForce.NoCutoff
+        The nonbonded method for the NonbondedForce.
+
+    Returns
+    -------
+    system : simtk.openmm.System
+        The environment System, containing a NonbondedForce and empty valence forces (as a parameterized environment would).
+    positions : simtk.unit.Quantity of (nparticles,3) with units compatible with angstroms
+        Lattice positions.
+
+    """
+    system = mm.System()
+    nonbonded_force = mm.NonbondedForce()
+    nonbonded_force.setNonbondedMethod(nonbonded_method)
+    for index in range(nparticles):
+        system.addParticle(MASS)
+        nonbonded_force.addParticle(0.0*unit.elementary_charge, SIGMA, EPSILON)
+    system.addForce(nonbonded_force)
+
+    # Non-core valence terms of variants are added to the environment valence forces.
+    for force in [mm.HarmonicBondForce(), mm.HarmonicAngleForce(), mm.PeriodicTorsionForce()]:
+        system.addForce(force)
+
+    nside = int(np.ceil(nparticles ** (1.0/3.0)))
+    grid = np.indices([nside,nside,nside]).reshape(3,-1).T[:nparticles]
+    positions = grid * (spacing / unit.angstroms)
+    positions[:,2] += offset / unit.angstroms
+    positions = unit.Quantity(positions.astype(np.float64), unit.angstroms)
+
+    return [system, positions]
+
+def create_variant_series(nvariants, ncore=4, max_extra=4):
+    """
+    Create a series of synthetic alkane variants sharing a common core.
+
+    Parameters
+    ----------
+    nvariants : int
+        The number of variants to create.
+    ncore : int, optional, default=4
+        The number of atoms in the common core (the first `ncore` atoms of every variant).
+    max_extra : int, optional, default=4
+        The maximum number of non-core atoms in a variant.
+
+    Returns
+    -------
+    variants : list of [system, positions, core_atoms]
+        For each variant, the System, positions, and list of core atom indices in core order.
+
+    """
+    variants = list()
+    for variant in range(nvariants):
+        ncarbons = ncore + 1 + (variant % max_extra)
+        [system, positions] = create_alkane_system(ncarbons)
+        variants.append([system, positions, range(ncore)])
+    return variants
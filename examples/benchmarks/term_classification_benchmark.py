@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for partitioning valence and exception terms into core and variant terms.
+
+Compares the original per-term loop, which tests `set([...]).issubset(core_atoms)` against a list for every
+term and routes unit-wrapped parameters one term at a time, with the vectorized `get_term_arrays` /
+`classify_core_terms` pass used by `add_molecule_to_system`.  Both variants route the terms into
+Custom*Force objects (core terms) or standard forces (variant terms).
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import time
+
+import simtk.openmm as mm
+import numpy as np
+
+from examol.multitopology.multitopology import get_term_arrays, classify_core_terms
+from synthetic import create_alkane_system
+
+################################################################################
+# SUBROUTINES
+################################################################################
+
+def create_target_forces():
+    """
+    Create empty destination forces for routed terms.
+
+    """
+    custom_bond_force = mm.CustomBondForce('K*(r-length)^2')
+    for name in ['variant', 'length', 'K']:
+        custom_bond_force.addPerBondParameter(name)
+    custom_angle_force = mm.CustomAngleForce('K*(theta-theta0)^2')
+    for name in ['variant', 'theta0', 'K']:
+        custom_angle_force.addPerAngleParameter(name)
+    custom_torsion_force = mm.CustomTorsionForce('K*(1+cos(periodicity*theta-phase))')
+    for name in ['variant', 'periodicity', 'phase', 'K']:
+        custom_torsion_force.addPerTorsionParameter(name)
+    return { 'CustomBondForce' : custom_bond_force, 'CustomAngleForce' : custom_angle_force, 'CustomTorsionForce' : custom_torsion_force,
+             'HarmonicBondForce' : mm.HarmonicBondForce(), 'HarmonicAngleForce' : mm.HarmonicAngleForce(),
+             'PeriodicTorsionForce' : mm.PeriodicTorsionForce(), 'NonbondedForce' : mm.NonbondedForce() }
+
+def partition_per_term(molecule_forces, forces, core_atoms, mapping, variant):
+    """
+    Partition terms one at a time, as done originally in `add_molecule_to_system`.
+
+    """
+    force = molecule_forces['HarmonicBondForce']
+    for index in range(force.getNumBonds()):
+        [atom_i, atom_j, length, K] = force.getBondParameters(index)
+        if set([atom_i, atom_j]).issubset(core_atoms):
+            forces['CustomBondForce'].addBond(mapping[atom_i], mapping[atom_j], [variant, length, K])
+        else:
+            forces['HarmonicBondForce'].addBond(mapping[atom_i], mapping[atom_j], length, K)
+    force = molecule_forces['HarmonicAngleForce']
+    for index in range(force.getNumAngles()):
+        [atom_i, atom_j, atom_k, theta0, K] = force.getAngleParameters(index)
+        if set([atom_i, atom_j, atom_k]).issubset(core_atoms):
+            forces['CustomAngleForce'].addAngle(mapping[atom_i], mapping[atom_j], mapping[atom_k], [variant, theta0, K])
+        else:
+            forces['HarmonicAngleForce'].addAngle(mapping[atom_i], mapping[atom_j], mapping[atom_k], theta0, K)
+    force = molecule_forces['PeriodicTorsionForce']
+    for index in range(force.getNumTorsions()):
+        [atom_i, atom_j, atom_k, atom_l, periodicity, phase, K] = force.getTorsionParameters(index)
+        if set([atom_i, atom_j, atom_k, atom_l]).issubset(core_atoms):
+            forces['CustomTorsionForce'].addTorsion(mapping[atom_i], mapping[atom_j], mapping[atom_k], mapping[atom_l], [variant, periodicity, phase, K])
+        else:
+            forces['PeriodicTorsionForce'].addTorsion(mapping[atom_i], mapping[atom_j], mapping[atom_k], mapping[atom_l], periodicity, phase, K)
+    force = molecule_forces['NonbondedForce']
+    for index in range(force.getNumExceptions()):
+        [atom_i, atom_j, chargeProd, sigma, epsilon] = force.getExceptionParameters(index)
+        if not set([atom_i, atom_j]).issubset(core_atoms):
+            forces['NonbondedForce'].addException(mapping[atom_i], mapping[atom_j], chargeProd, sigma, epsilon)
+    return
+
+def partition_vectorized(molecule_forces, forces, core_atoms, mapping_array, variant):
+    """
+    Partition terms with one vectorized classification pass per force, as done in `add_molecule_to_system`.
+
+    """
+    nparticles = mapping_array.shape[0]
+    [indices, parameters] = get_term_arrays(molecule_forces['HarmonicBondForce'])
+    is_core_term = classify_core_terms(indices, core_atoms, nparticles)
+    for ([atom_i, atom_j], [length, K]) in zip(mapping_array[indices[is_core_term]], parameters[is_core_term]):
+        forces['CustomBondForce'].addBond(int(atom_i), int(atom_j), [variant, length, K])
+    for ([atom_i, atom_j], [length, K]) in zip(mapping_array[indices[~is_core_term]], parameters[~is_core_term]):
+        forces['HarmonicBondForce'].addBond(int(atom_i), int(atom_j), length, K)
+    [indices, parameters] = get_term_arrays(molecule_forces['HarmonicAngleForce'])
+    is_core_term = classify_core_terms(indices, core_atoms, nparticles)
+    for ([atom_i, atom_j, atom_k], [theta0, K]) in zip(mapping_array[indices[is_core_term]], parameters[is_core_term]):
+        forces['CustomAngleForce'].addAngle(int(atom_i), int(atom_j), int(atom_k), [variant, theta0, K])
+    for ([atom_i, atom_j, atom_k], [theta0, K]) in zip(mapping_array[indices[~is_core_term]], parameters[~is_core_term]):
+        forces['HarmonicAngleForce'].addAngle(int(atom_i), int(atom_j), int(atom_k), theta0, K)
+    [indices, parameters] = get_term_arrays(molecule_forces['PeriodicTorsionForce'])
+    is_core_term = classify_core_terms(indices, core_atoms, nparticles)
+    for ([atom_i, atom_j, atom_k, atom_l], [periodicity, phase, K]) in zip(mapping_array[indices[is_core_term]], parameters[is_core_term]):
+        forces['CustomTorsionForce'].addTorsion(int(atom_i), int(atom_j), int(atom_k), int(atom_l), [variant, periodicity, phase, K])
+    for ([atom_i, atom_j, atom_k, atom_l], [periodicity, phase, K]) in zip(mapping_array[indices[~is_core_term]], parameters[~is_core_term]):
+        forces['PeriodicTorsionForce'].addTorsion(int(atom_i), int(atom_j), int(atom_k), int(atom_l), int(periodicity), phase, K)
+    [indices, parameters] = get_term_arrays(molecule_forces['NonbondedForce'])
+    is_core_term = classify_core_terms(indices, core_atoms, nparticles)
+    for ([atom_i, atom_j], [chargeProd, sigma, epsilon]) in zip(mapping_array[indices[~is_core_term]], parameters[~is_core_term]):
+        forces['NonbondedForce'].addException(int(atom_i), int(atom_j), chargeProd, sigma, epsilon)
+    return
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    ncarbons = 40
+    ncore = 20
+    [molecule_system, molecule_positions] = create_alkane_system(ncarbons)
+    molecule_forces = { molecule_system.getForce(index).__class__.__name__ : molecule_system.getForce(index) for index in range(molecule_system.getNumForces()) }
+    core_atoms = list(range(ncore))
+
+    print("%9s %14s %14s %8s" % ('nvariants', 'per-term (s)', 'vectorized (s)', 'speedup'))
+    for nvariants in [10, 100, 1000]:
+        forces = create_target_forces()
+        initial_time = time.time()
+        for variant in range(nvariants):
+            mapping = { index : variant*ncarbons + index for index in range(ncarbons) }
+            partition_per_term(molecule_forces, forces, core_atoms, mapping, variant)
+        per_term_time = time.time() - initial_time
+
+        forces = create_target_forces()
+        initial_time = time.time()
+        for variant in range(nvariants):
+            mapping_array = variant*ncarbons + np.arange(ncarbons)
+            partition_vectorized(molecule_forces, forces, core_atoms, mapping_array, variant)
+        vectorized_time = time.time() - initial_time
+
+        print("%9d %14.3f %14.3f %8.2f" % (nvariants, per_term_time, vectorized_time, per_term_time / vectorized_time))
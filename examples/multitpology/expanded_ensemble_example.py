@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Explore a small library of molecules sharing a common core in a single expanded-ensemble simulation.
+
+Instead of a fixed lambda sweep for one hard-coded variant, the sampler alternates dynamics with Gibbs
+moves over (alchemical_variant, alchemical_lambda) and writes the state path and reduced potentials to
+`expanded-ensemble.npz`.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import simtk.openmm as mm
+from simtk import unit
+import numpy as np
+
+from examol.multitopology.multitopology import AlchemicalMergedTopologyFactory, create_molecule, parameterize_molecule
+from examol.multitopology.expanded_ensemble import ExpandedEnsembleSampler
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    # Create list of molecules that share a common core.
+    molecule_names = ['benzene', 'toluene', 'methoxytoluene']
+    molecules = [ create_molecule(name) for name in molecule_names ]
+
+    # Create an environment, translated out of the way so it doesn't overlap with anything.
+    [environment_system, environment_topology, environment_positions, environment_molecule] = parameterize_molecule(create_molecule('phenol'))
+    environment_positions[:,2] += 15.0 * unit.angstroms
+
+    # Create the merged topology.
+    factory = AlchemicalMergedTopologyFactory(environment_system, environment_topology, environment_positions, valence_layout='force_groups')
+    variant_indices = factory.addMolecules(molecules)
+    [system, topology, positions] = factory.generateMergedTopology(reference_molecule=molecules[0])
+
+    # Run expanded-ensemble simulation over all variants and a few lambda values.
+    temperature = 300.0 * unit.kelvin
+    integrator = mm.LangevinIntegrator(temperature, 20.0 / unit.picoseconds, 1.0 * unit.femtoseconds)
+    context = mm.Context(system, integrator)
+    context.setPositions(positions)
+    variants = [ variant_index + 1 for variant_index in variant_indices if variant_index is not None ]
+    lambda_values = np.linspace(0.0, 1.0, 5)
+    sampler = ExpandedEnsembleSampler(context, integrator, variants, lambda_values, temperature, nsteps_per_iteration=100,
+                                      valence_layout='force_groups', factory=factory)
+    sampler.run(niterations=100, verbose=True)
+
+    # Report occupancies.
+    print("Iterations spent in each (variant, lambda) state:")
+    print(sampler.getStateCounts())
+    sampler.save('expanded-ensemble.npz')
+    del context, integrator
@@ -13,6 +13,10 @@ import copy
 
 from openmoltools import openeye
 
+from examol.multitopology.multitopology import set_alchemical_state
+from examol.reporters import load_energy_store
+from examol.runner import AlchemicalRunner
+
 ################################################################################
 # SUBROUTINES
 ################################################################################
@@ -177,36 +181,26 @@ if __name__ == '__main__':
     app.PDBFile.writeFile(topology, positions, file=open('initial.pdb','w'))
 
     # Create an OpenMM test simulation of the merged-topology system to test stability.
-    # A PDB file containing the trajectory is generated.
+    # A DCD trajectory and an energy store are generated.
     temperature = 300.0 * unit.kelvin
     collision_rate = 20.0 / unit.picoseconds
     timestep = 1.0 * unit.femtoseconds
-    integrator = mm.LangevinIntegrator(temperature, collision_rate, timestep)
-    context = mm.Context(system, integrator)
-    context.setParameter('alchemical_variant', 1) # Select variant index.
-    context.setPositions(positions)
     niterations = 100
     nsteps_per_iteration = 100
-    filename = 'trajectory.pdb'
+    lambda_values = [ 1.0 - float(iteration) / float(niterations - 1) for iteration in range(niterations) ]
+    variants = [1] * niterations # Select variant index.
+    set_state = lambda context, lambda_value, variant: set_alchemical_state(context, variant=variant, alchemical_lambda=lambda_value)
+    filename = 'trajectory.dcd'
     print "Writing out trajectory to %s ..." % filename
-    outfile = open(filename, 'w')
-    app.PDBFile.writeHeader(topology, file=outfile)
-    for iteration in range(niterations):
-        # Modify the lambda value.
-        lambda_value = 1.0 - float(iteration) / float(niterations - 1)
-        context.setParameter('alchemical_lambda', lambda_value)
-        # Run some dynamics
-        integrator.step(nsteps_per_iteration)
-        # Get potential energy.
-        state = context.getState(getPositions=True, getEnergy=True)
-        # Report current information.
-        print "Iteration %5d / %5d : lambda %8.5f : potential %8.3f kcal/mol" % (iteration, niterations, lambda_value, state.getPotentialEnergy() / unit.kilocalories_per_mole)
-        # Write frame to trajectory.
-        positions = state.getPositions()
-        app.PDBFile.writeModel(topology, positions, file=outfile, modelIndex=(iteration+1))
+    # Run the protocol, resuming from 'run.checkpoint' if a previous run was interrupted.
+    runner = AlchemicalRunner(system, positions, lambda_values, 'run.checkpoint', variants=variants, set_state=set_state,
+                              nsteps_per_iteration=nsteps_per_iteration, checkpoint_interval=10, temperature=temperature,
+                              collision_rate=collision_rate, timestep=timestep, topology=topology, trajectory_filename=filename,
+                              energy_directory='energies', report_stride=10)
+    runner.run()
     # Clean up.
-    app.PDBFile.writeFooter(topology, file=outfile)
-    outfile.close()
-    del context, integrator
+    runner.close()
+    energies = load_energy_store('energies')
+    print "Final potential %8.3f kcal/mol" % (energies['potential_energy'][-1] * unit.kilojoules_per_mole / unit.kilocalories_per_mole)
 
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Parameterize a small library of molecules concurrently, add them as variants of a merged topology, and check the result.
+
+Exits with an exception if any molecule fails to parameterize, if a repeated parameterization misses the cache, or if
+the merged system does not have a finite potential energy.  Requires AmberTools (antechamber, tleap) and an OpenEye license.
+
+"""
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import shutil
+import tempfile
+
+import numpy as np
+import simtk.openmm as mm
+from simtk import unit
+
+from examol.multitopology.multitopology import AlchemicalMergedTopologyFactory, create_molecule, parameterize_molecule
+from examol.parameterization_cache import ParameterizationCache
+
+################################################################################
+# MAIN
+################################################################################
+
+if __name__ == '__main__':
+    # Create list of molecules that share a common core.
+    molecule_names = ['benzene', 'toluene', 'methoxytoluene']
+    molecules = [ create_molecule(name) for name in molecule_names ]
+
+    # Create an environment, translated out of the way so it doesn't overlap with anything.
+    [environment_system, environment_topology, environment_positions, environment_molecule] = parameterize_molecule(create_molecule('phenol'))
+    environment_positions[:,2] += 15.0 * unit.angstroms
+
+    cache_directory = tempfile.mkdtemp()
+    try:
+        cache = ParameterizationCache(cache_directory)
+
+        # Parameterize all molecules in worker processes, storing them in the cache.
+        factory = AlchemicalMergedTopologyFactory(environment_system, environment_topology, environment_positions)
+        if factory.addMolecules([], nworkers=2, cache=cache) != []:
+            raise Exception("Adding no molecules should add no variants.")
+        variant_indices = factory.addMolecules(molecules, nworkers=2, cache=cache, verbose=True)
+        if len(factory.parameterization_failures) > 0:
+            raise Exception("Parameterization failed for molecules %s." % sorted(factory.parameterization_failures.keys()))
+        print("Added variants %s." % variant_indices)
+
+        # Parameterizing the same molecules again in this process should reuse every cached entry.
+        for molecule in molecules:
+            [system, topology, positions, gaff_molecule] = parameterize_molecule(molecule, cache=cache)
+            if system.getNumParticles() != molecule.NumAtoms():
+                raise Exception("Cached System of %s has %d particles, but molecule has %d atoms." % (molecule.GetTitle(), system.getNumParticles(), molecule.NumAtoms()))
+        if cache.nhits != len(molecules):
+            raise Exception("Expected %d cache hits, got %d." % (len(molecules), cache.nhits))
+    finally:
+        shutil.rmtree(cache_directory)
+
+    # The merged topology built from the concurrently parameterized variants should be usable.
+    [system, topology, positions] = factory.generateMergedTopology(reference_molecule=molecules[0])
+    integrator = mm.VerletIntegrator(1.0 * unit.femtoseconds)
+    context = mm.Context(system, integrator, mm.Platform.getPlatformByName('Reference'))
+    context.setPositions(positions)
+    potential = context.getState(getEnergy=True).getPotentialEnergy() / unit.kilocalories_per_mole
+    if not np.isfinite(potential):
+        raise Exception("Merged system has non-finite potential energy %s." % potential)
+    print("Merged system of %d particles has potential energy %.3f kcal/mol." % (system.getNumParticles(), potential))
+    del context, integrator